@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,11 +44,15 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'profiles.middleware.InvalidationBusMiddleware',
+    'profiles.middleware.ReplicaPinningMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django_htmx.middleware.HtmxMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'profiles.middleware.CachedAuthenticationMiddleware',
+    'profiles.middleware.ProfileMiddleware',
+    'profiles.middleware.LastOnlineMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -82,13 +87,80 @@ WSGI_APPLICATION = 'dating_site.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# SQLite connection profiles: connection settings and pragmas run on every new connection.
+# `manage.py bench_db_profiles` compares them on a mixed search/conversation/send workload.
+SQLITE_CONNECTION_PROFILES = {
+    # Django defaults: rollback journal, synchronous=FULL, new connection per request
+    'django': {
+        'CONN_MAX_AGE': 0,
+        'CONN_HEALTH_CHECKS': False,
+        'OPTIONS': {
+            'init_command': 'PRAGMA journal_mode=DELETE',
+        },
+    },
+    # WAL: readers do not block the writer and vice versa; synchronous=NORMAL is durable
+    # in WAL mode except for the last transactions on power loss. Writers wait for the lock
+    # (busy_timeout) instead of failing with "database is locked", and IMMEDIATE transactions
+    # take the write lock up front so a read transaction never has to be upgraded.
+    'production': {
+        'CONN_MAX_AGE': 600,  # seconds a connection is reused between requests
+        'CONN_HEALTH_CHECKS': True,  # reused connections are checked before the request uses them
+        'OPTIONS': {
+            'init_command': ';'.join([
+                'PRAGMA journal_mode=WAL',
+                'PRAGMA synchronous=NORMAL',
+                'PRAGMA busy_timeout=5000',  # ms
+                'PRAGMA mmap_size=268435456',  # 256 MB of the file read through the page cache
+                'PRAGMA cache_size=-32768',  # 32 MB page cache per connection
+                'PRAGMA temp_store=MEMORY',
+            ]),
+            'transaction_mode': 'IMMEDIATE',
+        },
+    },
+}
+SQLITE_CONNECTION_PROFILE = os.environ.get('SQLITE_CONNECTION_PROFILE', 'production')
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',  # Файловая база данных вместо :memory:
+        **SQLITE_CONNECTION_PROFILES[SQLITE_CONNECTION_PROFILE],
     }
 }
 
+# Read replicas (profiles.db_router.ReplicaRouter): writes go to 'default', reads to a replica
+# whose last snapshot is recent enough and newer than the user's last write.
+# A local SQLite replica is enabled with SQLITE_REPLICA_NAME=/path/to/db-replica.sqlite3
+# and kept in sync by `manage.py sync_replicas` (sqlite3 online backup API).
+SQLITE_REPLICA_NAME = os.environ.get('SQLITE_REPLICA_NAME')
+if SQLITE_REPLICA_NAME:
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'NAME': SQLITE_REPLICA_NAME,
+        'TEST': {'MIRROR': 'default'},
+    }
+
+# Message sharding (profiles.db_router.MessageShardRouter): Message rows live in one of
+# MESSAGE_SHARDS, chosen by a jump consistent hash of the conversation id; 'default' is
+# always shard 0, so one shard means no sharding. SQLITE_MESSAGE_SHARDS=4 adds files
+# db-messages-1.sqlite3 ... next to the main database (`migrate --database messages_1`).
+# Growing the shard count moves only the conversations that change shard:
+# `manage.py reshard_messages --from 2 --to 4`.
+SQLITE_MESSAGE_SHARDS = int(os.environ.get('SQLITE_MESSAGE_SHARDS', 1))
+MESSAGE_SHARDS = ['default']
+for index in range(1, SQLITE_MESSAGE_SHARDS):
+    DATABASES[f'messages_{index}'] = {
+        **DATABASES['default'],
+        'NAME': BASE_DIR / f'db-messages-{index}.sqlite3',
+    }
+    MESSAGE_SHARDS.append(f'messages_{index}')
+
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias not in MESSAGE_SHARDS]
+DATABASE_ROUTERS = ['profiles.db_router.MessageShardRouter', 'profiles.db_router.ReplicaRouter']
+DATABASE_REPLICA_MAX_LAG = 30  # seconds; staler replicas are skipped
+DATABASE_REPLICA_PIN_SECONDS = 10  # reads stay on 'default' at most this long after a user's write
+DATABASE_REPLICA_STATUS_DIR = BASE_DIR / 'var' / 'replicas'  # last snapshot time of each replica
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -133,6 +205,39 @@ STATICFILES_DIRS = [
 MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Media serving (profiles.views_package.media_views.serve_media)
+MEDIA_CACHE_MAX_AGE = 86400  # Cache-Control max-age для опубликованных файлов
+MEDIA_IMMUTABLE_PREFIXES = ('photos/variants/',)  # Файлы, которые никогда не перезаписываются
+# Передача файла фронтовому прокси вместо чтения через Python:
+# MEDIA_ACCEL_HEADER = 'X-Accel-Redirect'  # nginx (location /protected-media/ { internal; alias <MEDIA_ROOT>/; })
+# MEDIA_ACCEL_HEADER = 'X-Sendfile'  # Apache mod_xsendfile / lighttpd
+MEDIA_ACCEL_HEADER = None
+MEDIA_ACCEL_PREFIX = '/protected-media/'
+
+# Форматы, в которые фотографии перекодируются при первом запросе (выбор по заголовку Accept)
+PHOTO_VARIANT_FORMATS = ('avif', 'webp')
+PHOTO_VARIANT_MAX_SIDE = 2048  # ограничивает память на декодирование больших фотографий
+
+# Файлы удаленных фотографий удаляются фоновым потоком процесса после коммита;
+# при False очередь обрабатывает только manage.py cleanup_photo_files (например, по cron)
+PHOTO_DELETION_WORKER = True
+
+# Runtime files (metrics snapshots and other per-host state)
+RUNTIME_DIR = BASE_DIR / 'var'
+METRICS_DIR = RUNTIME_DIR / 'metrics'
+METRICS_FLUSH_INTERVAL = 10  # seconds
+
+# Profile.last_online is tracked in memory by profiles.middleware.LastOnlineMiddleware
+# and written in bulk (profiles.activity)
+LAST_ONLINE_UPDATE_INTERVAL = 300  # seconds; a user's last_online is written at most this often
+LAST_ONLINE_FLUSH_INTERVAL = 30  # seconds between bulk writes of a worker
+LAST_ONLINE_FLUSH_ON_EXIT = True  # write pending activity when a worker shuts down cleanly
+
+# "Online now" presence (profiles.presence): a ring of per-minute buckets in a cache shared by workers
+PRESENCE_CACHE_ALIAS = 'shared'
+PRESENCE_WINDOW_MINUTES = 5  # a user is online if seen within this many minutes
+PRESENCE_SYNC_INTERVAL = 5  # seconds between merges of a worker's buckets into the cache
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -144,20 +249,28 @@ LOGIN_REDIRECT_URL = '/profiles/'
 LOGOUT_REDIRECT_URL = '/'
 
 # File upload settings
-# FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
-DATA_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
+# Файлы всегда пишутся во временные файлы блоками по 64KB (без MemoryFileUploadHandler),
+# загрузка прерывается при превышении лимитов размера и количества файлов
+FILE_UPLOAD_HANDLERS = [
+    'profiles.upload_handlers.LimitedTemporaryFileUploadHandler',
+]
+FILE_UPLOAD_MAX_MEMORY_SIZE = 0
+DATA_UPLOAD_MAX_MEMORY_SIZE = 2621440  # 2.5MB, только обычные поля формы
+PHOTO_UPLOAD_MAX_SIZE = 5 * 1024 * 1024  # 5MB на файл
+PHOTO_UPLOAD_MAX_FILES = 5  # файлов за один запрос
 
 # ====================== CACHING CONFIGURATION ======================
 
 # Caching configuration with multiple cache backends
 CACHES = {
+    # Size-aware W-TinyLFU: capacity in bytes, rare large values do not evict hot small ones
     'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'BACKEND': 'profiles.cache_backends.size_aware.SizeAwareCache',
         'LOCATION': 'default-cache',
         'TIMEOUT': 300,  # 5 minutes default timeout
         'OPTIONS': {
-            'MAX_ENTRIES': 1000,
-            'CULL_FREQUENCY': 4,
+            'MAX_BYTES': 8 * 1024 * 1024,
+            'MAX_ENTRY_BYTES': 512 * 1024,
         }
     },
     'profiles': {
@@ -170,12 +283,12 @@ CACHES = {
         }
     },
     'search': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'BACKEND': 'profiles.cache_backends.size_aware.SizeAwareCache',
         'LOCATION': 'search-cache',
         'TIMEOUT': 600,  # 10 minutes for search results
         'OPTIONS': {
-            'MAX_ENTRIES': 300,
-            'CULL_FREQUENCY': 4,
+            'MAX_BYTES': 4 * 1024 * 1024,
+            'MAX_ENTRY_BYTES': 512 * 1024,
         }
     },
     'messages': {
@@ -187,16 +300,110 @@ CACHES = {
             'CULL_FREQUENCY': 4,
         }
     },
+    # Tag versions for tag-based invalidation (profiles.cache_utils.invalidate_tags)
+    'tags': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'tags-cache',
+        'TIMEOUT': None,  # versions never expire; an evicted version restarts from time_ns()
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,
+            'CULL_FREQUENCY': 4,
+        }
+    },
+    # Shared by all worker processes on the host (no external service required)
+    'shared': {
+        'BACKEND': 'profiles.cache_backends.sqlite.SQLiteCache',
+        'LOCATION': RUNTIME_DIR / 'cache.sqlite3',
+        'TIMEOUT': 900,
+        'OPTIONS': {
+            'MAX_ENTRIES': 20000,
+            'CULL_FREQUENCY': 4,
+        }
+    },
+}
+
+# Caches that CacheManager runs as two tiers: a small per-process LRU in front of
+# the 'shared' cache. Writes go through to the shared tier; changes are propagated
+# to other processes through the invalidation bus.
+CACHE_TIERED_ALIASES = ('profiles', 'messages', 'tags')
+CACHE_TIERED_OPTIONS = {
+    'SHARED_ALIAS': 'shared',
+    'LOCAL_MAX_ENTRIES': 256,
+    'LOCAL_TIMEOUT': 5,  # seconds a local copy may be served without checking the shared tier
+}
+
+# Cross-process cache invalidation bus (append-only SQLite log, see profiles.invalidation_bus).
+# Deletes from per-process caches are published here; every worker applies other workers'
+# deletes at the start of a request, at most once per poll interval.
+INVALIDATION_BUS_PATH = RUNTIME_DIR / 'invalidation.sqlite3'
+INVALIDATION_BUS_POLL_INTERVAL = 0.25  # seconds
+INVALIDATION_BUS_RETENTION = 300  # seconds the log keeps applied entries
+
+# Message ids (profiles.message_ids) embed a 10-bit node id that every process leases from this
+# SQLite registry, so two live processes never share one. A lease is renewed while ids are
+# generated; a node not renewed for MESSAGE_ID_NODE_LEASE seconds may be taken by another process.
+MESSAGE_ID_NODE_PATH = RUNTIME_DIR / 'message-id-nodes.sqlite3'
+MESSAGE_ID_NODE_LEASE = 60  # seconds
+
+# Session storage profiles; `manage.py bench_sessions` compares their session reads and writes.
+SESSION_PROFILES = {
+    # Per-process cache in front of the database: every save writes to SQLite, and a request
+    # served by another worker misses its local cache and reads the session from the database
+    'cached_db': {
+        'ENGINE': 'django.contrib.sessions.backends.cached_db',
+        'CACHE_ALIAS': 'default',
+    },
+    # Cache shared by all workers; a copy is written to the database in batches
+    # (profiles.session_backends.write_behind) for sessions evicted from the cache
+    'shared_cache': {
+        'ENGINE': 'profiles.session_backends.write_behind',
+        'CACHE_ALIAS': 'shared',
+    },
+    # No server-side state; sessions cannot be revoked before they expire
+    'signed_cookies': {
+        'ENGINE': 'django.contrib.sessions.backends.signed_cookies',
+        'CACHE_ALIAS': 'default',
+    },
 }
+SESSION_PROFILE = os.environ.get('SESSION_PROFILE', 'shared_cache')
+SESSION_ENGINE = SESSION_PROFILES[SESSION_PROFILE]['ENGINE']
+SESSION_CACHE_ALIAS = SESSION_PROFILES[SESSION_PROFILE]['CACHE_ALIAS']
+SESSION_DB_WRITE_INTERVAL = 10  # seconds between batched session writes of a worker (shared_cache)
 
-# Cache configuration for sessions
-SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
-SESSION_CACHE_ALIAS = 'default'
+# Flash messages live in a signed cookie and never modify the session
+MESSAGE_STORAGE = 'django.contrib.messages.storage.cookie.CookieStorage'
 
 # Cache keys prefixes to avoid collisions
 CACHE_KEY_PREFIX = 'dating_site'
 
+# Cache instrumentation (hits/misses/latency per cache and key family, see profiles.cache_metrics)
+CACHE_METRICS_ENABLED = True
+CACHE_METRICS_MEASURE_BYTES = False  # re-pickle values of non-local backends to count bytes written (costly)
+# Directory for per-process key traces replayed by `manage.py bench_cache_policy` (off when None)
+CACHE_TRACE_DIR = None
+
+# Cache warm-up (profiles.cache_warmup). Run `manage.py warm_caches` once per deploy, after
+# migrate: it fills the shared tier that every worker reads through. With
+# CACHE_PREWARM_ON_STARTUP a worker warms after its first request instead; only the worker
+# that takes the lock in the shared cache does, the rest skip it for CACHE_PREWARM_LOCK_TIMEOUT.
+CACHE_PREWARM_ON_STARTUP = False
+CACHE_PREWARM_TIME_BUDGET = 20  # seconds; tasks not started by then are skipped
+CACHE_PREWARM_WORKERS = 4
+CACHE_PREWARM_LOCK_TIMEOUT = 600  # seconds
+
 # Cache middleware settings (optional - for full page caching)
 CACHE_MIDDLEWARE_ALIAS = 'default'
 CACHE_MIDDLEWARE_SECONDS = 300
 CACHE_MIDDLEWARE_KEY_PREFIX = 'page'
+
+# Log INFO messages of the profiles app (cache warm-up coverage etc.) to the console
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'profiles': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
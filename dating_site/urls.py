@@ -14,18 +14,23 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+import re
+
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, re_path, include
 from django.conf import settings
 from django.conf.urls.static import static
 
+from profiles.views_package import media_views
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('auth/', include('profiles.auth_urls')),  # Аутентификация
     path('', include('profiles.urls')),
+    # Медиафайлы: ETag, Range и передача файла прокси-серверу (см. MEDIA_ACCEL_HEADER)
+    re_path(r'^%s(?P<path>.+)$' % re.escape(settings.MEDIA_URL.lstrip('/')), media_views.serve_media, name='media'),
 ]
 
-# Добавляем обслуживание медиа и статических файлов в режиме разработки
+# Добавляем обслуживание статических файлов в режиме разработки
 if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
     urlpatterns += static(settings.STATIC_URL, document_root=settings.STATICFILES_DIRS[0])
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dating_site.settings')
 
 application = get_wsgi_application()
+
+# With CACHE_PREWARM_ON_STARTUP one worker warms caches in the background after its first request
+from profiles.cache_warmup import prewarm_on_startup  # noqa: E402
+
+prewarm_on_startup()
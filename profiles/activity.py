@@ -0,0 +1,150 @@
+"""
+Учет активности пользователей для поля Profile.last_online
+Middleware (middleware.LastOnlineMiddleware) только запоминает время последнего запроса
+пользователя в памяти процесса; не чаще раза в LAST_ONLINE_FLUSH_INTERVAL секунд накопленные
+значения записываются в базу пакетами (один UPDATE ... CASE на пакет), причем last_online
+одного пользователя обновляется не чаще раза в LAST_ONLINE_UPDATE_INTERVAL секунд.
+При штатном завершении процесса несохраненные значения записываются, если включен
+LAST_ONLINE_FLUSH_ON_EXIT
+"""
+
+import atexit
+import datetime
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.db import DatabaseError, connections, router
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_UPDATE_INTERVAL = 300
+DEFAULT_FLUSH_INTERVAL = 30
+
+# Пользователей в одном UPDATE: по 2 параметра на ветку CASE и 1 на IN (лимит SQLite - 999)
+FLUSH_BATCH_SIZE = 300
+
+
+class ActivityTracker:
+    """Время последней активности пользователей текущего процесса, еще не записанное в базу"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending: Dict[int, float] = {}
+        self._written: Dict[int, float] = {}
+        self._last_flush = time.monotonic()
+
+    @property
+    def update_interval(self) -> float:
+        return getattr(settings, 'LAST_ONLINE_UPDATE_INTERVAL', DEFAULT_UPDATE_INTERVAL)
+
+    def record(self, user_id: int, seen_at: Optional[float] = None):
+        """Запомнить активность пользователя (без обращения к базе)"""
+        with self._lock:
+            self._pending[user_id] = seen_at or time.time()
+        metrics.incr('activity.recorded')
+
+    def maybe_flush(self):
+        """Записать накопленные значения, если с прошлой записи прошло LAST_ONLINE_FLUSH_INTERVAL секунд"""
+        interval = getattr(settings, 'LAST_ONLINE_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL)
+        if time.monotonic() - self._last_flush >= interval:
+            self.flush()
+
+    def flush(self, force: bool = False, now: Optional[float] = None) -> int:
+        """
+        Записать last_online пользователей, у которых он не обновлялся дольше
+        LAST_ONLINE_UPDATE_INTERVAL секунд (force - всех накопленных)
+        now - текущее время (для воспроизведения нагрузки в бенчмарке)
+        Returns:
+            число обновленных строк
+        """
+        if not self._flush_lock.acquire(blocking=force):
+            # Запись уже выполняет другой поток
+            return 0
+        try:
+            self._last_flush = time.monotonic()
+            now = now or time.time()
+            with self._lock:
+                due = {
+                    user_id: seen_at for user_id, seen_at in self._pending.items()
+                    if force or seen_at - self._written.get(user_id, 0) >= self.update_interval
+                }
+                for user_id in due:
+                    del self._pending[user_id]
+                # Пользователи без записей дольше интервала могут быть записаны сразу
+                self._written = {
+                    user_id: written_at for user_id, written_at in self._written.items()
+                    if now - written_at < self.update_interval
+                }
+            if not due:
+                return 0
+
+            updated = 0
+            items = sorted(due.items())
+            for start in range(0, len(items), FLUSH_BATCH_SIZE):
+                batch = dict(items[start:start + FLUSH_BATCH_SIZE])
+                try:
+                    updated += write_last_online(batch)
+                except DatabaseError:
+                    logger.exception('Не удалось записать last_online (%s пользователей)', len(batch))
+                    with self._lock:
+                        for user_id, seen_at in batch.items():
+                            self._pending.setdefault(user_id, seen_at)
+                    continue
+                with self._lock:
+                    self._written.update(batch)
+            metrics.incr('activity.flushes')
+            metrics.incr('activity.rows_written', updated)
+            return updated
+        finally:
+            self._flush_lock.release()
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+
+def write_last_online(seen: Dict[int, float]) -> int:
+    """
+    Один UPDATE ... SET last_online = CASE user_id WHEN ... END для пакета пользователей
+    Запрос собирается вручную: выражение Case из сотен When строится ORM дольше, чем выполняется
+    """
+    from . import db_router
+    from .models import Profile
+
+    # Фоновая запись чужих last_online не должна закреплять текущего пользователя за основной базой
+    with db_router.untracked_writes():
+        connection = connections[router.db_for_write(Profile)]
+    quote = connection.ops.quote_name
+    params = []
+    for user_id, seen_at in seen.items():
+        params.append(user_id)
+        params.append(connection.ops.adapt_datetimefield_value(
+            datetime.datetime.fromtimestamp(seen_at, tz=datetime.timezone.utc)
+        ))
+    params.extend(seen)
+    sql = (
+        f'UPDATE {quote(Profile._meta.db_table)} SET {quote("last_online")} = CASE {quote("user_id")} '
+        f'{" ".join(["WHEN %s THEN %s"] * len(seen))} END '
+        f'WHERE {quote("user_id")} IN ({", ".join(["%s"] * len(seen))})'
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+
+# Трекер процесса
+activity_tracker = ActivityTracker()
+
+
+def _flush_on_exit():
+    if getattr(settings, 'LAST_ONLINE_FLUSH_ON_EXIT', True) and activity_tracker.pending_count():
+        activity_tracker.flush(force=True)
+
+
+atexit.register(_flush_on_exit)
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Profile, Photo, Conversation, Message, MessageLimit, Report
+from .models import Profile, Photo, Conversation, Message, MessageLimit, Report, PendingFileDeletion
 
 
 @admin.register(Profile)
@@ -121,6 +121,15 @@ class ReportAdmin(admin.ModelAdmin):
         return super().get_queryset(request).select_related('reporter', 'reported_user')
 
 
+@admin.register(PendingFileDeletion)
+class PendingFileDeletionAdmin(admin.ModelAdmin):
+    list_display = ('path', 'attempts', 'created_at')
+    list_filter = ('attempts',)
+    search_fields = ('path',)
+    readonly_fields = ('created_at',)
+    ordering = ('id',)
+
+
 # Дополнительные настройки админки
 admin.site.site_header = 'Администрирование сайта знакомств'
 admin.site.site_title = 'Админ-панель'
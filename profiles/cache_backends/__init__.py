@@ -0,0 +1,5 @@
+"""
+Дополнительные backend-ы кэша для сайта знакомств
+sqlite.SQLiteCache - общий для всех рабочих процессов кэш в файле SQLite
+tiered.TieredCache - небольшой LRU в памяти процесса перед общим кэшем
+"""
@@ -0,0 +1,274 @@
+"""
+Кэш в памяти процесса с ограничением по объему и политикой W-TinyLFU
+Записи сначала попадают в небольшое окно LRU; вытесненная из окна запись допускается
+в основную область (сегментированный LRU: испытательный и защищенный сегменты), только
+если по оценке частоты обращений (Count-Min sketch со старением) она популярнее записей,
+которые придется вытеснить ради ее объема. Поэтому несколько больших редких значений
+не вытесняют много маленьких часто читаемых
+"""
+
+import pickle
+import sys
+from collections import OrderedDict
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.locmem import LocMemCache
+
+# Состояние политики общее для всех экземпляров с одним LOCATION (как хранилище LocMemCache)
+_policies = {}
+
+WINDOW, PROBATION, PROTECTED = 'window', 'probation', 'protected'
+
+
+class FrequencySketch:
+    """
+    Count-Min sketch с 4-битными счетчиками и периодическим делением пополам
+    Оценивает частоту обращений к ключу за последние ~10 * width обращений
+    """
+
+    MAX_COUNT = 15
+
+    # Нечетные 64-битные множители строк: индекс строки - старшие биты произведения хэша
+    # на множитель, поэтому совпадение индексов ключей в одной строке не повторяется в других
+    # (индексы hash((row, key)) разных строк совпадали почти всегда одновременно)
+    SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93)
+    HASH_MASK = (1 << 64) - 1
+
+    def __init__(self, capacity: int):
+        width = 64
+        while width < capacity:
+            width *= 2
+        self.shift = 64 - (width.bit_length() - 1)
+        self.rows = [bytearray(width) for _ in self.SEEDS]
+        self.sample_size = 10 * width
+        self.additions = 0
+
+    def _indexes(self, key):
+        value = hash(key) & self.HASH_MASK
+        return [((value * seed) & self.HASH_MASK) >> self.shift for seed in self.SEEDS]
+
+    def increment(self, key):
+        added = False
+        for row, index in zip(self.rows, self._indexes(key)):
+            if row[index] < self.MAX_COUNT:
+                row[index] += 1
+                added = True
+        if added:
+            self.additions += 1
+            if self.additions >= self.sample_size:
+                self._reset()
+
+    def frequency(self, key) -> int:
+        return min(row[index] for row, index in zip(self.rows, self._indexes(key)))
+
+    def _reset(self):
+        """Старение: делим все счетчики пополам, чтобы забывать прошлую популярность"""
+        for row in self.rows:
+            for index, count in enumerate(row):
+                if count:
+                    row[index] = count >> 1
+        self.additions //= 2
+
+
+class SizeAwarePolicy:
+    """Сегменты W-TinyLFU с учетом объема записей (ключ -> размер в байтах)"""
+
+    def __init__(self, max_bytes, max_entries, window_percent, protected_percent):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.window_bytes = max(max_bytes * window_percent // 100, 1)
+        self.main_bytes = max_bytes - self.window_bytes
+        self.protected_bytes = self.main_bytes * protected_percent // 100
+        self.segments = {WINDOW: OrderedDict(), PROBATION: OrderedDict(), PROTECTED: OrderedDict()}
+        self.used = {WINDOW: 0, PROBATION: 0, PROTECTED: 0}
+        self.location = {}
+        self.sketch = FrequencySketch(min(max_entries, max_bytes // 512))
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self.location)
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(self.used.values())
+
+    def _move(self, key, segment):
+        size = self.segments[self.location[key]].pop(key)
+        self.used[self.location[key]] -= size
+        self.segments[segment][key] = size
+        self.used[segment] += size
+        self.location[key] = segment
+
+    def record_access(self, key):
+        self.sketch.increment(key)
+
+    def on_hit(self, key):
+        segment = self.location.get(key)
+        if segment is None:
+            return
+        if segment == PROBATION:
+            # Повторное обращение: переводим в защищенный сегмент
+            self._move(key, PROTECTED)
+            protected = self.segments[PROTECTED]
+            while self.used[PROTECTED] > self.protected_bytes and len(protected) > 1:
+                self._move(next(iter(protected)), PROBATION)
+        else:
+            self.segments[segment].move_to_end(key)
+
+    def remove(self, key):
+        segment = self.location.pop(key, None)
+        if segment is not None:
+            self.used[segment] -= self.segments[segment].pop(key)
+
+    def clear(self):
+        for segment in self.segments.values():
+            segment.clear()
+        self.used = dict.fromkeys(self.used, 0)
+        self.location.clear()
+
+    def insert(self, key, size):
+        """
+        Добавить или обновить запись
+        Returns:
+            ключи, которые нужно удалить из хранилища (вытесненные или не допущенные)
+        """
+        removed = []
+        if key in self.location:
+            segment = self.location[key]
+            self.used[segment] += size - self.segments[segment][key]
+            self.segments[segment][key] = size
+            self.on_hit(key)
+            if segment != WINDOW:
+                # Новое значение могло не поместиться в основную область
+                removed.extend(self._evict_main())
+        else:
+            self.location[key] = WINDOW
+            self.segments[WINDOW][key] = size
+            self.used[WINDOW] += size
+
+        window = self.segments[WINDOW]
+        while window and (self.used[WINDOW] > self.window_bytes or len(self.location) > self.max_entries):
+            candidate = next(iter(window))
+            removed.extend(self._admit(candidate))
+        return removed
+
+    def _evict_main(self):
+        """
+        Вернуть основную область в пределы объема после увеличения записи
+        Лишнее из защищенного сегмента переходит в испытательный, затем вытесняются LRU
+        испытательного и защищенного сегментов (обновленная запись - последней)
+        """
+        protected = self.segments[PROTECTED]
+        while self.used[PROTECTED] > self.protected_bytes and len(protected) > 1:
+            self._move(next(iter(protected)), PROBATION)
+        removed = []
+        while self.used[PROBATION] + self.used[PROTECTED] > self.main_bytes:
+            victim = next(self._victims())
+            self.remove(victim)
+            removed.append(victim)
+        return removed
+
+    def _victims(self):
+        """Кандидаты на вытеснение: LRU испытательного сегмента, затем защищенного"""
+        for segment in (PROBATION, PROTECTED):
+            yield from self.segments[segment]
+
+    def _admit(self, candidate):
+        """
+        Перенести запись из окна в основную область или отклонить ее
+        Запись допускается, если она чаще используется, чем каждая из вытесняемых ради нее
+        """
+        size = self.segments[WINDOW].pop(candidate)
+        self.used[WINDOW] -= size
+        del self.location[candidate]
+
+        main_used = self.used[PROBATION] + self.used[PROTECTED]
+        excess_entries = len(self.location) + 1 - self.max_entries
+        victims, freed = [], 0
+        for victim in self._victims():
+            if main_used - freed + size <= self.main_bytes and len(victims) >= excess_entries:
+                break
+            victims.append(victim)
+            freed += self.segments[self.location[victim]][victim]
+
+        fits = main_used - freed + size <= self.main_bytes and len(victims) >= excess_entries
+        if not fits or (victims and self.sketch.frequency(candidate) <= max(
+                self.sketch.frequency(victim) for victim in victims)):
+            self.rejected += 1
+            return [candidate]
+
+        for victim in victims:
+            self.remove(victim)
+        self.location[candidate] = PROBATION
+        self.segments[PROBATION][candidate] = size
+        self.used[PROBATION] += size
+        return victims
+
+
+class SizeAwareCache(LocMemCache):
+    """
+    LocMemCache с ограничением по объему сериализованных значений и политикой W-TinyLFU
+    OPTIONS:
+        MAX_BYTES - общий объем значений (по умолчанию 16 MB)
+        MAX_ENTRIES - дополнительное ограничение числа записей (по умолчанию без ограничения)
+        MAX_ENTRY_BYTES - значения больше не кэшируются (по умолчанию MAX_BYTES / 8)
+        WINDOW_PERCENT - доля окна LRU в объеме (по умолчанию 1)
+        PROTECTED_PERCENT - доля защищенного сегмента в основной области (по умолчанию 80)
+    """
+
+    def __init__(self, name, params):
+        super().__init__(name, params)
+        options = params.get('OPTIONS', {})
+        self.max_bytes = options.get('MAX_BYTES', 16 * 1024 * 1024)
+        self.max_entry_bytes = options.get('MAX_ENTRY_BYTES', self.max_bytes // 8)
+        self._max_entries = options.get('MAX_ENTRIES', sys.maxsize)
+        self._policy = _policies.setdefault(name, SizeAwarePolicy(
+            self.max_bytes, self._max_entries,
+            options.get('WINDOW_PERCENT', 1), options.get('PROTECTED_PERCENT', 80),
+        ))
+
+    @property
+    def current_bytes(self) -> int:
+        return self._policy.total_bytes
+
+    @property
+    def rejected(self) -> int:
+        """Сколько записей не было допущено в кэш"""
+        return self._policy.rejected
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        with self._lock:
+            self._policy.record_access(key)
+            if self._has_expired(key):
+                self._delete(key)
+                return default
+            pickled = self._cache[key]
+            self._policy.on_hit(key)
+        return pickle.loads(pickled)
+
+    def _set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        if len(value) > self.max_entry_bytes:
+            self._delete(key)
+            self._policy.rejected += 1
+            return
+        self._policy.record_access(key)
+        self._cache[key] = value
+        self._expire_info[key] = self.get_backend_timeout(timeout)
+        for removed in self._policy.insert(key, len(value)):
+            self._cache.pop(removed, None)
+            self._expire_info.pop(removed, None)
+
+    def _cull(self):
+        # Вытеснение выполняет политика при каждой записи
+        pass
+
+    def _delete(self, key):
+        self._policy.remove(key)
+        return super()._delete(key)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._expire_info.clear()
+            self._policy.clear()
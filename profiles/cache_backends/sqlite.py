@@ -0,0 +1,243 @@
+"""
+Кэш в отдельном файле SQLite, общий для всех рабочих процессов одного хоста
+Не требует внешних сервисов; файл работает в режиме WAL, поэтому чтения не блокируют записи
+"""
+
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+# Максимум параметров в одном запросе IN (...)
+QUERY_CHUNK_SIZE = 500
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS cache_entries ('
+    ' key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL'
+    ') WITHOUT ROWID',
+    'CREATE INDEX IF NOT EXISTS cache_entries_expires ON cache_entries (expires)',
+)
+
+
+def chunked(items, size=QUERY_CHUNK_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class SQLiteCache(BaseCache):
+    """
+    Backend кэша в файле SQLite
+    OPTIONS:
+        MAX_ENTRIES, CULL_FREQUENCY - как у стандартных backend-ов
+        CULL_EVERY - проверять переполнение раз в указанное число записей (по умолчанию 100)
+    """
+
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self.path = os.fspath(location)
+        self.cull_every = options.get('CULL_EVERY', 100)
+        self._local = threading.local()
+        self._writes = 0
+
+    # ---------------------------------------------------------------- соединение
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """Соединение текущего потока (пересоздается после fork)"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.pid == os.getpid():
+            return connection
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            connection.execute(statement)
+        self._local.connection = connection
+        self._local.pid = os.getpid()
+        return connection
+
+    def close(self, **kwargs):
+        # Соединение переиспользуется между запросами
+        pass
+
+    # ---------------------------------------------------------------- сериализация
+
+    def _dumps(self, value) -> bytes:
+        return pickle.dumps(value, self.pickle_protocol)
+
+    def _loads(self, key, data, default):
+        try:
+            return pickle.loads(data)
+        except Exception:
+            # Запись от несовместимой версии кода: считаем промахом
+            self.connection.execute('DELETE FROM cache_entries WHERE key = ?', (key,))
+            return default
+
+    # ---------------------------------------------------------------- чтение
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        row = self.connection.execute(
+            'SELECT value FROM cache_entries WHERE key = ? AND (expires IS NULL OR expires > ?)',
+            (key, time.time()),
+        ).fetchone()
+        if row is None:
+            return default
+        return self._loads(key, row[0], default)
+
+    def get_many(self, keys, version=None):
+        key_map = {self.make_and_validate_key(key, version=version): key for key in keys}
+        result = {}
+        now = time.time()
+        for chunk in chunked(key_map):
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.connection.execute(
+                f'SELECT key, value FROM cache_entries WHERE key IN ({placeholders}) '
+                f'AND (expires IS NULL OR expires > ?)',
+                (*chunk, now),
+            ).fetchall()
+            for made_key, data in rows:
+                value = self._loads(made_key, data, self)
+                if value is not self:
+                    result[key_map[made_key]] = value
+        return result
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        row = self.connection.execute(
+            'SELECT 1 FROM cache_entries WHERE key = ? AND (expires IS NULL OR expires > ?)',
+            (key, time.time()),
+        ).fetchone()
+        return row is not None
+
+    # ---------------------------------------------------------------- запись
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.set_many({key: value}, timeout, version=version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        expires = self.get_backend_timeout(timeout)
+        rows = [
+            (self.make_and_validate_key(key, version=version), self._dumps(value), expires)
+            for key, value in data.items()
+        ]
+        with self._transaction() as connection:
+            if timeout == 0:
+                connection.executemany('DELETE FROM cache_entries WHERE key = ?', [row[:1] for row in rows])
+            else:
+                connection.executemany(
+                    'INSERT OR REPLACE INTO cache_entries (key, value, expires) VALUES (?, ?, ?)', rows
+                )
+        self._maybe_cull(len(rows))
+        return []
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        expires = self.get_backend_timeout(timeout)
+        cursor = self.connection.execute(
+            'INSERT INTO cache_entries (key, value, expires) VALUES (?, ?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires = excluded.expires '
+            'WHERE cache_entries.expires IS NOT NULL AND cache_entries.expires <= ?',
+            (key, self._dumps(value), expires, time.time()),
+        )
+        self._maybe_cull(1)
+        return cursor.rowcount > 0
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        cursor = self.connection.execute(
+            'UPDATE cache_entries SET expires = ? WHERE key = ? AND (expires IS NULL OR expires > ?)',
+            (self.get_backend_timeout(timeout), key, time.time()),
+        )
+        return cursor.rowcount > 0
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        with self._transaction() as connection:
+            row = connection.execute(
+                'SELECT value FROM cache_entries WHERE key = ? AND (expires IS NULL OR expires > ?)',
+                (key, time.time()),
+            ).fetchone()
+            if row is None:
+                raise ValueError("Key '%s' not found" % key)
+            new_value = pickle.loads(row[0]) + delta
+            connection.execute(
+                'UPDATE cache_entries SET value = ? WHERE key = ?', (self._dumps(new_value), key)
+            )
+        return new_value
+
+    # ---------------------------------------------------------------- удаление
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        cursor = self.connection.execute('DELETE FROM cache_entries WHERE key = ?', (key,))
+        return cursor.rowcount > 0
+
+    def delete_many(self, keys, version=None):
+        made_keys = [self.make_and_validate_key(key, version=version) for key in keys]
+        with self._transaction() as connection:
+            connection.executemany('DELETE FROM cache_entries WHERE key = ?', [(key,) for key in made_keys])
+
+    def delete_prefix(self, prefix: str, version=None) -> int:
+        """Удалить все записи, ключ которых начинается с prefix"""
+        made_prefix = self.make_key(prefix, version=version)
+        cursor = self.connection.execute(
+            'DELETE FROM cache_entries WHERE key >= ? AND key < ?',
+            (made_prefix, made_prefix + '\U0010ffff'),
+        )
+        return cursor.rowcount
+
+    def clear(self):
+        self.connection.execute('DELETE FROM cache_entries')
+
+    # ---------------------------------------------------------------- обслуживание
+
+    def _transaction(self):
+        return _Transaction(self.connection)
+
+    def _maybe_cull(self, count):
+        """Удалять просроченные записи и вытеснять ближайшие к истечению при переполнении"""
+        self._writes += count
+        if self._writes < self.cull_every:
+            return
+        self._writes = 0
+        now = time.time()
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM cache_entries WHERE expires IS NOT NULL AND expires <= ?', (now,))
+            (entries,) = connection.execute('SELECT COUNT(*) FROM cache_entries').fetchone()
+            if entries > self._max_entries:
+                if self._cull_frequency == 0:
+                    connection.execute('DELETE FROM cache_entries')
+                else:
+                    connection.execute(
+                        'DELETE FROM cache_entries WHERE key IN ('
+                        ' SELECT key FROM cache_entries ORDER BY expires IS NULL, expires LIMIT ?'
+                        ')',
+                        (entries // self._cull_frequency,),
+                    )
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK для соединения в режиме autocommit"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def __exit__(self, exc_type, exc, tb):
+        self.connection.execute('ROLLBACK' if exc_type else 'COMMIT')
+        return False
@@ -0,0 +1,203 @@
+"""
+Двухуровневый кэш: небольшой LRU в памяти процесса перед общим кэшем (SQLiteCache)
+Записи идут сквозь оба уровня; локальные копии живут не дольше LOCAL_TIMEOUT секунд,
+а изменения и удаления публикуются в шину инвалидаций (profiles.invalidation_bus),
+по которой другие процессы сбрасывают свои локальные копии
+"""
+
+import os
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.locmem import LocMemCache
+
+from ..invalidation_bus import get_invalidation_bus
+from ..metrics import metrics
+
+_MISSING = object()
+
+# Процесс, в котором локальный уровень пространства имен уже использовался
+_owner_pids = {}
+
+
+class TieredCache(LocMemCache):
+    """
+    Backend кэша с локальным уровнем (LocMemCache) и общим уровнем (алиас SHARED_ALIAS)
+    OPTIONS:
+        SHARED_ALIAS - алиас общего кэша в settings.CACHES (по умолчанию 'shared')
+        LOCAL_MAX_ENTRIES - размер локального LRU (по умолчанию 256)
+        LOCAL_TIMEOUT - время жизни локальной копии в секундах (по умолчанию 5)
+        METRICS_LABEL - имя кэша в метриках (по умолчанию LOCATION)
+    """
+
+    def __init__(self, name, params):
+        options = params.get('OPTIONS', {})
+        local_params = dict(params, OPTIONS={
+            'MAX_ENTRIES': options.get('LOCAL_MAX_ENTRIES', 256),
+            'CULL_FREQUENCY': options.get('CULL_FREQUENCY', 4),
+        })
+        super().__init__(f'tiered:{name}', local_params)
+        self.namespace = name
+        self.shared_alias = options.get('SHARED_ALIAS', 'shared')
+        self.local_timeout = options.get('LOCAL_TIMEOUT', 5)
+        self.metrics_label = options.get('METRICS_LABEL', name)
+        self.bus = get_invalidation_bus()
+        if self.bus is not None:
+            self.bus.subscribe(name, self.apply_invalidations, name='tiered')
+
+    @classmethod
+    def from_alias(cls, alias: str) -> 'TieredCache':
+        """Двухуровневый кэш с настройками (TIMEOUT, KEY_PREFIX) существующего алиаса"""
+        params = dict(settings.CACHES[alias])
+        options = dict(getattr(settings, 'CACHE_TIERED_OPTIONS', {}))
+        options.update(params.get('OPTIONS', {}).get('TIERED', {}))
+        options.setdefault('METRICS_LABEL', alias)
+        params['OPTIONS'] = options
+        return cls(params.get('LOCATION') or alias, params)
+
+    @property
+    def shared(self):
+        return caches[self.shared_alias]
+
+    def shared_key(self, key, version=None) -> str:
+        """Ключ в общем кэше: пространство имен + ключ с версией"""
+        return f'{self.namespace}:{self.make_and_validate_key(key, version=version)}'
+
+    def _local_timeout(self, timeout):
+        timeout = self.get_backend_timeout(timeout)
+        if timeout is None:
+            return self.local_timeout
+        return max(min(timeout - time.time(), self.local_timeout), 0)
+
+    # ---------------------------------------------------------------- синхронизация
+
+    def sync(self):
+        """Применить инвалидации других процессов (не чаще интервала опроса шины)"""
+        if _owner_pids.get(self.namespace) != os.getpid():
+            # Копия локального уровня, унаследованная при fork, могла устареть
+            _owner_pids[self.namespace] = os.getpid()
+            super().clear()
+        if self.bus is not None:
+            self.bus.poll()
+
+    def apply_invalidations(self, keys):
+        """Сбросить локальные копии ключей, измененных другими процессами"""
+        prefix = f'{self.namespace}:'
+        with self._lock:
+            if keys is None:
+                self._cache.clear()
+                self._expire_info.clear()
+            else:
+                for key in keys:
+                    if key.startswith(prefix):
+                        self._delete(key[len(prefix):])
+        metrics.incr('cache.tier_invalidations', len(keys) if keys else 1, cache=self.metrics_label)
+
+    def _publish(self, keys):
+        if self.bus is not None:
+            self.bus.publish(self.namespace, keys)
+
+    # ---------------------------------------------------------------- чтение
+
+    def get(self, key, default=None, version=None):
+        self.sync()
+        value = super().get(key, _MISSING, version=version)
+        if value is not _MISSING:
+            metrics.incr('cache.tier_hits', cache=self.metrics_label, tier='local')
+            return value
+
+        value = self.shared.get(self.shared_key(key, version), _MISSING)
+        if value is _MISSING:
+            return default
+        metrics.incr('cache.tier_hits', cache=self.metrics_label, tier='shared')
+        super().set(key, value, self.local_timeout, version=version)
+        return value
+
+    def get_many(self, keys, version=None):
+        self.sync()
+        result = {}
+        missing = {}
+        for key in keys:
+            value = super().get(key, _MISSING, version=version)
+            if value is _MISSING:
+                missing[self.shared_key(key, version)] = key
+            else:
+                result[key] = value
+
+        if result:
+            metrics.incr('cache.tier_hits', len(result), cache=self.metrics_label, tier='local')
+        if missing:
+            found = self.shared.get_many(list(missing))
+            for shared_key, value in found.items():
+                key = missing[shared_key]
+                super().set(key, value, self.local_timeout, version=version)
+                result[key] = value
+            if found:
+                metrics.incr('cache.tier_hits', len(found), cache=self.metrics_label, tier='shared')
+        return result
+
+    def has_key(self, key, version=None):
+        self.sync()
+        return super().has_key(key, version=version) or self.shared.has_key(self.shared_key(key, version))
+
+    # ---------------------------------------------------------------- запись
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.set_many({key: value}, timeout, version=version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        shared_data = {self.shared_key(key, version): value for key, value in data.items()}
+        self.shared.set_many(shared_data, timeout)
+        local_timeout = self._local_timeout(timeout)
+        for key, value in data.items():
+            super().set(key, value, local_timeout, version=version)
+        self._publish(shared_data)
+        return []
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        shared_key = self.shared_key(key, version)
+        if not self.shared.add(shared_key, value, timeout):
+            return False
+        super().set(key, value, self._local_timeout(timeout), version=version)
+        self._publish([shared_key])
+        return True
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        return self.shared.touch(self.shared_key(key, version), timeout)
+
+    def incr(self, key, delta=1, version=None):
+        shared_key = self.shared_key(key, version)
+        value = self.shared.incr(shared_key, delta)
+        super().delete(key, version=version)
+        self._publish([shared_key])
+        return value
+
+    # ---------------------------------------------------------------- удаление
+
+    def delete(self, key, version=None):
+        shared_key = self.shared_key(key, version)
+        deleted = self.shared.delete(shared_key)
+        super().delete(key, version=version)
+        self._publish([shared_key])
+        return deleted
+
+    def delete_many(self, keys, version=None):
+        shared_keys = [self.shared_key(key, version) for key in keys]
+        self.shared.delete_many(shared_keys)
+        for key in keys:
+            super().delete(key, version=version)
+        self._publish(shared_keys)
+
+    def clear(self):
+        """Очистить только свое пространство имен общего кэша"""
+        self.shared.delete_prefix(f'{self.namespace}:')
+        super().clear()
+        self._publish([None])
@@ -0,0 +1,288 @@
+"""
+Инструментирование кэшей сайта знакомств
+Обертка над backend-ом кэша считает попадания, промахи, записи, удаления, вытеснения
+и объем записанных данных, а также строит гистограммы задержек по кэшу и семейству
+ключей; все значения попадают в общий реестр метрик (profiles.metrics)
+"""
+
+import os
+import pickle
+import sys
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from django.conf import settings
+
+from .metrics import metrics
+
+# Значение-маркер промаха (None может быть сохраненным значением)
+_MISSING = object()
+
+
+def get_key_family(key: str) -> str:
+    """
+    Семейство ключа: второй сегмент ключа вида <prefix>:<тип>:...
+    Например: dating_site:profile:user:user_id-1 -> profile
+    """
+    prefix = getattr(settings, 'CACHE_KEY_PREFIX', 'dating_site')
+    parts = str(key).split(':', 2)
+    if len(parts) >= 2 and parts[0] == prefix:
+        return parts[1]
+    return 'other'
+
+
+def group_by_family(keys) -> Dict[str, list]:
+    """Ключи, сгруппированные по семействам (для пакетных операций с ключами разных типов)"""
+    families: Dict[str, list] = {}
+    for key in keys:
+        families.setdefault(get_key_family(key), []).append(key)
+    return families
+
+
+class KeyTraceWriter:
+    """
+    Запись трассы обращений к кэшу для воспроизведения (bench_cache_policy)
+    Строки файла <CACHE_TRACE_DIR>/<алиас>-<pid>.trace: операция, ключ и размер записи через табуляцию
+    """
+
+    def __init__(self, directory, alias: str):
+        self.directory = directory
+        self.alias = alias
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+
+    def write(self, op: str, key, size: int = 0):
+        with self._lock:
+            if self._pid != os.getpid():
+                os.makedirs(self.directory, exist_ok=True)
+                path = os.path.join(self.directory, f'{self.alias}-{os.getpid()}.trace')
+                self._file = open(path, 'a', buffering=1, encoding='utf-8')
+                self._pid = os.getpid()
+            self._file.write(f'{op}\t{key}\t{size}\n')
+
+
+def get_trace_writer(alias: str) -> Optional[KeyTraceWriter]:
+    """Запись трассы алиаса, если задан CACHE_TRACE_DIR (выключено по умолчанию)"""
+    directory = getattr(settings, 'CACHE_TRACE_DIR', None)
+    if not directory:
+        return None
+    return KeyTraceWriter(directory, alias)
+
+
+class InstrumentedCache:
+    """
+    Прокси над backend-ом кэша с подсчетом метрик
+    Поддерживает основной API Django-кэша; остальные атрибуты передаются backend-у
+    """
+
+    def __init__(self, cache, alias: str):
+        self._cache = cache
+        self.alias = alias
+        # LocMemCache хранит записи в словаре процесса: по нему считаются размер и вытеснения
+        # (обертки вроде BroadcastingCache хранят backend в том же атрибуте _cache)
+        local = getattr(cache, '_cache', None)
+        while local is not None and not isinstance(local, dict):
+            local = getattr(local, '_cache', None)
+        self._local = local
+        self._max_entries = getattr(cache, '_max_entries', None)
+        self._trace = get_trace_writer(alias)
+
+    def __getattr__(self, name):
+        return getattr(self._cache, name)
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    # ---------------------------------------------------------------- учет
+
+    def _observe(self, op: str, family: str, started: float):
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        metrics.observe('cache.latency_ms', elapsed_ms, cache=self.alias, family=family, op=op)
+
+    def _count(self, name: str, family: str, value: int = 1):
+        if value:
+            metrics.incr(name, value, cache=self.alias, family=family)
+
+    def _entry_size(self, key, value, version=None) -> int:
+        """Размер сохраненной записи в байтах"""
+        if isinstance(self._local, dict):
+            stored = self._local.get(self._cache.make_key(key, version=version))
+            if isinstance(stored, bytes):
+                return len(stored)
+        # Повторная сериализация ради подсчета байт - только по настройке или для трассы
+        if self._trace is None and not getattr(settings, 'CACHE_METRICS_MEASURE_BYTES', False):
+            return 0
+        try:
+            return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            return 0
+
+    def _local_size(self) -> Optional[int]:
+        return len(self._local) if isinstance(self._local, dict) else None
+
+    def _record_writes(self, family: str, items: Dict, version, size_before: Optional[int], existing: int):
+        """
+        Учесть записи, их объем и вытеснения (LocMemCache чистит записи при переполнении)
+        Записи и объем считаются по семействам ключей; вытеснения - на семейство family
+        """
+        sizes = {key: self._entry_size(key, value, version) for key, value in items.items()}
+        for key_family, keys in group_by_family(items).items():
+            self._count('cache.sets', key_family, len(keys))
+            self._count('cache.bytes_written', key_family, sum(sizes[key] for key in keys))
+        if self._trace is not None:
+            for key, size in sizes.items():
+                self._trace.write('set', key, size)
+
+        size_after = self._local_size()
+        if size_after is None:
+            return
+        expected = size_before + len(items) - existing
+        self._count('cache.evictions', family, max(expected - size_after, 0))
+        metrics.set_gauge('cache.entries', size_after, cache=self.alias)
+        if self._max_entries and self._max_entries < sys.maxsize:
+            metrics.set_gauge('cache.max_entries', self._max_entries, cache=self.alias)
+        current_bytes = getattr(self._cache, 'current_bytes', None)
+        if current_bytes is not None:
+            # Backend с ограничением по объему (cache_backends.size_aware.SizeAwareCache)
+            metrics.set_gauge('cache.bytes', current_bytes, cache=self.alias)
+
+    def _count_existing(self, keys, version) -> int:
+        if not isinstance(self._local, dict):
+            return 0
+        return sum(1 for key in keys if self._cache.make_key(key, version=version) in self._local)
+
+    # ---------------------------------------------------------------- чтение
+
+    def get(self, key, default=None, version=None):
+        family = get_key_family(key)
+        started = time.perf_counter()
+        value = self._cache.get(key, _MISSING, version=version)
+        self._observe('get', family, started)
+        if self._trace is not None:
+            self._trace.write('get', key)
+        if value is _MISSING:
+            self._count('cache.misses', family)
+            return default
+        self._count('cache.hits', family)
+        return value
+
+    def get_many(self, keys, version=None) -> Dict[str, Any]:
+        keys = list(keys)
+        if not keys:
+            return {}
+        family = get_key_family(keys[0])
+        started = time.perf_counter()
+        result = self._cache.get_many(keys, version=version)
+        self._observe('get_many', family, started)
+        if self._trace is not None:
+            for key in keys:
+                self._trace.write('get', key)
+        for key_family, family_keys in group_by_family(keys).items():
+            hits = sum(1 for key in family_keys if key in result)
+            self._count('cache.hits', key_family, hits)
+            self._count('cache.misses', key_family, len(family_keys) - hits)
+        return result
+
+    def has_key(self, key, version=None):
+        return self._cache.has_key(key, version=version)
+
+    # ---------------------------------------------------------------- запись
+
+    def set(self, key, value, timeout=_MISSING, version=None):
+        family = get_key_family(key)
+        size_before = self._local_size()
+        existing = self._count_existing([key], version)
+        started = time.perf_counter()
+        if timeout is _MISSING:
+            self._cache.set(key, value, version=version)
+        else:
+            self._cache.set(key, value, timeout, version=version)
+        self._observe('set', family, started)
+        self._record_writes(family, {key: value}, version, size_before, existing)
+
+    def add(self, key, value, timeout=_MISSING, version=None):
+        family = get_key_family(key)
+        size_before = self._local_size()
+        started = time.perf_counter()
+        if timeout is _MISSING:
+            added = self._cache.add(key, value, version=version)
+        else:
+            added = self._cache.add(key, value, timeout, version=version)
+        self._observe('add', family, started)
+        if added:
+            self._record_writes(family, {key: value}, version, size_before, 0)
+        return added
+
+    def set_many(self, data, timeout=_MISSING, version=None):
+        if not data:
+            return []
+        family = get_key_family(next(iter(data)))
+        size_before = self._local_size()
+        existing = self._count_existing(data, version)
+        started = time.perf_counter()
+        if timeout is _MISSING:
+            failed = self._cache.set_many(data, version=version)
+        else:
+            failed = self._cache.set_many(data, timeout, version=version)
+        self._observe('set_many', family, started)
+        self._record_writes(family, data, version, size_before, existing)
+        return failed
+
+    def get_or_set(self, key, default, timeout=_MISSING, version=None):
+        value = self.get(key, _MISSING, version=version)
+        if value is _MISSING:
+            if callable(default):
+                default = default()
+            self.add(key, default, timeout=timeout, version=version)
+            # Значение могло быть записано другим процессом
+            return self.get(key, default, version=version)
+        return value
+
+    def touch(self, key, timeout=_MISSING, version=None):
+        if timeout is _MISSING:
+            return self._cache.touch(key, version=version)
+        return self._cache.touch(key, timeout, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        return self._cache.incr(key, delta, version=version)
+
+    def decr(self, key, delta=1, version=None):
+        return self._cache.decr(key, delta, version=version)
+
+    # ---------------------------------------------------------------- удаление
+
+    def delete(self, key, version=None):
+        family = get_key_family(key)
+        started = time.perf_counter()
+        deleted = self._cache.delete(key, version=version)
+        self._observe('delete', family, started)
+        if self._trace is not None:
+            self._trace.write('delete', key)
+        self._count('cache.deletes', family)
+        return deleted
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        if not keys:
+            return
+        family = get_key_family(keys[0])
+        started = time.perf_counter()
+        self._cache.delete_many(keys, version=version)
+        self._observe('delete_many', family, started)
+        if self._trace is not None:
+            for key in keys:
+                self._trace.write('delete', key)
+        for key_family, family_keys in group_by_family(keys).items():
+            self._count('cache.deletes', key_family, len(family_keys))
+
+    def clear(self):
+        self._cache.clear()
+        metrics.incr('cache.clears', cache=self.alias)
+        if self._local_size() is not None:
+            metrics.set_gauge('cache.entries', 0, cache=self.alias)
+
+    def close(self, **kwargs):
+        return self._cache.close(**kwargs)
+
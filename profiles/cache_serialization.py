@@ -0,0 +1,152 @@
+"""
+Компактная сериализация объектов для кэша
+Вместо pickle целых экземпляров моделей (с состоянием Django и всеми связанными
+объектами) в кэш пишутся кортежи значений только нужных полей; при чтении из них
+собираются экземпляры моделей (так же, как это делает pickle: без вызова __init__,
+незагруженные поля остаются отложенными). Версия схемы (хэш набора полей)
+входит в ключ кэша, поэтому изменение проекции или модели не читает старые записи.
+Большие значения сжимаются zlib
+"""
+
+import hashlib
+import pickle
+import zlib
+from typing import Any, Dict, Iterable, Optional
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.base import ModelState
+
+# Признак формата в первом байте упакованного значения
+_RAW = b'r'
+_ZLIB = b'z'
+
+# Значения меньше этого размера (байт) не сжимаются
+DEFAULT_COMPRESS_MIN_SIZE = 1024
+
+
+def pack(data: Any) -> bytes:
+    """Сериализовать кортежи/простые значения, сжимая большие"""
+    raw = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+    if len(raw) >= getattr(settings, 'CACHE_COMPRESS_MIN_SIZE', DEFAULT_COMPRESS_MIN_SIZE):
+        compressed = zlib.compress(raw, 6)
+        if len(compressed) < len(raw):
+            return _ZLIB + compressed
+    return _RAW + raw
+
+
+def unpack(blob: bytes) -> Any:
+    """Обратная операция к pack"""
+    marker, payload = blob[:1], blob[1:]
+    if marker == _ZLIB:
+        payload = zlib.decompress(payload)
+    return pickle.loads(payload)
+
+
+class ModelProjection:
+    """
+    Проекция экземпляра модели на кортеж значений выбранных полей
+    Args:
+        model: класс модели
+        fields: attname полей (по умолчанию все конкретные поля модели)
+        related: {имя ForeignKey/OneToOne: ModelProjection} для связанных объектов
+    """
+
+    def __init__(self, model, fields: Optional[Iterable[str]] = None,
+                 related: Optional[Dict[str, 'ModelProjection']] = None):
+        self.model = model
+        self.fields = tuple(fields) if fields is not None else tuple(
+            field.attname for field in model._meta.concrete_fields
+        )
+        self.related = related or {}
+        self._related_fields = tuple(
+            (model._meta.get_field(name), projection) for name, projection in self.related.items()
+        )
+
+    @property
+    def schema(self) -> str:
+        """Описание схемы проекции (входит в версию ключа)"""
+        related = ','.join(f'{name}={projection.schema}' for name, projection in sorted(self.related.items()))
+        return f'{self.model._meta.label}({",".join(self.fields)})[{related}]'
+
+    def dump(self, instance) -> Optional[tuple]:
+        if instance is None:
+            return None
+        values = tuple(getattr(instance, attname) for attname in self.fields)
+        related = tuple(
+            projection.dump(getattr(instance, name)) for name, projection in self.related.items()
+        )
+        return (values, related) if related else (values,)
+
+    def load(self, data: Optional[tuple], using: str = DEFAULT_DB_ALIAS):
+        if data is None:
+            return None
+        # Как Model.from_db, но без __init__: поля вне проекции остаются отложенными
+        instance = self.model.__new__(self.model)
+        instance.__dict__.update(zip(self.fields, data[0]))
+        instance._state = ModelState()
+        instance._state.adding = False
+        instance._state.db = using
+        for (field, projection), related_data in zip(self._related_fields, data[1] if self.related else ()):
+            field.set_cached_value(instance, projection.load(related_data, using))
+        return instance
+
+
+class RowProjection:
+    """
+    Проекция словаря (строки данных для шаблона) на кортеж
+    Значения ключей с проекцией None хранятся как есть (числа, строки)
+    """
+
+    def __init__(self, **columns: Optional[ModelProjection]):
+        self.columns = columns
+
+    @property
+    def schema(self) -> str:
+        return ';'.join(
+            f'{name}:{projection.schema if projection else "-"}' for name, projection in self.columns.items()
+        )
+
+    def dump(self, row: Dict) -> tuple:
+        return tuple(
+            projection.dump(row[name]) if projection else row[name]
+            for name, projection in self.columns.items()
+        )
+
+    def load(self, data: tuple) -> Dict:
+        return {
+            name: projection.load(value) if projection else value
+            for (name, projection), value in zip(self.columns.items(), data)
+        }
+
+
+class ListOf:
+    """Проекция списка элементов одной проекцией"""
+
+    def __init__(self, projection):
+        self.projection = projection
+
+    @property
+    def schema(self) -> str:
+        return f'list[{self.projection.schema}]'
+
+    def dump(self, items) -> tuple:
+        return tuple(self.projection.dump(item) for item in items)
+
+    def load(self, data) -> list:
+        return [self.projection.load(item) for item in data]
+
+
+class CacheCodec:
+    """Упаковка значения через проекцию для хранения в кэше"""
+
+    def __init__(self, projection):
+        self.projection = projection
+        self.version = hashlib.md5(projection.schema.encode('utf-8')).hexdigest()[:8]
+
+    def dumps(self, value) -> bytes:
+        return pack(self.projection.dump(value) if value is not None else None)
+
+    def loads(self, blob: bytes):
+        data = unpack(blob)
+        return self.projection.load(data) if data is not None else None
@@ -4,25 +4,59 @@
 """
 
 import hashlib
+import inspect
 import json
-from functools import wraps
-from typing import Any, Optional, Dict, List
+import math
+import random
+import time
+from functools import lru_cache, wraps
+from typing import Any, Callable, Optional, Dict, Iterable, List, NamedTuple, Union
 
 from django.core.cache import caches, cache
+from django.core.cache.backends.locmem import LocMemCache
 from django.core.cache.utils import make_template_fragment_key
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db.models import QuerySet
+from django.db.models import Q, QuerySet
+
+from .cache_backends.tiered import TieredCache
+from .cache_metrics import InstrumentedCache
+from .cache_serialization import CacheCodec, ListOf, ModelProjection, RowProjection
+from .invalidation_bus import BroadcastingCache, get_invalidation_bus
+from .metrics import metrics, collect_metrics, histogram_percentile, parse_metric_name
+from .models.profile import PROFILE_LIST_FIELDS
+
+# Кэши, которыми управляет CacheManager
+MANAGED_CACHES = ('default', 'profiles', 'search', 'messages', 'tags')
 
 
 class CacheManager:
     """Менеджер кэширования для различных типов данных"""
     
     def __init__(self):
-        self.default_cache = cache
-        self.profiles_cache = caches['profiles']
-        self.search_cache = caches['search']
-        self.messages_cache = caches['messages']
+        self.default_cache = self.get_cache('default')
+        self.profiles_cache = self.get_cache('profiles')
+        self.search_cache = self.get_cache('search')
+        self.messages_cache = self.get_cache('messages')
+        self.tags_cache = self.get_cache('tags')
+
+    def get_cache(self, alias: str):
+        """
+        Кэш по алиасу, обернутый сбором метрик (если CACHE_METRICS_ENABLED)
+        Алиасы из CACHE_TIERED_ALIASES работают как двухуровневый кэш: локальный LRU
+        процесса перед общим для всех процессов кэшем; удаления из остальных LocMem-кэшей
+        рассылаются другим процессам через шину инвалидаций
+        """
+        if alias in getattr(settings, 'CACHE_TIERED_ALIASES', ()):
+            backend = TieredCache.from_alias(alias)
+        else:
+            backend = caches[alias]
+            bus = get_invalidation_bus()
+            if bus is not None and isinstance(backend, LocMemCache):
+                backend = BroadcastingCache(backend, alias, bus)
+        if getattr(settings, 'CACHE_METRICS_ENABLED', True):
+            return InstrumentedCache(backend, alias)
+        return backend
     
     def get_cache_key(self, key_type: str, identifier: str, **kwargs) -> str:
         """Генерирует стандартизированный ключ кэша"""
@@ -48,256 +82,766 @@ class CacheManager:
 cache_manager = CacheManager()
 
 
-def cache_profile(timeout: int = 900):
+# ====================== ТЕГИ И ВЕРСИИ ======================
+
+# Тег, которым неявно помечены все записи (сброс всех кэшей без clear())
+GLOBAL_TAG = 'all'
+
+# Значение-маркер промаха
+_MISSING = object()
+
+
+class TaggedValue(NamedTuple):
     """
-    Декоратор для кэширования профильных данных
-    Args:
-        timeout: время жизни кэша в секундах (по умолчанию 15 минут)
+    Запись кэша вместе с версиями тегов на момент вычисления значения
+    fresh_until - время (unix), после которого значение считается устаревшим, но еще
+    может отдаваться, пока один из запросов его пересчитывает; delta - длительность
+    вычисления в секундах (для вероятностного раннего обновления)
     """
-    def decorator(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            # Создаем ключ на основе имени функции и аргументов
-            key_data = f"{func.__name__}_{str(args)}_{str(sorted(kwargs.items()))}"
-            cache_key = cache_manager.hash_key(key_data)
-            
-            # Пытаемся получить из кэша
-            cached_result = cache_manager.profiles_cache.get(cache_key)
-            if cached_result is not None:
-                return cached_result
-            
-            # Выполняем функцию и кэшируем результат
-            result = func(*args, **kwargs)
-            cache_manager.profiles_cache.set(cache_key, result, timeout)
-            return result
-        return wrapper
-    return decorator
+    value: Any
+    versions: Dict[str, int]
+    fresh_until: Optional[float] = None
+    delta: float = 0.0
+
+
+def profile_tag(user_id: int) -> str:
+    """Тег данных профиля пользователя (карточка, списки и переписки, где он показан)"""
+    return f'profile:{user_id}'
+
+
+def city_tag(city: int) -> str:
+    """Тег результатов поиска с фильтром по городу"""
+    return f'city:{city}'
 
 
-def cache_search_results(timeout: int = 600):
+def _tag_key(tag: str) -> str:
+    return cache_manager.get_cache_key('tag', tag)
+
+
+def get_tag_versions(tags: Iterable[str]) -> Dict[str, int]:
     """
-    Декоратор для кэширования результатов поиска
+    Текущие версии тегов одним запросом get_many
+    Отсутствующая версия создается из time.time_ns(): она всегда больше любой прежней,
+    поэтому вытеснение версии из кэша не может «воскресить» устаревшие записи
+    """
+    tags = list(dict.fromkeys([GLOBAL_TAG, *tags]))
+    keys = {_tag_key(tag): tag for tag in tags}
+    found = cache_manager.tags_cache.get_many(list(keys))
+
+    versions = {}
+    for key, tag in keys.items():
+        version = found.get(key)
+        if version is None:
+            cache_manager.tags_cache.add(key, time.time_ns(), None)
+            # Версию мог одновременно создать другой процесс
+            version = cache_manager.tags_cache.get(key)
+        versions[tag] = version
+    return versions
+
+
+def invalidate_tags(*tags: str):
+    """Инвалидировать все записи с указанными тегами: одно увеличение версии на тег"""
+    for tag in tags:
+        key = _tag_key(tag)
+        try:
+            cache_manager.tags_cache.incr(key)
+        except ValueError:
+            # Версии нет (или она вытеснена): новая версия из time_ns больше любой прежней
+            cache_manager.tags_cache.set(key, time.time_ns(), None)
+
+
+def set_tagged(cache_backend, key: str, value: Any, tags: Iterable[str],
+               timeout: Optional[int] = None, versions: Optional[Dict[str, int]] = None):
+    """
+    Сохранить значение вместе с версиями его тегов
     Args:
-        timeout: время жизни кэша в секундах (по умолчанию 10 минут)
+        versions: версии, прочитанные до вычисления значения (get_tag_versions);
+                  иначе читаются в момент записи
     """
-    def decorator(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            # Создаем ключ на основе имени функции и аргументов
-            key_data = f"search_{func.__name__}_{str(args)}_{str(sorted(kwargs.items()))}"
-            cache_key = cache_manager.hash_key(key_data)
-            
-            # Пытаемся получить из кэша
-            cached_result = cache_manager.search_cache.get(cache_key)
-            if cached_result is not None:
-                return cached_result
-            
-            # Выполняем функцию и кэшируем результат
-            result = func(*args, **kwargs)
-            cache_manager.search_cache.set(cache_key, result, timeout)
-            return result
-        return wrapper
-    return decorator
+    if versions is None:
+        versions = get_tag_versions(tags)
+    else:
+        versions = dict(versions)
+        missing = [tag for tag in [GLOBAL_TAG, *tags] if tag not in versions]
+        if missing:
+            versions.update(get_tag_versions(missing))
+    if timeout is None:
+        cache_backend.set(key, TaggedValue(value, versions))
+    else:
+        cache_backend.set(key, TaggedValue(value, versions), timeout)
+
+
+def get_tagged(cache_backend, key: str, default: Any = None) -> Any:
+    """Получить значение, если ни один из его тегов не был инвалидирован"""
+    entry = cache_backend.get(key)
+    if not isinstance(entry, TaggedValue):
+        return default
+    current = get_tag_versions(entry.versions)
+    if current != entry.versions:
+        return default
+    return entry.value
+
+
+# ====================== ЗАЩИТА ОТ ЛАВИНЫ ПЕРЕСЧЕТОВ ======================
+
+# Сколько ждать значения, которое вычисляет другой запрос (секунды)
+COMPUTE_WAIT_TIMEOUT = 3.0
+COMPUTE_WAIT_STEP = 0.05
+
+# Время жизни блокировки пересчета (секунды): защищает от зависшего вычислителя
+COMPUTE_LOCK_TIMEOUT = 30
+
+# Разброс времени жизни записей: записи, созданные одновременно, не истекают одновременно
+TTL_JITTER = 0.1
+
+# Коэффициент вероятностного раннего обновления (XFetch): больше - раньше
+EARLY_REFRESH_BETA = 1.0
+
+
+def _lock_key(key: str) -> str:
+    return f'{key}:lock'
+
 
+def _acquire_compute_lock(cache_backend, key: str) -> Optional[str]:
+    """Взять блокировку пересчета ключа; вернуть токен или None, если пересчет уже идет"""
+    token = f'{time.time_ns()}-{random.getrandbits(32)}'
+    if cache_backend.add(_lock_key(key), token, COMPUTE_LOCK_TIMEOUT):
+        return token
+    return None
 
-def cache_conversation_data(timeout: int = 180):
+
+def _release_compute_lock(cache_backend, key: str, token: str):
+    # Блокировка могла истечь и достаться другому запросу: удаляем только свою
+    if cache_backend.get(_lock_key(key)) == token:
+        cache_backend.delete(_lock_key(key))
+
+
+def _needs_refresh(entry: TaggedValue, now: float) -> bool:
+    """Истекла ли свежесть записи с учетом вероятностного раннего обновления"""
+    if entry.fresh_until is None:
+        return False
+    # XFetch: чем дольше вычисление, тем раньше один из запросов начнет пересчет
+    early = -entry.delta * EARLY_REFRESH_BETA * math.log(1.0 - random.random())
+    return now + early >= entry.fresh_until
+
+
+def get_or_compute(cache_backend, key: str, compute: Callable[[], Any],
+                   timeout: Union[int, Callable[[Any], int]], tags: Iterable[str] = (),
+                   value_tags: Optional[Callable[[Any], Iterable[str]]] = None,
+                   stale_timeout: Optional[int] = None, codec: Optional[CacheCodec] = None) -> Any:
+    """
+    Получить значение из кэша или вычислить его с защитой от лавины пересчетов
+    - только один запрос (по блокировке в том же кэше) пересчитывает значение;
+    - после истечения свежести остальные запросы получают прежнее значение, пока
+      идет пересчет; после инвалидации тегов - ждут новое значение;
+    - свежесть обновляется заранее с вероятностью, растущей к концу срока (XFetch);
+    - срок жизни случайно уменьшается на TTL_JITTER, чтобы записи не истекали разом
+    Args:
+        timeout: срок свежести в секундах или функция от значения
+        tags: теги записи (версии читаются до вычисления)
+        value_tags: функция, возвращающая дополнительные теги по вычисленному значению
+        stale_timeout: сколько устаревшее значение может отдаваться (по умолчанию = timeout)
+        codec: компактная сериализация значения (cache_serialization.CacheCodec);
+               версию схемы codec.version нужно включить в ключ
+    """
+    tags = list(tags)
+    load = codec.loads if codec is not None else (lambda stored: stored)
+    deadline = time.monotonic() + COMPUTE_WAIT_TIMEOUT
+    while True:
+        entry = cache_backend.get(key)
+        now = time.time()
+        stale_value = _MISSING
+        if isinstance(entry, TaggedValue) and get_tag_versions(entry.versions) == entry.versions:
+            if not _needs_refresh(entry, now):
+                return load(entry.value)
+            stale_value = entry.value
+
+        token = _acquire_compute_lock(cache_backend, key)
+        if token is not None:
+            break
+        if stale_value is not _MISSING:
+            # Значение уже пересчитывается другим запросом
+            metrics.incr('cache.stale_served', cache=getattr(cache_backend, 'alias', ''))
+            return load(stale_value)
+        if time.monotonic() >= deadline:
+            # Вычислитель завис или слишком медленный: считаем сами
+            token = None
+            break
+        metrics.incr('cache.compute_waits', cache=getattr(cache_backend, 'alias', ''))
+        time.sleep(COMPUTE_WAIT_STEP)
+
+    try:
+        versions = get_tag_versions(tags)
+        started = time.perf_counter()
+        value = compute()
+        delta = time.perf_counter() - started
+        metrics.incr('cache.recomputes', cache=getattr(cache_backend, 'alias', ''))
+        if value_tags is not None:
+            extra_tags = [tag for tag in value_tags(value) if tag not in versions]
+            if extra_tags:
+                versions.update(get_tag_versions(extra_tags))
+
+        fresh_timeout = timeout(value) if callable(timeout) else timeout
+        fresh_timeout *= 1 - random.uniform(0, TTL_JITTER)
+        stale = stale_timeout if stale_timeout is not None else fresh_timeout
+        stored = codec.dumps(value) if codec is not None else value
+        entry = TaggedValue(stored, versions, time.time() + fresh_timeout, delta)
+        cache_backend.set(key, entry, math.ceil(fresh_timeout + stale))
+        return value
+    finally:
+        if token is not None:
+            _release_compute_lock(cache_backend, key, token)
+
+
+# ====================== ДЕКОРАТОР КЭШИРОВАНИЯ ======================
+
+def _extract(arguments: Dict[str, Any], extractor: Union[str, Callable[[Dict[str, Any]], Any]]) -> Any:
+    """Значение части ключа: путь в аргументах ('user.id') или функция от словаря аргументов"""
+    if callable(extractor):
+        return extractor(arguments)
+    name, *attributes = extractor.split('.')
+    value = arguments[name]
+    for attribute in attributes:
+        value = getattr(value, attribute)
+    return value
+
+
+def cached(cache_alias: str, key_type: str, identifier: str, *, timeout: int,
+           key: Optional[Dict[str, Union[str, Callable[[Dict[str, Any]], Any]]]] = None,
+           tags: Union[Iterable[str], Callable[[Dict[str, Any]], Iterable[str]]] = (),
+           value_tags: Optional[Callable[[Any], Iterable[str]]] = None,
+           negative_timeout: Optional[int] = None, stale_timeout: Optional[int] = None,
+           codec: Optional[str] = None):
     """
-    Декоратор для кэширования данных сообщений/переписок
+    Декоратор кэширования результата функции через get_or_compute
+    Ключ строится только из объявленных частей, поэтому не зависит от repr аргументов
     Args:
-        timeout: время жизни кэша в секундах (по умолчанию 3 минуты)
+        cache_alias: кэш CacheManager ('profiles', 'search', 'messages', ...)
+        key_type, identifier: начало ключа (CacheManager.get_cache_key)
+        timeout: срок свежести в секундах
+        key: {часть ключа: путь в аргументах ('user.id') или функция от словаря аргументов}
+        tags: теги записи - шаблоны с частями ключа ('conversations:{user_id}')
+              или функция от словаря аргументов
+        value_tags: функция дополнительных тегов по вычисленному значению
+        negative_timeout: срок свежести результата None (по умолчанию timeout)
+        stale_timeout: сколько устаревшее значение отдается, пока идет пересчет
+        codec: компактное представление значения (get_codec)
+    Декорированная функция принимает use_cache=False для вызова в обход кэша;
+    wrapper.cache_key(**части ключа) возвращает ключ записи
     """
+    key = key or {}
+
     def decorator(func):
+        signature = inspect.signature(func)
+        metric_name = func.__name__
+
+        def cache_key(**parts) -> str:
+            if codec is not None:
+                parts['s'] = get_codec(codec).version
+            return cache_manager.get_cache_key(key_type, identifier, **parts)
+
+        def entry_timeout(value) -> int:
+            if value is None and negative_timeout is not None:
+                return negative_timeout
+            return timeout
+
         @wraps(func)
-        def wrapper(*args, **kwargs):
-            key_data = f"msg_{func.__name__}_{str(args)}_{str(sorted(kwargs.items()))}"
-            cache_key = cache_manager.hash_key(key_data)
-            
-            cached_result = cache_manager.messages_cache.get(cache_key)
-            if cached_result is not None:
-                return cached_result
-            
-            result = func(*args, **kwargs)
-            cache_manager.messages_cache.set(cache_key, result, timeout)
-            return result
+        def wrapper(*args, use_cache: bool = True, **kwargs):
+            if not use_cache:
+                metrics.incr('cache.calls', func=metric_name, result='bypass')
+                return func(*args, **kwargs)
+
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = bound.arguments
+            parts = {name: _extract(arguments, extractor) for name, extractor in key.items()}
+            entry_tags = tags(arguments) if callable(tags) else [tag.format(**parts) for tag in tags]
+
+            computed = []
+
+            def compute():
+                computed.append(True)
+                return func(*args, **kwargs)
+
+            value = get_or_compute(
+                getattr(cache_manager, f'{cache_alias}_cache'), cache_key(**parts), compute,
+                timeout=entry_timeout, tags=entry_tags, value_tags=value_tags,
+                stale_timeout=stale_timeout, codec=get_codec(codec) if codec is not None else None,
+            )
+            metrics.incr('cache.calls', func=metric_name, result='miss' if computed else 'hit')
+            return value
+
+        wrapper.cache_key = cache_key
         return wrapper
     return decorator
 
 
 # ====================== СПЕЦИФИЧНЫЕ ФУНКЦИИ КЭШИРОВАНИЯ ======================
 
+# Тег списков новых профилей и статистики профилей (меняются при создании профиля)
+RECENT_PROFILES_TAG = 'profiles:recent'
+
+# Тег всех записей кэша профилей
+PROFILES_TAG = 'profiles'
+
+# Теги результатов поиска: все результаты / результаты без фильтра по городу
+SEARCH_TAG = 'search'
+SEARCH_ANY_CITY_TAG = 'search:any-city'
+
+
+# Поля пользователя в кэшированных профилях (без хэша пароля)
+USER_CACHE_FIELDS = (
+    'id', 'username', 'first_name', 'last_name', 'email',
+    'is_active', 'is_staff', 'is_superuser', 'last_login', 'date_joined',
+)
+
+# Поля профилей в списке новых профилей (templates/home.html)
+RECENT_PROFILE_FIELDS = (*PROFILE_LIST_FIELDS, 'created_at')
+
+
+@lru_cache(maxsize=None)
+def get_codec(name: str) -> CacheCodec:
+    """
+    Компактное представление значений кэша по имени:
+    'profile' - профиль со всеми полями и пользователем (get_cached_user_profile);
+    'auth_user' - пользователь запроса без хэша пароля (get_cached_auth_user);
+    'recent_profiles' - список новых профилей; 'conversation_list' - строки списка переписок
+    """
+    from .models import Conversation, Message, Profile
+
+    projections = {
+        'profile': lambda: ModelProjection(
+            Profile, related={'user': ModelProjection(User, USER_CACHE_FIELDS)},
+        ),
+        'auth_user': lambda: ModelProjection(User, USER_CACHE_FIELDS),
+        'recent_profiles': lambda: ListOf(ModelProjection(
+            Profile, RECENT_PROFILE_FIELDS, related={'user': ModelProjection(User, ('id', 'username'))},
+        )),
+        'conversation_list': lambda: ListOf(RowProjection(
+            conversation=ModelProjection(Conversation, ('id', 'participant1_id', 'participant2_id', 'last_message_at')),
+            other_user=ModelProjection(User, ('id', 'username')),
+            other_profile=ModelProjection(Profile, PROFILE_LIST_FIELDS),
+            last_message=ModelProjection(
+                Message, ('id', 'conversation_id', 'sender_id', 'receiver_id', 'content', 'sent_at', 'is_read'),
+            ),
+            unread_count=None,
+        )),
+    }
+    return CacheCodec(projections[name]())
+
+
+@cached('profiles', 'stats', 'profiles', timeout=600, tags=[RECENT_PROFILES_TAG, PROFILES_TAG])  # 10 минут
 def get_cached_profile_stats() -> Dict[str, int]:
     """Получить кэшированную статистику профилей"""
-    cache_key = cache_manager.get_cache_key('stats', 'profiles')
-    cached_stats = cache_manager.profiles_cache.get(cache_key)
-    
-    if cached_stats is None:
-        # Импортируем здесь, чтобы избежать циклических импортов
-        from .models import Profile
-        
-        stats = Profile.objects.stats()
-        cache_manager.profiles_cache.set(cache_key, stats, 600)  # 10 минут
-        return stats
-    
-    return cached_stats
+    from .models import Profile
+
+    return Profile.objects.stats()
+
+
+def _profile_tags(user_id: int) -> List[str]:
+    return [profile_tag(user_id), PROFILES_TAG]
 
 
-def get_cached_user_profile(user: User, use_cache: bool = True) -> Optional['Profile']:
+# Сроки свежести профиля: 15 минут; отсутствие профиля (None) кэшируем на короткое время
+PROFILE_TIMEOUT = 900
+NO_PROFILE_TIMEOUT = 60
+
+
+@cached('profiles', 'profile', 'user', key={'user_id': 'user.id'},
+        tags=lambda arguments: _profile_tags(arguments['user'].id),
+        timeout=PROFILE_TIMEOUT, negative_timeout=NO_PROFILE_TIMEOUT, codec='profile')
+def get_cached_user_profile(user: User) -> Optional['Profile']:
     """
     Получить кэшированный профиль пользователя
     Args:
         user: экземпляр пользователя
-        use_cache: использовать ли кэш
+        use_cache: использовать ли кэш (False - свежие данные из базы)
     """
-    if not use_cache:
-        from .models import Profile
-        try:
-            return Profile.objects.select_related('user').get(user=user)
-        except Profile.DoesNotExist:
-            return None
-    
-    cache_key = cache_manager.get_cache_key('profile', 'user', user_id=user.id)
-    cached_profile = cache_manager.profiles_cache.get(cache_key)
-    
-    if cached_profile is None:
-        from .models import Profile
-        try:
-            profile = Profile.objects.select_related('user').get(user=user)
-            cache_manager.profiles_cache.set(cache_key, profile, 900)  # 15 минут
-            return profile
-        except Profile.DoesNotExist:
-            # Кэшируем информацию об отсутствии профиля на короткое время
-            cache_manager.profiles_cache.set(cache_key, 'NO_PROFILE', 60)
-            return None
-    
-    return cached_profile if cached_profile != 'NO_PROFILE' else None
+    from .models import Profile
+
+    try:
+        return Profile.objects.with_user().get(user=user)
+    except Profile.DoesNotExist:
+        return None
+
+
+def auth_user_tag(user_id: int) -> str:
+    """Тег пользователя запроса (меняется при сохранении пользователя и смене его групп и прав)"""
+    return f'auth-user:{user_id}'
+
+
+# Пользователь запроса: 5 минут (хэш сессии проверяется заново после истечения)
+AUTH_USER_TIMEOUT = 300
+NO_AUTH_USER_TIMEOUT = 60
+
+
+@cached('profiles', 'auth', 'user',
+        key={'user_id': 'user_id', 'hash': lambda arguments: cache_manager.hash_key(arguments['session_hash'])},
+        tags=lambda arguments: [auth_user_tag(arguments['user_id'])],
+        timeout=AUTH_USER_TIMEOUT, negative_timeout=NO_AUTH_USER_TIMEOUT, codec='auth_user')
+def get_cached_auth_user(user_id: int, session_hash: str, request) -> Optional[User]:
+    """
+    Пользователь сессии запроса, проверенный django.contrib.auth.get_user
+    Запись привязана к хэшу сессии (производному от хэша пароля) и сбрасывается
+    при сохранении пользователя, поэтому смена пароля, блокировка и изменение прав
+    действуют со следующего запроса
+    Returns:
+        пользователь без хэша пароля или None, если сессия недействительна
+    """
+    from django.contrib.auth import get_user
+
+    user = get_user(request)
+    return user if user.is_authenticated else None
+
+
+def invalidate_auth_user_cache(user_id: int):
+    """Инвалидировать кэшированного пользователя запросов"""
+    invalidate_tags(auth_user_tag(user_id))
+
+
+def get_cached_user_profiles(users: Iterable[User]) -> Dict[int, Optional['Profile']]:
+    """
+    Получить профили нескольких пользователей пакетно
+    Записи те же, что у get_cached_user_profile: одно чтение get_many, один запрос
+    к базе для всех промахов и одна запись set_many на каждый срок жизни
+    (отсутствие профиля тоже кэшируется)
+    Returns:
+        {user_id: профиль или None}
+    """
+    from .models import Profile
+
+    user_ids = list(dict.fromkeys(user.id for user in users))
+    if not user_ids:
+        return {}
+    codec = get_codec('profile')
+    profiles_cache = cache_manager.profiles_cache
+    keys = {get_cached_user_profile.cache_key(user_id=user_id): user_id for user_id in user_ids}
+    found = profiles_cache.get_many(list(keys))
+
+    # Версии тегов всех записей и промахов читаются одним запросом
+    versions = get_tag_versions(tag for user_id in user_ids for tag in _profile_tags(user_id))
+    now = time.time()
+    result = {}
+    for key, entry in found.items():
+        if (isinstance(entry, TaggedValue)
+                and all(versions.get(tag) == version for tag, version in entry.versions.items())
+                and not _needs_refresh(entry, now)):
+            result[keys[key]] = codec.loads(entry.value)
+    missing = [user_id for user_id in user_ids if user_id not in result]
+    if not missing:
+        return result
+
+    started = time.perf_counter()
+    loaded = {profile.user_id: profile
+              for profile in Profile.objects.with_user().filter(user__in=missing)}
+    delta = time.perf_counter() - started
+    metrics.incr('cache.recomputes', len(missing), cache='profiles')
+
+    by_timeout = {}
+    for user_id in missing:
+        profile = loaded.get(user_id)
+        result[user_id] = profile
+        timeout = PROFILE_TIMEOUT if profile is not None else NO_PROFILE_TIMEOUT
+        fresh_timeout = timeout * (1 - random.uniform(0, TTL_JITTER))
+        entry_versions = {tag: versions[tag] for tag in [GLOBAL_TAG, *_profile_tags(user_id)]}
+        entry = TaggedValue(codec.dumps(profile), entry_versions, now + fresh_timeout, delta)
+        by_timeout.setdefault(timeout, {})[get_cached_user_profile.cache_key(user_id=user_id)] = entry
+    for timeout, data in by_timeout.items():
+        # Жесткий срок = свежесть + столько же для отдачи устаревшего значения
+        profiles_cache.set_many(data, timeout * 2)
+    return result
 
 
 def invalidate_user_profile_cache(user: User):
-    """Инвалидировать кэш профиля пользователя"""
-    cache_key = cache_manager.get_cache_key('profile', 'user', user_id=user.id)
-    cache_manager.profiles_cache.delete(cache_key)
+    """Инвалидировать кэш профиля пользователя и все записи, где показан его профиль"""
+    invalidate_tags(profile_tag(user.id))
+
+
+def invalidate_recent_profiles_cache():
+    """Инвалидировать кэш списков новых профилей"""
+    invalidate_tags(RECENT_PROFILES_TAG)
 
 
+def invalidate_profile_photos_cache(user_id: int):
+    """Инвалидировать кэши, зависящие от фотографий профиля (списки помечены тегом профиля)"""
+    invalidate_tags(profile_tag(user_id))
+
+
+@cached('profiles', 'profiles', 'recent', key={'limit': 'limit'}, timeout=300,  # 5 минут
+        tags=[RECENT_PROFILES_TAG, PROFILES_TAG],
+        value_tags=lambda profiles: [profile_tag(p.user_id) for p in profiles], codec='recent_profiles')
 def get_cached_recent_profiles(limit: int = 10) -> List['Profile']:
     """Получить кэшированный список новых профилей"""
-    cache_key = cache_manager.get_cache_key('profiles', 'recent', limit=limit)
-    cached_profiles = cache_manager.profiles_cache.get(cache_key)
-    
-    if cached_profiles is None:
+    from .models import Profile
+
+    return list(Profile.objects.as_list_items('created_at').order_by('-created_at')[:limit])
+
+
+def _search_params_hash(arguments: Dict[str, Any]) -> str:
+    return cache_manager.hash_key(json.dumps(arguments['search_params'], sort_keys=True))
+
+
+def _search_tags(search_params: Dict) -> List[str]:
+    """Теги результатов поиска: город из фильтра или «любой город»"""
+    city = search_params.get('city')
+    return [SEARCH_TAG, city_tag(city) if city else SEARCH_ANY_CITY_TAG]
+
+
+# Сколько идентификаторов результатов поиска кэшируется (страниц по 12 профилей ~ 83)
+SEARCH_RESULT_IDS_LIMIT = 1000
+
+
+@cached('search', 'search', 'ids', key={'q': _search_params_hash, 'limit': 'limit'}, timeout=600,
+        tags=lambda arguments: _search_tags(arguments['search_params']))
+def get_cached_search_ids(search_params: Dict, limit: int = SEARCH_RESULT_IDS_LIMIT) -> Dict:
+    """
+    Получить идентификаторы профилей, подходящих под фильтры поиска
+    Кэшируется только список id (общий для всех пользователей); страница профилей
+    загружается по нему отдельным запросом
+    Returns:
+        {'ids': [id профилей не больше limit], 'total_count': всего подходящих профилей}
+    """
+    from .models import Profile
+
+    queryset = Profile.objects.search_filtered(search_params)
+    ids = list(queryset.values_list('id', flat=True)[:limit])
+    total_count = len(ids) if len(ids) < limit else queryset.count()
+    return {'ids': ids, 'total_count': total_count}
+
+
+class SearchResultIds:
+    """
+    id результатов поиска для Paginator без профиля exclude_id
+    Первые SEARCH_RESULT_IDS_LIMIT id берутся из кэша (get_cached_search_ids); страницы
+    за этим окном читаются из базы тем же запросом со сдвигом
+    """
+
+    def __init__(self, search_params: Dict, exclude_id: Optional[int] = None):
         from .models import Profile
-        
-        profiles = list(Profile.objects.with_primary_photo()
-                       .select_related('user')
-                       .order_by('-created_at')[:limit])
-        
-        cache_manager.profiles_cache.set(cache_key, profiles, 300)  # 5 минут
-        return profiles
-    
-    return cached_profiles
 
+        results = get_cached_search_ids(search_params, SEARCH_RESULT_IDS_LIMIT)
+        self.queryset = Profile.objects.search_filtered(search_params).exclude(id=exclude_id)
+        self.ids = [profile_id for profile_id in results['ids'] if profile_id != exclude_id]
+        self.complete = len(results['ids']) >= results['total_count']
+        self.total_count = results['total_count'] - (len(results['ids']) - len(self.ids))
+        if not self.complete and len(self.ids) == len(results['ids']) and exclude_id is not None:
+            # Исключенный профиль может оказаться за окном кэша
+            self.total_count -= Profile.objects.search_filtered(search_params).filter(id=exclude_id).exists()
 
-def cache_search_results_data(search_params: Dict, results: List, total_count: int, timeout: int = 600):
-    """Кэшировать результаты поиска"""
-    # Создаем стабильный ключ из параметров поиска
-    search_key = json.dumps(search_params, sort_keys=True)
-    cache_key = cache_manager.hash_key(f"search_results_{search_key}")
-    
-    cache_data = {
-        'results': results,
-        'total_count': total_count,
-        'params': search_params
-    }
-    
-    cache_manager.search_cache.set(cache_key, cache_data, timeout)
+    def __len__(self) -> int:
+        return self.total_count
 
+    def __getitem__(self, index: slice) -> List[int]:
+        start, stop, _ = index.indices(self.total_count)
+        if self.complete or stop <= len(self.ids):
+            return self.ids[start:stop]
+        return list(self.queryset.values_list('id', flat=True)[start:stop])
 
-def get_cached_search_results(search_params: Dict) -> Optional[Dict]:
-    """Получить кэшированные результаты поиска"""
-    search_key = json.dumps(search_params, sort_keys=True)
-    cache_key = cache_manager.hash_key(f"search_results_{search_key}")
-    
-    return cache_manager.search_cache.get(cache_key)
+
+def invalidate_search_cache(cities: Optional[Iterable[int]] = None):
+    """
+    Инвалидировать кэш поиска
+    Args:
+        cities: города измененных профилей; без них инвалидируются все результаты поиска
+    """
+    if cities is None:
+        invalidate_tags(SEARCH_TAG)
+        return
+    invalidate_tags(SEARCH_ANY_CITY_TAG, *(city_tag(city) for city in set(cities) if city))
 
 
-def invalidate_search_cache():
-    """Инвалидировать весь кэш поиска"""
-    cache_manager.search_cache.clear()
+def _conversations_tag(user_id: int) -> str:
+    return f'conversations:{user_id}'
 
 
-def get_cached_conversation_list(user: User) -> Optional[List]:
-    """Получить кэшированный список переписок"""
-    cache_key = cache_manager.get_cache_key('conversations', 'list', user_id=user.id)
-    return cache_manager.messages_cache.get(cache_key)
+def _conversation_list_tags(conversations: List) -> List[str]:
+    """Теги профилей собеседников: переименование собеседника обновляет список"""
+    return [profile_tag(item['other_user'].id) for item in conversations]
 
 
-def cache_conversation_list(user: User, conversations: List, timeout: int = 180):
-    """Кэшировать список переписок"""
-    cache_key = cache_manager.get_cache_key('conversations', 'list', user_id=user.id)
-    cache_manager.messages_cache.set(cache_key, conversations, timeout)
+@cached('messages', 'conversations', 'list', key={'user_id': 'user.id'}, timeout=180,  # 3 минуты
+        tags=lambda arguments: [_conversations_tag(arguments['user'].id)], value_tags=_conversation_list_tags, codec='conversation_list')
+def get_cached_conversation_list(user: User) -> List[Dict]:
+    """Получить кэшированный список переписок пользователя (строки для conversations_list.html)"""
+    from .models import Conversation
+
+    # Все переписки пользователя вместе с участниками
+    conversations = list(Conversation.objects.with_participants()
+                         .filter(Q(participant1=user) | Q(participant2=user)).order_by('-last_message_at'))
+
+    # Профили всех собеседников одним обращением к кэшу
+    other_users = [conv.get_other_participant(user) for conv in conversations]
+    profiles = get_cached_user_profiles(other_users)
+
+    conversation_data = []
+    for conv, other_user in zip(conversations, other_users):
+        other_profile = profiles.get(other_user.id)
+        if not other_profile:
+            continue
+        conversation_data.append({
+            'conversation': conv,
+            'other_user': other_user,
+            'other_profile': other_profile,
+            'last_message': conv.messages.last(),
+            'unread_count': conv.messages.filter(receiver=user, is_read=False).count(),
+        })
+    return conversation_data
 
 
 def invalidate_conversation_cache(user: User):
     """Инвалидировать кэш переписок пользователя"""
-    cache_key = cache_manager.get_cache_key('conversations', 'list', user_id=user.id)
-    cache_manager.messages_cache.delete(cache_key)
+    invalidate_tags(_conversations_tag(user.id))
 
 
-def get_cached_unread_count(user: User) -> Optional[int]:
-    """Получить кэшированное количество непрочитанных сообщений"""
-    cache_key = cache_manager.get_cache_key('unread', 'count', user_id=user.id)
-    return cache_manager.messages_cache.get(cache_key)
+def _unread_tag(user_id: int) -> str:
+    return f'unread:{user_id}'
 
 
-def cache_unread_count(user: User, count: int, timeout: int = 60):
-    """Кэшировать количество непрочитанных сообщений"""
-    cache_key = cache_manager.get_cache_key('unread', 'count', user_id=user.id)
-    cache_manager.messages_cache.set(cache_key, count, timeout)
+@cached('messages', 'unread', 'count', key={'user_id': 'user.id'}, timeout=60,
+        tags=lambda arguments: [_unread_tag(arguments['user'].id)])
+def get_cached_unread_count(user: User) -> int:
+    """Получить кэшированное количество непрочитанных сообщений"""
+    from .models import Message
+
+    return Message.objects.unread_count(user)
 
 
 def invalidate_unread_count_cache(user: User):
     """Инвалидировать кэш непрочитанных сообщений"""
-    cache_key = cache_manager.get_cache_key('unread', 'count', user_id=user.id)
-    cache_manager.messages_cache.delete(cache_key)
+    invalidate_tags(_unread_tag(user.id))
 
 
 # ====================== УТИЛИТЫ ДЛЯ МАССОВОЙ ИНВАЛИДАЦИИ ======================
 
 def invalidate_all_profile_caches():
-    """Инвалидировать все кэши профилей"""
-    cache_manager.profiles_cache.clear()
+    """Инвалидировать все кэши профилей (без очистки кэша целиком)"""
+    invalidate_tags(PROFILES_TAG)
 
 
 def invalidate_all_caches():
-    """Инвалидировать все кэши"""
-    cache_manager.default_cache.clear()
-    cache_manager.profiles_cache.clear()
-    cache_manager.search_cache.clear()
-    cache_manager.messages_cache.clear()
+    """
+    Инвалидировать все записи с тегами
+    Кэши не очищаются: сессии и другие записи без тегов в общем кэше сохраняются
+    """
+    invalidate_tags(GLOBAL_TAG)
 
 
 def get_cache_stats() -> Dict[str, Any]:
-    """Получить статистику использования кэша (если поддерживается)"""
+    """
+    Статистика использования кэшей, собранная со всех рабочих процессов
+    Returns:
+        {алиас: {'backend', 'location', 'timeout', 'max_entries', 'max_bytes', 'hits', 'misses', 'hit_rate',
+                 'sets', 'deletes', 'evictions', 'bytes_written', 'latency', 'families', 'entries'}}
+    """
+    collected = collect_metrics()
+    caches_config = getattr(settings, 'CACHES', {})
     stats = {}
-    
-    # Для LocMemCache можем попытаться получить базовую информацию
-    try:
-        stats['default'] = {
-            'backend': 'LocMemCache',
-            'location': 'default-cache'
-        }
-        stats['profiles'] = {
-            'backend': 'LocMemCache', 
-            'location': 'profiles-cache'
-        }
-        stats['search'] = {
-            'backend': 'LocMemCache',
-            'location': 'search-cache'
+
+    for alias in MANAGED_CACHES:
+        config = caches_config.get(alias, {})
+        backend = config.get('BACKEND', 'Unknown').rsplit('.', 1)[-1]
+        if alias in getattr(settings, 'CACHE_TIERED_ALIASES', ()):
+            tiered_options = getattr(settings, 'CACHE_TIERED_OPTIONS', {})
+            backend = f"TieredCache (локальный LRU + {tiered_options.get('SHARED_ALIAS', 'shared')})"
+            config = dict(config, OPTIONS={'MAX_ENTRIES': tiered_options.get('LOCAL_MAX_ENTRIES', 256)})
+        stats[alias] = {
+            'backend': backend,
+            'location': config.get('LOCATION', ''),
+            'timeout': config.get('TIMEOUT'),
+            'max_entries': config.get('OPTIONS', {}).get('MAX_ENTRIES'),
+            'max_bytes': config.get('OPTIONS', {}).get('MAX_BYTES'),
+            'families': {},
+            'entries': [],
+            'latency': {},
         }
-        stats['messages'] = {
-            'backend': 'LocMemCache',
-            'location': 'messages-cache'
+
+    def family_stats(alias, family):
+        return stats[alias]['families'].setdefault(family, {
+            'hits': 0, 'misses': 0, 'sets': 0, 'deletes': 0, 'evictions': 0, 'bytes_written': 0,
+        })
+
+    for name, value in collected['counters'].items():
+        base, labels = parse_metric_name(name)
+        alias = labels.get('cache')
+        if not base.startswith('cache.') or alias not in stats:
+            continue
+        counter = base.split('.', 1)[1]
+        if counter == 'tier_hits':
+            stats[alias].setdefault('tiers', {})[labels.get('tier')] = value
+        elif 'family' in labels:
+            family_stats(alias, labels['family'])[counter] = value
+
+    for name, histogram in collected['histograms'].items():
+        base, labels = parse_metric_name(name)
+        alias = labels.get('cache')
+        if base != 'cache.latency_ms' or alias not in stats:
+            continue
+        key = f"{labels.get('family', 'other')}:{labels.get('op', '')}"
+        stats[alias]['latency'][key] = {
+            'count': histogram['count'],
+            'avg_ms': histogram['sum'] / histogram['count'] if histogram['count'] else None,
+            'p50_ms': histogram_percentile(histogram, 50),
+            'p99_ms': histogram_percentile(histogram, 99),
         }
-    except Exception as e:
-        stats['error'] = str(e)
-    
-    return stats 
\ No newline at end of file
+
+    # Количество записей видно только изнутри процесса, поэтому показывается по процессам
+    for snapshot in collected['processes']:
+        by_alias = {}
+        for name, value in snapshot.get('gauges', {}).items():
+            base, labels = parse_metric_name(name)
+            if base in ('cache.entries', 'cache.bytes') and labels.get('cache') in stats:
+                by_alias.setdefault(labels['cache'], {'pid': snapshot.get('pid')})[base.split('.', 1)[1]] = value
+        for alias, process in by_alias.items():
+            stats[alias]['entries'].append(process)
+
+    for alias_stats in stats.values():
+        for counter in ('hits', 'misses', 'sets', 'deletes', 'evictions', 'bytes_written'):
+            alias_stats[counter] = sum(f[counter] for f in alias_stats['families'].values())
+        for family in alias_stats['families'].values():
+            lookups = family['hits'] + family['misses']
+            family['hit_rate'] = family['hits'] / lookups if lookups else None
+        lookups = alias_stats['hits'] + alias_stats['misses']
+        alias_stats['hit_rate'] = alias_stats['hits'] / lookups if lookups else None
+
+    return stats
+
+
+def get_invalidation_bus_stats() -> Dict[str, Any]:
+    """Статистика шины инвалидаций по всем рабочим процессам"""
+    collected = collect_metrics()
+    stats = {'published': 0, 'applied': 0, 'publish': None, 'propagation': None}
+    publish = propagation = None
+
+    for name, value in collected['counters'].items():
+        base, _ = parse_metric_name(name)
+        if base == 'invalidation.published':
+            stats['published'] += value
+        elif base == 'invalidation.applied':
+            stats['applied'] += value
+
+    for name, histogram in collected['histograms'].items():
+        base, _ = parse_metric_name(name)
+        if base == 'invalidation.publish_ms':
+            publish = _merge_histograms(publish, histogram)
+        elif base == 'invalidation.propagation_ms':
+            propagation = _merge_histograms(propagation, histogram)
+
+    for key, histogram in (('publish', publish), ('propagation', propagation)):
+        if histogram and histogram['count']:
+            stats[key] = {
+                'count': histogram['count'],
+                'avg_ms': histogram['sum'] / histogram['count'],
+                'p50_ms': histogram_percentile(histogram, 50),
+                'p99_ms': histogram_percentile(histogram, 99),
+            }
+    return stats
+
+
+def _merge_histograms(merged: Optional[Dict], histogram: Dict) -> Dict:
+    """Сложить гистограммы с одинаковыми границами корзин"""
+    if merged is None:
+        return dict(histogram, counts=list(histogram['counts']))
+    merged['counts'] = [a + b for a, b in zip(merged['counts'], histogram['counts'])]
+    merged['sum'] += histogram['sum']
+    merged['count'] += histogram['count']
+    return merged
@@ -0,0 +1,230 @@
+"""
+Прогрев кэшей после развертывания
+Заранее вычисляет то, что первые запросы к главной странице, поиску и перепискам
+иначе вычисляли бы одновременно: статистику и новые профили, списки id для частых
+поисковых запросов, профили и списки переписок активных пользователей. Задачи
+выполняются пакетами в нескольких потоках и прекращаются по истечении бюджета времени
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Callable, Dict, List, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import request_started
+from django.db import connections
+from django.db.models import Count
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# Значения по умолчанию (переопределяются аргументами warm_caches и настройками CACHE_PREWARM_*)
+DEFAULT_TIME_BUDGET = 20.0
+DEFAULT_WORKERS = 4
+DEFAULT_TOP_SEARCHES = 20
+DEFAULT_ACTIVE_USERS = 200
+DEFAULT_LOCK_TIMEOUT = 600
+
+# Ключ блокировки прогрева при старте в общем кэше (CACHE_TIERED_OPTIONS['SHARED_ALIAS'])
+PREWARM_LOCK_KEY = 'cache-prewarm'
+
+# Сколько пользователей обрабатывает одна задача и за какой период пользователь считается активным
+ACTIVE_USERS_BATCH = 50
+ACTIVE_DAYS = 7
+
+
+@dataclass
+class WarmupReport:
+    """Итоги прогрева: запланированные и выполненные задачи по видам"""
+    planned: Dict[str, int] = field(default_factory=dict)
+    warmed: Dict[str, int] = field(default_factory=dict)
+    failed: int = 0
+    duration: float = 0.0
+    budget_exhausted: bool = False
+
+    @property
+    def coverage(self) -> float:
+        planned = sum(self.planned.values())
+        return sum(self.warmed.values()) / planned if planned else 1.0
+
+    def summary(self) -> str:
+        kinds = ', '.join(
+            f'{kind} {self.warmed.get(kind, 0)}/{planned}' for kind, planned in self.planned.items()
+        )
+        status = ' (бюджет времени исчерпан)' if self.budget_exhausted else ''
+        return (f'прогрев кэшей: покрытие {self.coverage * 100:.0f}% за {self.duration:.1f} с{status}; '
+                f'{kinds}; ошибок {self.failed}')
+
+
+def common_searches(limit: int) -> List[Dict]:
+    """
+    Наборы фильтров самых частых поисковых запросов: без фильтров, по полу,
+    по городам с наибольшим числом профилей (без пола и с полом)
+    Параметры в том же виде, что дает ProfileSearchForm.get_search_params
+    """
+    from .models import Profile
+
+    genders = [code for code, _ in Profile.GENDER_CHOICES]
+    searches = [{}] + [{'gender': gender} for gender in genders]
+    top_cities = (Profile.objects.filter(is_active=True).values('city')
+                  .annotate(profiles=Count('id')).order_by('-profiles')[:limit])
+    for row in top_cities:
+        searches.append({'city': row['city']})
+        searches.extend({'city': row['city'], 'gender': gender} for gender in genders)
+    return searches[:limit]
+
+
+def active_users(limit: int) -> List:
+    """Недавно заходившие пользователи с профилем, от последних к более ранним"""
+    from django.contrib.auth.models import User
+
+    since = timezone.now() - timedelta(days=ACTIVE_DAYS)
+    return list(User.objects.filter(profile__is_active=True, profile__last_online__gte=since)
+                .order_by('-profile__last_online')[:limit])
+
+
+def plan_warmup(top_searches: int, users_limit: int) -> List[Tuple[str, int, Callable[[], None]]]:
+    """Задачи прогрева: (вид, число прогреваемых записей, функция)"""
+    from .cache_utils import (
+        get_cached_conversation_list, get_cached_profile_stats, get_cached_recent_profiles,
+        get_cached_search_ids, get_cached_user_profiles,
+    )
+    from .views_package.profile_views import RECENT_PROFILES_LIMIT
+
+    tasks = [
+        ('stats', 1, get_cached_profile_stats),
+        ('recent', 1, lambda: get_cached_recent_profiles(limit=RECENT_PROFILES_LIMIT)),
+    ]
+    for params in common_searches(top_searches):
+        tasks.append(('search', 1, lambda params=params: get_cached_search_ids(params)))
+
+    users = active_users(users_limit)
+    for start in range(0, len(users), ACTIVE_USERS_BATCH):
+        batch = users[start:start + ACTIVE_USERS_BATCH]
+        tasks.append(('profiles', len(batch), lambda batch=batch: get_cached_user_profiles(batch)))
+    for user in users:
+        tasks.append(('conversations', 1, lambda user=user: get_cached_conversation_list(user)))
+    return tasks
+
+
+def _run_task(func):
+    try:
+        func()
+    finally:
+        # Соединения с базой принадлежат потоку пула
+        connections.close_all()
+
+
+def warm_caches(time_budget: float = DEFAULT_TIME_BUDGET, workers: int = DEFAULT_WORKERS,
+                top_searches: int = DEFAULT_TOP_SEARCHES,
+                users_limit: int = DEFAULT_ACTIVE_USERS) -> WarmupReport:
+    """
+    Прогреть кэши за время не больше time_budget секунд
+    Задачи, не начатые до истечения бюджета, отменяются
+    """
+    started = time.monotonic()
+    deadline = started + time_budget
+    report = WarmupReport()
+    tasks = plan_warmup(top_searches, users_limit)
+    for kind, count, _ in tasks:
+        report.planned[kind] = report.planned.get(kind, 0) + count
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='cache-warmup') as executor:
+        pending = {}
+        queue = iter(tasks)
+        while True:
+            # В пуле одновременно не больше двух задач на поток: остальные ждут бюджета
+            while len(pending) < workers * 2 and time.monotonic() < deadline:
+                task = next(queue, None)
+                if task is None:
+                    break
+                kind, count, func = task
+                pending[executor.submit(_run_task, func)] = (kind, count)
+            if not pending:
+                report.budget_exhausted = next(queue, None) is not None
+                break
+            done, _ = wait(pending, timeout=max(deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, count = pending.pop(future)
+                if future.exception() is not None:
+                    report.failed += 1
+                    logger.warning('Прогрев %s не удался: %s', kind, future.exception())
+                else:
+                    report.warmed[kind] = report.warmed.get(kind, 0) + count
+            if time.monotonic() >= deadline:
+                report.budget_exhausted = next(queue, None) is not None or bool(pending)
+                for future in pending:
+                    future.cancel()
+                break
+
+    report.duration = time.monotonic() - started
+    logger.info(report.summary())
+    return report
+
+
+def acquire_prewarm_lock() -> bool:
+    """
+    Взять блокировку прогрева в общем для процессов хоста кэше на CACHE_PREWARM_LOCK_TIMEOUT секунд
+    add атомарен, поэтому прогревает только один рабочий процесс, остальные его пропускают
+    """
+    shared_alias = getattr(settings, 'CACHE_TIERED_OPTIONS', {}).get('SHARED_ALIAS', 'shared')
+    timeout = getattr(settings, 'CACHE_PREWARM_LOCK_TIMEOUT', DEFAULT_LOCK_TIMEOUT)
+    return caches[shared_alias].add(PREWARM_LOCK_KEY, os.getpid(), timeout)
+
+
+def start_prewarm():
+    """
+    Прогреть кэши в фоновом потоке, если блокировку прогрева не взял другой процесс
+    Returns:
+        поток прогрева или None
+    """
+    if not acquire_prewarm_lock():
+        return None
+
+    def run():
+        try:
+            warm_caches(
+                time_budget=getattr(settings, 'CACHE_PREWARM_TIME_BUDGET', DEFAULT_TIME_BUDGET),
+                workers=getattr(settings, 'CACHE_PREWARM_WORKERS', DEFAULT_WORKERS),
+            )
+        except Exception:
+            logger.exception('Прогрев кэшей при старте не удался')
+
+    thread = threading.Thread(target=run, name='cache-prewarm', daemon=True)
+    thread.start()
+    return thread
+
+
+_started_pid = None
+_started_lock = threading.Lock()
+
+
+def _prewarm_in_worker(**kwargs):
+    """Запустить прогрев при первом запросе рабочего процесса (один раз на процесс)"""
+    global _started_pid
+    if _started_pid == os.getpid():
+        return
+    with _started_lock:
+        if _started_pid == os.getpid():
+            return
+        _started_pid = os.getpid()
+    start_prewarm()
+
+
+def prewarm_on_startup():
+    """
+    Включить прогрев кэшей рабочим процессом (wsgi.py / asgi.py)
+    Включается настройкой CACHE_PREWARM_ON_STARTUP; по умолчанию прогрев - шаг развертывания
+    `manage.py warm_caches`. Прогрев запускается при первом запросе процесса, а не при импорте:
+    при загрузке приложения до fork (gunicorn --preload) поток главного процесса не попал бы
+    в рабочие процессы. Запросы не ждут окончания прогрева
+    """
+    if not getattr(settings, 'CACHE_PREWARM_ON_STARTUP', False):
+        return
+    request_started.connect(_prewarm_in_worker, dispatch_uid=PREWARM_LOCK_KEY)
@@ -0,0 +1,277 @@
+"""
+Маршрутизация запросов к базе: записи в основную базу, чтения в реплики
+Реплика используется только если ее снимок не старше DATABASE_REPLICA_MAX_LAG секунд и
+сделан после последней записи пользователя: после записи пользователь читает из основной
+базы, пока реплика его не догонит, но не дольше DATABASE_REPLICA_PIN_SECONDS (время записи
+хранится в cookie, см. middleware.ReplicaPinningMiddleware).
+Локальные реплики SQLite синхронизируются online backup API (manage.py sync_replicas);
+время последнего снимка каждой реплики записывается в файл состояния.
+Сообщения (Message) могут быть разложены по нескольким базам (settings.MESSAGE_SHARDS):
+шард беседы выбирается jump consistent hash от ее id, сами беседы остаются в основной базе
+"""
+
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Приложения, записи которых не закрепляют пользователя за основной базой
+UNPINNED_APP_LABELS = frozenset({'sessions'})
+
+# Как часто перечитывается файл состояния реплики (секунды)
+STATUS_CHECK_INTERVAL = 0.5
+
+DEFAULT_MAX_LAG = 30
+DEFAULT_PIN_SECONDS = 10
+
+
+class RequestState:
+    """Состояние маршрутизации текущего запроса: время последней записи пользователя"""
+
+    def __init__(self, written_at: float = 0.0):
+        self.written_at = written_at
+        self.wrote = False
+
+    def record_write(self):
+        self.written_at = time.time()
+        self.wrote = True
+
+
+_request_state: ContextVar[Optional[RequestState]] = ContextVar('db_request_state', default=None)
+
+
+def begin_request(written_at: float = 0.0):
+    """Начать отслеживание записей запроса; возвращает токен для end_request"""
+    return _request_state.set(RequestState(written_at))
+
+
+def end_request(token) -> RequestState:
+    state = _request_state.get()
+    _request_state.reset(token)
+    return state
+
+
+@contextmanager
+def untracked_writes():
+    """Записи внутри блока не закрепляют пользователя текущего запроса за основной базой"""
+    token = _request_state.set(None)
+    try:
+        yield
+    finally:
+        _request_state.reset(token)
+
+
+def get_replica_aliases() -> List[str]:
+    return list(getattr(settings, 'DATABASE_REPLICAS', ()))
+
+
+# ---------------------------------------------------------------- шарды сообщений
+
+MESSAGE_MODEL = 'profiles.message'
+CONVERSATION_MODEL = 'profiles.conversation'
+
+_JUMP_MULTIPLIER = 2862933555777941757
+_UINT64_MASK = (1 << 64) - 1
+
+
+def get_message_shards() -> List[str]:
+    """Алиасы баз сообщений; первый - всегда основная база"""
+    return list(getattr(settings, 'MESSAGE_SHARDS', None) or [DEFAULT_DB_ALIAS])
+
+
+def is_message_shard(alias: Optional[str]) -> bool:
+    """Отдельная база сообщений (не основная и не ее реплика): пользователей и бесед в ней нет"""
+    return alias != DEFAULT_DB_ALIAS and alias in get_message_shards()
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """
+    Jump consistent hash (Lamping, Veach): номер корзины ключа из buckets
+    При росте числа корзин с N до M ключ переходит в другую корзину с вероятностью 1 - N/M,
+    причем только в одну из новых: при решардинге переносится минимум бесед
+    """
+    key &= _UINT64_MASK
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * _JUMP_MULTIPLIER + 1) & _UINT64_MASK
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def message_shard(conversation_id: int, shards: Optional[List[str]] = None) -> str:
+    """Алиас базы с сообщениями беседы (shards - список шардов, по умолчанию MESSAGE_SHARDS)"""
+    shards = shards or get_message_shards()
+    if len(shards) == 1:
+        return shards[0]
+    return shards[jump_hash(int(conversation_id), len(shards))]
+
+
+def _hinted_conversation_id(hints) -> Optional[int]:
+    """id беседы из подсказок роутера: сообщение, беседа (conv.messages) или conversation=..."""
+    instance = hints.get('instance')
+    if instance is not None:
+        label = instance._meta.label_lower
+        if label == MESSAGE_MODEL:
+            return instance.conversation_id
+        if label == CONVERSATION_MODEL:
+            return instance.pk
+    conversation = hints.get('conversation')
+    return getattr(conversation, 'pk', conversation)
+
+
+# ---------------------------------------------------------------- состояние реплик
+
+def _status_path(alias: str) -> str:
+    return os.path.join(settings.DATABASE_REPLICA_STATUS_DIR, f'{alias}.json')
+
+
+def read_replica_status(alias: str) -> Optional[Dict]:
+    """Последняя синхронизация реплики: {'synced_at', 'duration', 'pages', 'size'} или None"""
+    try:
+        with open(_status_path(alias), encoding='utf-8') as status:
+            return json.load(status)
+    except (OSError, ValueError):
+        return None
+
+
+def write_replica_status(alias: str, **status):
+    """Атомарно записать состояние реплики"""
+    path = _status_path(alias)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(status, f)
+    os.replace(tmp_path, path)
+
+
+class _ReplicaClock:
+    """Время снимков реплик, перечитываемое не чаще раза в STATUS_CHECK_INTERVAL секунд"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._synced_at: Dict[str, float] = {}
+        self._checked_at = 0.0
+
+    def synced_at(self, alias: str) -> float:
+        now = time.monotonic()
+        if now - self._checked_at >= STATUS_CHECK_INTERVAL:
+            with self._lock:
+                for replica in get_replica_aliases():
+                    status = read_replica_status(replica)
+                    self._synced_at[replica] = status['synced_at'] if status else 0.0
+                self._checked_at = now
+        return self._synced_at.get(alias, 0.0)
+
+
+replica_clock = _ReplicaClock()
+
+
+def sync_replica(alias: str) -> Dict:
+    """
+    Скопировать основную базу в реплику (sqlite3 online backup) и записать состояние
+    Снимок содержит все транзакции, завершенные до начала копирования
+    """
+    primary = connections[DEFAULT_DB_ALIAS].settings_dict['NAME']
+    replica = connections[alias].settings_dict['NAME']
+    pages = []
+    started = time.time()
+    source = sqlite3.connect(primary, timeout=30)
+    target = sqlite3.connect(replica, timeout=30)
+    try:
+        source.backup(target, progress=lambda status, remaining, total: pages.append(total))
+    finally:
+        target.close()
+        source.close()
+    status = {
+        'synced_at': started,
+        'duration': time.time() - started,
+        'pages': pages[-1] if pages else 0,
+        'size': os.path.getsize(replica),
+    }
+    write_replica_status(alias, **status)
+    return status
+
+
+# ---------------------------------------------------------------- роутеры
+
+class MessageShardRouter:
+    """
+    Роутер Django (settings.DATABASE_ROUTERS, перед ReplicaRouter)
+    Запросы к сообщениям, для которых известна беседа, идут в ее шард; сообщения шарда
+    основной базы и остальные модели обрабатывает следующий роутер
+    """
+
+    def _shard(self, model, hints) -> Optional[str]:
+        if model._meta.label_lower != MESSAGE_MODEL or len(get_message_shards()) == 1:
+            return None
+        conversation_id = _hinted_conversation_id(hints)
+        if conversation_id is None:
+            return None
+        shard = message_shard(conversation_id)
+        return None if shard == DEFAULT_DB_ALIAS else shard
+
+    def db_for_read(self, model, **hints):
+        return self._shard(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._shard(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Сообщение шарда ссылается на беседу и пользователей основной базы
+        labels = {obj1._meta.label_lower, obj2._meta.label_lower}
+        databases = {DEFAULT_DB_ALIAS, *get_replica_aliases(), *get_message_shards()}
+        if MESSAGE_MODEL in labels and obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # В шардах есть только таблица сообщений
+        if not is_message_shard(db):
+            return None
+        return f'{app_label}.{model_name}' == MESSAGE_MODEL
+
+
+class ReplicaRouter:
+    """
+    Роутер Django (settings.DATABASE_ROUTERS)
+    Записи и чтения внутри транзакций идут в основную базу, остальные чтения -
+    в случайную реплику, успевшую получить последнюю запись пользователя
+    """
+
+    def db_for_read(self, model, **hints):
+        replicas = get_replica_aliases()
+        if not replicas or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+
+        state = _request_state.get()
+        max_lag = getattr(settings, 'DATABASE_REPLICA_MAX_LAG', DEFAULT_MAX_LAG)
+        required = time.time() - max_lag
+        if state is not None:
+            required = max(required, state.written_at)
+        fresh = [alias for alias in replicas if replica_clock.synced_at(alias) >= required]
+        return random.choice(fresh) if fresh else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        state = _request_state.get()
+        if state is not None and model._meta.app_label not in UNPINNED_APP_LABELS:
+            state.record_write()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *get_replica_aliases()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Реплики получают схему вместе с данными из основной базы
+        return db not in get_replica_aliases()
@@ -0,0 +1,24 @@
+"""
+Декораторы представлений сайта знакомств
+"""
+
+from functools import wraps
+
+from django.contrib import messages
+from django.shortcuts import redirect
+
+from .middleware import get_profile
+
+
+def profile_required(view_func):
+    """
+    Представление только для пользователей с профилем (request.profile, см. middleware.ProfileMiddleware)
+    Пользователь без профиля перенаправляется на создание профиля; применяется после login_required
+    """
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        if not get_profile(request):
+            messages.info(request, 'Сначала создайте свой профиль!')
+            return redirect('profiles:create_profile')
+        return view_func(request, *args, **kwargs)
+    return wrapper
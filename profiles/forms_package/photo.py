@@ -31,7 +31,8 @@ class PhotoUploadForm(forms.ModelForm):
         super().__init__(*args, **kwargs)
         
         # Если у профиля нет фотографий, автоматически делаем загружаемую основной
-        if self.profile and not self.profile.photos.exists():
+        # (photos.all() использует фотографии, уже загруженные prefetch_related, без запроса)
+        if self.profile and not self.profile.photos.all().exists():
             self.fields['is_primary'].initial = True
             self.fields['is_primary'].widget.attrs['checked'] = True
 
@@ -86,13 +87,10 @@ class PhotoUploadForm(forms.ModelForm):
         
         if self.profile:
             photo.profile = self.profile
-            
-            # Если это основная фотография, убираем флаг у других
-            if photo.is_primary:
-                self.profile.photos.update(is_primary=False)
         
         if commit:
-            photo.save()
+            # Снятие флага с предыдущей основной фотографии и сохранение - одной транзакцией
+            Photo.objects.add_photo(photo)
         
         return photo
 
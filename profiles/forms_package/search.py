@@ -97,6 +97,13 @@ class ProfileSearchForm(forms.Form):
         })
     )
 
+    # Только пользователи онлайн (profiles.presence): фильтры проверяются по профилям онлайн
+    online_now = forms.BooleanField(
+        label='Сейчас онлайн',
+        required=False,
+        widget=forms.CheckboxInput(attrs={'class': 'form-check-input'})
+    )
+
     def clean(self):
         cleaned_data = super().clean()
         
@@ -113,3 +120,30 @@ class ProfileSearchForm(forms.Form):
             raise forms.ValidationError('Минимальный рост не может быть больше максимального')
         
         return cleaned_data
+
+    # Поля с числовыми кодами выбора
+    CHOICE_FIELDS = ('gender', 'city', 'education', 'employment', 'smoking', 'alcohol')
+
+    def get_search_params(self):
+        """
+        Заполненные фильтры в каноническом виде (ключ кэша результатов поиска)
+        Коды выбора приводятся к int, наличие детей - к bool, пустые значения отбрасываются
+        """
+        if not self.is_valid():
+            return {}
+        params = {}
+        for name, value in self.cleaned_data.items():
+            if value in (None, ''):
+                continue
+            if name in self.CHOICE_FIELDS:
+                value = int(value)
+            elif name == 'has_children':
+                value = value == 'true'
+            elif name == 'search':
+                value = value.strip()
+                if not value:
+                    continue
+            elif name == 'online_now' and not value:
+                continue
+            params[name] = value
+        return params
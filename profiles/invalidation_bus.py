@@ -0,0 +1,256 @@
+"""
+Шина инвалидации кэшей между рабочими процессами одного хоста
+Инвалидации дописываются в журнал SQLite (файл INVALIDATION_BUS_PATH); каждый процесс
+читает новые записи не чаще раза в INVALIDATION_BUS_POLL_INTERVAL секунд (в начале
+запроса, см. middleware.InvalidationBusMiddleware) и применяет удаления пакетами.
+Если непрочитанные процессом записи уже удалены по сроку хранения (INVALIDATION_BUS_RETENTION),
+кэши подписчиков сбрасываются целиком.
+Задержка доставки и стоимость публикации пишутся в метрики
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from django.conf import settings
+
+from .metrics import metrics
+
+# Корзины гистограммы задержки доставки (миллисекунды)
+PROPAGATION_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 15000)
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS invalidations ('
+    ' id INTEGER PRIMARY KEY AUTOINCREMENT, namespace TEXT NOT NULL, key TEXT,'
+    ' pid INTEGER NOT NULL, created REAL NOT NULL'
+    ')',
+)
+
+
+class InvalidationBus:
+    """
+    Журнал инвалидаций с подписчиками по пространствам имен
+    Ключ None в журнале означает сброс всего пространства имен
+    """
+
+    def __init__(self, path, poll_interval: float = 0.25, retention: float = 300):
+        self.path = os.fspath(path)
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._subscribers: Dict[str, Dict[Any, Callable]] = defaultdict(dict)
+        self._local = threading.local()
+        self._poll_lock = threading.Lock()
+        self._pid = None
+        self._last_id = 0
+        self._checked_at = 0.0
+        self._publishes = 0
+
+    # ---------------------------------------------------------------- соединение
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """Соединение текущего потока (пересоздается после fork)"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.pid == os.getpid():
+            return connection
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            connection.execute(statement)
+        self._local.connection = connection
+        self._local.pid = os.getpid()
+        return connection
+
+    def _ensure_process_state(self):
+        """После fork процесс читает журнал с текущего конца: его кэши еще пусты"""
+        if self._pid != os.getpid():
+            (self._last_id,) = self.connection.execute(
+                'SELECT COALESCE(MAX(id), 0) FROM invalidations'
+            ).fetchone()
+            self._pid = os.getpid()
+            self._checked_at = time.monotonic()
+
+    # ---------------------------------------------------------------- подписка
+
+    def subscribe(self, namespace: str, callback: Callable[[Optional[List[str]]], None], name: Any = None):
+        """
+        Подписаться на инвалидации пространства имен
+        callback получает список ключей или None, если нужно сбросить все;
+        повторная подписка с тем же name заменяет предыдущую
+        """
+        self._subscribers[namespace][name if name is not None else callback] = callback
+        self._ensure_process_state()
+
+    # ---------------------------------------------------------------- публикация
+
+    def publish(self, namespace: str, keys: Iterable[Optional[str]]):
+        """Опубликовать ключи, которые другие процессы должны удалить из своих кэшей"""
+        keys = list(keys)
+        if not keys:
+            return
+        started = time.perf_counter()
+        now = time.time()
+        pid = os.getpid()
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany(
+                'INSERT INTO invalidations (namespace, key, pid, created) VALUES (?, ?, ?, ?)',
+                [(namespace, key, pid, now) for key in keys],
+            )
+            self._publishes += 1
+            if self._publishes % 100 == 0:
+                connection.execute('DELETE FROM invalidations WHERE created < ?', (now - self.retention,))
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+        metrics.observe('invalidation.publish_ms', (time.perf_counter() - started) * 1000, namespace=namespace)
+        metrics.incr('invalidation.published', len(keys), namespace=namespace)
+
+    # ---------------------------------------------------------------- чтение
+
+    def poll(self, force: bool = False) -> int:
+        """
+        Применить новые инвалидации других процессов
+        Returns:
+            количество примененных записей журнала
+        """
+        now = time.monotonic()
+        if not force and self._pid == os.getpid() and now - self._checked_at < self.poll_interval:
+            return 0
+        if not self._poll_lock.acquire(blocking=False):
+            # Журнал уже читает другой поток
+            return 0
+        try:
+            self._ensure_process_state()
+            self._checked_at = now
+            started = time.perf_counter()
+            # Последняя запись журнала выбирается всегда: по ней видно, что журнал пересоздан
+            rows = self.connection.execute(
+                'SELECT id, namespace, key, pid, created FROM invalidations'
+                ' WHERE id > ? OR id = (SELECT MAX(id) FROM invalidations) ORDER BY id',
+                (self._last_id,),
+            ).fetchall()
+            last_id = rows[-1][0] if rows else 0
+            rows = [row for row in rows if row[0] > self._last_id]
+            if last_id < self._last_id or (rows and rows[0][0] != self._last_id + 1):
+                # Непрочитанные записи удалены по сроку хранения (или журнал пересоздан):
+                # какие ключи менялись, неизвестно - сбрасываются все кэши подписчиков
+                self._last_id = last_id
+                self._clear_subscribers()
+                return len(rows)
+            if not rows:
+                return 0
+            self._last_id = last_id
+
+            pid = os.getpid()
+            batches: Dict[str, Optional[List[str]]] = {}
+            oldest: Dict[str, float] = {}
+            applied = 0
+            for _, namespace, key, row_pid, created in rows:
+                if row_pid == pid or namespace not in self._subscribers:
+                    continue
+                applied += 1
+                oldest[namespace] = min(oldest.get(namespace, created), created)
+                if key is None:
+                    batches[namespace] = None
+                elif batches.get(namespace, []) is not None:
+                    batches.setdefault(namespace, []).append(key)
+
+            for namespace, keys in batches.items():
+                for callback in list(self._subscribers[namespace].values()):
+                    callback(keys)
+
+            wall_now = time.time()
+            for namespace, created in oldest.items():
+                metrics.observe(
+                    'invalidation.propagation_ms', (wall_now - created) * 1000,
+                    buckets=PROPAGATION_BUCKETS_MS, namespace=namespace,
+                )
+            if applied:
+                metrics.incr('invalidation.applied', applied)
+                metrics.observe('invalidation.poll_ms', (time.perf_counter() - started) * 1000)
+            return applied
+        finally:
+            self._poll_lock.release()
+
+    def _clear_subscribers(self):
+        for namespace, subscribers in self._subscribers.items():
+            for callback in list(subscribers.values()):
+                callback(None)
+        metrics.incr('invalidation.full_clears')
+
+
+_bus = None
+_bus_lock = threading.Lock()
+
+
+def get_invalidation_bus() -> Optional[InvalidationBus]:
+    """Шина инвалидаций процесса (None, если INVALIDATION_BUS_PATH не задан)"""
+    global _bus
+    if _bus is None:
+        path = getattr(settings, 'INVALIDATION_BUS_PATH', None)
+        if not path:
+            return None
+        with _bus_lock:
+            if _bus is None:
+                _bus = InvalidationBus(
+                    path,
+                    poll_interval=getattr(settings, 'INVALIDATION_BUS_POLL_INTERVAL', 0.25),
+                    retention=getattr(settings, 'INVALIDATION_BUS_RETENTION', 300),
+                )
+    return _bus
+
+
+class BroadcastingCache:
+    """
+    Обертка над LocMemCache: удаления и очистка публикуются в шину,
+    чтобы те же ключи удалили и другие рабочие процессы
+    В журнал пишутся полные ключи (с префиксом и версией), поэтому подписчик
+    удаляет их напрямую из хранилища LocMemCache
+    """
+
+    def __init__(self, cache, namespace: str, bus: InvalidationBus):
+        self._cache = cache
+        self.namespace = namespace
+        self.bus = bus
+        bus.subscribe(namespace, self.apply_invalidations, name='broadcast')
+
+    def __getattr__(self, name):
+        return getattr(self._cache, name)
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def apply_invalidations(self, keys: Optional[List[str]]):
+        """Применить инвалидации, полученные от других процессов"""
+        if keys is None:
+            self._cache.clear()
+            return
+        with self._cache._lock:
+            for key in keys:
+                self._cache._delete(key)
+
+    def delete(self, key, version=None):
+        deleted = self._cache.delete(key, version=version)
+        self.bus.publish(self.namespace, [self._cache.make_key(key, version=version)])
+        return deleted
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        self._cache.delete_many(keys, version=version)
+        self.bus.publish(self.namespace, [self._cache.make_key(key, version=version) for key in keys])
+
+    def clear(self):
+        self._cache.clear()
+        self.bus.publish(self.namespace, [None])
@@ -0,0 +1,196 @@
+"""
+Общие помощники нагрузочных бенчмарков (management-команды bench_*)
+Бенчмарки работают с отдельной временной базой SQLite, заполненной синтетическими
+пользователями, профилями и переписками, и не трогают рабочую базу
+"""
+
+import copy
+import random
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from profiles.models import Conversation, Message, Profile
+
+SEED_BATCH_SIZE = 500
+
+
+@contextmanager
+def temporary_database(alias='default'):
+    """
+    Подменить базу алиаса пустым временным файлом с примененными миграциями
+    Настройки соединения меняются на месте: соединения всех потоков, открытые после
+    подмены, используют временный файл. Yields: каталог временной базы
+    """
+    directory = Path(tempfile.mkdtemp(prefix='bench-db-'))
+    settings_dict = connections[alias].settings_dict
+    original = copy.deepcopy(settings_dict)
+    connections.close_all()
+    settings_dict['NAME'] = str(directory / 'bench.sqlite3')
+    try:
+        call_command('migrate', database=alias, verbosity=0, interactive=False)
+        yield directory
+    finally:
+        connections.close_all()
+        settings_dict.clear()
+        settings_dict.update(original)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+@contextmanager
+def temporary_message_shards(count, directory):
+    """
+    Разложить сообщения по count шардам: основная база и временные файлы messages_1...
+    в каталоге directory (обычно каталог temporary_database) с примененными миграциями
+    Yields: алиасы шардов
+    """
+    shards = [DEFAULT_DB_ALIAS] + [f'messages_{index}' for index in range(1, count)]
+    original = {alias: connections.settings.get(alias) for alias in shards[1:]}
+    connections.close_all()
+    for alias in shards[1:]:
+        connections.settings[alias] = {
+            **copy.deepcopy(connections[DEFAULT_DB_ALIAS].settings_dict),
+            'NAME': str(Path(directory) / f'bench-{alias}.sqlite3'),
+        }
+    try:
+        with override_settings(MESSAGE_SHARDS=shards):
+            for alias in shards[1:]:
+                call_command('migrate', database=alias, verbosity=0, interactive=False)
+            yield shards
+    finally:
+        connections.close_all()
+        for alias, settings_dict in original.items():
+            try:
+                del connections[alias]
+            except AttributeError:
+                pass
+            if settings_dict is None:
+                del connections.settings[alias]
+            else:
+                connections.settings[alias] = settings_dict
+
+
+def apply_connection_profile(profile, alias='default'):
+    """Применить профиль соединения (элемент settings.SQLITE_CONNECTION_PROFILES) к новым соединениям"""
+    connections.close_all()
+    settings_dict = connections[alias].settings_dict
+    settings_dict.update(copy.deepcopy(profile))
+
+
+def random_profile_values(rng):
+    """Значения обязательных полей профиля: случайный вариант для полей с choices"""
+    values = {}
+    for field in Profile._meta.concrete_fields:
+        if field.choices and not field.null:
+            values[field.attname] = rng.choice([code for code, _ in field.flatchoices])
+    values.update(
+        age=rng.randint(18, 45), height=rng.randint(150, 200), weight=rng.randint(45, 110),
+        health_rating=rng.randint(5, 10),
+    )
+    return values
+
+
+def seed_dating_data(users=200, conversations_per_user=3, messages_per_conversation=10, seed=42):
+    """
+    Заполнить базу синтетическими данными
+    Returns:
+        (список пользователей, список переписок)
+    """
+    rng = random.Random(seed)
+    password = make_password(None)
+    now = timezone.now()
+    with transaction.atomic():
+        User.objects.bulk_create(
+            [User(username=f'bench{index}', password=password) for index in range(users)],
+            batch_size=SEED_BATCH_SIZE,
+        )
+        created = list(User.objects.filter(username__startswith='bench').order_by('id'))
+        Profile.objects.bulk_create(
+            [Profile(user=user, nickname=f'Bench {user.id}', last_online=now, **random_profile_values(rng))
+             for user in created],
+            batch_size=SEED_BATCH_SIZE,
+        )
+
+        pairs = set()
+        for index, user in enumerate(created):
+            for offset in range(1, conversations_per_user + 1):
+                other = created[(index + offset * 7) % len(created)]
+                if other.id != user.id:
+                    pairs.add((min(user.id, other.id), max(user.id, other.id)))
+        Conversation.objects.bulk_create(
+            [Conversation(participant1_id=first, participant2_id=second) for first, second in sorted(pairs)],
+            batch_size=SEED_BATCH_SIZE,
+        )
+        conversations = list(Conversation.objects.order_by('id'))
+
+        messages = []
+        for conversation in conversations:
+            for number in range(messages_per_conversation):
+                sender, receiver = conversation.participant1_id, conversation.participant2_id
+                if number % 2:
+                    sender, receiver = receiver, sender
+                messages.append(Message(
+                    conversation=conversation, sender_id=sender, receiver_id=receiver,
+                    content=f'Сообщение {number} ' * rng.randint(1, 12), is_read=number < messages_per_conversation - 2,
+                ))
+        Message.objects.bulk_create(messages, batch_size=SEED_BATCH_SIZE)
+    return created, conversations
+
+
+def percentile(values, percent):
+    """Перцентиль списка значений (ближайший ранг)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(int(len(ordered) * percent / 100), len(ordered) - 1)
+    return ordered[index]
+
+
+
+def seed_messages_sql(users, conversations_per_user=5, messages=1_000_000, unread_every=50):
+    """
+    Быстро заполнить переписки и сообщения одним INSERT ... SELECT на каждую таблицу
+    (рекурсивный CTE в SQLite: миллионы строк без передачи через Python)
+    Args:
+        users: пользователи с последовательными id (seed_dating_data)
+        conversations_per_user: переписок, начатых каждым пользователем
+        messages: сообщений всего, равномерно по перепискам
+        unread_every: каждое N-е сообщение не прочитано
+    Returns:
+        число переписок
+    """
+    first_id, count = users[0].id, len(users)
+    conversations = count * conversations_per_user
+    conversation_table = Conversation._meta.db_table
+    message_table = Message._meta.db_table
+    with transaction.atomic(), connections['default'].cursor() as cursor:
+        # Собеседник k-й переписки пользователя: сдвиг 1 + 13k по кругу (пары не повторяются)
+        cursor.execute(f'''
+            WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i + 1 < %s)
+            INSERT INTO {conversation_table} (participant1_id, participant2_id, last_message_at, created_at, updated_at)
+            SELECT %s + i %% %s, %s + (i %% %s + 1 + (i / %s) * 13) %% %s,
+                   datetime('2025-01-01', '+' || (i * 7) || ' minutes'), '2025-01-01 00:00:00', '2025-01-01 00:00:00'
+            FROM n
+        ''', [conversations, first_id, count, first_id, count, count, count])
+        cursor.execute(f'SELECT MIN(id) FROM {conversation_table}')
+        (first_conversation,) = cursor.fetchone()
+        cursor.execute(f'''
+            WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i + 1 < %s)
+            INSERT INTO {message_table} (conversation_id, sender_id, receiver_id, content, sent_at, is_read)
+            SELECT c.id,
+                   CASE WHEN n.i %% 2 THEN c.participant2_id ELSE c.participant1_id END,
+                   CASE WHEN n.i %% 2 THEN c.participant1_id ELSE c.participant2_id END,
+                   'Сообщение ' || n.i,
+                   datetime('2025-01-01', '+' || (n.i / 4) || ' seconds'),
+                   n.i %% %s != 0
+            FROM n JOIN {conversation_table} c ON c.id = %s + (n.i * 7919) %% %s
+        ''', [messages, unread_every, first_conversation, conversations])
+    return conversations
@@ -0,0 +1,147 @@
+"""
+Django management команда для сравнения политик вытеснения кэша на трассах обращений
+Воспроизводит трассы, записанные InstrumentedCache (settings.CACHE_TRACE_DIR), на
+LocMemCache (MAX_ENTRIES + CULL_FREQUENCY) и SizeAwareCache (W-TinyLFU, объем в байтах)
+при одинаковом бюджете памяти и сравнивает долю попаданий
+Использование:
+    python manage.py bench_cache_policy [--trace FILE ...] [--alias default] [--capacity 1048576 ...]
+    python manage.py bench_cache_policy --synthetic 200000
+"""
+
+import glob
+import itertools
+import os
+import random
+import time
+
+from django.conf import settings
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand, CommandError
+
+from profiles.cache_backends.size_aware import SizeAwareCache
+
+
+def read_traces(paths):
+    """Операции (op, key, size) из файлов трасс"""
+    for path in paths:
+        with open(path, encoding='utf-8') as trace:
+            for line in trace:
+                op, key, size = line.rstrip('\n').split('\t')
+                yield op, key, int(size)
+
+
+def synthetic_trace(operations, seed=42):
+    """
+    Трасса, похожая на обращения наших представлений: частые маленькие профили
+    (распределение Ципфа), списки переписок среднего размера и редкие большие
+    страницы поиска, которые почти не читаются повторно
+    Операции get несут размер значения: при промахе значение записывается (read-through)
+    """
+    rng = random.Random(seed)
+    users = 5000
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(users)))
+    trace = []
+    while len(trace) < operations:
+        roll = rng.random()
+        if roll < 0.7:
+            user = rng.choices(range(users), cum_weights=cum_weights)[0]
+            key, size = f'dating_site:profile:user:user_id-{user}', 500 + user % 700
+        elif roll < 0.9:
+            user = rng.choices(range(users), cum_weights=cum_weights)[0]
+            key, size = f'dating_site:conversations:list:user_id-{user}', 2000 + (user % 20) * 1500
+        else:
+            key, size = f'dating_site:search:{rng.getrandbits(40):x}', rng.randint(50_000, 300_000)
+        trace.append(('get', key, size))
+    return trace
+
+
+class Command(BaseCommand):
+    help = 'Сравнить LocMemCache и SizeAwareCache (W-TinyLFU) на записанных трассах обращений'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--trace', nargs='*', help='Файлы трасс (по умолчанию все в CACHE_TRACE_DIR)')
+        parser.add_argument('--alias', help='Только трассы указанного алиаса кэша')
+        parser.add_argument('--capacity', nargs='*', type=int,
+                            default=[1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024],
+                            help='Бюджеты памяти в байтах')
+        parser.add_argument('--synthetic', type=int, metavar='N',
+                            help='Вместо записанных трасс сгенерировать N обращений')
+
+    def handle(self, *args, **options):
+        if options['synthetic']:
+            trace = synthetic_trace(options['synthetic'])
+            source = f'синтетическая трасса ({options["synthetic"]} обращений)'
+        else:
+            paths = options['trace'] or self.default_traces(options['alias'])
+            if not paths:
+                raise CommandError(
+                    'Трассы не найдены: задайте CACHE_TRACE_DIR, соберите трафик или используйте --synthetic'
+                )
+            trace = list(read_traces(paths))
+            source = f'{len(paths)} файл(ов), {len(trace)} операций'
+
+        sizes = [size for _, _, size in trace if size]
+        mean_size = sum(sizes) / len(sizes) if sizes else 1024
+        self.stdout.write(self.style.SUCCESS('=== Политики вытеснения кэша ===\n'))
+        self.stdout.write(f'Трасса: {source}; средний размер записи: {mean_size / 1024:.1f} KB')
+
+        for capacity in options['capacity']:
+            max_entries = max(int(capacity // mean_size), 1)
+            self.stdout.write(f'\n💾 Бюджет {capacity / 1024 / 1024:.1f} MB')
+            self.report(
+                f'LocMemCache (MAX_ENTRIES={max_entries})', trace,
+                LocMemCache(f'bench-lru-{capacity}', {'OPTIONS': {'MAX_ENTRIES': max_entries, 'CULL_FREQUENCY': 4}}),
+            )
+            self.report(
+                'SizeAwareCache (W-TinyLFU)', trace,
+                SizeAwareCache(f'bench-tinylfu-{capacity}', {'OPTIONS': {'MAX_BYTES': capacity}}),
+            )
+
+    @staticmethod
+    def default_traces(alias):
+        directory = getattr(settings, 'CACHE_TRACE_DIR', None)
+        if not directory:
+            return []
+        return sorted(glob.glob(os.path.join(directory, f'{alias or "*"}-*.trace')))
+
+    def report(self, title, trace, cache):
+        """Воспроизвести трассу и вывести долю попаданий по запросам и по байтам"""
+        cache.clear()
+        sizes = {}
+        hits = lookups = hit_bytes = lookup_bytes = sets = 0
+        peak_bytes = 0
+        elapsed = 0.0
+        for op, key, size in trace:
+            started = time.perf_counter()
+            sets_before = sets
+            if op == 'get':
+                found = cache.get(key) is not None
+                if not found and size:
+                    # Синтетическая трасса: значение вычисляется и записывается при промахе
+                    cache.set(key, b'x' * size, None)
+                    sets += 1
+                elapsed += time.perf_counter() - started
+                sizes.setdefault(key, size)
+                lookups += 1
+                hits += found
+                lookup_bytes += sizes[key]
+                hit_bytes += sizes[key] if found else 0
+            elif op == 'set':
+                cache.set(key, b'x' * size, None)
+                elapsed += time.perf_counter() - started
+                sizes[key] = size
+                sets += 1
+            elif op == 'delete':
+                cache.delete(key)
+                elapsed += time.perf_counter() - started
+            if sets != sets_before and sets % 500 == 0:
+                # Объем хранимых значений замеряется выборочно
+                peak_bytes = max(peak_bytes, sum(len(value) for value in cache._cache.values()))
+
+        hit_rate = hits / lookups * 100 if lookups else 0
+        byte_rate = hit_bytes / lookup_bytes * 100 if lookup_bytes else 0
+        self.stdout.write(
+            f'   {title}: hit rate {hit_rate:.1f}%, по байтам {byte_rate:.1f}%, '
+            f'записей в конце {len(cache._cache)}, пик объема ~{peak_bytes / 1024 / 1024:.1f} MB, '
+            f'{len(trace) / elapsed / 1000:.0f}K операций/с'
+        )
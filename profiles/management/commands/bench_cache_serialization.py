@@ -0,0 +1,116 @@
+"""
+Django management команда для сравнения форматов значений в кэше
+Сравнивает pickle целых экземпляров моделей (прежний формат) с компактными проекциями
+(profiles.cache_serialization): размер записи и время чтения из LocMemCache
+Использование: python manage.py bench_cache_serialization [--iterations 2000] [--rows 20]
+"""
+
+import datetime
+import pickle
+import time
+
+from django.contrib.auth.models import User
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand
+from django.db import models
+from django.utils import timezone
+
+from profiles.cache_utils import TaggedValue, get_codec
+from profiles.models import Conversation, Message, Profile
+
+
+def build_instance(model, pk, **values):
+    """Экземпляр модели «как из базы» (from_db) с правдоподобными значениями полей"""
+    field_names, row = [], []
+    for field in model._meta.concrete_fields:
+        if field.attname in values:
+            value = values[field.attname]
+        elif field.primary_key:
+            value = pk
+        elif isinstance(field, (models.DateTimeField, models.DateField)):
+            value = timezone.now()
+        elif isinstance(field, models.BooleanField):
+            value = False
+        elif isinstance(field, (models.IntegerField, models.ForeignKey)):
+            value = pk
+        elif isinstance(field, models.TextField):
+            value = f'{field.name} {pk} ' * 8
+        else:
+            value = f'{field.name}{pk}'[:getattr(field, 'max_length', None) or 50]
+        field_names.append(field.attname)
+        row.append(value)
+    return model.from_db('default', field_names, row)
+
+
+def build_profile(pk):
+    user = build_instance(User, pk, password='pbkdf2_sha256$1000000$' + 'x' * 66)
+    profile = build_instance(Profile, pk, user_id=pk)
+    Profile._meta.get_field('user').set_cached_value(profile, user)
+    return profile
+
+
+def build_conversation_row(pk, owner):
+    other = build_profile(pk)
+    conversation = build_instance(Conversation, pk, participant1_id=owner.user.id, participant2_id=pk)
+    conversation._meta.get_field('participant1').set_cached_value(conversation, owner.user)
+    conversation._meta.get_field('participant2').set_cached_value(conversation, other.user)
+    last_message = build_instance(
+        Message, pk, conversation_id=pk, sender_id=pk, receiver_id=owner.user.id,
+        content='Привет! Как дела? ' * 6, sent_at=timezone.now() - datetime.timedelta(minutes=pk),
+    )
+    return {
+        'conversation': conversation,
+        'other_user': other.user,
+        'other_profile': other,
+        'last_message': last_message,
+        'unread_count': pk % 3,
+    }
+
+
+class Command(BaseCommand):
+    help = 'Сравнить размер и время чтения значений кэша: pickle моделей и компактные проекции'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=2000, help='Чтений на сценарий')
+        parser.add_argument('--rows', type=int, default=20, help='Строк в списке переписок')
+        parser.add_argument('--recent', type=int, default=6, help='Профилей в списке новых профилей')
+
+    def handle(self, *args, **options):
+        owner = build_profile(1)
+        scenarios = [
+            ('Профиль пользователя', 'profile', build_profile(2)),
+            (f'Новые профили ({options["recent"]})', 'recent_profiles',
+             [build_profile(100 + i) for i in range(options['recent'])]),
+            (f'Список переписок ({options["rows"]})', 'conversation_list',
+             [build_conversation_row(200 + i, owner) for i in range(options['rows'])]),
+        ]
+
+        self.stdout.write(self.style.SUCCESS('=== Сериализация значений кэша ===\n'))
+        cache = LocMemCache('bench-cache-serialization', {'OPTIONS': {'MAX_ENTRIES': 100}})
+        versions = {'all': time.time_ns()}
+        for title, codec_name, value in scenarios:
+            codec = get_codec(codec_name)
+            before = TaggedValue(value, versions)
+            after = TaggedValue(codec.dumps(value), versions)
+
+            before_size = len(pickle.dumps(before, pickle.HIGHEST_PROTOCOL))
+            after_size = len(pickle.dumps(after, pickle.HIGHEST_PROTOCOL))
+            before_us = self.measure(cache, 'before', before, lambda entry: entry.value, options['iterations'])
+            after_us = self.measure(cache, 'after', after, lambda entry: codec.loads(entry.value),
+                                    options['iterations'])
+
+            self.stdout.write(f'\n📦 {title}')
+            self.stdout.write(f'   Размер записи: {before_size} B -> {after_size} B '
+                              f'({after_size / before_size * 100:.0f}%)')
+            self.stdout.write(f'   Чтение (get + восстановление): {before_us:.1f} мкс -> {after_us:.1f} мкс')
+            if after.value[:1] == b'z':
+                self.stdout.write('   Сжато zlib')
+
+    @staticmethod
+    def measure(cache, key, entry, restore, iterations) -> float:
+        """Среднее время get + восстановления объекта, микросекунды"""
+        cache.set(key, entry, None)
+        started = time.perf_counter()
+        for _ in range(iterations):
+            restore(cache.get(key))
+        return (time.perf_counter() - started) / iterations * 1e6
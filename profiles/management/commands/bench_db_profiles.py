@@ -0,0 +1,150 @@
+"""
+Django management команда для сравнения профилей соединения SQLite
+(settings.SQLITE_CONNECTION_PROFILES) на смешанной нагрузке чтения и записи:
+поиск профилей, список и страница переписки, отправка сообщений из нескольких процессов
+(как рабочие процессы gunicorn). Каждый профиль проверяется на отдельной временной базе
+с одинаковыми данными
+Использование:
+    python manage.py bench_db_profiles [--profiles django production] [--workers 8] [--duration 10]
+"""
+
+import multiprocessing
+import random
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections
+from django.test import Client
+
+from profiles.cache_utils import invalidate_all_caches
+from profiles.management.bench_data import (
+    apply_connection_profile, percentile, seed_dating_data, temporary_database,
+)
+
+# Доли операций в нагрузке
+WORKLOAD = (
+    ('search', 0.5),
+    ('conversations', 0.2),
+    ('conversation', 0.15),
+    ('send', 0.15),
+)
+
+
+class Command(BaseCommand):
+    help = 'Сравнить профили соединения SQLite на смешанной нагрузке поиска, переписок и отправки сообщений'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', nargs='*', help='Профили из SQLITE_CONNECTION_PROFILES (по умолчанию все)')
+        parser.add_argument('--workers', type=int, default=8, help='Параллельных клиентов (процессов)')
+        parser.add_argument('--duration', type=float, default=10, help='Длительность прогона профиля в секундах')
+        parser.add_argument('--users', type=int, default=300, help='Синтетических пользователей')
+
+    def handle(self, *args, **options):
+        available = settings.SQLITE_CONNECTION_PROFILES
+        names = options['profiles'] or list(available)
+        unknown = [name for name in names if name not in available]
+        if unknown:
+            raise CommandError(f'Неизвестные профили: {", ".join(unknown)}')
+        if connections['default'].vendor != 'sqlite':
+            raise CommandError('Бенчмарк предназначен для SQLite')
+
+        self.stdout.write(self.style.SUCCESS('=== Профили соединения SQLite ===\n'))
+        self.stdout.write(
+            f'Процессов: {options["workers"]}, {options["duration"]:.0f} с на профиль, '
+            f'пользователей: {options["users"]}'
+        )
+        for name in names:
+            with temporary_database():
+                apply_connection_profile(available[name])
+                users, conversations = seed_dating_data(users=options['users'])
+                connections.close_all()
+                invalidate_all_caches()
+                results = self.run_workload(conversations, options['workers'], options['duration'])
+                self.report(name, results, options['duration'])
+
+    def run_workload(self, conversations, workers, duration):
+        """Запустить клиентов в процессах; каждый пишет в свою переписку (как живой диалог)"""
+        settings.ALLOWED_HOSTS = [*settings.ALLOWED_HOSTS, 'testserver']
+        context = multiprocessing.get_context('fork')
+        queue = context.Queue()
+        deadline = time.time() + duration
+        processes = [
+            context.Process(target=self.client_loop, args=(
+                conversations[index % len(conversations)], deadline, queue, index,
+            ))
+            for index in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        results = defaultdict(lambda: {'latencies': [], 'errors': 0, 'locked': 0})
+        for _ in processes:
+            for operation, stats in queue.get().items():
+                results[operation]['latencies'].extend(stats['latencies'])
+                results[operation]['errors'] += stats['errors']
+                results[operation]['locked'] += stats['locked']
+        for process in processes:
+            process.join()
+        return results
+
+    def client_loop(self, conversation, deadline, queue, seed):
+        """Нагрузка одного клиента; результаты передаются родительскому процессу через очередь"""
+        rng = random.Random(seed)
+        operations, weights = zip(*WORKLOAD)
+        results = defaultdict(lambda: {'latencies': [], 'errors': 0, 'locked': 0})
+        clients = []
+        for user in (conversation.participant1, conversation.participant2):
+            client = Client()
+            client.force_login(user)
+            clients.append(client)
+        detail_url = f'/profiles/conversations/{conversation.id}/'
+        turn = 0
+        try:
+            while time.time() < deadline:
+                operation = rng.choices(operations, weights)[0]
+                if operation == 'send':
+                    # Участники пишут по очереди: лимит неотвеченных сообщений не срабатывает
+                    client = clients[turn % 2]
+                    turn += 1
+                    method, url, data = 'post', detail_url, {'send_message': '1', 'content': 'Бенчмарк ' * 4}
+                else:
+                    client = clients[rng.randrange(2)]
+                    method, url, data = 'get', detail_url, None
+                    if operation == 'search':
+                        url = '/profiles/search/'
+                        data = {'city': rng.randint(1, 5), 'gender': rng.randint(1, 2), 'age_min': rng.randint(18, 35)}
+                    elif operation == 'conversations':
+                        url = '/profiles/conversations/'
+
+                started = time.perf_counter()
+                try:
+                    response = getattr(client, method)(url, data)
+                    failed = response.status_code >= 400
+                    locked = False
+                except OperationalError as error:
+                    failed, locked = True, 'locked' in str(error)
+                stats = results[operation]
+                stats['latencies'].append((time.perf_counter() - started) * 1000)
+                stats['errors'] += failed
+                stats['locked'] += locked
+        finally:
+            connections.close_all()
+            queue.put(dict(results))
+
+    def report(self, name, results, duration):
+        total = sum(len(stats['latencies']) for stats in results.values())
+        locked = sum(stats['locked'] for stats in results.values())
+        self.stdout.write(
+            f'\n🗄  {name}: {total / duration:.0f} запросов/с, ошибок "database is locked": {locked}'
+        )
+        for operation, _ in WORKLOAD:
+            stats = results.get(operation)
+            if not stats or not stats['latencies']:
+                continue
+            latencies = stats['latencies']
+            self.stdout.write(
+                f'   {operation:<14} {len(latencies):>6} запросов, p50 {percentile(latencies, 50):6.1f} мс, '
+                f'p95 {percentile(latencies, 95):6.1f} мс, max {max(latencies):7.1f} мс, '
+                f'ошибок {stats["errors"]}'
+            )
@@ -0,0 +1,95 @@
+"""
+Django management команда для оценки записи Profile.last_online
+Воспроизводит поток запросов авторизованных пользователей (частота по закону Ципфа) в
+ускоренном времени и сравнивает запись last_online на каждый запрос (update_last_online)
+с пакетной записью profiles.activity: число UPDATE, обновленных строк и время
+Использование:
+    python manage.py bench_last_online [--users 2000] [--requests 20000] [--minutes 60]
+"""
+
+import itertools
+import random
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from profiles.activity import DEFAULT_FLUSH_INTERVAL, ActivityTracker
+from profiles.management.bench_data import seed_dating_data, temporary_database
+from profiles.models import Profile
+
+
+def request_stream(user_ids, requests, duration, seed=42):
+    """Запросы (время, user_id), равномерно распределенные по duration секунд"""
+    rng = random.Random(seed)
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(user_ids))))
+    started = time.time()
+    for number, user_id in enumerate(rng.choices(user_ids, cum_weights=cum_weights, k=requests)):
+        yield started + duration * number / requests, user_id
+
+
+class StatementCounter:
+    """Обертка выполнения запросов (connection.execute_wrapper), считающая запросы"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = 'Сравнить запись last_online на каждый запрос с пакетной записью (profiles.activity)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000, help='Активных пользователей')
+        parser.add_argument('--requests', type=int, default=20000, help='Запросов в потоке')
+        parser.add_argument('--minutes', type=float, default=60, help='Длительность потока (ускоренное время)')
+
+    def handle(self, *args, **options):
+        duration = options['minutes'] * 60
+        flush_interval = getattr(settings, 'LAST_ONLINE_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL)
+        self.stdout.write(self.style.SUCCESS('=== Запись last_online ===\n'))
+        self.stdout.write(
+            f'{options["requests"]} запросов от {options["users"]} пользователей за {options["minutes"]:.0f} мин; '
+            f'интервал записи пользователя {settings.LAST_ONLINE_UPDATE_INTERVAL} с, пакетов - {flush_interval} с'
+        )
+
+        with temporary_database():
+            users, _ = seed_dating_data(users=options['users'], conversations_per_user=0, messages_per_conversation=0)
+            user_ids = [user.id for user in users]
+            stream = list(request_stream(user_ids, options['requests'], duration))
+
+            # Запись на каждый запрос
+            profiles = {profile.user_id: profile for profile in Profile.objects.all()}
+            counter = StatementCounter()
+            started = time.perf_counter()
+            with connection.execute_wrapper(counter):
+                for _, user_id in stream:
+                    profiles[user_id].update_last_online()
+            self.report('На каждый запрос', counter.count, len(stream), time.perf_counter() - started)
+
+            # Пакетная запись: запросы только отмечаются в памяти, запись - раз в flush_interval
+            tracker = ActivityTracker()
+            rows = 0
+            next_flush = stream[0][0] + flush_interval
+            counter = StatementCounter()
+            started = time.perf_counter()
+            with connection.execute_wrapper(counter):
+                for seen_at, user_id in stream:
+                    if seen_at >= next_flush:
+                        rows += tracker.flush(now=seen_at)
+                        next_flush += flush_interval
+                    tracker.record(user_id, seen_at)
+                rows += tracker.flush(force=True)
+            self.report('Пакетами', counter.count, rows, time.perf_counter() - started)
+
+            writes_per_user = rows / len(set(user_id for _, user_id in stream))
+            self.stdout.write(f'\nЗаписей last_online на активного пользователя: {writes_per_user:.1f}')
+
+    def report(self, title, statements, rows, elapsed):
+        self.stdout.write(
+            f'   {title}: {statements} UPDATE, {rows} строк, {elapsed * 1000:.0f} мс'
+        )
@@ -0,0 +1,171 @@
+"""
+Django management команда для измерения пропускной способности отправки сообщений
+при разном числе шардов сообщений (settings.MESSAGE_SHARDS). Несколько процессов
+(как рабочие процессы gunicorn) одновременно отправляют сообщения в свои беседы:
+    insert - только запись сообщения (Message.objects.create) в шард беседы;
+    send   - полная отправка через представление переписки: кроме сообщения пишутся
+             беседа (last_message_at) и лимиты сообщений в основной базе
+Каждое число шардов проверяется на отдельных временных базах с одинаковыми данными
+Использование:
+    python manage.py bench_message_shards [--shards 1 2 4] [--modes insert send] [--workers 8] [--duration 5]
+"""
+
+import multiprocessing
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections
+from django.test import Client
+
+from profiles.activity import activity_tracker
+from profiles.cache_utils import invalidate_all_caches
+from profiles.management.bench_data import (
+    percentile, seed_dating_data, temporary_database, temporary_message_shards,
+)
+from profiles.models import Message
+
+MODES = ('insert', 'send')
+
+# Бесед, в которые по очереди пишет один процесс в режиме send
+SEND_CONVERSATIONS_PER_WORKER = 4
+
+# Текст проходит проверки MessageForm (длина, стоп-слова, повторяющиеся символы)
+MESSAGE_TEXT = 'Привет! Как прошли выходные? ({})'
+
+
+class Command(BaseCommand):
+    help = 'Сравнить пропускную способность отправки сообщений при 1, 2 и 4 шардах сообщений'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shards', type=int, nargs='*', default=[1, 2, 4], help='Числа шардов')
+        parser.add_argument('--modes', nargs='*', choices=MODES, default=list(MODES), help='Режимы отправки')
+        parser.add_argument('--workers', type=int, default=8, help='Параллельных отправителей (процессов)')
+        parser.add_argument('--duration', type=float, default=5, help='Длительность прогона в секундах')
+        parser.add_argument('--users', type=int, default=200, help='Синтетических пользователей')
+
+    def handle(self, *args, **options):
+        if connections['default'].vendor != 'sqlite':
+            raise CommandError('Бенчмарк предназначен для SQLite')
+        if min(options['shards']) < 1:
+            raise CommandError('Число шардов должно быть положительным')
+        settings.ALLOWED_HOSTS = [*settings.ALLOWED_HOSTS, 'testserver']
+
+        self.stdout.write(self.style.SUCCESS('=== Шарды сообщений: параллельная отправка ===\n'))
+        self.stdout.write(
+            f'Процессов: {options["workers"]}, {options["duration"]:.0f} с на прогон, '
+            f'пользователей: {options["users"]}'
+        )
+        summary = {}
+        for mode in options['modes']:
+            for count in options['shards']:
+                with temporary_database() as directory, temporary_message_shards(count, directory) as shards:
+                    _, conversations = seed_dating_data(users=options['users'], conversations_per_user=2,
+                                                        messages_per_conversation=2)
+                    # Активность пользователей сида записывается во временную базу, а не при выходе
+                    activity_tracker.flush(force=True)
+                    seeded = {alias: Message.objects.using(alias).count() for alias in shards}
+                    connections.close_all()
+                    invalidate_all_caches()
+                    results = self.run_senders(mode, conversations, options['workers'], options['duration'])
+                    # Отправленные сообщения по шардам (без созданных при заполнении)
+                    distribution = {
+                        alias: Message.objects.using(alias).count() - seeded[alias] for alias in shards
+                    }
+                    summary[mode, count] = self.report(mode, count, results, distribution, options['duration'])
+
+        self.stdout.write(self.style.SUCCESS('\n=== Итог: сообщений/с ==='))
+        for mode in options['modes']:
+            baseline = summary.get((mode, options['shards'][0]))
+            row = ', '.join(
+                f'{count} шард(ов): {summary[mode, count]:.0f}'
+                + (f' (x{summary[mode, count] / baseline:.2f})' if baseline else '')
+                for count in options['shards']
+            )
+            self.stdout.write(f'   {mode:<7} {row}')
+
+    def run_senders(self, mode, conversations, workers, duration):
+        """Запустить отправителей в процессах; каждому достается своя часть бесед"""
+        context = multiprocessing.get_context('fork')
+        queue = context.Queue()
+        deadline = time.time() + duration
+        processes = [
+            context.Process(target=self.sender_loop, args=(
+                mode, conversations[index::workers], deadline, queue,
+            ))
+            for index in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        results = {'latencies': [], 'errors': 0, 'locked': 0}
+        for _ in processes:
+            stats = queue.get()
+            results['latencies'].extend(stats['latencies'])
+            results['errors'] += stats['errors']
+            results['locked'] += stats['locked']
+        for process in processes:
+            process.join()
+        return results
+
+    def sender_loop(self, mode, conversations, deadline, queue):
+        """Отправка сообщений по кругу в беседы процесса; результаты - через очередь"""
+        results = {'latencies': [], 'errors': 0, 'locked': 0}
+        if mode == 'send':
+            conversations = conversations[:SEND_CONVERSATIONS_PER_WORKER]
+            clients = {}
+            for conversation in conversations:
+                for user in (conversation.participant1, conversation.participant2):
+                    client = Client()
+                    client.force_login(user)
+                    clients[conversation.id, user.id] = client
+        turns = defaultdict(int)
+        index = 0
+        try:
+            while conversations and time.time() < deadline:
+                conversation = conversations[index % len(conversations)]
+                index += 1
+                # Участники пишут по очереди: лимит неотвеченных сообщений не срабатывает
+                sender, receiver = conversation.participant1, conversation.participant2
+                if turns[conversation.id] % 2:
+                    sender, receiver = receiver, sender
+                turns[conversation.id] += 1
+
+                started = time.perf_counter()
+                try:
+                    if mode == 'insert':
+                        Message.objects.create(conversation=conversation, sender=sender, receiver=receiver,
+                                               content=MESSAGE_TEXT.format(index))
+                        failed = False
+                    else:
+                        response = clients[conversation.id, sender.id].post(
+                            f'/profiles/conversations/{conversation.id}/',
+                            {'send_message': '1', 'content': MESSAGE_TEXT.format(index)},
+                        )
+                        # Успешная отправка перенаправляет на страницу переписки
+                        failed = response.status_code != 302
+                    locked = False
+                except OperationalError as error:
+                    failed, locked = True, 'locked' in str(error)
+                results['latencies'].append((time.perf_counter() - started) * 1000)
+                results['errors'] += failed
+                results['locked'] += locked
+        finally:
+            activity_tracker.flush(force=True)
+            connections.close_all()
+            queue.put(results)
+
+    def report(self, mode, count, results, distribution, duration):
+        """Вывести результаты прогона; возвращает сообщений в секунду"""
+        latencies = results['latencies']
+        throughput = len(latencies) / duration
+        self.stdout.write(
+            f'\n✉️  {mode}, шардов: {count}: {throughput:.0f} сообщений/с, '
+            f'p50 {percentile(latencies, 50):6.1f} мс, p95 {percentile(latencies, 95):6.1f} мс, '
+            f'max {max(latencies, default=0):7.1f} мс, ошибок {results["errors"]} '
+            f'(из них "database is locked": {results["locked"]})'
+        )
+        self.stdout.write('   отправлено в шарды: ' + ', '.join(
+            f'{alias} {rows}' for alias, rows in distribution.items()
+        ))
+        return throughput
@@ -0,0 +1,141 @@
+"""
+Django management команда для проверки индексов таблиц переписки
+Заполняет временную базу (по умолчанию 10 млн сообщений), выполняет запросы представлений
+переписки без индексов из Meta.indexes и с ними и выводит EXPLAIN QUERY PLAN и задержки
+Использование:
+    python manage.py bench_messaging_indexes [--messages 10000000] [--users 50000] [--samples 200]
+"""
+
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models import Q
+from django.test.utils import CaptureQueriesContext
+
+from profiles.management.bench_data import (
+    percentile, seed_dating_data, seed_messages_sql, temporary_database,
+)
+from profiles.models import Conversation, Message, MessageLimit, Report
+
+
+def last_page(conversation):
+    """Последняя страница переписки, как в conversation_detail (счетчик + срез)"""
+    paginator = Paginator(Message.objects.in_conversation(conversation).order_by('sent_at'), 20)
+    return list(paginator.get_page(paginator.num_pages))
+
+
+# Запросы представлений переписки: (представление, запрос, функция от (user, other, conversation))
+QUERIES = (
+    ('conversations_list', 'переписки пользователя', lambda user, other, conv: list(
+        Conversation.objects.with_participants()
+        .filter(Q(participant1=user) | Q(participant2=user)).order_by('-last_message_at')
+    )),
+    ('conversations_list', 'последнее сообщение', lambda user, other, conv: conv.messages.last()),
+    ('conversations_list', 'непрочитанные в беседе', lambda user, other, conv: conv.messages.filter(
+        receiver=user, is_read=False).count()),
+    ('conversation_detail', 'последняя страница', lambda user, other, conv: last_page(conv)),
+    ('conversation_detail', 'непрочитанные для отметки', lambda user, other, conv: list(
+        Message.objects.unread_for_user(user).filter(conversation=conv)
+    )),
+    ('unread_count', 'непрочитанные пользователя', lambda user, other, conv: Message.objects.unread_for_user(
+        user).count()),
+    ('send_message', 'лимит сообщений', lambda user, other, conv: MessageLimit.objects.filter(
+        sender=user, receiver=other).first()),
+    ('report_user', 'жалоба пользователя', lambda user, other, conv: Report.objects.filter(
+        reporter=user, reported_user=other).first()),
+)
+
+
+class Command(BaseCommand):
+    help = 'Сравнить планы и задержки запросов переписки без индексов Meta.indexes и с ними'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=10_000_000, help='Сообщений в базе')
+        parser.add_argument('--users', type=int, default=50_000, help='Пользователей')
+        parser.add_argument('--conversations-per-user', type=int, default=5, help='Переписок на пользователя')
+        parser.add_argument('--samples', type=int, default=200, help='Случайных переписок на каждый запрос')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('Бенчмарк предназначен для SQLite')
+        indexes = [(Message, index) for index in Message._meta.indexes]
+
+        self.stdout.write(self.style.SUCCESS('=== Индексы таблиц переписки ===\n'))
+        with temporary_database():
+            # Индексы строятся после заполнения: так быстрее, и план «до» считается без них
+            self.alter_indexes(indexes, add=False)
+            started = time.perf_counter()
+            users, _ = seed_dating_data(
+                users=options['users'], conversations_per_user=0, messages_per_conversation=0,
+            )
+            conversations = seed_messages_sql(users, options['conversations_per_user'], options['messages'])
+            self.stdout.write(
+                f'База: {len(users)} пользователей, {conversations} переписок, '
+                f'{options["messages"]} сообщений ({time.perf_counter() - started:.0f} с)'
+            )
+
+            rng = random.Random(42)
+            samples = [
+                (conv.participant1, conv.participant2, conv)
+                for conv in Conversation.objects.select_related('participant1', 'participant2')
+                .filter(id__in=rng.sample(range(1, conversations + 1), min(options['samples'], conversations)))
+            ]
+
+            before = self.measure(samples)
+            started = time.perf_counter()
+            self.alter_indexes(indexes, add=True)
+            self.stdout.write(
+                f'Индексы: {", ".join(index.name for _, index in indexes)} '
+                f'(построены за {time.perf_counter() - started:.1f} с)'
+            )
+            after = self.measure(samples)
+
+        for (view, title, _), (plan_before, times_before), (plan_after, times_after) in zip(QUERIES, before, after):
+            self.stdout.write(f'\n📨 {view}: {title}')
+            self.stdout.write(
+                f'   без индексов: p50 {percentile(times_before, 50):.3f} мс, p95 {percentile(times_before, 95):.3f} мс'
+            )
+            for line in plan_before:
+                self.stdout.write(f'      {line}')
+            self.stdout.write(
+                f'   с индексами:  p50 {percentile(times_after, 50):.3f} мс, p95 {percentile(times_after, 95):.3f} мс'
+            )
+            for line in plan_after:
+                self.stdout.write(f'      {line}')
+
+    @staticmethod
+    def alter_indexes(indexes, add):
+        with connection.schema_editor() as editor:
+            for model, index in indexes:
+                if add:
+                    editor.add_index(model, index)
+                else:
+                    editor.remove_index(model, index)
+
+    @staticmethod
+    def measure(samples):
+        """Для каждого запроса: (строки EXPLAIN QUERY PLAN, задержки в мс по выборке)"""
+        results = []
+        for _, _, query in QUERIES:
+            user, other, conv = samples[0]
+            with CaptureQueriesContext(connection) as captured:
+                query(user, other, conv)
+            plan = []
+            with connection.cursor() as cursor:
+                for executed in captured.captured_queries:
+                    cursor.execute(f'EXPLAIN QUERY PLAN {executed["sql"]}')
+                    plan.extend(row[-1] for row in cursor.fetchall())
+
+            # Первый проход прогревает кэш страниц, замеряется второй
+            for user, other, conv in samples:
+                query(user, other, conv)
+            timings = []
+            for user, other, conv in samples:
+                started = time.perf_counter()
+                query(user, other, conv)
+                timings.append((time.perf_counter() - started) * 1000)
+            results.append((plan, timings))
+        return results
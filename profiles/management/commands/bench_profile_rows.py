@@ -0,0 +1,156 @@
+"""
+Django management команда для оценки размера строки профиля
+Заполняет временную базу профилями с целями поиска разной длины и показывает по dbstat
+средний размер строки и число строк на страницу таблицы профилей целиком и после выноса
+в отдельную таблицу один-к-одному редко читаемых полей (COLD_FIELDS) и цели поиска, а также
+задержки запроса поиска по каждой таблице и загрузки страницы результатов полными строками
+и проекцией карточек (ProfileManager.as_cards)
+Использование:
+    python manage.py bench_profile_rows [--profiles 50000] [--samples 200]
+"""
+
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from profiles.management.bench_data import percentile, seed_dating_data, temporary_database
+from profiles.models import Profile
+
+# Редко читаемые поля: показываются только на странице профиля и в форме редактирования
+COLD_FIELDS = (
+    'conception_method', 'father_contact', 'payment_approach',
+    'desired_age_min', 'desired_age_max', 'desired_height_min', 'desired_height_max',
+    'desired_weight_min', 'desired_weight_max', 'desired_appearance', 'desired_city',
+    'health_rating', 'has_diseases',
+)
+
+GOAL_WORDS = ('ищу', 'партнера', 'для', 'создания', 'семьи', 'и', 'рождения', 'ребенка', 'серьезные',
+              'отношения', 'спокойный', 'надежный', 'человек', 'без', 'вредных', 'привычек')
+
+# Профилей на странице результатов поиска
+PAGE_SIZE = 12
+
+
+class Command(BaseCommand):
+    help = 'Оценить размер строки профиля и выигрыш от проекций и выноса редких полей'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', type=int, default=50_000, help='Профилей в базе')
+        parser.add_argument('--samples', type=int, default=200, help='Повторов каждого запроса')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('Бенчмарк предназначен для SQLite (статистика страниц из dbstat)')
+        table = Profile._meta.db_table
+        columns = [field.column for field in Profile._meta.concrete_fields if field.column != 'id']
+        cold = [Profile._meta.get_field(name).column for name in COLD_FIELDS]
+        hot = [column for column in columns if column not in cold]
+        narrow = [column for column in hot if column != 'goal']
+
+        self.stdout.write(self.style.SUCCESS('=== Размер строки профиля ===\n'))
+        with temporary_database():
+            started = time.perf_counter()
+            seed_dating_data(users=options['profiles'], conversations_per_user=0, messages_per_conversation=0)
+            self.fill_goals()
+            # Таблицы, какими они были бы после выноса COLD_FIELDS (и цели поиска)
+            with connection.cursor() as cursor:
+                for name, table_columns in (('bench_profile_hot', hot), ('bench_profile_narrow', narrow),
+                                            ('bench_profile_cold', cold)):
+                    cursor.execute(f'CREATE TABLE {name} (id INTEGER PRIMARY KEY, {", ".join(table_columns)})')
+                    cursor.execute(
+                        f'INSERT INTO {name} (id, {", ".join(table_columns)}) '
+                        f'SELECT id, {", ".join(table_columns)} FROM {table}'
+                    )
+            self.stdout.write(
+                f'База: {options["profiles"]} профилей ({time.perf_counter() - started:.0f} с), '
+                f'{len(columns) + 1} столбцов, из них редких: {len(cold)}'
+            )
+
+            self.stdout.write('\n📏 Строки таблиц (dbstat)')
+            for name, title in ((table, 'профиль целиком'), ('bench_profile_hot', 'без редких полей'),
+                                ('bench_profile_narrow', 'без редких и goal'), ('bench_profile_cold', 'редкие поля')):
+                self.report_table(name, title)
+
+            rng = random.Random(42)
+            filters = [(rng.randint(1, 15), rng.randint(1, 2), rng.randint(18, 40)) for _ in range(options['samples'])]
+            self.stdout.write('\n🔎 Поиск: id по фильтрам (полное сканирование, 1000 строк)')
+            for name, title in ((table, 'профиль целиком'), ('bench_profile_hot', 'без редких полей'),
+                                ('bench_profile_narrow', 'без редких и goal')):
+                timings = self.measure_search(name, filters)
+                self.stdout.write(
+                    f'   {title:<20} p50 {percentile(timings, 50):7.2f} мс, p95 {percentile(timings, 95):7.2f} мс'
+                )
+
+            pages = [
+                list(Profile.objects.filter(city=city, gender=gender).values_list('id', flat=True)[:PAGE_SIZE])
+                for city, gender, _ in filters
+            ]
+            self.stdout.write(f'\n🗂  Страница результатов ({PAGE_SIZE} профилей)')
+            for title, queryset in (
+                ('полные строки', Profile.objects.select_related('user')),
+                ('as_cards', Profile.objects.as_cards()),
+            ):
+                timings, size = self.measure_page(queryset, pages)
+                self.stdout.write(
+                    f'   {title:<20} p50 {percentile(timings, 50):7.3f} мс, p95 {percentile(timings, 95):7.3f} мс, '
+                    f'{size / PAGE_SIZE:.0f} байт данных на профиль'
+                )
+
+    @staticmethod
+    def fill_goals():
+        """Цели поиска разной длины, как у заполненных пользователями анкет"""
+        rng = random.Random(7)
+        ids = Profile.objects.values_list('id', flat=True)
+        goals = [(' '.join(rng.choices(GOAL_WORDS, k=rng.randint(5, 80))), profile_id) for profile_id in ids]
+        with connection.cursor() as cursor:
+            cursor.executemany(f'UPDATE {Profile._meta.db_table} SET goal = %s WHERE id = %s', goals)
+
+    def report_table(self, name, title):
+        """Средний размер записи, строк на листовую страницу и страниц переполнения"""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pagetype, COUNT(*), SUM(ncell), SUM(payload), MAX(pgsize) FROM dbstat '
+                'WHERE name = %s GROUP BY pagetype', [name],
+            )
+            stats = {pagetype: (pages, cells, payload, page_size) for pagetype, pages, cells, payload, page_size
+                     in cursor.fetchall()}
+        leaf_pages, rows, payload, page_size = stats.get('leaf', (0, 0, 0, 0))
+        overflow_pages, _, overflow_payload, _ = stats.get('overflow', (0, 0, 0, 0))
+        total_pages = sum(pages for pages, _, _, _ in stats.values())
+        rows = rows or 1
+        self.stdout.write(
+            f'   {title:<20} {(payload + overflow_payload) / rows:6.0f} байт на строку, '
+            f'{rows / max(leaf_pages, 1):5.1f} строк на страницу {page_size} байт, '
+            f'{total_pages} страниц ({total_pages * page_size / 1024 / 1024:.1f} MB)'
+            + (f', переполнение: {overflow_pages}' if overflow_pages else '')
+        )
+
+    @staticmethod
+    def measure_search(table, filters):
+        """Запрос search_filtered (id активных профилей по фильтрам) к таблице table"""
+        sql = (f'SELECT id FROM {table} WHERE is_active AND city = %s AND gender = %s AND age >= %s '
+               f'ORDER BY last_online DESC LIMIT 1000')
+        timings = []
+        with connection.cursor() as cursor:
+            for params in filters:
+                started = time.perf_counter()
+                cursor.execute(sql, params)
+                cursor.fetchall()
+                timings.append((time.perf_counter() - started) * 1000)
+        return timings
+
+    @staticmethod
+    def measure_page(queryset, pages):
+        """Загрузка профилей страницы по id: задержки в мс и объем полученных значений в байтах"""
+        timings = []
+        for ids in pages:
+            started = time.perf_counter()
+            list(queryset.filter(id__in=ids))
+            timings.append((time.perf_counter() - started) * 1000)
+        sql, params = queryset.filter(id__in=pages[0]).query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            size = sum(len(str(value).encode()) for row in cursor.fetchall() for value in row if value is not None)
+        return timings, size
@@ -0,0 +1,175 @@
+"""
+Django management команда для сравнения хранилищ сессий (settings.SESSION_PROFILES)
+Пользователи входят на сайт, ищут профили и отправляют сообщения; запросы по очереди
+попадают в разные рабочие процессы (у каждого свой экземпляр локального кэша сессий).
+Для каждого профиля выводятся чтения и записи таблицы сессий на запрос по сценариям
+и размер cookie сессии и сообщений
+Использование:
+    python manage.py bench_sessions [--profiles cached_db shared_cache] [--users 30] [--workers 4]
+"""
+
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+from django.utils.module_loading import import_string
+
+from profiles.cache_utils import invalidate_all_caches
+from profiles.management.bench_data import seed_dating_data, temporary_database
+from profiles.models import Conversation
+from profiles.session_backends.write_behind import session_writer
+
+PASSWORD = 'bench-password'
+
+FLOWS = ('login', 'search', 'send')
+
+
+class SessionQueryCounter:
+    """Обертка выполнения запросов (connection.execute_wrapper): чтения и записи таблицы сессий"""
+
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        if Session._meta.db_table in sql:
+            if sql.lstrip().upper().startswith('SELECT'):
+                self.reads += 1
+            else:
+                self.writes += 1
+        return execute(sql, params, many, context)
+
+
+class Workers:
+    """
+    Рабочие процессы, между которыми по очереди распределяются запросы
+    Локальный кэш сессий (LocMemCache) у каждого процесса свой; общий кэш - один на всех
+    """
+
+    def __init__(self, count):
+        alias = settings.SESSION_CACHE_ALIAS
+        self.alias = alias
+        self.caches = [caches[alias]]
+        if isinstance(caches[alias], LocMemCache):
+            params = dict(settings.CACHES[alias])
+            backend = import_string(params.pop('BACKEND'))
+            location = params.pop('LOCATION', alias)
+            self.caches = [backend(f'{location}-bench-worker-{index}', params) for index in range(count)]
+        self.turn = 0
+
+    def next(self):
+        caches[self.alias] = self.caches[self.turn % len(self.caches)]
+        self.turn += 1
+
+
+class Command(BaseCommand):
+    help = 'Сравнить чтения и записи сессий в базе для хранилищ сессий на входе, поиске и отправке сообщений'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', nargs='*', help='Профили из SESSION_PROFILES (по умолчанию все)')
+        parser.add_argument('--users', type=int, default=30, help='Пользователей, проходящих сценарии')
+        parser.add_argument('--workers', type=int, default=4, help='Рабочих процессов')
+        parser.add_argument('--rounds', type=int, default=5, help='Повторов поиска и отправки на пользователя')
+
+    def handle(self, *args, **options):
+        available = settings.SESSION_PROFILES
+        names = options['profiles'] or list(available)
+        unknown = [name for name in names if name not in available]
+        if unknown:
+            raise CommandError(f'Неизвестные профили: {", ".join(unknown)}')
+        settings.ALLOWED_HOSTS = [*settings.ALLOWED_HOSTS, 'testserver']
+
+        self.stdout.write(self.style.SUCCESS('=== Хранилища сессий ===\n'))
+        self.stdout.write(
+            f'Пользователей: {options["users"]}, рабочих процессов: {options["workers"]}, '
+            f'повторов поиска и отправки: {options["rounds"]}'
+        )
+        hashers = ['django.contrib.auth.hashers.MD5PasswordHasher']
+        for name in names:
+            profile = available[name]
+            with temporary_database(), override_settings(
+                SESSION_ENGINE=profile['ENGINE'], SESSION_CACHE_ALIAS=profile['CACHE_ALIAS'],
+                PASSWORD_HASHERS=hashers,
+            ):
+                users, _ = seed_dating_data(users=options['users'], conversations_per_user=1,
+                                            messages_per_conversation=0)
+                for user in users:
+                    user.set_password(PASSWORD)
+                    user.save(update_fields=['password'])
+                invalidate_all_caches()
+                session_writer.flush(force=True)
+                results = self.run_flows(users, options['workers'], options['rounds'])
+                self.report(name, results)
+
+    def run_flows(self, users, workers, rounds):
+        """{сценарий: {'requests', 'reads', 'writes', 'cookie_bytes', 'seconds'}}"""
+        pool = Workers(workers)
+        original_cache = caches[pool.alias]
+        results = defaultdict(lambda: defaultdict(float))
+        counter = SessionQueryCounter()
+        clients = [Client() for _ in users]
+        conversations = {}
+        for conversation in Conversation.objects.all():
+            conversations.setdefault(conversation.participant1_id, conversation)
+            conversations.setdefault(conversation.participant2_id, conversation)
+
+        def request(flow, client, method, url, data=None):
+            pool.next()
+            before = (counter.reads, counter.writes)
+            started = time.perf_counter()
+            response = getattr(client, method)(url, data)
+            stats = results[flow]
+            stats['seconds'] += time.perf_counter() - started
+            stats['requests'] += 1
+            stats['reads'] += counter.reads - before[0]
+            stats['writes'] += counter.writes - before[1]
+            stats['cookie_bytes'] += sum(len(morsel.OutputString()) for morsel in response.cookies.values())
+            return response
+
+        try:
+            with connection.execute_wrapper(counter):
+                for user, client in zip(users, clients):
+                    request('login', client, 'get', '/auth/login/')
+                    request('login', client, 'post', '/auth/login/', {'username': user.username, 'password': PASSWORD})
+                    request('login', client, 'get', '/')
+                for round_number in range(rounds):
+                    for user, client in zip(users, clients):
+                        request('search', client, 'get', '/profiles/search/', {'city': round_number % 15 + 1})
+                        conversation = conversations.get(user.id)
+                        if conversation is not None:
+                            url = f'/profiles/conversations/{conversation.id}/'
+                            request('send', client, 'post', url, {'send_message': '1', 'content': 'Бенчмарк ' * 4})
+                            request('send', client, 'get', url)
+                # Отложенная запись сессий, оставшаяся к концу прогона, относится ко входу
+                before = counter.writes
+                session_writer.flush(force=True)
+                results['login']['writes'] += counter.writes - before
+        finally:
+            caches[pool.alias] = original_cache
+        return results
+
+    def report(self, name, results):
+        total_requests = sum(stats['requests'] for stats in results.values())
+        total_reads = sum(stats['reads'] for stats in results.values())
+        total_writes = sum(stats['writes'] for stats in results.values())
+        self.stdout.write(
+            f'\n🍪 {name}: {total_reads / total_requests:.2f} чтений и {total_writes / total_requests:.2f} '
+            f'записей сессий в базе на запрос'
+        )
+        for flow in FLOWS:
+            stats = results.get(flow)
+            if not stats or not stats['requests']:
+                continue
+            requests = stats['requests']
+            self.stdout.write(
+                f'   {flow:<8} {int(requests):>5} запросов: чтений {stats["reads"] / requests:5.2f}, '
+                f'записей {stats["writes"] / requests:5.2f} на запрос, '
+                f'cookie {stats["cookie_bytes"] / requests:5.0f} байт, {stats["seconds"] / requests * 1000:6.1f} мс'
+            )
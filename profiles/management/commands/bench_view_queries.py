@@ -0,0 +1,67 @@
+"""
+Django management команда для подсчета запросов к базе в представлениях
+Выполняет представления профиля, фотографий и переписки от имени пользователя с профилем
+на временной базе и выводит число запросов при первом обращении (пустой кэш)
+и при повторном (кэш прогрет)
+Использование:
+    python manage.py bench_view_queries [-v 2]
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from profiles.activity import activity_tracker
+from profiles.cache_utils import invalidate_all_caches
+from profiles.management.bench_data import seed_dating_data, temporary_database
+from profiles.models import Photo
+
+
+def view_urls(user, photo):
+    """(представление, URL) от имени user; photo - его основная фотография"""
+    return (
+        ('home', '/'),
+        ('my_profile', '/profiles/my/'),
+        ('create_profile', '/profiles/create/'),
+        ('edit_profile', '/profiles/edit/'),
+        ('search_profiles', f'/profiles/search/?city={user.profile.city}'),
+        ('manage_photos', '/profiles/photos/'),
+        ('upload_photo', '/profiles/photos/upload/'),
+        ('upload_multiple_photos', '/profiles/photos/upload-multiple/'),
+        ('set_primary_photo', f'/profiles/photos/set-primary/{photo.id}/'),
+        # Несуществующая фотография: представление проходит проверки, но ничего не удаляет
+        ('delete_photo', '/profiles/photos/delete/0/'),
+        ('conversations_list', '/profiles/conversations/'),
+    )
+
+
+class Command(BaseCommand):
+    help = 'Показать число запросов к базе в представлениях с пустым и прогретым кэшем'
+
+    def handle(self, *args, **options):
+        settings.ALLOWED_HOSTS = [*settings.ALLOWED_HOSTS, 'testserver']
+        self.stdout.write(self.style.SUCCESS('=== Запросы к базе в представлениях ===\n'))
+        with temporary_database():
+            users, _ = seed_dating_data(users=50, conversations_per_user=3, messages_per_conversation=5)
+            user = users[0]
+            photo = Photo.objects.create(profile=user.profile, image='bench/photo.jpg',
+                                         is_primary=True, is_verified=True)
+            invalidate_all_caches()
+            client = Client()
+            client.force_login(user)
+
+            self.stdout.write(f'{"представление":<24} {"пустой кэш":>10} {"прогретый":>10}')
+            for view, url in view_urls(user, photo):
+                counts = []
+                for _ in range(2):
+                    with CaptureQueriesContext(connection) as captured:
+                        client.get(url)
+                    counts.append(len(captured.captured_queries))
+                self.stdout.write(f'{view:<24} {counts[0]:>10} {counts[1]:>10}')
+                if options['verbosity'] >= 2:
+                    for query in captured.captured_queries:
+                        self.stdout.write(f'      {query["sql"][:150]}')
+            # Активность тестового пользователя записывается во временную базу, а не при выходе
+            activity_tracker.flush(force=True)
@@ -1,11 +1,13 @@
 """
 Django management команда для статистики кэширования
-Использование: python manage.py cache_stats
+Использование: python manage.py cache_stats [--cache profiles] [--families] [--reset-metrics]
+Показывает попадания, промахи, вытеснения и задержки, собранные со всех рабочих процессов
 """
 
 from django.core.management.base import BaseCommand
 from django.core.cache import caches
-from profiles.cache_utils import get_cache_stats, cache_manager
+from profiles.cache_utils import get_cache_stats, get_invalidation_bus_stats, cache_manager, MANAGED_CACHES
+from profiles.metrics import reset_metrics
 
 
 class Command(BaseCommand):
@@ -20,10 +22,20 @@ class Command(BaseCommand):
         parser.add_argument(
             '--cache',
             type=str,
-            choices=['default', 'profiles', 'search', 'messages', 'all'],
+            choices=[*MANAGED_CACHES, 'all'],
             default='all',
             help='Показать статистику конкретного кэша',
         )
+        parser.add_argument(
+            '--families',
+            action='store_true',
+            help='Показать статистику и задержки по семействам ключей',
+        )
+        parser.add_argument(
+            '--reset-metrics',
+            action='store_true',
+            help='Удалить накопленные метрики после показа статистики',
+        )
 
     def handle(self, *args, **options):
         self.stdout.write(
@@ -37,44 +49,100 @@ class Command(BaseCommand):
             # Показываем все кэши
             for cache_name, cache_info in stats.items():
                 if cache_name != 'error':
-                    self.show_cache_info(cache_name, cache_info)
+                    self.show_cache_info(cache_name, cache_info, options['families'])
         else:
             # Показываем конкретный кэш
             cache_name = options['cache']
             if cache_name in stats:
-                self.show_cache_info(cache_name, stats[cache_name])
+                self.show_cache_info(cache_name, stats[cache_name], options['families'])
             else:
                 self.stdout.write(
                     self.style.ERROR(f'Кэш "{cache_name}" не найден')
                 )
 
-        # Дополнительная информация о конфигурации
-        self.stdout.write('\n=== Конфигурация кэширования ===')
-        self.stdout.write(f'Backend: {stats.get("default", {}).get("backend", "Unknown")}')
-        
-        if 'error' in stats:
-            self.stdout.write(
-                self.style.ERROR(f'Ошибка получения статистики: {stats["error"]}')
-            )
+        if options['cache'] == 'all':
+            self.show_invalidation_bus_stats()
+
+        if options['reset_metrics']:
+            reset_metrics()
+            self.stdout.write(self.style.SUCCESS('\n✅ Накопленные метрики удалены'))
 
         # Очистка кэшей если запрошена
         if options['clear']:
             self.clear_caches(options['cache'])
 
-    def show_cache_info(self, cache_name, cache_info):
+    def show_cache_info(self, cache_name, cache_info, show_families=False):
         """Показать информацию о конкретном кэше"""
         self.stdout.write(f'\n📦 Кэш: {cache_name.upper()}')
-        self.stdout.write(f'   Backend: {cache_info.get("backend", "Unknown")}')
-        self.stdout.write(f'   Location: {cache_info.get("location", "Unknown")}')
-        
-        # Показываем конфигурацию из settings если доступна
-        from django.conf import settings
-        cache_config = getattr(settings, 'CACHES', {}).get(cache_name, {})
-        if cache_config:
-            timeout = cache_config.get('TIMEOUT', 'Не указан')
-            max_entries = cache_config.get('OPTIONS', {}).get('MAX_ENTRIES', 'Не указан')
-            self.stdout.write(f'   Timeout: {timeout} секунд')
-            self.stdout.write(f'   Max Entries: {max_entries}')
+        self.stdout.write(f'   Backend: {cache_info["backend"]}')
+        self.stdout.write(f'   Location: {cache_info["location"]}')
+        self.stdout.write(f'   Timeout: {cache_info["timeout"]} секунд')
+
+        max_entries = cache_info['max_entries'] or '∞'
+        if cache_info['entries']:
+            for process in cache_info['entries']:
+                line = f'   Записей (pid {process["pid"]}): {process.get("entries", "?")} / {max_entries}'
+                if cache_info['max_bytes']:
+                    line += (f', объем: {self.format_bytes(process.get("bytes", 0))}'
+                             f' / {self.format_bytes(cache_info["max_bytes"])}')
+                self.stdout.write(line)
+        else:
+            self.stdout.write(f'   Записей: нет данных / {max_entries}')
+
+        self.stdout.write(
+            f'   Попадания: {cache_info["hits"]}, промахи: {cache_info["misses"]}, '
+            f'hit rate: {self.format_rate(cache_info["hit_rate"])}'
+        )
+        self.stdout.write(
+            f'   Записи: {cache_info["sets"]} ({self.format_bytes(cache_info["bytes_written"])}), '
+            f'удаления: {cache_info["deletes"]}, вытеснения: {cache_info["evictions"]}'
+        )
+
+        if cache_info.get('tiers'):
+            tiers = cache_info['tiers']
+            self.stdout.write(
+                f'   Попадания по уровням: локальный {tiers.get("local", 0)}, общий {tiers.get("shared", 0)}'
+            )
+
+        if not show_families:
+            return
+        for family, family_info in sorted(cache_info['families'].items()):
+            self.stdout.write(
+                f'   • {family}: hits {family_info["hits"]}, misses {family_info["misses"]}, '
+                f'hit rate {self.format_rate(family_info["hit_rate"])}, '
+                f'evictions {family_info["evictions"]}, '
+                f'записано {self.format_bytes(family_info["bytes_written"])}'
+            )
+        for key, latency in sorted(cache_info['latency'].items()):
+            self.stdout.write(
+                f'     {key}: {latency["count"]} оп., avg {latency["avg_ms"]:.3f} мс, '
+                f'p50 ≤ {latency["p50_ms"]} мс, p99 ≤ {latency["p99_ms"]} мс'
+            )
+
+    def show_invalidation_bus_stats(self):
+        """Показать статистику шины межпроцессной инвалидации"""
+        stats = get_invalidation_bus_stats()
+        self.stdout.write('\n📡 Шина инвалидаций')
+        self.stdout.write(f'   Опубликовано ключей: {stats["published"]}, применено записей: {stats["applied"]}')
+        for key, title in (('publish', 'Публикация'), ('propagation', 'Доставка')):
+            latency = stats[key]
+            if latency:
+                self.stdout.write(
+                    f'   {title}: avg {latency["avg_ms"]:.2f} мс, '
+                    f'p50 ≤ {latency["p50_ms"]} мс, p99 ≤ {latency["p99_ms"]} мс'
+                )
+
+    @staticmethod
+    def format_rate(rate):
+        return f'{rate:.1%}' if rate is not None else '—'
+
+    @staticmethod
+    def format_bytes(size):
+        for unit in ('B', 'KB', 'MB'):
+            if size < 1024:
+                return f'{size:.0f}{unit}'
+            size /= 1024
+        return f'{size:.1f}GB'
 
     def clear_caches(self, cache_type):
         """Очистить кэши"""
@@ -85,6 +153,7 @@ class Command(BaseCommand):
             cache_manager.profiles_cache.clear()
             cache_manager.search_cache.clear()
             cache_manager.messages_cache.clear()
+            cache_manager.tags_cache.clear()
             self.stdout.write(
                 self.style.SUCCESS('✅ Все кэши очищены')
             )
@@ -107,4 +176,9 @@ class Command(BaseCommand):
             cache_manager.messages_cache.clear()
             self.stdout.write(
                 self.style.SUCCESS('✅ Кэш сообщений очищен')
-            ) 
\ No newline at end of file
+            )
+        elif cache_type == 'tags':
+            cache_manager.tags_cache.clear()
+            self.stdout.write(
+                self.style.SUCCESS('✅ Версии тегов сброшены')
+            )
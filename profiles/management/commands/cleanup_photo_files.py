@@ -0,0 +1,178 @@
+"""
+Django management команда для сборки мусора в файлах фотографий
+Использование: python manage.py cleanup_photo_files [--dry-run] [--max-per-second 50]
+"""
+
+import os
+import time
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from profiles.models import Photo, PendingFileDeletion
+from profiles.media_utils import (
+    process_pending_deletions, get_variant_name, VARIANT_PATH_RE, IMAGE_FORMATS
+)
+
+
+class RateLimiter:
+    """Простой ограничитель скорости операций с диском"""
+
+    def __init__(self, max_per_second: float):
+        self.interval = 1.0 / max_per_second if max_per_second > 0 else 0
+        self.next_at = time.monotonic()
+
+    def wait(self, count: int = 1):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if self.next_at > now:
+            time.sleep(self.next_at - now)
+        self.next_at = max(self.next_at, now) + self.interval * count
+
+
+class Command(BaseCommand):
+    help = 'Удалить файлы из очереди удаления и осиротевшие файлы фотографий в MEDIA_ROOT/photos'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=200,
+            help='Размер пакета при сверке с таблицей Photo',
+        )
+        parser.add_argument(
+            '--max-per-second',
+            type=float,
+            default=50,
+            help='Максимум удалений файлов в секунду (0 - без ограничения)',
+        )
+        parser.add_argument(
+            '--min-age',
+            type=int,
+            default=3600,
+            help='Не трогать файлы моложе указанного числа секунд (загрузка может быть не закоммичена)',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Только показать осиротевшие файлы, ничего не удалять',
+        )
+        parser.add_argument(
+            '--skip-queue',
+            action='store_true',
+            help='Не обрабатывать очередь отложенного удаления',
+        )
+        parser.add_argument(
+            '--skip-orphans',
+            action='store_true',
+            help='Не искать осиротевшие файлы',
+        )
+
+    def handle(self, *args, **options):
+        limiter = RateLimiter(options['max_per_second'])
+
+        if not options['skip_queue'] and not options['dry_run']:
+            self.drain_queue(options['batch_size'], limiter)
+
+        if not options['skip_orphans']:
+            self.remove_orphans(options, limiter)
+
+    def drain_queue(self, batch_size, limiter):
+        """Обработать очередь отложенного удаления"""
+        pending = PendingFileDeletion.objects.count()
+        self.stdout.write(f'В очереди на удаление: {pending}')
+
+        processed = 0
+        last_id = 0
+        while True:
+            ids = list(
+                PendingFileDeletion.objects.filter(id__gt=last_id)
+                .order_by('id').values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            limiter.wait(len(ids))
+            processed += process_pending_deletions(ids=ids, batch_size=batch_size)
+            last_id = ids[-1]
+
+        left = PendingFileDeletion.objects.count()
+        self.stdout.write(
+            self.style.SUCCESS(f'✅ Обработано записей очереди: {processed}, осталось: {left}')
+        )
+
+    def remove_orphans(self, options, limiter):
+        """Найти и удалить файлы, на которые не ссылается ни одна запись Photo"""
+        root = os.path.join(settings.MEDIA_ROOT, 'photos')
+        if not os.path.isdir(root):
+            self.stdout.write('Каталог с фотографиями не найден')
+            return
+
+        cutoff = time.time() - options['min_age']
+        scanned = orphans = 0
+        batch = []
+
+        for name in self.iter_files(root, cutoff):
+            if name.endswith(('.lock', '.tmp')):
+                continue
+            scanned += 1
+            batch.append(name)
+            if len(batch) >= options['batch_size']:
+                orphans += self.process_batch(batch, options['dry_run'], limiter)
+                batch = []
+        if batch:
+            orphans += self.process_batch(batch, options['dry_run'], limiter)
+
+        action = 'Найдено' if options['dry_run'] else 'Удалено'
+        self.stdout.write(
+            self.style.SUCCESS(f'✅ Просмотрено файлов: {scanned}, {action.lower()} осиротевших: {orphans}')
+        )
+
+    def iter_files(self, root, cutoff):
+        """Потоково обойти каталог, возвращая имена файлов относительно MEDIA_ROOT"""
+        media_root = os.fspath(settings.MEDIA_ROOT)
+        stack = [root]
+        while stack:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False) and entry.stat().st_mtime < cutoff:
+                        yield os.path.relpath(entry.path, media_root).replace(os.sep, '/')
+
+    def process_batch(self, names, dry_run, limiter):
+        """Сверить пакет файлов с таблицей Photo и удалить осиротевшие"""
+        variants = {}
+        originals = []
+        for name in names:
+            match = VARIANT_PATH_RE.match(name)
+            if match:
+                variants[name] = int(match.group('photo_id'))
+            else:
+                originals.append(name)
+
+        known = set(Photo.objects.filter(image__in=originals).values_list('image', flat=True))
+        orphans = [name for name in originals if name not in known]
+
+        # Вариант нужен, пока существует фотография с тем же исходным файлом
+        if variants:
+            photos = {
+                photo_id: (image, user_id)
+                for photo_id, image, user_id in Photo.objects.filter(id__in=set(variants.values()))
+                .values_list('id', 'image', 'profile__user_id')
+            }
+            for name, photo_id in variants.items():
+                image, user_id = photos.get(photo_id, (None, None))
+                fmt = name.rsplit('.', 1)[-1]
+                if not image or fmt not in IMAGE_FORMATS or name != get_variant_name(photo_id, user_id, image, fmt):
+                    orphans.append(name)
+
+        for name in orphans:
+            if dry_run:
+                self.stdout.write(f'   {name}')
+                continue
+            limiter.wait()
+            default_storage.delete(name)
+
+        return len(orphans)
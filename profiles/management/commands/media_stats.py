@@ -0,0 +1,69 @@
+"""
+Django management команда для статистики отдачи фотографий
+Использование: python manage.py media_stats [--reset]
+"""
+
+import re
+
+from django.core.management.base import BaseCommand
+
+from profiles.metrics import collect_metrics, reset_metrics
+
+
+METRIC_RE = re.compile(r'^(?P<name>[\w.]+)\{format=(?P<format>\w+)\}$')
+
+
+class Command(BaseCommand):
+    help = 'Показать объем отданных фотографий по форматам (по всем рабочим процессам)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reset',
+            action='store_true',
+            help='Удалить сохраненные метрики после показа',
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            self.style.SUCCESS('=== Отдача фотографий по форматам ===\n')
+        )
+
+        collected = collect_metrics()
+        by_format = {}
+        for metric, value in collected['counters'].items():
+            match = METRIC_RE.match(metric)
+            if match and match.group('name').startswith('media.'):
+                by_format.setdefault(match.group('format'), {})[match.group('name')] = value
+
+        if not by_format:
+            self.stdout.write('Нет данных (метрики записываются рабочими процессами в METRICS_DIR)')
+
+        total_bytes = sum(stats.get('media.bytes_served', 0) for stats in by_format.values())
+        for fmt, stats in sorted(by_format.items()):
+            bytes_served = stats.get('media.bytes_served', 0)
+            share = bytes_served / total_bytes * 100 if total_bytes else 0
+            self.stdout.write(f'\n🖼  Формат: {fmt.upper()}')
+            self.stdout.write(f'   Запросов: {int(stats.get("media.requests", 0))}')
+            self.stdout.write(f'   Отдано: {bytes_served / 1024:.1f} KB ({share:.1f}%)')
+            if stats.get('media.variants_encoded'):
+                encoded = int(stats['media.variants_encoded'])
+                avg_ms = stats.get('media.encode_seconds', 0) / encoded * 1000
+                self.stdout.write(f'   Создано вариантов: {encoded} (в среднем {avg_ms:.0f} мс)')
+
+        # Загрузки фотографий (LimitedTemporaryFileUploadHandler)
+        counters = collected['counters']
+        self.stdout.write('\n📤 Загрузки')
+        self.stdout.write(f'   Файлов принято: {int(counters.get("uploads.files", 0))}')
+        self.stdout.write(f'   Получено: {counters.get("uploads.bytes", 0) / 1024 / 1024:.1f} MB')
+        for metric, value in sorted(counters.items()):
+            if metric.startswith('uploads.rejected'):
+                self.stdout.write(f'   Отклонено {metric[len("uploads.rejected"):]}: {int(value)}')
+        peak_rss = collected['gauges'].get('uploads.peak_rss_kb')
+        if peak_rss:
+            self.stdout.write(f'   Пиковый RSS процесса при загрузке: {peak_rss / 1024:.1f} MB')
+
+        self.stdout.write(f'\nПроцессов с метриками: {len(collected["processes"])}')
+
+        if options['reset']:
+            reset_metrics()
+            self.stdout.write(self.style.SUCCESS('✅ Метрики удалены'))
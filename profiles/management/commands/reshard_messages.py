@@ -0,0 +1,137 @@
+"""
+Django management команда для переноса сообщений при изменении числа шардов
+(settings.MESSAGE_SHARDS). Беседы перебираются пакетами по id, сообщения бесед, сменивших
+шард, копируются пакетами (keyset по id) с сохранением id; в памяти одновременно находится
+не больше одного пакета. При росте числа шардов jump consistent hash переносит только
+долю 1 - N/M бесед, и только в новые шарды.
+Порядок решардинга с N на M шардов:
+    1. SQLITE_MESSAGE_SHARDS=M python manage.py migrate --database messages_<k> (новые шарды)
+    2. SQLITE_MESSAGE_SHARDS=M python manage.py reshard_messages --from N --to M
+       (сайт работает с N шардами; копия повторяема, источник остается основным)
+    3. Переключить сайт на M шардов
+    4. SQLITE_MESSAGE_SHARDS=M python manage.py reshard_messages --from N --to M --finalize
+       (дописать сообщения, отправленные между шагами 2 и 3, и удалить перенесенные из старых шардов)
+Использование:
+    python manage.py reshard_messages --from 2 --to 4 [--finalize] [--batch-size 500] [--dry-run]
+"""
+
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from profiles.db_router import message_shard
+from profiles.models import Conversation, Message
+
+
+class Command(BaseCommand):
+    help = 'Перенести сообщения бесед, сменивших шард, при изменении числа шардов сообщений'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', type=int, required=True, dest='from_count', help='Прежнее число шардов')
+        parser.add_argument('--to', type=int, dest='to_count',
+                            help='Новое число шардов (по умолчанию - MESSAGE_SHARDS)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Бесед в пакете')
+        parser.add_argument('--message-batch-size', type=int, default=1000, help='Сообщений в пакете копирования')
+        parser.add_argument('--finalize', action='store_true',
+                            help='Дописать отставшие сообщения и удалить перенесенные из прежних шардов')
+        parser.add_argument('--dry-run', action='store_true', help='Только посчитать переносимые беседы')
+
+    def handle(self, *args, **options):
+        configured = list(settings.MESSAGE_SHARDS)
+        from_count = options['from_count']
+        to_count = options['to_count'] or len(configured)
+        if min(from_count, to_count) < 1 or max(from_count, to_count) > len(configured):
+            raise CommandError(
+                f'Число шардов должно быть от 1 до {len(configured)} (MESSAGE_SHARDS); '
+                f'запустите команду с SQLITE_MESSAGE_SHARDS={max(from_count, to_count)}'
+            )
+        old_shards, new_shards = configured[:from_count], configured[:to_count]
+        table = Message._meta.db_table
+        missing = [alias for alias in new_shards if table not in connections[alias].introspection.table_names()]
+        if missing:
+            raise CommandError(f'Нет таблицы сообщений в {", ".join(missing)}: выполните migrate --database')
+
+        self.message_batch_size = options['message_batch_size']
+        self.finalize = options['finalize']
+        stats = defaultdict(int)
+        moved = defaultdict(int)
+        started = time.perf_counter()
+        last_id = 0
+        while True:
+            # Беседы читаются из основной базы, а не из реплики
+            ids = list(
+                Conversation.objects.using(DEFAULT_DB_ALIAS).filter(id__gt=last_id)
+                .order_by('id').values_list('id', flat=True)[:options['batch_size']]
+            )
+            if not ids:
+                break
+            last_id = ids[-1]
+            stats['conversations'] += len(ids)
+            moves = defaultdict(list)
+            for conversation_id in ids:
+                source = message_shard(conversation_id, old_shards)
+                target = message_shard(conversation_id, new_shards)
+                if source != target:
+                    moves[source, target].append(conversation_id)
+            for (source, target), conversation_ids in moves.items():
+                moved[source, target] += len(conversation_ids)
+                if options['dry_run']:
+                    continue
+                stats['copied'] += self.copy_messages(source, target, conversation_ids)
+                if self.finalize:
+                    deleted, _ = Message.objects.using(source).filter(conversation_id__in=conversation_ids).delete()
+                    stats['deleted'] += deleted
+            if options['verbosity'] >= 2:
+                self.stdout.write(f'   до беседы {last_id}: скопировано {stats["copied"]} сообщений')
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Шардов {from_count} -> {to_count}: бесед {stats["conversations"]}, '
+            f'переносится {sum(moved.values())}'
+        ))
+        for (source, target), count in sorted(moved.items()):
+            self.stdout.write(f'   {source} -> {target}: {count} бесед')
+        if not options['dry_run']:
+            self.stdout.write(
+                f'Скопировано сообщений: {stats["copied"]}, удалено из прежних шардов: {stats["deleted"]}, '
+                f'{elapsed:.1f} с ({stats["copied"] / elapsed if elapsed else 0:.0f} сообщений/с)'
+            )
+
+    def copy_messages(self, source, target, conversation_ids):
+        """Скопировать сообщения бесед из source в target пакетами; возвращает число сообщений"""
+        copied = 0
+        last_id = None
+        while True:
+            queryset = Message.objects.using(source).filter(conversation_id__in=conversation_ids)
+            if last_id is not None:
+                queryset = queryset.filter(id__gt=last_id)
+            rows = list(queryset.order_by('id')[:self.message_batch_size])
+            if not rows:
+                return copied
+            last_id = rows[-1].id
+            with transaction.atomic(using=target):
+                if self.finalize:
+                    self.merge_batch(target, rows)
+                else:
+                    # До переключения источник основной: копия в новом шарде повторяет его
+                    Message.objects.using(target).bulk_create(
+                        rows, update_conflicts=True, unique_fields=['id'], update_fields=['is_read', 'read_at'],
+                    )
+            copied += len(rows)
+
+    def merge_batch(self, target, rows):
+        """
+        После переключения основной - новый шард: дописываются только отсутствующие сообщения,
+        а прочтение в прежнем шарде переносится, но не отменяет прочтение в новом
+        """
+        Message.objects.using(target).bulk_create(rows, ignore_conflicts=True)
+        read = {row.id: row for row in rows if row.is_read}
+        if not read:
+            return
+        stale = list(Message.objects.using(target).filter(id__in=list(read), is_read=False).only('id'))
+        for message in stale:
+            message.is_read, message.read_at = True, read[message.id].read_at
+        Message.objects.using(target).bulk_update(stale, ['is_read', 'read_at'])
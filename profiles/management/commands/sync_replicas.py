@@ -0,0 +1,77 @@
+"""
+Django management команда для синхронизации локальных реплик SQLite
+Копирует основную базу в каждую реплику (settings.DATABASE_REPLICAS) через online backup API
+с заданным интервалом и показывает отставание реплик
+Использование:
+    python manage.py sync_replicas [--interval 1] [--once]
+    python manage.py sync_replicas --status
+"""
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from profiles.db_router import DEFAULT_MAX_LAG, get_replica_aliases, read_replica_status, sync_replica
+
+# Как часто выводится сводка при непрерывной синхронизации (секунды)
+REPORT_INTERVAL = 10
+
+
+class Command(BaseCommand):
+    help = 'Синхронизировать реплики SQLite с основной базой и показать их отставание'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=1.0, help='Интервал между снимками в секундах')
+        parser.add_argument('--once', action='store_true', help='Сделать один снимок и выйти')
+        parser.add_argument('--status', action='store_true', help='Только показать отставание реплик')
+
+    def handle(self, *args, **options):
+        replicas = get_replica_aliases()
+        if not replicas:
+            raise CommandError('Реплики не настроены: задайте SQLITE_REPLICA_NAME (settings.DATABASE_REPLICAS)')
+        for alias in replicas:
+            if connections[alias].vendor != 'sqlite':
+                raise CommandError(f'Реплика {alias} не SQLite: синхронизация выполняется средствами СУБД')
+
+        if options['status']:
+            self.report(replicas)
+            return
+
+        self.stdout.write(self.style.SUCCESS('=== Синхронизация реплик ===\n'))
+        reported_at = time.monotonic()
+        try:
+            while True:
+                started = time.monotonic()
+                for alias in replicas:
+                    status = sync_replica(alias)
+                    if options['verbosity'] >= 2:
+                        self.stdout.write(
+                            f'{alias}: {status["size"] / 1024 / 1024:.1f} MB за {status["duration"] * 1000:.0f} мс'
+                        )
+                if options['once']:
+                    break
+                if time.monotonic() - reported_at >= REPORT_INTERVAL:
+                    self.report(replicas)
+                    reported_at = time.monotonic()
+                time.sleep(max(options['interval'] - (time.monotonic() - started), 0))
+        except KeyboardInterrupt:
+            pass
+        self.report(replicas)
+
+    def report(self, replicas):
+        """Отставание реплик: время с начала последнего снимка"""
+        max_lag = getattr(settings, 'DATABASE_REPLICA_MAX_LAG', DEFAULT_MAX_LAG)
+        for alias in replicas:
+            status = read_replica_status(alias)
+            if status is None:
+                self.stdout.write(self.style.WARNING(f'   {alias}: еще не синхронизирована (чтения идут в основную базу)'))
+                continue
+            lag = time.time() - status['synced_at']
+            line = (f'   {alias}: отставание {lag:.1f} с, последний снимок {status["duration"] * 1000:.0f} мс, '
+                    f'{status["pages"]} страниц, {status["size"] / 1024 / 1024:.1f} MB')
+            if lag > max_lag:
+                self.stdout.write(self.style.WARNING(f'{line} - больше {max_lag} с, реплика не используется'))
+            else:
+                self.stdout.write(line)
@@ -0,0 +1,42 @@
+"""
+Django management команда для прогрева кэшей после развертывания
+Запускается один раз при развертывании (после migrate): записи профилей и переписок попадают
+в общий уровень кэша, из которого их читают все рабочие процессы
+Использование: python manage.py warm_caches [--budget 20] [--workers 4] [--searches 20] [--users 200]
+"""
+
+from django.core.management.base import BaseCommand
+
+from profiles.cache_warmup import (
+    DEFAULT_ACTIVE_USERS, DEFAULT_TIME_BUDGET, DEFAULT_TOP_SEARCHES, DEFAULT_WORKERS, warm_caches,
+)
+
+
+class Command(BaseCommand):
+    help = 'Прогреть кэши: статистика, новые профили, частые поиски, профили и переписки активных пользователей'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--budget', type=float, default=DEFAULT_TIME_BUDGET,
+                            help='Бюджет времени в секундах')
+        parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Потоков прогрева')
+        parser.add_argument('--searches', type=int, default=DEFAULT_TOP_SEARCHES,
+                            help='Сколько частых поисковых запросов прогреть')
+        parser.add_argument('--users', type=int, default=DEFAULT_ACTIVE_USERS,
+                            help='Сколько активных пользователей прогреть')
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.SUCCESS('=== Прогрев кэшей ===\n'))
+        report = warm_caches(
+            time_budget=options['budget'], workers=options['workers'],
+            top_searches=options['searches'], users_limit=options['users'],
+        )
+
+        for kind, planned in report.planned.items():
+            self.stdout.write(f'   {kind}: {report.warmed.get(kind, 0)} / {planned}')
+        self.stdout.write(f'\nПокрытие: {report.coverage * 100:.0f}%, время: {report.duration:.1f} с')
+        if report.failed:
+            self.stdout.write(self.style.WARNING(f'Ошибок: {report.failed}'))
+        if report.budget_exhausted:
+            self.stdout.write(self.style.WARNING('Бюджет времени исчерпан: прогрета только часть записей'))
+        else:
+            self.stdout.write(self.style.SUCCESS('✅ Прогрев завершен'))
@@ -0,0 +1,463 @@
+"""
+Утилиты для работы с медиафайлами сайта знакомств
+Отложенное пакетное удаление файлов фотографий после коммита транзакции
+(фоновым потоком процесса или командой cleanup_photo_files),
+проверка доступа к файлам фотографий при отдаче медиа,
+создание вариантов фотографий в форматах AVIF/WebP фоновым потоком процесса
+(после загрузки и при первом запросе варианта, которого еще нет)
+"""
+
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction, connections, DEFAULT_DB_ALIAS
+from django.db.models import F
+
+from .cache_utils import cache_manager
+
+logger = logging.getLogger(__name__)
+
+# Размер пакета при обработке очереди удаления
+DELETION_BATCH_SIZE = 100
+
+# Путь фотографии: photos/user_<id>/<имя файла> (см. user_photo_path)
+PHOTO_PATH_RE = re.compile(r'^photos/user_(?P<user_id>\d+)/')
+
+# Время кэширования признака "файл доступен всем"
+MEDIA_ACCESS_CACHE_TIMEOUT = 300
+
+# Каталог вариантов фотографий в других форматах (файлы никогда не перезаписываются)
+VARIANTS_DIR = 'photos/variants'
+
+# Вариант фотографии: photos/variants/user_<id>/<photo_id>-<хэш исходного файла>.<формат>
+VARIANT_PATH_RE = re.compile(r'^photos/variants/user_\d+/(?P<photo_id>\d+)-(?P<digest>[0-9a-f]+)\.\w+$')
+
+# Форматы вариантов: MIME-тип, формат Pillow, расширение и параметры кодирования
+IMAGE_FORMATS = {
+    'avif': {'mime': 'image/avif', 'pillow': 'AVIF', 'ext': 'avif', 'options': {'quality': 60}},
+    'webp': {'mime': 'image/webp', 'pillow': 'WEBP', 'ext': 'webp', 'options': {'quality': 80, 'method': 4}},
+}
+
+# Сколько ждать, пока другой процесс кодирует тот же вариант, и когда считать блокировку брошенной
+VARIANT_LOCK_WAIT = 10
+VARIANT_LOCK_STALE = 60
+
+
+def schedule_file_deletion(names: Iterable[str], using: str = DEFAULT_DB_ALIAS):
+    """
+    Поставить файлы в очередь на удаление
+    Запись в очереди создается в текущей транзакции: при откате файл остается на месте,
+    а после коммита записи передаются фоновому потоку (PHOTO_DELETION_WORKER); файлы,
+    которые не удалось удалить, остаются в очереди для cleanup_photo_files
+    Args:
+        names: имена файлов в хранилище (как в FileField.name)
+        using: алиас базы данных текущей транзакции
+    """
+    from .models import PendingFileDeletion
+
+    names = [name for name in names if name]
+    if not names:
+        return
+
+    entries = PendingFileDeletion.objects.using(using).bulk_create(
+        [PendingFileDeletion(path=name) for name in names]
+    )
+    entry_ids = [entry.pk for entry in entries if entry.pk is not None]
+
+    if entry_ids and getattr(settings, 'PHOTO_DELETION_WORKER', True):
+        transaction.on_commit(lambda: file_deletion_worker.enqueue(entry_ids, using), using=using)
+
+
+class FileDeletionWorker:
+    """
+    Фоновый поток процесса, удаляющий файлы из очереди после коммита
+    Запрос только передает id записей очереди и не ждет файловых операций
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending: Dict[str, List[int]] = defaultdict(list)
+        self._thread: Optional[threading.Thread] = None
+
+    def enqueue(self, ids: List[int], using: str = DEFAULT_DB_ALIAS):
+        with self._lock:
+            self._pending[using].extend(ids)
+            # Поток не переживает fork: в дочернем процессе он запускается заново
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='photo-file-deletion', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return sum(len(ids) for ids in self._pending.values())
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            self.drain()
+
+    def drain(self) -> int:
+        """Обработать переданные записи очереди; returns: число обработанных записей"""
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(list)
+        processed = 0
+        for using, ids in pending.items():
+            try:
+                for start in range(0, len(ids), DELETION_BATCH_SIZE):
+                    processed += process_pending_deletions(ids=ids[start:start + DELETION_BATCH_SIZE], using=using)
+            except Exception:
+                # Записи остаются в очереди и будут обработаны cleanup_photo_files
+                logger.exception('Не удалось обработать очередь удаления файлов')
+            finally:
+                connections[using].close()
+        return processed
+
+
+# Фоновое удаление файлов процесса
+file_deletion_worker = FileDeletionWorker()
+
+
+def process_pending_deletions(ids: Optional[List[int]] = None, batch_size: int = DELETION_BATCH_SIZE,
+                              using: str = DEFAULT_DB_ALIAS, storage=None) -> int:
+    """
+    Удалить пакет файлов из очереди (фотографии - вместе с их вариантами в других форматах)
+    Args:
+        ids: идентификаторы записей очереди (по умолчанию - самые старые записи)
+        batch_size: максимальный размер пакета
+        using: алиас базы данных
+        storage: файловое хранилище (по умолчанию default_storage)
+    Returns:
+        количество обработанных записей очереди
+    """
+    from .models import PendingFileDeletion, Photo
+
+    storage = storage or default_storage
+    queue = PendingFileDeletion.objects.using(using)
+    if ids is not None:
+        queue = queue.filter(id__in=ids)
+
+    entries = list(queue.order_by('id').values_list('id', 'path')[:batch_size])
+    if not entries:
+        return 0
+
+    # Файл мог снова стать нужным (например, при повторной загрузке с тем же именем)
+    paths = {path for _, path in entries}
+    in_use = set(
+        Photo.objects.using(using).filter(image__in=paths).values_list('image', flat=True)
+    )
+
+    done_ids, failed_ids = [], []
+    for entry_id, path in entries:
+        if path in in_use:
+            done_ids.append(entry_id)
+            continue
+        try:
+            # Вместе с оригиналом удаляются созданные варианты в других форматах
+            for name in list_photo_variants(path, storage) + [path]:
+                storage.delete(name)
+            done_ids.append(entry_id)
+        except OSError as e:
+            logger.warning('Не удалось удалить файл %s: %s', path, e)
+            failed_ids.append(entry_id)
+
+    if done_ids:
+        PendingFileDeletion.objects.using(using).filter(id__in=done_ids).delete()
+    if failed_ids:
+        PendingFileDeletion.objects.using(using).filter(id__in=failed_ids).update(
+            attempts=F('attempts') + 1
+        )
+
+    return len(entries)
+
+
+# ====================== ДОСТУП К ФАЙЛАМ ФОТОГРАФИЙ ======================
+
+def _media_access_cache_key(name: str) -> str:
+    return 'media_access:' + hashlib.md5(name.encode('utf-8')).hexdigest()
+
+
+def get_photo_owner_id(name: str) -> Optional[int]:
+    """Получить id владельца фотографии по пути файла (без запросов к БД)"""
+    match = PHOTO_PATH_RE.match(name)
+    return int(match.group('user_id')) if match else None
+
+
+def is_media_public(name: str) -> bool:
+    """
+    Проверить, можно ли отдавать файл любому посетителю
+    Фотографии доступны всем только после проверки модератором; результат кэшируется,
+    поэтому для опубликованных фотографий не нужны ни запрос к БД, ни загрузка сессии
+    """
+    if get_photo_owner_id(name) is None:
+        return True
+
+    cache_key = _media_access_cache_key(name)
+    is_public = cache_manager.default_cache.get(cache_key)
+    if is_public is None:
+        from .models import Photo
+        is_public = Photo.objects.filter(image=name, is_verified=True).exists()
+        cache_manager.default_cache.set(cache_key, is_public, MEDIA_ACCESS_CACHE_TIMEOUT)
+    return is_public
+
+
+def invalidate_media_access_cache(name: str):
+    """Сбросить кэшированный признак доступности файла"""
+    cache_manager.default_cache.delete(_media_access_cache_key(name))
+
+
+# ====================== ВАРИАНТЫ ФОТОГРАФИЙ (AVIF/WEBP) ======================
+
+def get_supported_formats() -> List[str]:
+    """Форматы вариантов, которые может закодировать установленный Pillow"""
+    from PIL import features
+
+    enabled = getattr(settings, 'PHOTO_VARIANT_FORMATS', ('avif', 'webp'))
+    return [fmt for fmt in enabled if fmt in IMAGE_FORMATS and features.check(fmt)]
+
+
+def parse_accept(header: str) -> Dict[str, float]:
+    """Разобрать заголовок Accept в словарь {MIME-тип: q}"""
+    accepted = {}
+    for part in (header or '').split(','):
+        media_type, _, params = part.strip().partition(';')
+        if not media_type:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[media_type.strip().lower()] = q
+    return accepted
+
+
+def get_acceptable_formats(accept_header: str) -> List[str]:
+    """Форматы вариантов, которые клиент явно принимает (q > 0), в порядке предпочтения сервера"""
+    accepted = parse_accept(accept_header)
+    return [
+        fmt for fmt in get_supported_formats()
+        if accepted.get(IMAGE_FORMATS[fmt]['mime'], 0) > 0
+    ]
+
+
+def _variant_digest(image_name: str) -> str:
+    return hashlib.md5(image_name.encode('utf-8')).hexdigest()[:12]
+
+
+def get_variant_name(photo_id: int, user_id: int, image_name: str, fmt: str) -> str:
+    """Имя файла варианта; хэш исходного имени делает файл неизменяемым"""
+    return f"{VARIANTS_DIR}/user_{user_id}/{photo_id}-{_variant_digest(image_name)}.{IMAGE_FORMATS[fmt]['ext']}"
+
+
+def list_photo_variants(image_name: str, storage=None) -> List[str]:
+    """
+    Существующие варианты исходного файла фотографии (для удаления вместе с оригиналом)
+    Читает каталог вариантов владельца: вызывается при удалении файлов, а не в запросе
+    """
+    user_id = get_photo_owner_id(image_name)
+    if user_id is None:
+        return []
+    storage = storage or default_storage
+    directory = f'{VARIANTS_DIR}/user_{user_id}'
+    try:
+        _, filenames = storage.listdir(directory)
+    except OSError:
+        return []
+    suffix = f'-{_variant_digest(image_name)}.'
+    return [
+        f'{directory}/{filename}' for filename in filenames
+        if suffix in filename and VARIANT_PATH_RE.match(f'{directory}/{filename}')
+    ]
+
+
+def _acquire_lock(lock_path: str) -> bool:
+    """Межпроцессная блокировка через эксклюзивное создание файла"""
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(lock_path) > VARIANT_LOCK_STALE:
+                # Процесс, захвативший блокировку, завершился аварийно
+                os.remove(lock_path)
+        except OSError:
+            pass
+        return False
+    os.close(fd)
+    return True
+
+
+def encode_variant(source_path: str, target_path: str, fmt: str):
+    """Перекодировать изображение в формат варианта (запись во временный файл и атомарная замена)"""
+    from PIL import Image, ImageOps
+
+    options = IMAGE_FORMATS[fmt]
+    tmp_path = f'{target_path}.{os.getpid()}.tmp'
+    try:
+        # Pillow открывает файл по пути и читает его лениво, без копии в памяти процесса
+        with Image.open(source_path) as image:
+            max_side = getattr(settings, 'PHOTO_VARIANT_MAX_SIDE', 2048)
+            # Для JPEG draft() декодирует сразу в уменьшенном масштабе
+            image.draft('RGB', (max_side, max_side))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((max_side, max_side))
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+            image.save(tmp_path, format=options['pillow'], **options['options'])
+        os.replace(tmp_path, target_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def ensure_variant(source_name: str, variant_name: str, fmt: str) -> Optional[str]:
+    """
+    Получить вариант фотографии, создав его при необходимости (вызывается из VariantEncoder)
+    Один вариант кодируется только одним процессом: остальные ждут завершения
+    Returns:
+        имя варианта или None, если вариант пока недоступен
+    """
+    target_path = os.path.join(settings.MEDIA_ROOT, variant_name)
+    if os.path.exists(target_path):
+        return variant_name
+
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    lock_path = f'{target_path}.lock'
+    deadline = time.monotonic() + VARIANT_LOCK_WAIT
+
+    while not _acquire_lock(lock_path):
+        if os.path.exists(target_path):
+            return variant_name
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(0.05)
+
+    try:
+        if not os.path.exists(target_path):
+            started = time.monotonic()
+            encode_variant(os.path.join(settings.MEDIA_ROOT, source_name), target_path, fmt)
+            from .metrics import metrics
+            metrics.incr('media.variants_encoded', format=fmt)
+            metrics.incr('media.encode_seconds', time.monotonic() - started, format=fmt)
+        return variant_name
+    except Exception as e:
+        logger.warning('Не удалось создать вариант %s: %s', variant_name, e)
+        return None
+    finally:
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+
+
+def negotiate_photo_file(photo_id: int, user_id: int, image_name: str,
+                         accept_header: str, allow_variants: bool = True) -> Tuple[str, str]:
+    """
+    Выбрать самый компактный файл фотографии среди форматов, которые принимает клиент
+    Returns:
+        (имя файла в хранилище, формат)
+    """
+    original_ext = os.path.splitext(image_name)[1].lstrip('.').lower() or 'original'
+    candidates = [(image_name, original_ext)]
+
+    if allow_variants:
+        # Запрос не ждет кодирования: пока варианта нет, отдается оригинал
+        for fmt in get_acceptable_formats(accept_header):
+            variant_name = get_variant_name(photo_id, user_id, image_name, fmt)
+            if os.path.exists(os.path.join(settings.MEDIA_ROOT, variant_name)):
+                candidates.append((variant_name, fmt))
+            else:
+                variant_encoder.enqueue(image_name, variant_name, fmt)
+
+    def file_size(candidate):
+        try:
+            return os.path.getsize(os.path.join(settings.MEDIA_ROOT, candidate[0]))
+        except OSError:
+            return float('inf')
+
+    return min(candidates, key=file_size)
+
+
+def schedule_photo_variants(photo_id: int, user_id: int, image_name: str):
+    """Поставить в очередь кодирования недостающие варианты фотографии во всех форматах"""
+    for fmt in get_supported_formats():
+        variant_name = get_variant_name(photo_id, user_id, image_name, fmt)
+        if not os.path.exists(os.path.join(settings.MEDIA_ROOT, variant_name)):
+            variant_encoder.enqueue(image_name, variant_name, fmt)
+
+
+class VariantEncoder:
+    """Фоновый поток процесса, кодирующий варианты фотографий по очереди"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending: Dict[str, Tuple[str, str]] = {}
+        self._thread: Optional[threading.Thread] = None
+
+    def enqueue(self, source_name: str, variant_name: str, fmt: str):
+        with self._lock:
+            # Повторные запросы того же варианта до его создания не добавляют работы
+            self._pending.setdefault(variant_name, (source_name, fmt))
+            # Поток не переживает fork: в дочернем процессе он запускается заново
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='photo-variant-encoder', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            self.drain()
+
+    def drain(self) -> int:
+        """Закодировать варианты из очереди; returns: число созданных или уже готовых вариантов"""
+        done = 0
+        while True:
+            with self._lock:
+                if not self._pending:
+                    return done
+                variant_name, (source_name, fmt) = next(iter(self._pending.items()))
+            if ensure_variant(source_name, variant_name, fmt):
+                done += 1
+            with self._lock:
+                self._pending.pop(variant_name, None)
+
+
+# Кодирование вариантов процесса
+variant_encoder = VariantEncoder()
+
+
+def get_photo_meta(photo_id: int) -> Optional[Tuple[str, bool, int]]:
+    """Данные фотографии для отдачи файла: (имя файла, проверена, id владельца); кэшируются"""
+    cache_key = f'photo_meta:{photo_id}'
+    meta = cache_manager.default_cache.get(cache_key)
+    if meta is None:
+        from .models import Photo
+        meta = (Photo.objects.filter(id=photo_id)
+                .values_list('image', 'is_verified', 'profile__user_id').first())
+        cache_manager.default_cache.set(cache_key, meta or 'NO_PHOTO', MEDIA_ACCESS_CACHE_TIMEOUT)
+    return None if meta == 'NO_PHOTO' else tuple(meta)
+
+
+def invalidate_photo_meta_cache(photo_id: int):
+    """Сбросить кэшированные данные фотографии"""
+    cache_manager.default_cache.delete(f'photo_meta:{photo_id}')
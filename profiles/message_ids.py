@@ -0,0 +1,161 @@
+"""
+id сообщений, уникальные во всех шардах (settings.MESSAGE_SHARDS)
+id состоит из миллисекунд с MESSAGE_ID_EPOCH_MS (41 бит), номера узла (10 бит) и счетчика
+внутри миллисекунды (12 бит). Номер узла процесс арендует в реестре - файле SQLite
+MESSAGE_ID_NODE_PATH, общем для процессов хоста: свободный номер выбирается в транзакции,
+поэтому у двух живых процессов номера не совпадают. Аренда продлевается перед выдачей id
+не реже раза в треть MESSAGE_ID_NODE_LEASE секунд; номер процесса, который не продлевал
+аренду дольше срока, может занять другой. После fork дочерний процесс арендует свой номер
+"""
+
+import atexit
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Optional
+
+from django.conf import settings
+
+# Начало отсчета времени в id сообщений: 2024-01-01 UTC (мс)
+MESSAGE_ID_EPOCH_MS = 1_704_067_200_000
+
+NODE_BITS = 10
+SEQUENCE_BITS = 12
+MAX_NODES = 1 << NODE_BITS
+SEQUENCE_MASK = (1 << SEQUENCE_BITS) - 1
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS nodes ('
+    ' node INTEGER PRIMARY KEY, token TEXT NOT NULL, pid INTEGER NOT NULL, renewed REAL NOT NULL'
+    ')',
+)
+
+
+class NodeRegistry:
+    """
+    Аренда номеров узлов: один номер на процесс
+    Не потокобезопасен - вызовы сериализует generate_message_id
+    """
+
+    def __init__(self, path, lease: float = 60):
+        self.path = os.fspath(path)
+        self.lease = lease
+        self.node: Optional[int] = None
+        self._token = None
+        self._pid = None
+        self._renewed_at = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        """Соединение на одну операцию: аренда берется и продлевается редко"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        for statement in SCHEMA:
+            connection.execute(statement)
+        return connection
+
+    def current(self) -> int:
+        """Номер узла процесса; при необходимости аренда берется или продлевается"""
+        now = time.time()
+        if self._pid != os.getpid():
+            self._acquire(now)
+        elif now - self._renewed_at >= self.lease / 3:
+            self._renew(now)
+        return self.node
+
+    def _acquire(self, now: float):
+        """Занять случайный номер из свободных и просроченных"""
+        token = uuid.uuid4().hex
+        pid = os.getpid()
+        connection = self._connect()
+        try:
+            # BEGIN IMMEDIATE: выбор и запись номера - под блокировкой записи реестра
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                busy = {node for (node,) in connection.execute(
+                    'SELECT node FROM nodes WHERE renewed >= ?', (now - self.lease,)
+                )}
+                free = [node for node in range(MAX_NODES) if node not in busy]
+                if not free:
+                    raise RuntimeError(f'Все {MAX_NODES} номеров узлов для id сообщений заняты ({self.path})')
+                node = random.choice(free)
+                connection.execute(
+                    'INSERT OR REPLACE INTO nodes (node, token, pid, renewed) VALUES (?, ?, ?, ?)',
+                    (node, token, pid, now),
+                )
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+        self.node, self._token, self._pid, self._renewed_at = node, token, pid, now
+
+    def _renew(self, now: float):
+        """Продлить аренду; если номер уже занят другим процессом - взять новый"""
+        connection = self._connect()
+        try:
+            renewed = connection.execute(
+                'UPDATE nodes SET renewed = ? WHERE node = ? AND token = ?', (now, self.node, self._token)
+            ).rowcount
+        finally:
+            connection.close()
+        if renewed:
+            self._renewed_at = now
+        else:
+            self._acquire(now)
+
+    def release(self):
+        """Освободить номер процесса (при штатном завершении)"""
+        if self._pid != os.getpid():
+            return
+        connection = self._connect()
+        try:
+            connection.execute('DELETE FROM nodes WHERE node = ? AND token = ?', (self.node, self._token))
+        finally:
+            connection.close()
+        self._pid = None
+
+
+_registry = None
+_message_id_lock = threading.Lock()
+_message_id_state = {'ms': 0, 'sequence': 0}
+
+
+def get_node_registry() -> NodeRegistry:
+    """Реестр номеров узлов процесса"""
+    global _registry
+    if _registry is None:
+        with _message_id_lock:
+            if _registry is None:
+                _registry = NodeRegistry(
+                    settings.MESSAGE_ID_NODE_PATH, lease=getattr(settings, 'MESSAGE_ID_NODE_LEASE', 60),
+                )
+                atexit.register(_registry.release)
+    return _registry
+
+
+def generate_message_id() -> int:
+    """
+    id сообщения, уникальный во всех шардах
+    При переносе между шардами сообщения сохраняют свои id
+    """
+    registry = get_node_registry()
+    with _message_id_lock:
+        node = registry.current()
+        now = int(time.time() * 1000) - MESSAGE_ID_EPOCH_MS
+        if now <= _message_id_state['ms']:
+            # Та же миллисекунда (или часы отстали): продолжаем счетчик, при переполнении - следующая
+            now = _message_id_state['ms']
+            sequence = (_message_id_state['sequence'] + 1) & SEQUENCE_MASK
+            if sequence == 0:
+                now += 1
+        else:
+            sequence = 0
+        _message_id_state.update(ms=now, sequence=sequence)
+    return (now << (NODE_BITS + SEQUENCE_BITS)) | (node << SEQUENCE_BITS) | sequence
@@ -0,0 +1,212 @@
+"""
+Легковесные метрики сайта знакомств
+Счетчики, показатели и гистограммы накапливаются в памяти процесса и периодически
+сбрасываются в файл METRICS_DIR/<pid>.json; команды управления суммируют файлы
+работающих процессов (снимки завершившихся процессов удаляются при сборе)
+"""
+
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Sequence
+
+from django.conf import settings
+
+# Как часто процесс записывает свои метрики на диск (секунды)
+DEFAULT_FLUSH_INTERVAL = 10
+
+# Границы корзин гистограмм задержек (миллисекунды); последняя корзина - все, что больше
+LATENCY_BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250)
+
+
+class MetricsRegistry:
+    """Счетчики текущего процесса с периодической записью на диск"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, float] = {}
+        self._histograms: Dict[str, Dict] = {}
+        self._started_at = time.time()
+        self._last_flush = 0.0
+
+    @staticmethod
+    def make_name(name: str, **labels) -> str:
+        """Имя метрики с метками: media.bytes_served{format=webp}"""
+        if not labels:
+            return name
+        labels_str = ','.join(f'{k}={v}' for k, v in sorted(labels.items()))
+        return f'{name}{{{labels_str}}}'
+
+    def incr(self, name: str, value: float = 1, **labels):
+        """Увеличить счетчик"""
+        metric = self.make_name(name, **labels)
+        with self._lock:
+            self._counters[metric] = self._counters.get(metric, 0) + value
+        self.maybe_flush()
+
+    def set_gauge(self, name: str, value: float, **labels):
+        """Установить текущее значение показателя"""
+        metric = self.make_name(name, **labels)
+        with self._lock:
+            self._gauges[metric] = value
+        self.maybe_flush()
+
+    def observe(self, name: str, value: float, buckets: Sequence[float] = LATENCY_BUCKETS_MS, **labels):
+        """Добавить наблюдение в гистограмму"""
+        metric = self.make_name(name, **labels)
+        index = bisect.bisect_left(buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(metric)
+            if histogram is None:
+                histogram = self._histograms[metric] = {
+                    'bounds': list(buckets),
+                    'counts': [0] * (len(buckets) + 1),
+                    'sum': 0.0,
+                    'count': 0,
+                }
+            histogram['counts'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+        self.maybe_flush()
+
+    def snapshot(self) -> Dict:
+        """Снимок метрик текущего процесса"""
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'started_at': self._started_at,
+                'updated_at': time.time(),
+                'counters': dict(self._counters),
+                'gauges': dict(self._gauges),
+                'histograms': {
+                    name: dict(histogram, counts=list(histogram['counts']))
+                    for name, histogram in self._histograms.items()
+                },
+            }
+
+    def maybe_flush(self):
+        """Записать метрики на диск, если прошло больше METRICS_FLUSH_INTERVAL секунд"""
+        interval = getattr(settings, 'METRICS_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL)
+        if time.monotonic() - self._last_flush >= interval:
+            self.flush()
+
+    def flush(self):
+        """Атомарно записать снимок метрик процесса в METRICS_DIR"""
+        self._last_flush = time.monotonic()
+        metrics_dir = getattr(settings, 'METRICS_DIR', None)
+        if not metrics_dir:
+            return
+        try:
+            os.makedirs(metrics_dir, exist_ok=True)
+            path = os.path.join(metrics_dir, f'{os.getpid()}.json')
+            tmp_path = f'{path}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        except OSError:
+            # Метрики не должны ломать обработку запросов
+            pass
+
+
+# Глобальный реестр метрик процесса
+metrics = MetricsRegistry()
+
+# Последние значения записываются и при штатном завершении рабочего процесса
+atexit.register(metrics.flush)
+
+
+def is_process_alive(pid) -> bool:
+    """Процесс с pid работает на этой машине"""
+    try:
+        os.kill(int(pid), 0)
+    except PermissionError:
+        # Процесс есть, но принадлежит другому пользователю
+        return True
+    except (OSError, ValueError, TypeError):
+        return False
+    return True
+
+
+def collect_metrics(metrics_dir: Optional[str] = None) -> Dict:
+    """
+    Собрать метрики работающих рабочих процессов
+    Снимки завершившихся процессов удаляются: их показатели (например, cache.entries)
+    больше не соответствуют ни одному кэшу
+    Returns:
+        {'processes': [...снимки...], 'counters': {имя: сумма}, 'gauges': {имя: максимум},
+         'histograms': {имя: сумма гистограмм}}
+    """
+    metrics_dir = metrics_dir or getattr(settings, 'METRICS_DIR', None)
+    result = {'processes': [], 'counters': {}, 'gauges': {}, 'histograms': {}}
+    if not metrics_dir or not os.path.isdir(metrics_dir):
+        return result
+
+    for filename in sorted(os.listdir(metrics_dir)):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(metrics_dir, filename), encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not is_process_alive(snapshot.get('pid')):
+            try:
+                os.remove(os.path.join(metrics_dir, filename))
+            except OSError:
+                pass
+            continue
+        result['processes'].append(snapshot)
+        for name, value in snapshot.get('counters', {}).items():
+            result['counters'][name] = result['counters'].get(name, 0) + value
+        for name, value in snapshot.get('gauges', {}).items():
+            result['gauges'][name] = max(result['gauges'].get(name, value), value)
+        for name, histogram in snapshot.get('histograms', {}).items():
+            merged = result['histograms'].get(name)
+            if merged is None or merged['bounds'] != histogram['bounds']:
+                result['histograms'][name] = dict(histogram, counts=list(histogram['counts']))
+                continue
+            merged['counts'] = [a + b for a, b in zip(merged['counts'], histogram['counts'])]
+            merged['sum'] += histogram['sum']
+            merged['count'] += histogram['count']
+
+    return result
+
+
+def parse_metric_name(name: str):
+    """Разобрать имя метрики: cache.hits{cache=profiles,family=profile} -> ('cache.hits', {...})"""
+    if not name.endswith('}') or '{' not in name:
+        return name, {}
+    base, labels_str = name[:-1].split('{', 1)
+    labels = dict(part.split('=', 1) for part in labels_str.split(',') if '=' in part)
+    return base, labels
+
+
+def histogram_percentile(histogram: Dict, percentile: float) -> Optional[float]:
+    """Оценка перцентиля по гистограмме (верхняя граница корзины)"""
+    if not histogram or not histogram['count']:
+        return None
+    threshold = histogram['count'] * percentile / 100
+    cumulative = 0
+    bounds: List[float] = histogram['bounds']
+    for index, count in enumerate(histogram['counts']):
+        cumulative += count
+        if cumulative >= threshold:
+            return bounds[index] if index < len(bounds) else float('inf')
+    return float('inf')
+
+
+def reset_metrics(metrics_dir: Optional[str] = None):
+    """Удалить сохраненные снимки метрик"""
+    metrics_dir = metrics_dir or getattr(settings, 'METRICS_DIR', None)
+    if not metrics_dir or not os.path.isdir(metrics_dir):
+        return
+    for filename in os.listdir(metrics_dir):
+        if filename.endswith('.json'):
+            try:
+                os.remove(os.path.join(metrics_dir, filename))
+            except OSError:
+                pass
@@ -0,0 +1,144 @@
+"""
+Middleware сайта знакомств
+"""
+
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.auth.models import AnonymousUser, User
+from django.utils.functional import SimpleLazyObject
+
+from . import db_router
+from .activity import activity_tracker
+from .cache_utils import get_cached_auth_user, get_cached_user_profile
+from .invalidation_bus import get_invalidation_bus
+from .presence import presence_tracker
+
+
+class InvalidationBusMiddleware:
+    """Применяет инвалидации кэшей, опубликованные другими рабочими процессами"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.bus = get_invalidation_bus()
+
+    def __call__(self, request):
+        if self.bus is not None:
+            self.bus.poll()
+        return self.get_response(request)
+
+
+class ReplicaPinningMiddleware:
+    """
+    Чтение своих записей при работе с репликами (profiles.db_router)
+    Время последней записи пользователя хранится в cookie на DATABASE_REPLICA_PIN_SECONDS:
+    пока реплика не получила эту запись, чтения пользователя идут в основную базу
+    """
+
+    COOKIE_NAME = 'db_written_at'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not db_router.get_replica_aliases():
+            return self.get_response(request)
+
+        try:
+            written_at = float(request.COOKIES.get(self.COOKIE_NAME, 0))
+        except ValueError:
+            written_at = 0.0
+        token = db_router.begin_request(written_at)
+        try:
+            response = self.get_response(request)
+        finally:
+            state = db_router.end_request(token)
+        if state.wrote:
+            response.set_cookie(
+                self.COOKIE_NAME, f'{state.written_at:.3f}',
+                max_age=getattr(settings, 'DATABASE_REPLICA_PIN_SECONDS', db_router.DEFAULT_PIN_SECONDS),
+                httponly=True, samesite='Lax',
+            )
+        return response
+
+
+def get_user(request):
+    """
+    Пользователь запроса из кэша (get_cached_auth_user) по идентификатору и хэшу из сессии;
+    сессии без них и с неизвестным backend-ом проверяет django.contrib.auth.get_user
+    """
+    if not hasattr(request, '_cached_user'):
+        session = request.session
+        user_id = session.get(auth.SESSION_KEY)
+        session_hash = session.get(auth.HASH_SESSION_KEY)
+        backend_path = session.get(auth.BACKEND_SESSION_KEY)
+        if user_id is None or not session_hash or backend_path not in settings.AUTHENTICATION_BACKENDS:
+            request._cached_user = auth.get_user(request)
+        else:
+            user_id = User._meta.pk.to_python(user_id)
+            request._cached_user = get_cached_auth_user(user_id, session_hash, request) or AnonymousUser()
+    return request._cached_user
+
+
+class CachedAuthenticationMiddleware(AuthenticationMiddleware):
+    """
+    AuthenticationMiddleware, берущий request.user из кэша вместо запроса к auth_user
+    Выход из системы очищает сессию, а смена пароля меняет хэш сессии и сбрасывает кэш
+    (signals.user_changed), поэтому их действие не откладывается
+    """
+
+    def process_request(self, request):
+        super().process_request(request)
+        request.user = SimpleLazyObject(lambda: get_user(request))
+
+
+def get_profile(request):
+    """
+    Профиль пользователя запроса из кэша (get_cached_user_profile), определяется один раз
+    за запрос; None для анонимных пользователей и пользователей без профиля
+    """
+    if not hasattr(request, '_cached_profile'):
+        user = getattr(request, 'user', None)
+        is_authenticated = user is not None and user.is_authenticated
+        request._cached_profile = get_cached_user_profile(user) if is_authenticated else None
+    return request._cached_profile
+
+
+class ProfileMiddleware:
+    """
+    Добавляет request.profile - профиль текущего пользователя, загружаемый при первом обращении
+    Профиля может не быть: проверяйте его истинность (if request.profile), а не «is None»
+    (см. decorators.profile_required)
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.profile = SimpleLazyObject(lambda: get_profile(request))
+        return self.get_response(request)
+
+
+class LastOnlineMiddleware:
+    """
+    Отмечает активность авторизованных пользователей для Profile.last_online
+    Время запроса запоминается в памяти; в базу оно пишется пакетами (profiles.activity).
+    Пользователи с профилем также отмечаются онлайн (profiles.presence): профиль нужен
+    не чаще раза в минуту на пользователя и обычно уже загружен представлением
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            activity_tracker.record(user.id)
+            if not presence_tracker.seen(user.id):
+                profile = get_profile(request)
+                if profile is not None:
+                    presence_tracker.record(user.id, profile)
+        activity_tracker.maybe_flush()
+        presence_tracker.maybe_sync()
+        return response
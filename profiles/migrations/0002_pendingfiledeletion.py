@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('profiles', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingFileDeletion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=255, verbose_name='Путь к файлу')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата постановки в очередь')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Количество попыток')),
+            ],
+            options={
+                'verbose_name': 'Файл на удаление',
+                'verbose_name_plural': 'Файлы на удаление',
+                'ordering': ['id'],
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:25
+
+from django.db import migrations, models
+
+
+def keep_single_primary(apps, schema_editor):
+    """Оставить у каждого профиля только самую новую основную фотографию"""
+    Photo = apps.get_model('profiles', 'Photo')
+    db_alias = schema_editor.connection.alias
+
+    seen_profiles = set()
+    extra_ids = []
+    primaries = (Photo.objects.using(db_alias).filter(is_primary=True)
+                 .order_by('profile_id', '-created_at', '-id')
+                 .values_list('id', 'profile_id'))
+    for photo_id, profile_id in primaries.iterator():
+        if profile_id in seen_profiles:
+            extra_ids.append(photo_id)
+        else:
+            seen_profiles.add(profile_id)
+
+    if extra_ids:
+        Photo.objects.using(db_alias).filter(id__in=extra_ids).update(is_primary=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('profiles', '0002_pendingfiledeletion'),
+    ]
+
+    operations = [
+        migrations.RunPython(keep_single_primary, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='photo',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_primary', True)), fields=('profile',), name='unique_primary_photo_per_profile'),
+        ),
+    ]
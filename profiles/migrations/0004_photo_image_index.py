@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:26
+
+import profiles.models.base
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('profiles', '0003_unique_primary_photo'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='photo',
+            name='image',
+            field=models.ImageField(db_index=True, upload_to=profiles.models.base.user_photo_path, verbose_name='Фотография'),
+        ),
+    ]
@@ -1,9 +1,11 @@
 from .profile import Profile, Photo
 from .messaging import Conversation, Message, MessageLimit
 from .moderation import Report
+from .media import PendingFileDeletion
 
 __all__ = [
     'Profile', 'Photo',
     'Conversation', 'Message', 'MessageLimit',
-    'Report'
+    'Report',
+    'PendingFileDeletion',
 ]
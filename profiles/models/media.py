@@ -0,0 +1,16 @@
+from django.db import models
+
+
+class PendingFileDeletion(models.Model):
+    """Очередь файлов, ожидающих удаления из хранилища после коммита транзакции"""
+    path = models.CharField('Путь к файлу', max_length=255)
+    created_at = models.DateTimeField('Дата постановки в очередь', auto_now_add=True)
+    attempts = models.PositiveSmallIntegerField('Количество попыток', default=0)
+
+    class Meta:
+        verbose_name = 'Файл на удаление'
+        verbose_name_plural = 'Файлы на удаление'
+        ordering = ['id']
+
+    def __str__(self):
+        return f"{self.path} (попыток: {self.attempts})"
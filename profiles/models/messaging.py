@@ -1,16 +1,22 @@
-from django.db import models
+from collections import defaultdict
+
+from django.db import DEFAULT_DB_ALIAS, models
 from django.contrib.auth.models import User
 from django.utils import timezone
 
 from .base import BaseManager, TimestampedModel
+from ..db_router import get_message_shards, is_message_shard, message_shard
+from ..message_ids import generate_message_id
 
 
 class ConversationManager(BaseManager):
     """Оптимизированный менеджер для модели Conversation"""
     
     def with_participants(self):
-        """Возвращает беседы с предзагруженными участниками"""
-        return self.select_related('participant1', 'participant2')
+        """Возвращает беседы с предзагруженными участниками (без хэшей паролей)"""
+        return self.select_related('participant1', 'participant2').defer(
+            'participant1__password', 'participant2__password',
+        )
     
     def for_user(self, user):
         """Возвращает беседы для указанного пользователя"""
@@ -18,7 +24,11 @@ class ConversationManager(BaseManager):
         return self.filter(Q(participant1=user) | Q(participant2=user))
     
     def with_last_message(self):
-        """Возвращает беседы с предзагруженными последними сообщениями"""
+        """
+        Возвращает беседы с предзагруженными последними сообщениями
+        Предзагрузка выполняется одним запросом в шард первой беседы: при нескольких
+        шардах сообщений - только для бесед одного шарда
+        """
         return self.prefetch_related(
             models.Prefetch(
                 'messages',
@@ -28,20 +38,96 @@ class ConversationManager(BaseManager):
         )
 
 
+class MessageQuerySet(models.QuerySet):
+    """
+    Сообщения с маршрутизацией по шардам (settings.MESSAGE_SHARDS)
+    Фильтр и создание с беседой передают ее роутеру: запрос уходит в шард беседы
+    """
+
+    def _for_conversation(self, conversation):
+        clone = self._chain()
+        if conversation is not None:
+            clone._add_hints(conversation=conversation)
+        return clone
+
+    def filter(self, *args, **kwargs):
+        clone = super().filter(*args, **kwargs)
+        conversation = kwargs.get('conversation', kwargs.get('conversation_id'))
+        if conversation is not None:
+            clone._add_hints(conversation=conversation)
+        return clone
+
+    def create(self, **kwargs):
+        conversation = kwargs.get('conversation', kwargs.get('conversation_id'))
+        return super(MessageQuerySet, self._for_conversation(conversation)).create(**kwargs)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        """Без явной базы сообщения раскладываются по шардам своих бесед"""
+        objs = list(objs)
+        for obj in objs:
+            if obj.pk is None:
+                obj.pk = generate_message_id()
+        shards = get_message_shards()
+        if self._db is not None or len(shards) == 1:
+            return super().bulk_create(objs, *args, **kwargs)
+        by_shard = defaultdict(list)
+        for obj in objs:
+            by_shard[message_shard(obj.conversation_id, shards)].append(obj)
+        for alias, group in by_shard.items():
+            queryset = self if alias == DEFAULT_DB_ALIAS else self.using(alias)
+            super(MessageQuerySet, queryset).bulk_create(group, *args, **kwargs)
+        return objs
+
+    def with_users(self):
+        """
+        Сообщения с предзагруженными пользователями: JOIN в основной базе и репликах,
+        отдельные запросы для шарда (таблицы пользователей в нем нет)
+        """
+        if is_message_shard(self.db):
+            return self.prefetch_related('sender', 'receiver')
+        return self.select_related('sender', 'receiver')
+
+
 class MessageManager(BaseManager):
     """Оптимизированный менеджер для модели Message"""
     
+    def get_queryset(self):
+        return MessageQuerySet(self.model, using=self._db)
+    
     def with_users(self):
         """Возвращает сообщения с предзагруженными пользователями"""
-        return self.select_related('sender', 'receiver')
+        return self.get_queryset().with_users()
     
     def unread_for_user(self, user):
-        """Возвращает непрочитанные сообщения для пользователя"""
+        """
+        Возвращает непрочитанные сообщения для пользователя
+        Без фильтра по беседе запрос выполняется в основной базе; число непрочитанных
+        во всех шардах - unread_count
+        """
         return self.filter(receiver=user, is_read=False)
     
+    def unread_count(self, user):
+        """Число непрочитанных сообщений пользователя во всех шардах"""
+        total = 0
+        for alias in get_message_shards():
+            queryset = self.unread_for_user(user)
+            if alias != DEFAULT_DB_ALIAS:
+                queryset = queryset.using(alias)
+            total += queryset.count()
+        return total
+    
     def in_conversation(self, conversation):
         """Возвращает сообщения в указанной беседе"""
-        return self.filter(conversation=conversation).select_related('sender', 'receiver')
+        return self.filter(conversation=conversation).with_users()
+    
+    def delete_in_conversation(self, conversation_id):
+        """
+        Удалить сообщения беседы из ее шарда
+        Каскадное удаление Django обходит только базу беседы (основную)
+        """
+        shard = message_shard(conversation_id)
+        if shard != DEFAULT_DB_ALIAS:
+            self.using(shard).filter(conversation_id=conversation_id).delete()
 
 
 class Conversation(TimestampedModel):
@@ -74,9 +160,13 @@ class Conversation(TimestampedModel):
 
 class Message(models.Model):
     """Модель сообщения"""
-    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages')
-    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
-    receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_messages')
+    # Ограничения внешних ключей не создаются: беседы и пользователи могут быть в другой базе
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages',
+                                     db_constraint=False)
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages',
+                               db_constraint=False)
+    receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_messages',
+                                 db_constraint=False)
     content = models.TextField('Содержание сообщения')
     sent_at = models.DateTimeField('Время отправки', auto_now_add=True)
     is_read = models.BooleanField('Прочитано', default=False)
@@ -89,10 +179,24 @@ class Message(models.Model):
         verbose_name = 'Сообщение'
         verbose_name_plural = 'Сообщения'
         ordering = ['sent_at']
+        indexes = [
+            # Страница переписки и последнее сообщение беседы без сортировки
+            models.Index(fields=['conversation', 'sent_at'], name='message_conversation_sent_idx'),
+            # Непрочитанные сообщения: счетчики пользователя и беседы (только is_read=False)
+            models.Index(fields=['receiver', 'conversation'], condition=models.Q(is_read=False),
+                         name='message_unread_idx'),
+        ]
 
     def __str__(self):
         return f"Сообщение от {self.sender.username} к {self.receiver.username} - {self.sent_at.strftime('%d.%m.%Y %H:%M')}"
     
+    def save(self, *args, force_insert=False, **kwargs):
+        # id назначается приложением, а не автоинкрементом базы: он уникален во всех шардах
+        if self._state.adding and self.pk is None:
+            self.pk = generate_message_id()
+            force_insert = True
+        super().save(*args, force_insert=force_insert, **kwargs)
+    
     def mark_as_read(self):
         """Отметить сообщение как прочитанное"""
         if not self.is_read:
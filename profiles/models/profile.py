@@ -1,18 +1,47 @@
-from django.db import models
+from django.db import models, router, transaction, IntegrityError
+from django.db.models import Exists, Q, Subquery
+from django.db.models.functions import Substr
 from django.contrib.auth.models import User
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.utils import timezone
-import os
 
 from .base import user_photo_path, BaseManager, TimestampedModel, ActiveModel
 
+# Поля карточки профиля в результатах поиска (templates/profiles/search_results.html)
+PROFILE_CARD_FIELDS = ('id', 'user_id', 'nickname', 'gender', 'age', 'city', 'height', 'education', 'last_online')
+
+# Поля профиля в списках: новые профили на главной, собеседники в списке переписок
+PROFILE_LIST_FIELDS = ('id', 'user_id', 'nickname', 'age', 'city', 'gender')
+
+# Фильтры поиска (ProfileSearchForm.get_search_params): по равенству поля и по диапазону
+SEARCH_EXACT_FIELDS = ('gender', 'city', 'education', 'employment', 'smoking', 'alcohol', 'has_children')
+SEARCH_RANGE_FIELDS = {'age': ('age_min', 'age_max'), 'height': ('height_min', 'height_max')}
+
+# Поля профиля, по которым фильтры поиска проверяются без базы (matches_search_filters)
+SEARCH_FILTER_FIELDS = ('is_active', *SEARCH_EXACT_FIELDS, *SEARCH_RANGE_FIELDS)
+
+# Сколько символов цели поиска показывается в карточке
+GOAL_PREVIEW_LENGTH = 100
+
 
 class ProfileManager(BaseManager):
     """Оптимизированный менеджер для модели Profile"""
     
     def with_user(self):
-        """Возвращает профили с предзагруженными пользователями"""
-        return self.select_related('user')
+        """Возвращает профили с предзагруженными пользователями (без хэша пароля)"""
+        return self.select_related('user').defer('user__password')
+
+    def as_cards(self):
+        """
+        Профили для карточек поиска: только поля PROFILE_CARD_FIELDS, без строки пользователя;
+        вместо цели поиска (TextField) - goal_preview, ее начало длиной GOAL_PREVIEW_LENGTH + 1
+        (truncatechars в шаблоне обрезает его так же, как полный текст)
+        """
+        return self.only(*PROFILE_CARD_FIELDS).annotate(goal_preview=Substr('goal', 1, GOAL_PREVIEW_LENGTH + 1))
+
+    def as_list_items(self, *fields):
+        """Профили для списков: поля PROFILE_LIST_FIELDS (и fields) и имя пользователя"""
+        return self.select_related('user').only(*PROFILE_LIST_FIELDS, *fields, 'user__id', 'user__username')
     
     def with_photos(self):
         """Возвращает профили с предзагруженными фотографиями"""
@@ -30,9 +59,9 @@ class ProfileManager(BaseManager):
         return self.exclude(user=user)
     
     def search_optimized(self, exclude_user=None):
-        """Оптимизированный queryset для поиска профилей"""
+        """Оптимизированный queryset для поиска профилей (карточки as_cards с основной фотографией)"""
         from .profile import Photo  # Локальный импорт
-        qs = self.select_related('user').prefetch_related(
+        qs = self.as_cards().prefetch_related(
             models.Prefetch('photos', queryset=Photo.objects.filter(is_primary=True, is_verified=True))
         ).filter(is_active=True)
         
@@ -41,6 +70,38 @@ class ProfileManager(BaseManager):
             
         return qs.order_by('-last_online')
     
+    def search_filtered(self, params):
+        """
+        Активные профили, подходящие под фильтры поиска (ProfileSearchForm.get_search_params),
+        от недавно заходивших к давно заходившим
+        """
+        qs = self.filter(is_active=True)
+        qs = qs.filter(**{name: params[name] for name in SEARCH_EXACT_FIELDS if name in params})
+        for field, (low, high) in SEARCH_RANGE_FIELDS.items():
+            if low in params:
+                qs = qs.filter(**{f'{field}__gte': params[low]})
+            if high in params:
+                qs = qs.filter(**{f'{field}__lte': params[high]})
+        if 'search' in params:
+            qs = qs.filter(Q(nickname__icontains=params['search']) | Q(goal__icontains=params['search']))
+        # id - для однозначного порядка: страницы за окном кэша читаются со сдвигом
+        return qs.order_by('-last_online', '-id')
+    
+    def search_ids_among(self, params, profile_ids, batch_size=500):
+        """
+        id профилей из profile_ids, подходящих под фильтры поиска, в порядке search_filtered
+        Множество проверяется пакетами по batch_size id (ограничение числа параметров запроса)
+        """
+        profile_ids = sorted(profile_ids)
+        rows = []
+        for start in range(0, len(profile_ids), batch_size):
+            rows.extend(
+                self.search_filtered(params).filter(id__in=profile_ids[start:start + batch_size])
+                .values_list('last_online', 'id')
+            )
+        rows.sort(reverse=True)
+        return [profile_id for _, profile_id in rows]
+    
     def stats(self):
         """Возвращает статистику профилей (оптимизированный запрос)"""
         from django.db.models import Count, Q
@@ -51,6 +112,23 @@ class ProfileManager(BaseManager):
         )
 
 
+def matches_search_filters(params, values) -> bool:
+    """
+    Подходит ли профиль со значениями полей values ({поле SEARCH_FILTER_FIELDS: значение})
+    под фильтры поиска - то же условие, что в search_filtered, кроме текстового поиска
+    """
+    if not values['is_active']:
+        return False
+    if any(values[name] != params[name] for name in SEARCH_EXACT_FIELDS if name in params):
+        return False
+    for field, (low, high) in SEARCH_RANGE_FIELDS.items():
+        if low in params and values[field] < params[low]:
+            return False
+        if high in params and values[field] > params[high]:
+            return False
+    return True
+
+
 class PhotoManager(BaseManager):
     """Оптимизированный менеджер для модели Photo"""
     
@@ -61,6 +139,73 @@ class PhotoManager(BaseManager):
     def primary_first(self):
         """Сортирует фотографии: основные сначала"""
         return self.order_by('-is_primary', '-uploaded_at')
+    
+    @property
+    def write_db(self):
+        """
+        База для записей и транзакций менеджера
+        self.db - база для чтения и при настроенной реплике указывает на нее
+        """
+        return self._db or router.db_for_write(self.model, **self._hints)
+
+    def add_photo(self, photo):
+        """
+        Сохранить новую фотографию профиля одной транзакцией
+        Если фотография отмечена основной, флаг снимается с предыдущей основной;
+        если у профиля нет основной фотографии, новая становится основной
+        """
+        profile = photo.profile
+        db = self.write_db
+        photos = self.using(db)
+        with transaction.atomic(using=db):
+            if photo.is_primary:
+                photos.filter(profile=profile, is_primary=True).update(is_primary=False)
+                photo.save(using=db)
+            else:
+                photo.save(using=db)
+                if self._promote(db, profile, photos.filter(id=photo.id)):
+                    photo.is_primary = True
+        self._invalidate_caches(db, profile)
+        return photo
+    
+    def set_primary(self, profile, photo_id):
+        """Сделать фотографию основной (два UPDATE в одной транзакции, без загрузки объектов)"""
+        db = self.write_db
+        photos = self.using(db)
+        with transaction.atomic(using=db):
+            photos.filter(profile=profile, is_primary=True).exclude(id=photo_id).update(is_primary=False)
+            if not photos.filter(id=photo_id, profile=profile).update(is_primary=True):
+                raise self.model.DoesNotExist('Фотография не найдена')
+        self._invalidate_caches(db, profile)
+    
+    def delete_photo(self, profile, photo_id):
+        """Удалить фотографию и при необходимости назначить основной самую новую из оставшихся"""
+        db = self.write_db
+        photos = self.using(db)
+        with transaction.atomic(using=db):
+            photo = photos.get(id=photo_id, profile=profile)
+            was_primary = photo.is_primary
+            photo.delete(using=db)
+            if was_primary:
+                newest = photos.filter(profile=profile).order_by('-created_at', '-id').values('id')[:1]
+                self._promote(db, profile, photos.filter(id=Subquery(newest)))
+        self._invalidate_caches(db, profile)
+    
+    def _promote(self, db, profile, queryset):
+        """Отметить фотографию основной, только если у профиля еще нет основной"""
+        has_primary = Exists(self.using(db).filter(profile=profile, is_primary=True))
+        try:
+            with transaction.atomic(using=db):
+                return queryset.filter(~has_primary).update(is_primary=True)
+        except IntegrityError:
+            # Параллельный запрос уже назначил основную фотографию
+            return 0
+    
+    def _invalidate_caches(self, db, profile):
+        """Сбросить кэшированные карточки профиля после коммита"""
+        from ..cache_utils import invalidate_profile_photos_cache
+        user_id = profile.user_id
+        transaction.on_commit(lambda: invalidate_profile_photos_cache(user_id), using=db)
 
 
 class Profile(TimestampedModel, ActiveModel):
@@ -245,7 +390,7 @@ class Profile(TimestampedModel, ActiveModel):
 class Photo(TimestampedModel):
     """Модель фотографии профиля"""
     profile = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='photos')
-    image = models.ImageField('Фотография', upload_to=user_photo_path)
+    image = models.ImageField('Фотография', upload_to=user_photo_path, db_index=True)
     is_primary = models.BooleanField('Основная фотография', default=False)
     is_verified = models.BooleanField('Проверена', default=False)
 
@@ -256,13 +401,18 @@ class Photo(TimestampedModel):
         verbose_name = 'Фотография'
         verbose_name_plural = 'Фотографии'
         ordering = ['-is_primary', '-created_at']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['profile'],
+                condition=Q(is_primary=True),
+                name='unique_primary_photo_per_profile',
+            ),
+        ]
 
     def __str__(self):
         return f"Фото {self.profile.nickname} - {self.created_at.date()}"
     
-    def delete(self, *args, **kwargs):
-        """Удалить файл изображения при удалении объекта"""
-        if self.image:
-            if os.path.isfile(self.image.path):
-                os.remove(self.image.path)
-        super().delete(*args, **kwargs)
+    def get_image_url(self):
+        """URL фотографии с выбором формата (AVIF/WebP) по заголовку Accept"""
+        from django.urls import reverse
+        return reverse('profiles:photo_image', args=[self.id])
@@ -0,0 +1,176 @@
+"""
+Присутствие пользователей онлайн без обращений к базе
+Активные пользователи хранятся в общем для всех процессов кэше (PRESENCE_CACHE_ALIAS) в
+кольцевом буфере поминутных корзин: корзина минуты m лежит в слоте m % PRESENCE_RING_SIZE и
+содержит {user_id: (profile_id, значения SEARCH_FILTER_FIELDS профиля)} всех пользователей,
+сделавших запрос в эту минуту. Онлайн - пользователь, попавший в одну из последних
+PRESENCE_WINDOW_MINUTES корзин. Процесс копит корзину текущей минуты в памяти и объединяет ее
+с корзиной в кэше не чаще раза в PRESENCE_SYNC_INTERVAL секунд; объединенное окно кэшируется
+в процессе на тот же интервал, поэтому is_online и online_profile_ids работают по готовым
+множествам за O(1), а фильтры поиска среди пользователей онлайн (search_online) проверяются
+по значениям полей из корзин без запросов к базе. Значения полей - на момент последнего
+запроса пользователя: правка профиля видна в поиске онлайн не позже чем через окно
+"""
+
+import threading
+import time
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .metrics import metrics
+from .models.profile import SEARCH_FILTER_FIELDS, matches_search_filters
+
+DEFAULT_WINDOW_MINUTES = 5
+DEFAULT_SYNC_INTERVAL = 5
+
+# Корзина минуты: {user_id: (profile_id, значения SEARCH_FILTER_FIELDS)}
+Bucket = Dict[int, Tuple[int, tuple]]
+
+
+class PresenceSnapshot:
+    """
+    Пользователи онлайн за окно: множества для проверок за O(1)
+    entries: {user_id: (profile_id, значения SEARCH_FILTER_FIELDS, минута последнего запроса)}
+    """
+
+    def __init__(self, entries: Dict[int, Tuple[int, tuple, int]]):
+        self.user_ids: FrozenSet[int] = frozenset(entries)
+        self.profile_ids: FrozenSet[int] = frozenset(profile_id for profile_id, _, _ in entries.values())
+        # Профили от недавно заходивших к давно заходившим (как search_filtered)
+        self.profiles: List[Tuple[int, Dict[str, Any]]] = [
+            (profile_id, dict(zip(SEARCH_FILTER_FIELDS, values)))
+            for _, profile_id, values in sorted(
+                ((minute, profile_id, values) for profile_id, values, minute in entries.values()), reverse=True,
+            )
+        ]
+        by_city: Dict[Optional[int], set] = {}
+        for profile_id, values in self.profiles:
+            by_city.setdefault(values['city'], set()).add(profile_id)
+        self.by_city: Dict[Optional[int], FrozenSet[int]] = {
+            city: frozenset(profile_ids) for city, profile_ids in by_city.items()
+        }
+
+    def search(self, params: Dict) -> List[int]:
+        """id профилей онлайн, подходящих под фильтры поиска (без текстового поиска)"""
+        return [profile_id for profile_id, values in self.profiles if matches_search_filters(params, values)]
+
+
+class PresenceTracker:
+    """Поминутные корзины активных пользователей процесса и их синхронизация с кэшем"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        # Еще не объединенные с кэшем корзины процесса: {минута: корзина}
+        self._local: Dict[int, Bucket] = {}
+        self._synced_at = 0.0
+        self._snapshot: Optional[PresenceSnapshot] = None
+
+    @property
+    def window(self) -> int:
+        return getattr(settings, 'PRESENCE_WINDOW_MINUTES', DEFAULT_WINDOW_MINUTES)
+
+    @property
+    def ring_size(self) -> int:
+        # Запасной слот: корзина, выпавшая из окна, перезаписывается только в следующую минуту
+        return self.window + 1
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'PRESENCE_CACHE_ALIAS', 'shared')]
+
+    def slot_key(self, minute: int) -> str:
+        prefix = getattr(settings, 'CACHE_KEY_PREFIX', 'dating_site')
+        return f'{prefix}:presence:slot-{minute % self.ring_size}'
+
+    def seen(self, user_id: int, now: Optional[float] = None) -> bool:
+        """Отмечен ли пользователь процессом в текущую минуту (тогда record не нужен)"""
+        minute = int((now or time.time()) // 60)
+        return user_id in self._local.get(minute, ())
+
+    def record(self, user_id: int, profile, now: Optional[float] = None):
+        """Отметить пользователя с профилем profile онлайн (в памяти процесса)"""
+        now = now or time.time()
+        values = tuple(getattr(profile, field) for field in SEARCH_FILTER_FIELDS)
+        with self._lock:
+            self._local.setdefault(int(now // 60), {})[user_id] = (profile.id, values)
+        self.maybe_sync(now)
+
+    def maybe_sync(self, now: Optional[float] = None):
+        """Синхронизироваться с кэшем, если с прошлой синхронизации прошло PRESENCE_SYNC_INTERVAL секунд"""
+        interval = getattr(settings, 'PRESENCE_SYNC_INTERVAL', DEFAULT_SYNC_INTERVAL)
+        if time.monotonic() - self._synced_at >= interval:
+            self.sync(now)
+
+    def sync(self, now: Optional[float] = None) -> PresenceSnapshot:
+        """
+        Объединить корзины процесса с корзинами в кэше и перечитать окно
+        Корзина текущей минуты остается в памяти и объединяется повторно при каждой
+        синхронизации: отметки, потерянные при одновременной записи слота несколькими
+        процессами, восстанавливаются до конца минуты
+        """
+        now = now or time.time()
+        current = int(now // 60)
+        if not self._sync_lock.acquire(blocking=False):
+            # Синхронизацию уже выполняет другой поток
+            return self._snapshot or PresenceSnapshot({})
+        try:
+            self._synced_at = time.monotonic()
+            with self._lock:
+                local = {minute: dict(bucket) for minute, bucket in self._local.items()
+                         if minute > current - self.window}
+                self._local = {minute: bucket for minute, bucket in self._local.items() if minute == current}
+
+            cache = self.cache
+            minutes = range(current - self.window + 1, current + 1)
+            slots = cache.get_many([self.slot_key(minute) for minute in minutes])
+            timeout = self.ring_size * 60
+            entries = {}
+            for minute in minutes:
+                slot = slots.get(self.slot_key(minute))
+                # Слот с корзиной другой минуты - остаток прошлого оборота кольца;
+                # слот с другим набором полей записан прежней версией сайта
+                current_slot = slot and slot['minute'] == minute and slot.get('fields') == SEARCH_FILTER_FIELDS
+                bucket = dict(slot['users']) if current_slot else {}
+                if minute in local:
+                    bucket.update(local[minute])
+                    cache.set(self.slot_key(minute), {
+                        'minute': minute, 'fields': SEARCH_FILTER_FIELDS, 'users': bucket,
+                    }, timeout)
+                entries.update(
+                    (user_id, (profile_id, values, minute)) for user_id, (profile_id, values) in bucket.items()
+                )
+
+            self._snapshot = PresenceSnapshot(entries)
+            metrics.set_gauge('presence.online', len(entries))
+            return self._snapshot
+        finally:
+            self._sync_lock.release()
+
+    def snapshot(self) -> PresenceSnapshot:
+        """Пользователи онлайн, перечитанные из кэша не раньше чем PRESENCE_SYNC_INTERVAL секунд назад"""
+        self.maybe_sync()
+        return self._snapshot or PresenceSnapshot({})
+
+    def is_online(self, user_id: int) -> bool:
+        return user_id in self.snapshot().user_ids
+
+    def online_profile_ids(self, city: Optional[int] = None) -> FrozenSet[int]:
+        """Профили пользователей онлайн (в городе city, если задан)"""
+        snapshot = self.snapshot()
+        if city is None:
+            return snapshot.profile_ids
+        return snapshot.by_city.get(city, frozenset())
+
+    def search_online(self, params: Dict) -> List[int]:
+        """
+        id профилей онлайн, подходящих под фильтры поиска, от недавно заходивших
+        Текстовый поиск (params['search']) здесь не проверяется - см. Profile.objects.search_ids_among
+        """
+        return self.snapshot().search(params)
+
+
+# Трекер процесса
+presence_tracker = PresenceTracker()
@@ -0,0 +1,4 @@
+"""
+Дополнительные backend-ы сессий для сайта знакомств
+write_behind.SessionStore - сессии в общем кэше с отложенной пакетной записью копии в базу
+"""
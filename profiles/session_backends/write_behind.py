@@ -0,0 +1,177 @@
+"""
+Сессии в общем для всех рабочих процессов кэше (SESSION_CACHE_ALIAS, обычно 'shared')
+с отложенной записью копии в базу
+Чтения и изменения сессий идут в кэш; в базу изменившиеся сессии записываются пакетом
+(один INSERT ... ON CONFLICT DO UPDATE) не чаще раза в SESSION_DB_WRITE_INTERVAL секунд
+после завершения запроса. Копия в базе нужна, только если запись вытеснена из кэша:
+тогда сессия загружается из базы, как в cached_db. Удаление (выход) выполняется сразу
+и в кэше, и в базе; при записи копии берутся текущие данные из кэша, поэтому удаленная
+сессия не восстанавливается. Удаление оставляет в кэше отметку: если сессию удалили, пока
+пакет с ней записывался, строка копии удаляется сразу после записи
+"""
+
+import atexit
+import logging
+import threading
+import time
+from typing import Dict
+
+from django.conf import settings
+from django.contrib.sessions.backends.base import CreateError
+from django.contrib.sessions.backends.cached_db import SessionStore as CachedDBStore
+from django.core.cache import caches
+from django.core.signals import request_finished
+from django.db import DatabaseError, router
+
+from ..metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB_WRITE_INTERVAL = 10
+
+# Сессий в одном INSERT: по 3 параметра на строку (лимит SQLite - 999)
+WRITE_BATCH_SIZE = 300
+
+# Сколько хранится отметка об удалении сессии (секунды, с запасом больше записи пакета)
+TOMBSTONE_TIMEOUT = 300
+
+
+class SessionStore(CachedDBStore):
+    """Сессия в общем кэше; копия в базе обновляется отложенно (session_writer)"""
+
+    cache_key_prefix = 'profiles.sessions.write_behind'
+    tombstone_key_prefix = 'profiles.sessions.write_behind.deleted'
+
+    def exists(self, session_key):
+        # Новый ключ проверяется только по кэшу: совпадение 32 случайных символов с сессией,
+        # вытесненной из кэша в базу, практически невозможно, а add в save все равно атомарен
+        return bool(session_key) and (self.cache_key_prefix + session_key) in self._cache
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        data = self._get_session(no_load=must_create)
+        if must_create:
+            # Уникальность нового ключа проверяет атомарный add общего кэша
+            if not self._cache.add(self.cache_key, data, self.get_expiry_age()):
+                raise CreateError
+        else:
+            self._cache.set(self.cache_key, data, self.get_expiry_age())
+        session_writer.schedule(self.session_key, self.get_expiry_date())
+
+    def delete(self, session_key=None):
+        session_key = session_key or self.session_key
+        if session_key is not None:
+            session_writer.discard(session_key)
+            # Отметка ставится до удаления: запись копии, уже прочитавшая сессию из кэша, ее увидит
+            self._cache.set(self.tombstone_key_prefix + session_key, True, TOMBSTONE_TIMEOUT)
+        super().delete(session_key)
+
+
+class SessionWriteBehind:
+    """Ключи сессий процесса, измененных в кэше, но еще не записанных в базу"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending: Dict[str, object] = {}
+        self._last_flush = time.monotonic()
+
+    def schedule(self, session_key: str, expire_date):
+        with self._lock:
+            self._pending[session_key] = expire_date
+        metrics.incr('sessions.scheduled')
+
+    def discard(self, session_key: str):
+        with self._lock:
+            self._pending.pop(session_key, None)
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def maybe_flush(self, **kwargs):
+        """Записать сессии, если с прошлой записи прошло SESSION_DB_WRITE_INTERVAL секунд (request_finished)"""
+        interval = getattr(settings, 'SESSION_DB_WRITE_INTERVAL', DEFAULT_DB_WRITE_INTERVAL)
+        if self._pending and time.monotonic() - self._last_flush >= interval:
+            self.flush()
+
+    def flush(self, force: bool = False) -> int:
+        """
+        Записать в базу текущие данные измененных сессий из кэша
+        Сессии, которых уже нет в кэше (удалены или истекли), пропускаются; строки сессий,
+        удаленных во время записи пакета (есть отметка об удалении), удаляются после нее
+        Returns:
+            число записанных сессий
+        """
+        if not self._flush_lock.acquire(blocking=force):
+            # Запись уже выполняет другой поток
+            return 0
+        try:
+            self._last_flush = time.monotonic()
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+
+            store = SessionStore()
+            model = store.get_model_class()
+            cache = caches[settings.SESSION_CACHE_ALIAS]
+            written = 0
+            keys = sorted(pending)
+            for start in range(0, len(keys), WRITE_BATCH_SIZE):
+                batch = keys[start:start + WRITE_BATCH_SIZE]
+                cached = cache.get_many([SessionStore.cache_key_prefix + key for key in batch])
+                sessions = [
+                    model(
+                        session_key=key,
+                        session_data=store.encode(cached[SessionStore.cache_key_prefix + key]),
+                        expire_date=pending[key],
+                    )
+                    for key in batch if SessionStore.cache_key_prefix + key in cached
+                ]
+                if not sessions:
+                    continue
+                db = router.db_for_write(model)
+                try:
+                    model.objects.using(db).bulk_create(
+                        sessions, update_conflicts=True, unique_fields=['session_key'],
+                        update_fields=['session_data', 'expire_date'],
+                    )
+                    deleted = self._delete_tombstoned(cache, model, db, [session.session_key for session in sessions])
+                except DatabaseError:
+                    logger.exception('Не удалось записать сессии в базу (%s)', len(sessions))
+                    with self._lock:
+                        for session in sessions:
+                            self._pending.setdefault(session.session_key, session.expire_date)
+                    continue
+                written += len(sessions) - deleted
+            metrics.incr('sessions.db_flushes')
+            metrics.incr('sessions.db_rows_written', written)
+            return written
+        finally:
+            self._flush_lock.release()
+
+    def _delete_tombstoned(self, cache, model, db, session_keys) -> int:
+        """Удалить записанные строки сессий, удаленных после чтения пакета из кэша"""
+        prefix = SessionStore.tombstone_key_prefix
+        tombstones = cache.get_many([prefix + key for key in session_keys])
+        if not tombstones:
+            return 0
+        deleted = [key[len(prefix):] for key in tombstones]
+        model.objects.using(db).filter(session_key__in=deleted).delete()
+        metrics.incr('sessions.deleted_after_write', len(deleted))
+        return len(deleted)
+
+
+# Очередь записи процесса
+session_writer = SessionWriteBehind()
+request_finished.connect(session_writer.maybe_flush, dispatch_uid='profiles.sessions.write_behind')
+
+
+def _flush_on_exit():
+    if session_writer.pending_count():
+        session_writer.flush(force=True)
+
+
+atexit.register(_flush_on_exit)
@@ -0,0 +1,67 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .cache_utils import invalidate_auth_user_cache
+from .models import Conversation, Message, Photo
+from .media_utils import (
+    schedule_file_deletion, invalidate_media_access_cache,
+    invalidate_photo_meta_cache, get_photo_owner_id, schedule_photo_variants,
+)
+
+
+@receiver(post_delete, sender=Photo)
+def photo_post_delete(sender, instance, using, **kwargs):
+    """Поставить файл фотографии в очередь на удаление (в том числе при каскадном удалении профиля)"""
+    if instance.image:
+        # В очередь попадает только оригинал: варианты находит process_pending_deletions,
+        # поэтому в транзакции удаления нет обращений к диску
+        schedule_file_deletion([instance.image.name], using=using)
+        invalidate_media_access_cache(instance.image.name)
+    invalidate_photo_meta_cache(instance.id)
+
+
+@receiver(post_save, sender=Photo)
+def photo_post_save(sender, instance, using, **kwargs):
+    """Сбросить кэшированный признак доступности файла (например, после проверки модератором)"""
+    if instance.image:
+        invalidate_media_access_cache(instance.image.name)
+        if instance.is_verified:
+            # Варианты опубликованной фотографии кодируются заранее, не в запросе на ее показ
+            photo_id, image_name = instance.id, instance.image.name
+            user_id = get_photo_owner_id(image_name)
+            if user_id:
+                transaction.on_commit(
+                    lambda: schedule_photo_variants(photo_id, user_id, image_name), using=using
+                )
+    invalidate_photo_meta_cache(instance.id)
+
+
+@receiver(post_delete, sender=Conversation)
+def conversation_post_delete(sender, instance, **kwargs):
+    """Удалить сообщения беседы, лежащие в отдельном шарде (в том числе при удалении участника)"""
+    Message.objects.delete_in_conversation(instance.pk)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    """Сбросить кэшированного пользователя запросов (пароль, активность, флаги прав)"""
+    invalidate_auth_user_cache(instance.id)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+def user_permissions_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Сбросить кэшированных пользователей при изменении их групп и прав"""
+    if not reverse:
+        if action.startswith('post_'):
+            invalidate_auth_user_cache(instance.id)
+    elif action == 'pre_clear':
+        # Очистка со стороны группы или права: пользователи известны только до нее
+        for user_id in instance.user_set.values_list('id', flat=True):
+            invalidate_auth_user_cache(user_id)
+    elif action in ('post_add', 'post_remove'):
+        for user_id in pk_set:
+            invalidate_auth_user_cache(user_id)
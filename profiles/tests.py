@@ -1,3 +1,2140 @@
-from django.test import TestCase
+import copy
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from PIL import Image, features
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import AnonymousUser, Group, Permission, User
+from django.contrib.sessions.models import Session
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.core.management import call_command
+from django.core.signals import request_started
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, IntegrityError, connections, transaction
+from django.db.models import QuerySet
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.utils.cache import cc_delim_re
+from django.utils.text import Truncator
+
+from . import activity, cache_metrics, cache_utils, cache_warmup, invalidation_bus, media_utils, message_ids
+from .activity import ActivityTracker, activity_tracker
+from .cache_backends.size_aware import PROBATION, PROTECTED, SizeAwareCache, SizeAwarePolicy
+from .cache_backends.sqlite import QUERY_CHUNK_SIZE, SQLiteCache
+from .cache_backends.tiered import TieredCache
+from .cache_metrics import InstrumentedCache, get_key_family
+from .cache_serialization import DEFAULT_COMPRESS_MIN_SIZE, CacheCodec, ModelProjection, pack, unpack
+from .cache_utils import (
+    GLOBAL_TAG, cache_manager, get_cache_stats, get_cached_auth_user, get_cached_search_ids,
+    get_cached_user_profile, get_cached_user_profiles, get_or_compute, get_tag_versions, get_tagged,
+    invalidate_auth_user_cache, invalidate_recent_profiles_cache, invalidate_search_cache, invalidate_tags,
+    invalidate_user_profile_cache, set_tagged,
+)
+from .db_router import MessageShardRouter, jump_hash, message_shard, replica_clock, write_replica_status
+from .invalidation_bus import InvalidationBus
+from .management.bench_data import random_profile_values
+from .media_utils import (
+    IMAGE_FORMATS, VARIANT_PATH_RE, FileDeletionWorker, VariantEncoder, get_acceptable_formats, get_variant_name,
+    negotiate_photo_file, process_pending_deletions,
+)
+from .message_ids import MAX_NODES, NodeRegistry, generate_message_id
+from .metrics import MetricsRegistry, collect_metrics
+from .middleware import ProfileMiddleware, get_profile
+from .models import Conversation, Message, PendingFileDeletion, Photo, Profile
+from .models.profile import PROFILE_LIST_FIELDS
+from .presence import presence_tracker
+from .session_backends.write_behind import SessionStore, session_writer
+from .upload_handlers import get_upload_errors
+from .views_package.media_views import make_etag, parse_range, serve_file
+
+
+def reset_cache_manager():
+    """Пересоздать шину инвалидаций и кэши cache_manager по текущим настройкам"""
+    invalidation_bus._bus = None
+    cache_manager.__init__()
+
+
+def reset_message_id_registry():
+    """Освободить номер узла id сообщений; реестр пересоздается по текущим настройкам"""
+    if message_ids._registry is not None:
+        message_ids._registry.release()
+    message_ids._registry = None
+
+
+class IsolatedCachesMixin:
+    """
+    Кэши теста отделены от кэшей процесса и от других тестов: общий кэш, шина инвалидаций,
+    метрики и реестр номеров узлов id сообщений - во временном каталоге, у кэшей в памяти
+    свои хранилища (LOCATION); cache_manager пересоздается на время теста
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.runtime_dir = tempfile.mkdtemp(prefix='dating-site-tests-')
+        self.addCleanup(shutil.rmtree, self.runtime_dir, ignore_errors=True)
+        suffix = os.path.basename(self.runtime_dir)
+        shared_alias = settings.CACHE_TIERED_OPTIONS.get('SHARED_ALIAS', 'shared')
+
+        test_caches = {}
+        for alias, params in settings.CACHES.items():
+            if alias == shared_alias:
+                location = os.path.join(self.runtime_dir, 'cache.sqlite3')
+            else:
+                location = f'{params.get("LOCATION", alias)}-{suffix}'
+            test_caches[alias] = {**params, 'LOCATION': location}
+
+        overrides = override_settings(
+            CACHES=test_caches,
+            INVALIDATION_BUS_PATH=os.path.join(self.runtime_dir, 'invalidation.sqlite3'),
+            METRICS_DIR=os.path.join(self.runtime_dir, 'metrics'),
+            MESSAGE_ID_NODE_PATH=os.path.join(self.runtime_dir, 'message-id-nodes.sqlite3'),
+        )
+        overrides.enable()
+        # Очистка в обратном порядке: номер узла освобождается в реестре теста, затем
+        # восстанавливаются настройки и по ним пересоздается cache_manager
+        self.addCleanup(reset_cache_manager)
+        self.addCleanup(overrides.disable)
+        self.addCleanup(reset_message_id_registry)
+        reset_cache_manager()
+        reset_message_id_registry()
+
+
+def create_profile(username, **values):
+    """Пользователь с профилем (обязательные поля профиля заполняются случайно)"""
+    user = User.objects.create_user(username=username, password='secret-password-1')
+    fields = random_profile_values(random.Random(username))
+    fields.update(values)
+    return Profile.objects.create(user=user, nickname=username, **fields)
+
+
+def run_in_other_process(func) -> int:
+    """
+    Выполнить func в дочернем процессе: другой рабочий процесс с теми же общим кэшем и шиной
+    Returns: код завершения (0 - func выполнена без исключений)
+    """
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            func()
+            code = 0
+        finally:
+            os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    return os.waitstatus_to_exitcode(status)
+
+
+class TemporaryMediaMixin:
+    """MEDIA_ROOT теста - временный каталог"""
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp(prefix='dating-site-media-')
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        overrides = override_settings(MEDIA_ROOT=self.media_root)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def media_path(self, name):
+        return os.path.join(self.media_root, *name.split('/'))
+
+    def write_media(self, name, content=b'photo', age=0):
+        """Создать файл в хранилище; age - сколько секунд назад он изменен"""
+        path = self.media_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(content)
+        if age:
+            modified = time.time() - age
+            os.utime(path, (modified, modified))
+        return path
+
+
+@override_settings(PHOTO_DELETION_WORKER=False)
+class PhotoFileDeletionTests(TemporaryMediaMixin, IsolatedCachesMixin, TestCase):
+    """Очередь удаления файлов фотографий (schedule_file_deletion и process_pending_deletions)"""
+
+    def setUp(self):
+        super().setUp()
+        self.profile = create_profile('deletion_owner')
+        self.photo = self.add_photo('first.jpg')
+        self.variants = [
+            get_variant_name(self.photo.id, self.profile.user_id, self.photo.image.name, fmt) for fmt in IMAGE_FORMATS
+        ]
+        for name in self.variants:
+            self.write_media(name)
+
+    def add_photo(self, filename):
+        name = f'photos/user_{self.profile.user_id}/{filename}'
+        self.write_media(name)
+        return Photo.objects.add_photo(Photo(profile=self.profile, image=name))
+
+    def exists(self, name):
+        return os.path.exists(self.media_path(name))
+
+    def queued_paths(self):
+        return list(PendingFileDeletion.objects.values_list('path', flat=True))
+
+    def test_rolled_back_delete_keeps_file(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            self.photo.delete()
+            raise RuntimeError('откат')
+
+        self.assertTrue(self.exists(self.photo.image.name))
+        self.assertEqual(self.queued_paths(), [])
+        self.assertEqual(process_pending_deletions(), 0)
+        self.assertTrue(self.exists(self.photo.image.name))
+
+    @override_settings(PHOTO_DELETION_WORKER=True)
+    def test_committed_delete_removes_original_and_variants(self):
+        other = self.add_photo('second.jpg')
+        other_variant = get_variant_name(other.id, self.profile.user_id, other.image.name, 'webp')
+        self.write_media(other_variant)
+        worker = FileDeletionWorker()
+
+        # Поток не запускается: очередь процесса обрабатывается в тесте
+        with mock.patch.object(media_utils, 'file_deletion_worker', worker), \
+                mock.patch.object(media_utils.threading, 'Thread'):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.photo.delete()
+            # Запрос только ставит оригинал в очередь: файлы на месте
+            self.assertEqual(self.queued_paths(), [self.photo.image.name])
+            self.assertEqual(worker.pending_count(), 1)
+            self.assertTrue(self.exists(self.photo.image.name))
+
+            self.assertEqual(worker.drain(), 1)
+
+        for name in [self.photo.image.name] + self.variants:
+            self.assertFalse(self.exists(name), name)
+        self.assertTrue(self.exists(other.image.name))
+        self.assertTrue(self.exists(other_variant))
+        self.assertEqual(self.queued_paths(), [])
+
+    def test_failed_unlink_stays_queued_for_retry(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.photo.delete()
+        storage = FileSystemStorage()
+
+        with mock.patch.object(storage, 'delete', side_effect=PermissionError('файл занят')), \
+                self.assertLogs('profiles.media_utils', 'WARNING'):
+            self.assertEqual(process_pending_deletions(storage=storage), 1)
+        entry = PendingFileDeletion.objects.get()
+        self.assertEqual(entry.attempts, 1)
+        self.assertTrue(self.exists(self.photo.image.name))
+
+        self.assertEqual(process_pending_deletions(storage=storage), 1)
+        self.assertFalse(self.exists(self.photo.image.name))
+        self.assertEqual(self.queued_paths(), [])
+
+    def test_profile_delete_queues_originals_without_touching_disk(self):
+        second = self.add_photo('second.jpg')
+
+        with mock.patch.object(media_utils, 'list_photo_variants', side_effect=AssertionError('обращение к диску')):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.profile.user.delete()
+
+        self.assertCountEqual(self.queued_paths(), [self.photo.image.name, second.image.name])
+
+    def test_reuploaded_file_is_not_deleted(self):
+        """Файл снова используется фотографией: запись очереди снимается без удаления"""
+        with self.captureOnCommitCallbacks(execute=True):
+            self.photo.delete()
+        Photo.objects.add_photo(Photo(profile=self.profile, image=self.photo.image.name))
+
+        self.assertEqual(process_pending_deletions(), 1)
+        self.assertTrue(self.exists(self.photo.image.name))
+        self.assertEqual(self.queued_paths(), [])
+
+    def test_cleanup_command_keeps_files_of_encodes_in_progress(self):
+        user_dir = f'photos/user_{self.profile.user_id}'
+        orphan = self.write_media(f'{user_dir}/orphan.jpg', age=7200)
+        orphan_variant = self.write_media(f'photos/variants/{user_dir}/999999-0123456789ab.avif', age=7200)
+        # Файлы кодирования, которое еще идет: блокировка и временный файл
+        in_progress = [
+            self.write_media(f'{self.variants[0]}.lock', age=7200),
+            self.write_media(f'{self.variants[0]}.4242.tmp', age=7200),
+        ]
+        kept = [self.media_path(name) for name in [self.photo.image.name] + self.variants]
+        for path in kept:
+            os.utime(path, (time.time() - 7200,) * 2)
+
+        call_command('cleanup_photo_files', max_per_second=0, stdout=StringIO())
+
+        self.assertFalse(os.path.exists(orphan))
+        self.assertFalse(os.path.exists(orphan_variant))
+        for path in in_progress + kept:
+            self.assertTrue(os.path.exists(path), path)
+
+
+class PrimaryPhotoTests(IsolatedCachesMixin, TestCase):
+    """Одна основная фотография на профиль (ограничение и PhotoManager)"""
+
+    def setUp(self):
+        super().setUp()
+        self.profile = create_profile('photo_owner')
+
+    def add(self, name, is_primary=False):
+        return Photo.objects.add_photo(Photo(profile=self.profile, image=f'photos/test/{name}.jpg',
+                                             is_primary=is_primary))
+
+    def primary_ids(self):
+        return list(Photo.objects.filter(profile=self.profile, is_primary=True).values_list('id', flat=True))
+
+    def test_constraint_rejects_second_primary_photo(self):
+        Photo.objects.create(profile=self.profile, image='photos/test/a.jpg', is_primary=True)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Photo.objects.create(profile=self.profile, image='photos/test/b.jpg', is_primary=True)
+
+    def test_first_photo_becomes_primary(self):
+        first = self.add('first')
+        second = self.add('second')
+        self.assertTrue(first.is_primary)
+        self.assertFalse(second.is_primary)
+        self.assertEqual(self.primary_ids(), [first.id])
+
+    def test_new_primary_photo_replaces_previous(self):
+        self.add('first')
+        second = self.add('second', is_primary=True)
+        self.assertEqual(self.primary_ids(), [second.id])
+
+    def test_set_primary_swaps_in_one_transaction(self):
+        first = self.add('first')
+        second = self.add('second')
+
+        Photo.objects.set_primary(self.profile, second.id)
+        self.assertEqual(self.primary_ids(), [second.id])
+
+        Photo.objects.set_primary(self.profile, first.id)
+        self.assertEqual(self.primary_ids(), [first.id])
+
+    def test_set_primary_of_foreign_photo_keeps_current_primary(self):
+        first = self.add('first')
+        other = Photo.objects.create(profile=create_profile('someone_else'), image='photos/test/c.jpg')
+
+        with self.assertRaises(Photo.DoesNotExist):
+            Photo.objects.set_primary(self.profile, other.id)
+        self.assertEqual(self.primary_ids(), [first.id])
+
+    def test_deleting_primary_promotes_newest_photo(self):
+        first = self.add('first')
+        self.add('second')
+        third = self.add('third')
+
+        Photo.objects.delete_photo(self.profile, first.id)
+
+        self.assertEqual(self.primary_ids(), [third.id])
+
+    def test_photo_change_invalidates_cached_profile_after_commit(self):
+        get_cached_user_profile(self.profile.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add('first')
+        with self.assertNumQueries(1):
+            get_cached_user_profile(self.profile.user)
+
+
+class RangeParsingTests(SimpleTestCase):
+    """Разбор заголовка Range (parse_range)"""
+
+    def test_ranges(self):
+        cases = {
+            'bytes=0-9': (0, 9),
+            'bytes=90-': (90, 99),
+            'bytes=-10': (90, 99),
+            'bytes=-500': (0, 99),
+            'bytes=50-1000': (50, 99),
+            ' bytes=1-1 ': (1, 1),
+        }
+        for header, expected in cases.items():
+            with self.subTest(header=header):
+                self.assertEqual(parse_range(header, 100), expected)
+
+    def test_unsatisfiable_ranges(self):
+        for header in ('bytes=100-', 'bytes=150-200', 'bytes=-0'):
+            with self.subTest(header=header):
+                self.assertIs(parse_range(header, 100), False)
+
+    def test_unsupported_ranges_are_ignored(self):
+        for header in ('bytes=-', 'bytes=5-1', 'bytes=0-1,5-9', 'items=0-9', 'bytes=a-b'):
+            with self.subTest(header=header):
+                self.assertIsNone(parse_range(header, 100))
+
+
+@override_settings(MEDIA_ACCEL_HEADER=None)
+class ServeFileTests(SimpleTestCase):
+    """Условные запросы и диапазоны при отдаче медиафайлов (serve_file)"""
+
+    CONTENT = bytes(range(100))
+
+    def setUp(self):
+        directory = tempfile.mkdtemp(prefix='dating-site-media-')
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.path = os.path.join(directory, 'photo.jpg')
+        with open(self.path, 'wb') as file:
+            file.write(self.CONTENT)
+        self.etag = make_etag(os.stat(self.path))
+        self.factory = RequestFactory()
+
+    def serve(self, **headers):
+        response = serve_file(self.factory.get('/media/photos/photo.jpg', **headers), 'photos/photo.jpg', self.path)
+        self.addCleanup(response.close)
+        return response
+
+    def test_full_response_has_validators(self):
+        response = self.serve()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], self.etag)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Content-Length'], '100')
+        self.assertEqual(b''.join(response.streaming_content), self.CONTENT)
+
+    def test_matching_etag_returns_not_modified(self):
+        for header in (self.etag, f'W/{self.etag}', f'"other", {self.etag}', '*'):
+            with self.subTest(header=header):
+                response = self.serve(HTTP_IF_NONE_MATCH=header)
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response['ETag'], self.etag)
+
+    def test_stale_etag_returns_file(self):
+        self.assertEqual(self.serve(HTTP_IF_NONE_MATCH='"stale"').status_code, 200)
+
+    def test_range_returns_partial_content(self):
+        response = self.serve(HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/100')
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(b''.join(response.streaming_content), self.CONTENT[10:20])
+
+    def test_unsatisfiable_range(self):
+        response = self.serve(HTTP_RANGE='bytes=200-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */100')
+
+    def test_range_with_stale_if_range_returns_whole_file(self):
+        response = self.serve(HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.CONTENT)
+
+    def test_range_with_current_if_range(self):
+        response = self.serve(HTTP_RANGE='bytes=-5', HTTP_IF_RANGE=self.etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.CONTENT[95:])
+
+
+class PhotoFormatNegotiationTests(TemporaryMediaMixin, IsolatedCachesMixin, TestCase):
+    """Выбор формата фотографии по Accept (AVIF/WebP/оригинал) и ее отдача через photo_image"""
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(activity_tracker.flush, force=True)
+        self.addCleanup(session_writer.flush, force=True)
+        # Кодирование в фоне не запускается; набор форматов не зависит от сборки Pillow
+        self.encoder = mock.patch.object(media_utils, 'variant_encoder').start()
+        mock.patch.object(media_utils, 'get_supported_formats', return_value=['avif', 'webp']).start()
+        self.addCleanup(mock.patch.stopall)
+
+        self.profile = create_profile('format_owner')
+        self.image_name = f'photos/user_{self.profile.user_id}/photo.jpg'
+        self.write_media(self.image_name, b'j' * 1000)
+        self.photo = Photo.objects.add_photo(Photo(profile=self.profile, image=self.image_name, is_verified=True))
+
+    def write_variant(self, fmt, size, photo=None):
+        photo = photo or self.photo
+        name = get_variant_name(photo.id, self.profile.user_id, photo.image.name, fmt)
+        self.write_media(name, b'v' * size)
+        return name
+
+    def negotiate(self, accept, allow_variants=True):
+        return negotiate_photo_file(self.photo.id, self.profile.user_id, self.image_name, accept, allow_variants)
+
+    def get_image(self, photo=None, accept=''):
+        response = self.client.get((photo or self.photo).get_image_url(), HTTP_ACCEPT=accept)
+        self.addCleanup(response.close)
+        return response
+
+    def test_acceptable_formats_follow_q_values(self):
+        cases = {
+            'image/avif,image/webp,*/*;q=0.8': ['avif', 'webp'],
+            # Порядок - предпочтение сервера, а не клиента
+            'image/webp;q=0.9, image/avif;q=0.5': ['avif', 'webp'],
+            'image/avif;q=0, image/webp': ['webp'],
+            'image/avif;q=abc, IMAGE/WEBP;q=0.1': ['webp'],
+            # Маска не означает поддержку новых форматов: варианты только по явному типу
+            '*/*': [],
+            'image/*,*/*;q=0.8': [],
+            '': [],
+        }
+        for header, expected in cases.items():
+            with self.subTest(accept=header):
+                self.assertEqual(get_acceptable_formats(header), expected)
+
+    def test_original_is_served_until_variant_is_encoded(self):
+        self.assertEqual(self.negotiate('image/avif,image/webp'), (self.image_name, 'jpg'))
+        self.assertEqual(
+            sorted(call.args for call in self.encoder.enqueue.call_args_list),
+            sorted(
+                (self.image_name, get_variant_name(self.photo.id, self.profile.user_id, self.image_name, fmt), fmt)
+                for fmt in ('avif', 'webp')
+            ),
+        )
+
+    def test_smallest_acceptable_file_wins(self):
+        avif = self.write_variant('avif', 300)
+        webp = self.write_variant('webp', 500)
+        self.assertEqual(self.negotiate('image/avif,image/webp'), (avif, 'avif'))
+        self.assertEqual(self.negotiate('image/avif;q=0,image/webp'), (webp, 'webp'))
+        self.assertEqual(self.negotiate('image/jpeg,*/*'), (self.image_name, 'jpg'))
+        self.encoder.enqueue.assert_not_called()
+
+        # Вариант больше оригинала не отдается
+        self.write_variant('webp', 5000)
+        self.assertEqual(self.negotiate('image/webp'), (self.image_name, 'jpg'))
+
+    def test_variants_are_not_used_when_not_allowed(self):
+        self.write_variant('webp', 100)
+        self.assertEqual(self.negotiate('image/webp', allow_variants=False), (self.image_name, 'jpg'))
+        self.encoder.enqueue.assert_not_called()
+
+    def test_variant_name_depends_on_source_file(self):
+        name = get_variant_name(7, 3, 'photos/user_3/a.jpg', 'avif')
+        self.assertRegex(name, VARIANT_PATH_RE)
+        self.assertTrue(name.startswith('photos/variants/user_3/7-'))
+        self.assertTrue(name.endswith('.avif'))
+        self.assertEqual(get_variant_name(7, 3, 'photos/user_3/a.jpg', 'avif'), name)
+        self.assertNotEqual(get_variant_name(7, 3, 'photos/user_3/b.jpg', 'avif'), name)
+        self.assertEqual(get_variant_name(7, 3, 'photos/user_3/a.jpg', 'webp'), name[:-len('avif')] + 'webp')
+
+    def test_response_varies_on_accept(self):
+        self.write_variant('webp', 200)
+
+        response = self.get_image(accept='image/webp,*/*;q=0.8')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Accept', cc_delim_re.split(response['Vary']))
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertEqual(b''.join(response.streaming_content), b'v' * 200)
+        # Один адрес отдает разные файлы: он не может быть immutable
+        self.assertNotIn('immutable', response['Cache-Control'])
+
+        response = self.get_image(accept='*/*')
+        self.assertIn('Accept', cc_delim_re.split(response['Vary']))
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(b''.join(response.streaming_content), b'j' * 1000)
+
+    def test_unverified_photo_is_refused_to_other_users(self):
+        hidden_name = f'photos/user_{self.profile.user_id}/hidden.jpg'
+        self.write_media(hidden_name, b'h' * 1000)
+        hidden = Photo.objects.add_photo(Photo(profile=self.profile, image=hidden_name))
+        self.write_variant('webp', 100, photo=hidden)
+
+        self.assertEqual(self.get_image(hidden).status_code, 404)
+        self.client.force_login(create_profile('format_viewer').user)
+        self.assertEqual(self.get_image(hidden).status_code, 404)
+        self.assertEqual(self.get_image().status_code, 200)
+
+        # Владелец видит оригинал непроверенной фотографии без общего кэширования
+        self.client.force_login(self.profile.user)
+        response = self.get_image(hidden, accept='image/webp')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+
+    @skipUnless(features.check('webp'), 'Pillow собран без WebP')
+    def test_encoder_writes_each_variant_once(self):
+        Image.new('RGB', (64, 48), 'red').save(self.media_path(self.image_name), 'JPEG')
+        variant = get_variant_name(self.photo.id, self.profile.user_id, self.image_name, 'webp')
+        encoder = VariantEncoder()
+
+        with mock.patch.object(media_utils.threading, 'Thread'):
+            encoder.enqueue(self.image_name, variant, 'webp')
+            encoder.enqueue(self.image_name, variant, 'webp')
+            self.assertEqual(encoder.pending_count(), 1)
+            self.assertEqual(encoder.drain(), 1)
+
+        with Image.open(self.media_path(variant)) as image:
+            self.assertEqual((image.format, image.size), ('WEBP', (64, 48)))
+        self.assertEqual(os.listdir(os.path.dirname(self.media_path(variant))), [os.path.basename(variant)])
+
+
+@override_settings(PHOTO_UPLOAD_MAX_SIZE=100 * 1024, PHOTO_UPLOAD_MAX_FILES=2)
+class LimitedUploadHandlerTests(IsolatedCachesMixin, SimpleTestCase):
+    """Лимиты размера, количества и типа файлов при потоковой загрузке (LimitedTemporaryFileUploadHandler)"""
+
+    def setUp(self):
+        super().setUp()
+        self.factory = RequestFactory()
+
+    def upload(self, *files):
+        """Разобрать multipart-запрос с файлами поля images; returns: (request.FILES, ошибки загрузки)"""
+        request = self.factory.post('/profiles/photos/upload-multiple/', {'images': list(files)})
+        uploaded = request.FILES
+        for file in uploaded.getlist('images'):
+            self.addCleanup(file.close)
+        return uploaded, get_upload_errors(request)
+
+    def image(self, name, size=1024, content_type='image/jpeg'):
+        return SimpleUploadedFile(name, os.urandom(size), content_type=content_type)
+
+    def assertUploaded(self, uploaded, expected):
+        """Файлы записаны на диск и читаются целиком"""
+        files = uploaded.getlist('images')
+        self.assertEqual([file.name for file in files], [file.name for file in expected])
+        for file, source in zip(files, expected):
+            self.assertIsInstance(file, TemporaryUploadedFile)
+            file.seek(0)
+            source.seek(0)
+            self.assertEqual(file.read(), source.read())
+
+    def test_files_within_limits_are_written_to_temporary_files(self):
+        first, second = self.image('first.jpg', 90 * 1024), self.image('second.png', content_type='image/png')
+        uploaded, errors = self.upload(first, second)
+        self.assertEqual(errors, [])
+        self.assertUploaded(uploaded, [first, second])
+
+    def test_file_over_size_limit_is_skipped(self):
+        small, big = self.image('small.jpg'), self.image('big.jpg', 200 * 1024)
+        uploaded, errors = self.upload(big, small)
+        self.assertUploaded(uploaded, [small])
+        self.assertEqual(len(errors), 1)
+        self.assertIn('big.jpg', errors[0])
+
+    def test_files_over_count_limit_are_skipped(self):
+        files = [self.image(f'photo{index}.jpg') for index in range(4)]
+        uploaded, errors = self.upload(*files)
+        # Пропуск лишних файлов не закрывает временные файлы уже принятых
+        self.assertUploaded(uploaded, files[:2])
+        self.assertEqual(errors, ['Можно загрузить максимум 2 файлов за раз.'])
+
+    def test_non_image_is_skipped(self):
+        notes, photo = self.image('notes.txt', content_type='text/plain'), self.image('photo.jpg')
+        uploaded, errors = self.upload(notes, photo)
+        self.assertUploaded(uploaded, [photo])
+        self.assertEqual(len(errors), 1)
+        self.assertIn('notes.txt', errors[0])
+
+
+class CacheMetricsTests(IsolatedCachesMixin, SimpleTestCase):
+    """Счетчики InstrumentedCache, сбор снимков метрик процессов и get_cache_stats"""
+
+    def setUp(self):
+        super().setUp()
+        self.registry = MetricsRegistry()
+        mock.patch.object(cache_metrics, 'metrics', self.registry).start()
+        # Снимки процессов в METRICS_DIR пишет только тест
+        mock.patch.object(MetricsRegistry, 'maybe_flush').start()
+        self.addCleanup(mock.patch.stopall)
+        self.backend = LocMemCache(f'metrics-test-{id(self)}', {'OPTIONS': {'MAX_ENTRIES': 4, 'CULL_FREQUENCY': 2}})
+        self.cache = InstrumentedCache(self.backend, 'profiles')
+
+    def counter(self, name, family):
+        return self.registry.snapshot()['counters'].get(f'{name}{{cache=profiles,family={family}}}', 0)
+
+    def write_snapshot(self, registry, pid):
+        snapshot = dict(registry.snapshot(), pid=pid)
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        with open(os.path.join(settings.METRICS_DIR, f'{pid}.json'), 'w', encoding='utf-8') as file:
+            json.dump(snapshot, file)
+
+    # Работающие процессы (рабочие процессы, снимки которых собирает команда)
+    LIVE_PIDS = (os.getpid(), os.getppid())
+
+    def dead_pid(self):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        return pid
+
+    def test_key_family(self):
+        self.assertEqual(get_key_family('dating_site:profile:user:user_id-1'), 'profile')
+        self.assertEqual(get_key_family('dating_site:search'), 'search')
+        self.assertEqual(get_key_family('other_site:profile:1'), 'other')
+        self.assertEqual(get_key_family('dating_site'), 'other')
+
+    def test_hits_misses_sets_and_deletes_are_counted_per_family(self):
+        self.cache.set('dating_site:profile:1', {'name': 'Анна'})
+        self.cache.set('dating_site:profile:2', None)
+        stored = sum(len(value) for value in self.backend._cache.values())
+        self.assertEqual(self.cache.get('dating_site:profile:1'), {'name': 'Анна'})
+        # Сохраненный None - попадание, а не промах
+        self.assertIsNone(self.cache.get('dating_site:profile:2', 'default'))
+        self.assertEqual(self.cache.get('dating_site:profile:3', 'default'), 'default')
+        self.cache.get_many(['dating_site:profile:1', 'dating_site:search:1', 'dating_site:search:2'])
+        self.cache.delete_many(['dating_site:profile:1', 'dating_site:search:1'])
+
+        self.assertEqual(self.counter('cache.hits', 'profile'), 3)
+        self.assertEqual(self.counter('cache.misses', 'profile'), 1)
+        self.assertEqual(self.counter('cache.misses', 'search'), 2)
+        self.assertEqual(self.counter('cache.sets', 'profile'), 2)
+        self.assertEqual(self.counter('cache.deletes', 'profile'), 1)
+        self.assertEqual(self.counter('cache.deletes', 'search'), 1)
+        self.assertEqual(self.counter('cache.bytes_written', 'profile'), stored)
+        self.assertEqual(
+            self.registry.snapshot()['histograms']['cache.latency_ms{cache=profiles,family=profile,op=get}']['count'], 3,
+        )
+
+    def test_evictions_are_counted_and_overwrites_are_not(self):
+        self.cache.set_many({f'dating_site:profile:{index}': index for index in range(3)})
+        self.cache.set('dating_site:profile:0', 'updated')
+        self.assertEqual(self.counter('cache.evictions', 'profile'), 0)
+
+        for index in range(3, 10):
+            self.cache.set(f'dating_site:profile:{index}', index)
+        self.assertEqual(self.counter('cache.sets', 'profile'), 11)
+        # Всего 10 разных ключей: все, кого нет в кэше, вытеснены
+        self.assertEqual(self.counter('cache.evictions', 'profile'), 10 - len(self.backend._cache))
+        self.assertGreater(self.counter('cache.evictions', 'profile'), 0)
+        self.assertEqual(self.registry.snapshot()['gauges']['cache.entries{cache=profiles}'], len(self.backend._cache))
+
+    def test_snapshots_of_live_workers_are_merged_and_dead_ones_pruned(self):
+        first, second, dead = MetricsRegistry(), MetricsRegistry(), MetricsRegistry()
+        first.incr('cache.hits', 3, cache='profiles', family='profile')
+        first.set_gauge('cache.entries', 10, cache='profiles')
+        first.observe('cache.latency_ms', 0.2, cache='profiles', family='profile', op='get')
+        second.incr('cache.hits', 4, cache='profiles', family='profile')
+        second.set_gauge('cache.entries', 25, cache='profiles')
+        second.observe('cache.latency_ms', 30, cache='profiles', family='profile', op='get')
+        dead.incr('cache.hits', 100, cache='profiles', family='profile')
+        dead_pid = self.dead_pid()
+        self.write_snapshot(first, self.LIVE_PIDS[0])
+        self.write_snapshot(second, self.LIVE_PIDS[1])
+        self.write_snapshot(dead, dead_pid)
+
+        collected = collect_metrics()
+
+        self.assertEqual({snapshot['pid'] for snapshot in collected['processes']}, set(self.LIVE_PIDS))
+        self.assertEqual(collected['counters']['cache.hits{cache=profiles,family=profile}'], 7)
+        self.assertEqual(collected['gauges']['cache.entries{cache=profiles}'], 25)
+        histogram = collected['histograms']['cache.latency_ms{cache=profiles,family=profile,op=get}']
+        self.assertEqual((histogram['count'], histogram['sum']), (2, 30.2))
+        self.assertFalse(os.path.exists(os.path.join(settings.METRICS_DIR, f'{dead_pid}.json')))
+
+    def test_cache_stats_report(self):
+        first, second = MetricsRegistry(), MetricsRegistry()
+        first.incr('cache.hits', 6, cache='profiles', family='profile')
+        first.incr('cache.misses', 2, cache='profiles', family='profile')
+        first.incr('cache.sets', 2, cache='profiles', family='profile')
+        first.incr('cache.bytes_written', 300, cache='profiles', family='profile')
+        first.set_gauge('cache.entries', 2, cache='profiles')
+        second.incr('cache.misses', 2, cache='profiles', family='conversations')
+        second.incr('cache.evictions', 1, cache='profiles', family='conversations')
+        second.set_gauge('cache.entries', 5, cache='profiles')
+        for _ in range(10):
+            second.observe('cache.latency_ms', 0.3, cache='profiles', family='conversations', op='get')
+        self.write_snapshot(first, self.LIVE_PIDS[0])
+        self.write_snapshot(second, self.LIVE_PIDS[1])
+
+        stats = get_cache_stats()['profiles']
+
+        self.assertEqual(
+            {counter: stats[counter] for counter in ('hits', 'misses', 'sets', 'evictions', 'bytes_written')},
+            {'hits': 6, 'misses': 4, 'sets': 2, 'evictions': 1, 'bytes_written': 300},
+        )
+        self.assertEqual(stats['hit_rate'], 0.6)
+        self.assertEqual(stats['families']['profile']['hit_rate'], 0.75)
+        self.assertEqual(stats['families']['conversations']['hit_rate'], 0)
+        self.assertCountEqual(
+            stats['entries'], [{'pid': self.LIVE_PIDS[0], 'entries': 2}, {'pid': self.LIVE_PIDS[1], 'entries': 5}],
+        )
+        latency = stats['latency']['conversations:get']
+        self.assertEqual((latency['count'], latency['p50_ms'], latency['p99_ms']), (10, 0.5, 0.5))
+        self.assertAlmostEqual(latency['avg_ms'], 0.3)
+
+
+@override_settings(INVALIDATION_BUS_POLL_INTERVAL=0)
+class TieredCacheTests(IsolatedCachesMixin, SimpleTestCase):
+    """Двухуровневый кэш: локальный LRU процесса перед общим SQLiteCache"""
+
+    def setUp(self):
+        super().setUp()
+        self.cache = TieredCache.from_alias('profiles')
+        self.shared = caches['shared']
+
+    def shared_value(self, key, default=None):
+        return self.shared.get(self.cache.shared_key(key), default)
+
+    def test_writes_go_through_to_shared_tier(self):
+        self.cache.set('single', {'id': 1}, 60)
+        self.cache.set_many({'first': 1, 'second': 2})
+        self.assertTrue(self.cache.add('added', 'value'))
+        self.assertFalse(self.cache.add('added', 'other'))
+
+        for key, value in {'single': {'id': 1}, 'first': 1, 'second': 2, 'added': 'value'}.items():
+            self.assertEqual(self.shared_value(key), value)
+        # Общий уровень хранит запись весь срок, локальная копия - не дольше LOCAL_TIMEOUT
+        (expires,) = self.shared.connection.execute(
+            'SELECT expires FROM cache_entries WHERE key = ?', (self.shared.make_key(self.cache.shared_key('single')),)
+        ).fetchone()
+        self.assertAlmostEqual(expires - time.time(), 60, delta=2)
+
+    def test_reads_go_through_to_shared_tier_and_populate_local_tier(self):
+        self.shared.set_many({self.cache.shared_key(key): key.upper() for key in ('first', 'second', 'third')})
+
+        self.assertEqual(self.cache.get('first'), 'FIRST')
+        self.assertEqual(self.cache.get_many(['second', 'third', 'missing']), {'second': 'SECOND', 'third': 'THIRD'})
+        self.assertIsNone(self.cache.get('missing'))
+
+        # Локальные копии отдаются без общего уровня, пока не истек LOCAL_TIMEOUT
+        self.shared.clear()
+        self.assertEqual(self.cache.get_many(['first', 'second']), {'first': 'FIRST', 'second': 'SECOND'})
+        later = time.time() + self.cache.local_timeout + 1
+        with mock.patch('time.time', return_value=later):
+            self.assertIsNone(self.cache.get('first'))
+
+    def test_changes_of_other_process_reach_local_tier(self):
+        self.cache.set_many({'deleted': 'old', 'changed': 'old'})
+        self.assertEqual(self.cache.get_many(['deleted', 'changed']), {'deleted': 'old', 'changed': 'old'})
+
+        def change():
+            other = TieredCache.from_alias('profiles')
+            other.delete('deleted')
+            other.set('changed', 'new')
+
+        self.assertEqual(run_in_other_process(change), 0)
+        self.assertIsNone(self.cache.get('deleted'))
+        self.assertEqual(self.cache.get('changed'), 'new')
+
+    def test_clear_drops_only_own_namespace(self):
+        messages = TieredCache.from_alias('messages')
+        self.cache.set('key', 'profile')
+        messages.set('key', 'message')
+
+        self.cache.clear()
+
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(messages.get('key'), 'message')
+
+
+class SQLiteCacheTests(SimpleTestCase):
+    """Общий кэш в файле SQLite (SQLiteCache)"""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp(prefix='dating-site-cache-')
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.cache = SQLiteCache(
+            os.path.join(directory, 'cache.sqlite3'), {'TIMEOUT': 300, 'OPTIONS': {'MAX_ENTRIES': 10_000}},
+        )
+
+    def test_entries_expire(self):
+        self.cache.set('short', 'value', 10)
+        self.cache.set('forever', 'value', None)
+        now = time.time()
+
+        with mock.patch('time.time', return_value=now + 11):
+            self.assertIsNone(self.cache.get('short'))
+            self.assertFalse(self.cache.has_key('short'))
+            self.assertEqual(self.cache.get_many(['short', 'forever']), {'forever': 'value'})
+            self.assertFalse(self.cache.touch('short'))
+            # Место просроченной записи свободно для add
+            self.assertTrue(self.cache.add('short', 'new', 10))
+            self.assertEqual(self.cache.get('short'), 'new')
+
+    def test_touch_and_zero_timeout(self):
+        self.cache.set('key', 'value', 10)
+        self.assertTrue(self.cache.touch('key', 100))
+        with mock.patch('time.time', return_value=time.time() + 50):
+            self.assertEqual(self.cache.get('key'), 'value')
+
+        self.cache.set('key', 'value', 0)
+        self.assertFalse(self.cache.has_key('key'))
+
+    def test_many_keys_are_read_in_chunks(self):
+        count = 2 * QUERY_CHUNK_SIZE + 1
+        data = {f'key-{index}': index for index in range(count)}
+        self.cache.set_many(data)
+        statements = []
+        self.cache.connection.set_trace_callback(statements.append)
+        self.addCleanup(self.cache.connection.set_trace_callback, None)
+
+        self.assertEqual(self.cache.get_many(list(data) + ['missing']), data)
+
+        self.assertEqual(len([sql for sql in statements if sql.startswith('SELECT')]), 3)
+        self.cache.delete_many(list(data)[1:])
+        self.assertEqual(self.cache.get_many(list(data)), {'key-0': 0})
+
+    def test_undecodable_entry_is_a_miss(self):
+        self.cache.set('key', 'value')
+        self.cache.connection.execute('UPDATE cache_entries SET value = ?', (b'not a pickle',))
+        self.assertEqual(self.cache.get('key', 'default'), 'default')
+        self.assertFalse(self.cache.has_key('key'))
+
+    def test_overflow_culls_entries_closest_to_expiry(self):
+        cache = SQLiteCache(self.cache.path, {'OPTIONS': {'MAX_ENTRIES': 10, 'CULL_FREQUENCY': 2, 'CULL_EVERY': 1}})
+        cache.set('forever', 'value', None)
+        for index in range(20):
+            cache.set(f'key-{index}', index, 100 + index)
+
+        (entries,) = cache.connection.execute('SELECT COUNT(*) FROM cache_entries').fetchone()
+        self.assertLessEqual(entries, 11)
+        self.assertEqual(cache.get('forever'), 'value')
+        self.assertEqual(cache.get('key-19'), 19)
+        self.assertIsNone(cache.get('key-0'))
+
+
+class InvalidationBusTests(SimpleTestCase):
+    """Журнал инвалидаций: порядок чтения, свои записи, пропуски в журнале"""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp(prefix='dating-site-bus-')
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.bus = InvalidationBus(os.path.join(directory, 'invalidation.sqlite3'), poll_interval=0)
+        self.received = []
+        self.bus.subscribe('profiles', self.received.append)
+
+    def publish_from_other_process(self, *keys):
+        self.assertEqual(run_in_other_process(lambda: self.bus.publish('profiles', keys)), 0)
+
+    def test_other_process_keys_are_delivered_in_one_batch(self):
+        self.publish_from_other_process('first', 'second')
+        self.publish_from_other_process('third')
+        self.bus.publish('messages', ['not subscribed'])
+
+        self.assertEqual(self.bus.poll(), 3)
+        self.assertEqual(self.received, [['first', 'second', 'third']])
+        self.assertEqual(self.bus.poll(), 0)
+
+    def test_own_publications_are_skipped(self):
+        self.bus.publish('profiles', ['key'])
+        self.assertEqual(self.bus.poll(), 0)
+        self.assertEqual(self.received, [])
+
+    def test_truncated_log_forces_full_clear(self):
+        self.publish_from_other_process('first')
+        self.publish_from_other_process('second')
+        # Записи удалены по сроку хранения раньше, чем процесс их прочитал
+        self.bus.connection.execute('DELETE FROM invalidations WHERE key = ?', ('first',))
+
+        self.bus.poll()
+
+        self.assertEqual(self.received, [None])
+        self.publish_from_other_process('third')
+        self.bus.poll()
+        self.assertEqual(self.received, [None, ['third']])
+
+    def test_recreated_log_forces_full_clear(self):
+        self.publish_from_other_process('first', 'second')
+        self.bus.poll()
+        self.bus.connection.executescript('DELETE FROM invalidations; DELETE FROM sqlite_sequence;')
+        self.publish_from_other_process('third')
+
+        self.bus.poll()
+
+        self.assertEqual(self.received, [['first', 'second'], None])
+
+
+@override_settings(INVALIDATION_BUS_POLL_INTERVAL=0)
+class BroadcastingCacheTests(IsolatedCachesMixin, SimpleTestCase):
+    """Кэши процесса получают удаления и сбросы версий тегов из других процессов"""
+
+    def setUp(self):
+        super().setUp()
+        self.bus = invalidation_bus.get_invalidation_bus()
+        self.cache = cache_manager.default_cache
+        self.cache.set_many({'deleted': 'value', 'kept': 'value'})
+
+    def test_delete_in_other_process_evicts_local_copy(self):
+        self.assertEqual(run_in_other_process(lambda: cache_manager.default_cache.delete('deleted')), 0)
+        # Хранилище LocMemCache у процессов свое: без шины копия осталась бы
+        self.assertEqual(self.cache.get('deleted'), 'value')
+
+        self.bus.poll()
+
+        self.assertIsNone(self.cache.get('deleted'))
+        self.assertEqual(self.cache.get('kept'), 'value')
+
+    def test_clear_in_other_process_clears_local_cache(self):
+        self.assertEqual(run_in_other_process(cache_manager.default_cache.clear), 0)
+        self.bus.poll()
+        self.assertEqual(self.cache.get_many(['deleted', 'kept']), {})
+
+    def test_tag_bump_in_other_process_reaches_local_tier(self):
+        before = get_tag_versions(['city:1'])['city:1']
+
+        self.assertEqual(run_in_other_process(lambda: invalidate_tags('city:1')), 0)
+
+        self.assertEqual(get_tag_versions(['city:1'])['city:1'], before + 1)
+
+    def test_truncated_log_clears_local_caches(self):
+        self.bus.poll()
+        self.assertEqual(run_in_other_process(lambda: cache_manager.default_cache.delete('deleted')), 0)
+        self.assertEqual(run_in_other_process(lambda: cache_manager.default_cache.delete('other')), 0)
+        self.bus.connection.execute(
+            'DELETE FROM invalidations WHERE id = (SELECT MIN(id) FROM invalidations WHERE namespace = ?)',
+            ('default',),
+        )
+
+        self.bus.poll()
+
+        self.assertEqual(self.cache.get_many(['deleted', 'kept']), {})
+
+
+class TagInvalidationTests(IsolatedCachesMixin, SimpleTestCase):
+    """Инвалидация записей кэша по тегам (set_tagged / get_tagged / invalidate_tags)"""
+
+    def setUp(self):
+        super().setUp()
+        self.cache = LocMemCache(f'tags-test-{id(self)}', {})
+
+    def test_invalidated_tag_hides_only_its_entries(self):
+        set_tagged(self.cache, 'a', 'value a', ['city:1'])
+        set_tagged(self.cache, 'b', 'value b', ['city:2'])
+
+        invalidate_tags('city:1')
+
+        self.assertIsNone(get_tagged(self.cache, 'a'))
+        self.assertEqual(get_tagged(self.cache, 'b'), 'value b')
+
+    def test_entry_with_several_tags_is_invalidated_by_any_of_them(self):
+        set_tagged(self.cache, 'key', 'value', ['profile:1', 'profile:2'])
+        invalidate_tags('profile:2')
+        self.assertEqual(get_tagged(self.cache, 'key', 'missing'), 'missing')
+
+    def test_global_tag_invalidates_everything(self):
+        set_tagged(self.cache, 'a', 'value a', ['city:1'])
+        set_tagged(self.cache, 'b', 'value b', [])
+        invalidate_tags(GLOBAL_TAG)
+        self.assertIsNone(get_tagged(self.cache, 'a'))
+        self.assertIsNone(get_tagged(self.cache, 'b'))
+
+    def test_evicted_version_does_not_resurrect_stale_entries(self):
+        """Вытесненная версия тега создается заново большей, а не с начала"""
+        set_tagged(self.cache, 'key', 'value', ['city:1'])
+        version = get_tag_versions(['city:1'])['city:1']
+
+        cache_manager.tags_cache.delete(cache_utils._tag_key('city:1'))
+
+        self.assertGreater(get_tag_versions(['city:1'])['city:1'], version)
+        self.assertIsNone(get_tagged(self.cache, 'key'))
+
+    def test_versions_read_before_compute_win_over_concurrent_invalidation(self):
+        """Значение, вычисленное до инвалидации, записывается с прежними версиями и не отдается"""
+        versions = get_tag_versions(['city:1'])
+        invalidate_tags('city:1')
+        set_tagged(self.cache, 'key', 'stale value', ['city:1'], versions=versions)
+        self.assertIsNone(get_tagged(self.cache, 'key'))
+
+
+class GetOrComputeStampedeTests(IsolatedCachesMixin, SimpleTestCase):
+    """Защита от лавины пересчетов в cache_utils.get_or_compute"""
+
+    THREADS = 16
+
+    def setUp(self):
+        super().setUp()
+        self.cache = LocMemCache(f'stampede-test-{id(self)}', {})
+        self.key = 'dating_site:test:stampede'
+        self.tag = f'test-stampede:{id(self)}'
+        self.computations = 0
+        self.lock = threading.Lock()
+
+    def slow_compute(self, value='value', duration=0.2):
+        def compute():
+            with self.lock:
+                self.computations += 1
+            time.sleep(duration)
+            return value
+        return compute
+
+    def run_concurrently(self, func):
+        """Запустить func в нескольких потоках одновременно и вернуть результаты"""
+        barrier = threading.Barrier(self.THREADS)
+        results = [None] * self.THREADS
+
+        def worker(index):
+            barrier.wait()
+            results[index] = func()
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_cold_key_is_computed_once(self):
+        """Пустой кэш: значение вычисляет один поток, остальные дожидаются его"""
+        results = self.run_concurrently(
+            lambda: get_or_compute(self.cache, self.key, self.slow_compute(), timeout=60, tags=[self.tag])
+        )
+        self.assertEqual(self.computations, 1)
+        self.assertEqual(results, ['value'] * self.THREADS)
+
+    def test_expired_value_is_served_stale_while_one_recomputes(self):
+        """Истекшая свежесть: пересчитывает один поток, остальные сразу получают прежнее значение"""
+        get_or_compute(self.cache, self.key, self.slow_compute('old', 0), timeout=60, tags=[self.tag])
+        self.computations = 0
+
+        with mock.patch.object(cache_utils.time, 'time', return_value=time.time() + 70):
+            started = time.monotonic()
+            results = self.run_concurrently(
+                lambda: get_or_compute(self.cache, self.key, self.slow_compute('new'), timeout=60, tags=[self.tag])
+            )
+            elapsed = time.monotonic() - started
+
+        self.assertEqual(self.computations, 1)
+        self.assertEqual(results.count('new'), 1)
+        self.assertEqual(results.count('old'), self.THREADS - 1)
+        self.assertLess(elapsed, 1.0)
+
+    def test_invalidated_tag_is_recomputed_once_without_stale_values(self):
+        """После инвалидации тега устаревшее значение не отдается, пересчет выполняется один раз"""
+        get_or_compute(self.cache, self.key, self.slow_compute('old', 0), timeout=60, tags=[self.tag])
+        self.computations = 0
+        invalidate_tags(self.tag)
+
+        results = self.run_concurrently(
+            lambda: get_or_compute(self.cache, self.key, self.slow_compute('new'), timeout=60, tags=[self.tag])
+        )
+        self.assertEqual(self.computations, 1)
+        self.assertEqual(results, ['new'] * self.THREADS)
+
+    def test_ttl_jitter_spreads_expiry(self):
+        """Срок свежести уменьшается случайно, но не больше чем на TTL_JITTER"""
+        fresh_until = set()
+        for i in range(20):
+            key = f'{self.key}:{i}'
+            now = time.time()
+            get_or_compute(self.cache, key, lambda: i, timeout=100)
+            entry = self.cache.get(key)
+            self.assertLessEqual(entry.fresh_until, now + 100 + 1)
+            self.assertGreaterEqual(entry.fresh_until, now + 100 * (1 - cache_utils.TTL_JITTER))
+            fresh_until.add(round(entry.fresh_until - now, 3))
+        self.assertGreater(len(fresh_until), 1)
+
+
+class CacheCodecTests(TestCase):
+    """Компактная сериализация для кэша: проекции моделей, сжатие, версия схемы"""
+
+    def setUp(self):
+        create_profile('codec-user', goal='Серьезные отношения ' * 10)
+        self.profile = Profile.objects.select_related('user').get(user__username='codec-user')
+
+    def round_trip(self, codec_name, value):
+        codec = cache_utils.get_codec(codec_name)
+        return codec.loads(codec.dumps(value))
+
+    def assertProjected(self, loaded, source, fields):
+        """Поля проекции равны исходным и читаются без запросов, остальные - отложены"""
+        self.assertIs(type(loaded), type(source))
+        with self.assertNumQueries(0):
+            for attname in fields:
+                self.assertEqual(getattr(loaded, attname), getattr(source, attname), attname)
+        all_fields = {field.attname for field in source._meta.concrete_fields}
+        self.assertEqual(loaded.get_deferred_fields(), all_fields - set(fields))
+        self.assertFalse(loaded._state.adding)
+        self.assertEqual(loaded._state.db, DEFAULT_DB_ALIAS)
+
+    def test_profile_round_trip(self):
+        loaded = self.round_trip('profile', self.profile)
+
+        profile_fields = [field.attname for field in Profile._meta.concrete_fields]
+        self.assertProjected(loaded, self.profile, profile_fields)
+        with self.assertNumQueries(0):
+            user = loaded.user
+        self.assertProjected(user, self.profile.user, cache_utils.USER_CACHE_FIELDS)
+        self.assertEqual(loaded, self.profile)
+        self.assertIsNone(self.round_trip('profile', None))
+
+    def test_deferred_field_is_loaded_on_access(self):
+        (loaded,) = self.round_trip('recent_profiles', [self.profile])
+
+        self.assertProjected(loaded, self.profile, cache_utils.RECENT_PROFILE_FIELDS)
+        self.assertEqual(loaded.user.username, 'codec-user')
+        with self.assertNumQueries(1):
+            self.assertEqual(loaded.goal, self.profile.goal)
+
+    def test_conversation_row_round_trip(self):
+        other = create_profile('codec-other')
+        conversation = Conversation(
+            id=7, participant1_id=self.profile.user_id, participant2_id=other.user_id, last_message_at=timezone.now(),
+        )
+        message = Message(
+            id=1 << 40, conversation_id=conversation.id, sender_id=other.user_id, receiver_id=self.profile.user_id,
+            content='Привет', sent_at=conversation.last_message_at, is_read=False,
+        )
+        row = {
+            'conversation': conversation, 'other_user': other.user, 'other_profile': other,
+            'last_message': message, 'unread_count': 3,
+        }
+
+        (loaded,) = self.round_trip('conversation_list', [row])
+
+        self.assertEqual(loaded.keys(), row.keys())
+        self.assertProjected(
+            loaded['conversation'], conversation, ('id', 'participant1_id', 'participant2_id', 'last_message_at'),
+        )
+        self.assertProjected(loaded['other_user'], other.user, ('id', 'username'))
+        self.assertProjected(loaded['other_profile'], other, PROFILE_LIST_FIELDS)
+        self.assertProjected(
+            loaded['last_message'], message,
+            ('id', 'conversation_id', 'sender_id', 'receiver_id', 'content', 'sent_at', 'is_read'),
+        )
+        self.assertEqual(loaded['unread_count'], 3)
+
+    def test_large_values_are_compressed(self):
+        small = pack('x' * 10)
+        large = pack('x' * DEFAULT_COMPRESS_MIN_SIZE)
+        incompressible = pack(os.urandom(DEFAULT_COMPRESS_MIN_SIZE))
+
+        self.assertEqual(small[:1], b'r')
+        self.assertEqual(large[:1], b'z')
+        self.assertLess(len(large), DEFAULT_COMPRESS_MIN_SIZE)
+        self.assertEqual(incompressible[:1], b'r')
+        self.assertEqual(unpack(large), 'x' * DEFAULT_COMPRESS_MIN_SIZE)
+
+        profiles = [self.profile] * 200
+        blob = cache_utils.get_codec('recent_profiles').dumps(profiles)
+        self.assertEqual(blob[:1], b'z')
+        self.assertEqual(len(cache_utils.get_codec('recent_profiles').loads(blob)), 200)
+
+    def test_schema_change_changes_key_version(self):
+        def version(fields, user_fields=('id', 'username')):
+            return CacheCodec(ModelProjection(
+                Profile, fields, related={'user': ModelProjection(User, user_fields)},
+            )).version
+
+        self.assertEqual(version(('id', 'age')), version(('id', 'age')))
+        self.assertNotEqual(version(('id', 'age')), version(('id', 'age', 'city')))
+        self.assertNotEqual(version(('id', 'age')), version(('id', 'age'), ('id', 'username', 'email')))
+
+        key = get_cached_user_profile.cache_key(user_id=1)
+        self.assertIn(cache_utils.get_codec('profile').version, key)
+        changed = CacheCodec(ModelProjection(Profile, ('id', 'user_id')))
+        with mock.patch.object(cache_utils, 'get_codec', return_value=changed):
+            self.assertNotEqual(get_cached_user_profile.cache_key(user_id=1), key)
+
+
+class CachedUserProfilesBatchTests(IsolatedCachesMixin, TestCase):
+    """Пакетное чтение профилей из кэша (get_cached_user_profiles)"""
+
+    def setUp(self):
+        super().setUp()
+        self.profiles = [create_profile(f'batch{index}') for index in range(3)]
+        self.users = [profile.user for profile in self.profiles]
+        self.without_profile = User.objects.create_user(username='no_profile', password='secret-password-1')
+
+    def test_misses_are_loaded_with_one_query(self):
+        with self.assertNumQueries(1):
+            result = get_cached_user_profiles([*self.users, self.without_profile, self.users[0]])
+        self.assertEqual({user_id: profile and profile.id for user_id, profile in result.items()}, {
+            **{profile.user_id: profile.id for profile in self.profiles},
+            self.without_profile.id: None,
+        })
+
+    def test_second_read_is_served_from_cache(self):
+        get_cached_user_profiles([*self.users, self.without_profile])
+        with self.assertNumQueries(0):
+            result = get_cached_user_profiles([*self.users, self.without_profile])
+        self.assertEqual(result[self.users[1].id].nickname, 'batch1')
+        self.assertIsNone(result[self.without_profile.id])
+
+    def test_entries_are_shared_with_single_profile_reads(self):
+        get_cached_user_profiles(self.users)
+        with self.assertNumQueries(0):
+            profile = get_cached_user_profile(self.users[2])
+        self.assertEqual(profile.id, self.profiles[2].id)
+
+        get_cached_user_profile(self.without_profile)
+        with self.assertNumQueries(0):
+            self.assertIsNone(get_cached_user_profiles([self.without_profile])[self.without_profile.id])
+
+    def test_only_invalidated_profile_is_reloaded(self):
+        get_cached_user_profiles(self.users)
+        Profile.objects.filter(id=self.profiles[0].id).update(nickname='renamed')
+        invalidate_user_profile_cache(self.users[0])
+
+        with self.assertNumQueries(1) as context:
+            result = get_cached_user_profiles(self.users)
+        self.assertIn(f'IN ({self.users[0].id})', context.captured_queries[0]['sql'])
+        self.assertEqual(result[self.users[0].id].nickname, 'renamed')
+        self.assertEqual(result[self.users[1].id].nickname, 'batch1')
+
+
+@override_settings(PHOTO_DELETION_WORKER=False)
+class PhotoManagerReplicaTests(IsolatedCachesMixin, TransactionTestCase):
+    """
+    Записи PhotoManager при настроенной реплике идут в основную базу
+    Реплики нет в databases теста: любое обращение к ней завершается ошибкой.
+    Без TestCase: внутри его транзакции роутер и так читает из основной базы
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.profile = create_profile('replica_owner')
+        self.first = Photo.objects.add_photo(Photo(profile=self.profile, image='photos/test/first.jpg'))
+
+        connections.settings['replica'] = {
+            **copy.deepcopy(connections[DEFAULT_DB_ALIAS].settings_dict),
+            'NAME': os.path.join(self.runtime_dir, 'replica.sqlite3'),
+        }
+        self.addCleanup(self.remove_replica)
+        overrides = override_settings(DATABASE_REPLICAS=['replica'], DATABASE_REPLICA_STATUS_DIR=self.runtime_dir)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        write_replica_status('replica', synced_at=time.time())
+        replica_clock._checked_at = 0.0
+        self.addCleanup(setattr, replica_clock, '_checked_at', 0.0)
+
+    def remove_replica(self):
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+
+    def test_reads_go_to_replica(self):
+        self.assertEqual(Photo.objects.db, 'replica')
+
+    def test_writes_and_transactions_use_primary(self):
+        second = Photo.objects.add_photo(Photo(profile=self.profile, image='photos/test/second.jpg'))
+        Photo.objects.set_primary(self.profile, second.id)
+        Photo.objects.delete_photo(self.profile, second.id)
+
+        self.assertEqual(
+            list(Photo.objects.using(DEFAULT_DB_ALIAS).filter(profile=self.profile).values_list('id', 'is_primary')),
+            [(self.first.id, True)],
+        )
+
+
+class SizeAwareCacheTests(SimpleTestCase):
+    """Кэш с ограничением по объему и политикой W-TinyLFU (cache_backends.size_aware)"""
+
+    def make_cache(self, **options):
+        options = {'MAX_BYTES': 20000, 'MAX_ENTRY_BYTES': 2000, 'WINDOW_PERCENT': 10, **options}
+        return SizeAwareCache(f'size-aware-test-{id(self)}-{len(options)}', {'OPTIONS': options, 'TIMEOUT': None})
+
+    def test_byte_budget_is_never_exceeded(self):
+        cache = self.make_cache()
+        for index in range(500):
+            cache.set(f'key{index}', 'x' * random.Random(index).randint(10, 1500))
+            self.assertLessEqual(cache.current_bytes, cache.max_bytes)
+        self.assertEqual(len(cache._cache), len(cache._policy))
+
+    def test_rare_large_entries_do_not_evict_hot_small_ones(self):
+        """Редкая большая запись не допускается в основную область ценой частых маленьких"""
+        # Целые ключи: хэши (и коллизии в sketch) одинаковы при каждом запуске
+        policy = SizeAwarePolicy(200000, 10 ** 6, window_percent=10, protected_percent=80)
+        hot = range(40)
+        for key in hot:
+            policy.record_access(key)
+            policy.insert(key, 2000)
+        for _ in range(3):
+            for key in hot:
+                policy.record_access(key)
+                policy.on_hit(key)
+
+        removed = []
+        for key in range(1000, 1050):
+            policy.record_access(key)
+            removed.extend(policy.insert(key, 15000))
+
+        self.assertGreater(policy.rejected, 0)
+        self.assertEqual([key for key in hot if key not in policy.location], [])
+        self.assertLessEqual(policy.total_bytes, policy.max_bytes)
+
+    def test_value_over_max_entry_bytes_is_not_cached(self):
+        cache = self.make_cache()
+        cache.set('key', 'small')
+        cache.set('key', 'x' * 5000)
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(cache.rejected, 1)
+        self.assertEqual(cache.current_bytes, 0)
+
+    def test_delete_and_clear_release_bytes(self):
+        cache = self.make_cache()
+        for index in range(20):
+            cache.set(f'key{index}', 'x' * 100)
+        used = cache.current_bytes
+
+        cache.delete('key19')
+        self.assertLess(cache.current_bytes, used)
+        self.assertNotIn('key19', cache)
+
+        cache.clear()
+        self.assertEqual(cache.current_bytes, 0)
+        self.assertEqual(len(cache._policy), 0)
+        self.assertIsNone(cache.get('key0'))
+
+    def test_growing_value_in_main_area_evicts_to_fit(self):
+        """Перезапись записи основной области большим значением вытесняет LRU испытательного сегмента"""
+        policy = SizeAwarePolicy(1000, 10 ** 6, window_percent=10, protected_percent=80)
+        for index in range(10):
+            self.assertEqual(policy.insert(f'k{index}', 90), [])
+        self.assertEqual(policy.used[PROBATION], 810)
+
+        self.assertEqual(policy.insert('k0', 300), ['k1', 'k2'])
+        self.assertEqual(policy.location['k0'], PROTECTED)
+        self.assertLessEqual(policy.used[PROBATION] + policy.used[PROTECTED], policy.main_bytes)
+
+    def test_value_larger_than_main_area_is_evicted_on_overwrite(self):
+        policy = SizeAwarePolicy(1000, 10 ** 6, window_percent=10, protected_percent=80)
+        policy.insert('a', 90)
+        policy.insert('b', 90)
+        self.assertEqual(policy.location['a'], PROBATION)
+
+        self.assertEqual(policy.insert('a', 950), ['a'])
+        self.assertNotIn('a', policy.location)
+        self.assertEqual(policy.total_bytes, 90)
+
+
+class PrewarmOnStartupTests(IsolatedCachesMixin, SimpleTestCase):
+    """Прогрев кэшей рабочими процессами (cache_warmup.prewarm_on_startup)"""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(cache_warmup, 'warm_caches')
+        self.warm_caches = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(request_started.disconnect, dispatch_uid=cache_warmup.PREWARM_LOCK_KEY)
+        self.addCleanup(setattr, cache_warmup, '_started_pid', None)
+
+    def test_disabled_by_default(self):
+        cache_warmup.prewarm_on_startup()
+        request_started.send(sender=self.__class__)
+        self.warm_caches.assert_not_called()
+
+    @override_settings(CACHE_PREWARM_ON_STARTUP=True)
+    def test_starts_on_first_request_not_on_import(self):
+        cache_warmup.prewarm_on_startup()
+        self.warm_caches.assert_not_called()
+
+        request_started.send(sender=self.__class__)
+        request_started.send(sender=self.__class__)
+        self.wait_for_prewarm()
+        self.warm_caches.assert_called_once()
+
+    def test_only_one_process_warms(self):
+        """Блокировка в общем кэше: второй процесс (и повторный старт) прогрев пропускает"""
+        thread = cache_warmup.start_prewarm()
+        thread.join()
+        self.assertIsNone(cache_warmup.start_prewarm())
+        self.warm_caches.assert_called_once()
+
+    def wait_for_prewarm(self):
+        for thread in threading.enumerate():
+            if thread.name == 'cache-prewarm':
+                thread.join()
+
+
+# Быстрый хэш паролей: в тесте создаются десятки пользователей
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class SearchPaginationTests(IsolatedCachesMixin, TestCase):
+    """Страницы поиска за окном id, закэшированных get_cached_search_ids"""
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(activity_tracker.flush, force=True)
+        patcher = mock.patch.object(cache_utils, 'SEARCH_RESULT_IDS_LIMIT', 10)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.own = create_profile('searcher', city=1)
+        # Одинаковое время захода: порядок страниц задает id
+        self.matches = [create_profile(f'match{index}', city=1).id for index in range(30)]
+        Profile.objects.filter(id__in=self.matches).update(last_online=timezone.now())
+        create_profile('elsewhere', city=2)
+        self.client.force_login(self.own.user)
+
+    def set_own_last_online(self, delta):
+        Profile.objects.filter(id=self.own.id).update(last_online=timezone.now() + delta)
+
+    def search_all_pages(self):
+        ids = []
+        for page in range(1, 4):
+            response = self.client.get('/profiles/search/', {'city': 1, 'page': page})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.context['total_count'], len(self.matches))
+            ids.extend(profile.id for profile in response.context['profiles'])
+        return ids
+
+    def test_pages_past_cached_window_are_read_from_database(self):
+        self.set_own_last_online(timedelta(hours=1))
+        self.assertEqual(self.search_all_pages(), sorted(self.matches, reverse=True))
+        self.assertEqual(len(get_cached_search_ids({'city': 1}, 10)['ids']), 10)
+
+    def test_own_profile_past_cached_window_is_excluded(self):
+        self.set_own_last_online(-timedelta(hours=1))
+        self.assertEqual(self.search_all_pages(), sorted(self.matches, reverse=True))
+
+
+@override_settings(
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'], LAST_ONLINE_UPDATE_INTERVAL=300,
+)
+class ActivityTrackerTests(TestCase):
+    """Пакетная запись last_online (ActivityTracker.flush, write_last_online)"""
+
+    def setUp(self):
+        self.tracker = ActivityTracker()
+        self.profiles = [create_profile(f'active{index}') for index in range(5)]
+        self.started = time.time() - 3600
+
+    def record_all(self, offset=0):
+        for index, profile in enumerate(self.profiles):
+            self.tracker.record(profile.user_id, self.started + offset + index)
+
+    def assertLastOnline(self, offset=0):
+        for index, profile in enumerate(self.profiles):
+            profile.refresh_from_db(fields=['last_online'])
+            self.assertAlmostEqual(profile.last_online.timestamp(), self.started + offset + index, places=5)
+
+    def test_one_update_per_batch(self):
+        self.record_all()
+        with mock.patch.object(activity, 'FLUSH_BATCH_SIZE', 2), self.assertNumQueries(3):
+            self.assertEqual(self.tracker.flush(), 5)
+        self.assertLastOnline()
+        self.assertEqual(self.tracker.pending_count(), 0)
+
+    def test_user_is_written_at_most_once_per_interval(self):
+        self.record_all()
+        self.tracker.flush(now=self.started)
+        self.record_all(offset=60)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.tracker.flush(now=self.started + 60), 0)
+        self.assertEqual(self.tracker.pending_count(), 5)
+        self.assertLastOnline()
+
+        self.record_all(offset=300)
+        self.assertEqual(self.tracker.flush(now=self.started + 300), 5)
+        self.assertLastOnline(offset=300)
+
+    def test_force_writes_throttled_users(self):
+        self.record_all()
+        self.tracker.flush(now=self.started)
+        self.record_all(offset=60)
+
+        self.assertEqual(self.tracker.flush(force=True, now=self.started + 60), 5)
+        self.assertLastOnline(offset=60)
+
+    def test_failed_batch_is_queued_again(self):
+        self.record_all()
+        with mock.patch.object(activity, 'write_last_online', side_effect=DatabaseError('database is locked')), \
+                self.assertLogs('profiles.activity', 'ERROR'):
+            self.assertEqual(self.tracker.flush(), 0)
+        self.assertEqual(self.tracker.pending_count(), 5)
+
+        self.assertEqual(self.tracker.flush(), 5)
+        self.assertLastOnline()
+
+    def test_pending_activity_is_written_at_exit(self):
+        self.record_all()
+        self.tracker.flush(now=self.started)
+        self.record_all(offset=60)
+
+        with mock.patch.object(activity, 'activity_tracker', self.tracker):
+            with override_settings(LAST_ONLINE_FLUSH_ON_EXIT=False):
+                activity._flush_on_exit()
+            self.assertEqual(self.tracker.pending_count(), 5)
+            activity._flush_on_exit()
+
+        self.assertEqual(self.tracker.pending_count(), 0)
+        self.assertLastOnline(offset=60)
+
+
+class OnlineSearchTests(IsolatedCachesMixin, TestCase):
+    """Поиск среди пользователей онлайн (search_profiles с online_now)"""
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(presence_tracker.__init__)
+        presence_tracker.__init__()
+        # Активность из запросов теста записывается в тестовую базу, а не при выходе
+        self.addCleanup(activity_tracker.flush, force=True)
+        self.own = create_profile('searcher', city=1)
+        self.offline = create_profile('offline', city=1)
+        # Кэш поиска заполнен до появления остальных профилей (и не знает о них)
+        get_cached_search_ids({})
+        self.online = create_profile('online', city=1)
+        self.online_elsewhere = create_profile('online_elsewhere', city=2)
+        for profile in (self.own, self.online, self.online_elsewhere):
+            presence_tracker.record(profile.user_id, profile)
+        presence_tracker.sync()
+        self.client.force_login(self.own.user)
+
+    def search(self, **params):
+        response = self.client.get('/profiles/search/', params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_online_profiles_are_found_outside_cached_ids(self):
+        response = self.search(online_now='on')
+        self.assertEqual([profile.id for profile in response.context['profiles']],
+                         [self.online_elsewhere.id, self.online.id])
+        self.assertEqual(response.context['total_count'], 2)
+
+    def test_filters_apply_to_online_profiles(self):
+        response = self.search(online_now='on', city=2)
+        self.assertEqual([profile.id for profile in response.context['profiles']], [self.online_elsewhere.id])
+        self.assertEqual(response.context['total_count'], 1)
+
+    def test_filters_are_checked_in_presence_cache(self):
+        self.offline.delete()
+        for params in ({'gender': 1}, {'gender': 2}, {'age_min': 30}, {'height_max': 175},
+                       {'has_children': True}, {'city': 1, 'age_max': 40}):
+            with self.subTest(params=params), self.assertNumQueries(0):
+                found = presence_tracker.search_online(params)
+            self.assertCountEqual(found, Profile.objects.search_filtered(params).values_list('id', flat=True))
+
+    def test_inactive_profiles_are_skipped(self):
+        inactive = create_profile('inactive', city=1, is_active=False)
+        presence_tracker.record(inactive.user_id, inactive)
+        presence_tracker.sync()
+        self.assertNotIn(inactive.id, presence_tracker.search_online({}))
+        self.assertIn(inactive.id, presence_tracker.online_profile_ids())
+
+    def test_text_search_is_checked_in_database_among_online_profiles(self):
+        response = self.search(online_now='on', search='elsewhere')
+        self.assertEqual([profile.id for profile in response.context['profiles']], [self.online_elsewhere.id])
+
+    def test_slots_without_filter_fields_are_ignored(self):
+        minute = int(time.time() // 60)
+        presence_tracker.cache.set(presence_tracker.slot_key(minute), {'minute': minute, 'users': {10**6: (10**6, 1)}})
+        presence_tracker.__init__()
+        presence_tracker.record(self.own.user_id, self.own)
+        self.assertEqual(presence_tracker.sync().profile_ids, {self.own.id})
+
+    def test_search_ids_among_checks_ids_in_batches(self):
+        ids = {self.offline.id, self.online.id, self.online_elsewhere.id}
+        with self.assertNumQueries(3):
+            found = Profile.objects.search_ids_among({'city': 1}, ids, batch_size=1)
+        self.assertEqual(found, list(Profile.objects.search_filtered({'city': 1})
+                                     .filter(id__in=ids).values_list('id', flat=True)))
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class CardRenderingQueriesTests(IsolatedCachesMixin, TestCase):
+    """Карточки профилей на главной и в поиске: число запросов не зависит от числа карточек"""
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(activity_tracker.flush, force=True)
+        self.own = create_profile('viewer', city=1)
+        self.cards = []
+        self.client.force_login(self.own.user)
+
+    def add_cards(self, count):
+        for _ in range(count):
+            index = len(self.cards)
+            profile = create_profile(f'card{index}', city=1, goal=f'Цель {index} ' + 'подробно ' * 30)
+            profile.primary_photo = Photo.objects.create(
+                profile=profile, image=f'photos/card{index}/main.jpg', is_primary=True, is_verified=True,
+            )
+            profile.other_photo = Photo.objects.create(profile=profile, image=f'photos/card{index}/other.jpg')
+            self.cards.append(profile)
+        # Представления создания профиля сбрасывают эти кэши сами
+        invalidate_search_cache([1])
+        invalidate_recent_profiles_cache()
+
+    def test_search_cards(self):
+        """Страница поиска: id из кэша, профили as_cards одним запросом и основные фотографии вторым"""
+        for count in (2, 6):
+            self.add_cards(count - len(self.cards))
+            self.client.get('/profiles/search/', {'city': 1})
+            with self.assertNumQueries(2):
+                response = self.client.get('/profiles/search/', {'city': 1})
+
+            self.assertEqual({profile.id for profile in response.context['profiles']},
+                             {profile.id for profile in self.cards})
+            for profile in self.cards:
+                self.assertContains(response, Truncator(profile.goal).chars(100))
+                self.assertContains(response, profile.primary_photo.get_image_url())
+                self.assertNotContains(response, profile.other_photo.get_image_url())
+
+    def test_home_cards(self):
+        """Главная: статистика и новые профили as_list_items - по запросу (с теплым кэшем - без запросов)"""
+        for count in (2, 6):
+            self.add_cards(count - len(self.cards))
+            self.client.get('/')
+            with self.assertNumQueries(0):
+                self.client.get('/')
+            invalidate_recent_profiles_cache()
+            with self.assertNumQueries(2):
+                response = self.client.get('/')
+
+            for profile in self.cards:
+                self.assertContains(response, f'/profiles/message/{profile.user_id}/')
+                self.assertContains(response, f'<h3 class="profile-name">{profile.user.username}</h3>', html=True)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class ProfileMiddlewareTests(IsolatedCachesMixin, TestCase):
+    """request.profile (ProfileMiddleware) и декоратор profile_required"""
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(activity_tracker.flush, force=True)
+        self.profile = create_profile('with_profile')
+        self.without_profile = User.objects.create_user(username='without_profile', password='secret-password-1')
+
+    def resolve(self, user, view=None):
+        """Запрос через ProfileMiddleware; view по умолчанию трижды обращается к профилю"""
+        def default_view(request):
+            return [bool(request.profile), request.profile, get_profile(request)]
+
+        request = RequestFactory().get('/')
+        request.user = user
+        return ProfileMiddleware(view or default_view)(request)
+
+    def test_profile_is_resolved_once_per_request(self):
+        user = User.objects.get(id=self.profile.user_id)
+        with self.assertNumQueries(1):
+            found, profile, same = self.resolve(user)
+        self.assertTrue(found)
+        self.assertEqual(profile.id, self.profile.id)
+        self.assertEqual(same.id, self.profile.id)
+
+        # Следующие запросы - из кэша профилей
+        with self.assertNumQueries(0):
+            self.assertEqual(self.resolve(user)[1].id, self.profile.id)
+
+    def test_user_without_profile_gets_none(self):
+        with self.assertNumQueries(1):
+            found, _, profile = self.resolve(self.without_profile)
+        self.assertFalse(found)
+        self.assertIsNone(profile)
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.resolve(self.without_profile)[2])
+
+    def test_profile_is_not_loaded_unless_used(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(self.resolve(self.profile.user, view=lambda request: 'ok'), 'ok')
+
+    def test_anonymous_request_makes_no_queries(self):
+        with self.assertNumQueries(0):
+            found, _, profile = self.resolve(AnonymousUser())
+        self.assertFalse(found)
+        self.assertIsNone(profile)
+        # Статистика и новые профили на главной - из кэша, для анонимного запроса других запросов нет
+        self.client.get('/')
+        with self.assertNumQueries(0):
+            response = self.client.get('/')
+        self.assertFalse(response.context['has_profile'])
+
+    def test_profile_required_redirects_users_without_profile(self):
+        self.client.force_login(self.without_profile)
+        response = self.client.get('/profiles/search/', follow=True)
+        self.assertRedirects(response, '/profiles/create/')
+        self.assertEqual([str(message) for message in response.context['messages']], ['Сначала создайте свой профиль!'])
+
+    def test_profile_required_passes_users_with_profile(self):
+        self.client.force_login(self.profile.user)
+        response = self.client.get('/profiles/search/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.wsgi_request.profile.id, self.profile.id)
+
+
+@override_settings(SESSION_ENGINE='profiles.session_backends.write_behind', SESSION_CACHE_ALIAS='shared')
+class WriteBehindSessionTests(IsolatedCachesMixin, TestCase):
+    """Сессии в общем кэше с отложенной записью копии в базу (session_backends.write_behind)"""
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(session_writer.flush, force=True)
+
+    def create_session(self, **data):
+        session = SessionStore()
+        session.update(data or {'user': 'alice'})
+        session.create()
+        return session
+
+    def evict(self, session_key):
+        """Вытеснение сессии из кэша: дальше она читается из базы"""
+        SessionStore()._cache.delete(SessionStore.cache_key_prefix + session_key)
+
+    def test_save_is_written_to_database_in_batch(self):
+        session = self.create_session()
+        self.assertFalse(Session.objects.filter(session_key=session.session_key).exists())
+
+        self.assertEqual(session_writer.flush(force=True), 1)
+        self.assertEqual(Session.objects.get(session_key=session.session_key).get_decoded(), {'user': 'alice'})
+
+    def test_load_reads_cache_and_falls_back_to_database(self):
+        session = self.create_session()
+        self.assertEqual(SessionStore(session.session_key).load(), {'user': 'alice'})
+
+        session_writer.flush(force=True)
+        self.evict(session.session_key)
+        self.assertEqual(SessionStore(session.session_key).load(), {'user': 'alice'})
+
+    def test_flush_writes_current_data(self):
+        session = self.create_session()
+        session['user'] = 'bob'
+        session.save()
+        session_writer.flush(force=True)
+        self.evict(session.session_key)
+        self.assertEqual(SessionStore(session.session_key).load(), {'user': 'bob'})
+
+    def test_logout_before_flush_writes_nothing(self):
+        session = self.create_session()
+        session.delete()
+        self.assertEqual(session_writer.flush(force=True), 0)
+        self.assertFalse(Session.objects.filter(session_key=session.session_key).exists())
+
+    def test_logout_during_flush_does_not_resurrect_session(self):
+        """Выход между чтением пакета из кэша и его записью: строка копии удаляется"""
+        session = self.create_session()
+        bulk_create = QuerySet.bulk_create
+
+        def logout_then_write(queryset, *args, **kwargs):
+            SessionStore(session.session_key).delete()
+            return bulk_create(queryset, *args, **kwargs)
+
+        with mock.patch.object(QuerySet, 'bulk_create', logout_then_write):
+            self.assertEqual(session_writer.flush(force=True), 0)
+
+        self.assertFalse(Session.objects.filter(session_key=session.session_key).exists())
+        self.assertEqual(SessionStore(session.session_key).load(), {})
+
+    def test_cycle_key_does_not_resurrect_previous_key(self):
+        session = self.create_session()
+        session_writer.flush(force=True)
+        old_key = session.session_key
+
+        session.cycle_key()
+        session_writer.flush(force=True)
+
+        self.assertFalse(Session.objects.filter(session_key=old_key).exists())
+        self.evict(session.session_key)
+        self.assertEqual(SessionStore(session.session_key).load(), {'user': 'alice'})
+
+
+@override_settings(INVALIDATION_BUS_POLL_INTERVAL=0)
+class CachedAuthUserTests(IsolatedCachesMixin, TestCase):
+    """
+    Пользователь запроса из кэша (middleware.CachedAuthenticationMiddleware): изменения
+    пользователя действуют со следующего запроса, в том числе сделанные другим процессом
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(activity_tracker.flush, force=True)
+        self.addCleanup(session_writer.flush, force=True)
+        self.user = User.objects.create_user(username='auth_user', password='secret-password-1')
+        self.client.force_login(self.user)
+        self.permission = Permission.objects.get(codename='view_profile')
+
+    def request_user(self):
+        """Пользователь, которого видит следующий запрос"""
+        response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+        return response.wsgi_request.user
+
+    def in_other_process(self, func):
+        self.assertEqual(run_in_other_process(func), 0)
+
+    def test_user_is_served_from_cache(self):
+        self.assertTrue(self.request_user().is_authenticated)
+        with self.assertNumQueries(0):
+            user = get_cached_auth_user(self.user.id, self.user.get_session_auth_hash(), None)
+        self.assertEqual(user.id, self.user.id)
+
+    def test_password_change_logs_out_on_next_request(self):
+        self.assertTrue(self.request_user().is_authenticated)
+        self.user.set_password('another-password-2')
+        self.user.save()
+        self.assertFalse(self.request_user().is_authenticated)
+
+    def test_deactivation_logs_out_on_next_request(self):
+        self.assertTrue(self.request_user().is_authenticated)
+        self.user.is_active = False
+        self.user.save()
+        self.assertFalse(self.request_user().is_authenticated)
+
+    def test_staff_flag_is_visible_on_next_request(self):
+        self.assertFalse(self.request_user().is_staff)
+        self.user.is_staff = True
+        self.user.save()
+        self.assertTrue(self.request_user().is_staff)
+
+    def test_group_and_permission_changes_are_visible_on_next_request(self):
+        self.assertFalse(self.request_user().has_perm('profiles.view_profile'))
+
+        group = Group.objects.create(name='moderators')
+        group.permissions.add(self.permission)
+        self.user.groups.add(group)
+        self.assertTrue(self.request_user().has_perm('profiles.view_profile'))
+
+        group.user_set.clear()
+        self.assertFalse(self.request_user().has_perm('profiles.view_profile'))
+
+        self.user.user_permissions.add(self.permission)
+        self.assertTrue(self.request_user().has_perm('profiles.view_profile'))
+
+    def test_logout_elsewhere_logs_out_on_next_request(self):
+        """Сессия удалена (выход на другом устройстве): тот же cookie больше не действует"""
+        self.assertTrue(self.request_user().is_authenticated)
+        SessionStore(self.client.session.session_key).delete()
+        self.assertFalse(self.request_user().is_authenticated)
+
+    def test_password_change_in_other_process_is_applied_through_bus(self):
+        self.assertTrue(self.request_user().is_authenticated)
+
+        # Строка меняется без сигналов: этот процесс о смене пароля не знает
+        User.objects.filter(id=self.user.id).update(password=make_password('another-password-2'))
+        self.assertTrue(self.request_user().is_authenticated)
+
+        # Другой процесс сохранил пользователя: его signals.user_changed инвалидирует кэш
+        self.in_other_process(lambda: invalidate_auth_user_cache(self.user.id))
+        self.assertFalse(self.request_user().is_authenticated)
+
+    def test_deactivation_in_other_process_is_applied_through_bus(self):
+        self.assertTrue(self.request_user().is_authenticated)
+        User.objects.filter(id=self.user.id).update(is_active=False)
+        self.in_other_process(lambda: invalidate_auth_user_cache(self.user.id))
+        self.assertFalse(self.request_user().is_authenticated)
+
+
+class MessageIdTests(IsolatedCachesMixin, SimpleTestCase):
+    """id сообщений (message_ids): номер узла арендуется в реестре, id не повторяются"""
+
+    @staticmethod
+    def node_of(message_id):
+        return (message_id >> message_ids.SEQUENCE_BITS) & (MAX_NODES - 1)
+
+    def test_ids_are_unique_across_threads(self):
+        results = [[] for _ in range(8)]
+
+        def worker(index):
+            results[index].extend(generate_message_id() for _ in range(5000))
+
+        threads = [threading.Thread(target=worker, args=(index,)) for index in range(len(results))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        ids = [message_id for chunk in results for message_id in chunk]
+        self.assertEqual(len(set(ids)), len(ids))
+
+    def test_forked_processes_lease_their_own_nodes(self):
+        """Дочерние процессы наследуют номер родителя, но берут свой до выдачи первого id"""
+        ids = [generate_message_id() for _ in range(1000)]
+        paths = [os.path.join(self.runtime_dir, f'ids-{index}.txt') for index in range(4)]
+        pids = []
+        for path in paths:
+            pid = os.fork()
+            if pid == 0:
+                code = 1
+                try:
+                    with open(path, 'w') as output:
+                        output.write('\n'.join(str(generate_message_id()) for _ in range(5000)))
+                    code = 0
+                finally:
+                    os._exit(code)
+            pids.append(pid)
+        for pid in pids:
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+
+        nodes = {self.node_of(ids[0])}
+        for path in paths:
+            with open(path) as output:
+                child_ids = [int(line) for line in output]
+            self.assertEqual({self.node_of(message_id) for message_id in child_ids}, {self.node_of(child_ids[0])})
+            nodes.add(self.node_of(child_ids[0]))
+            ids.extend(child_ids)
+        self.assertEqual(len(nodes), 1 + len(paths))
+        self.assertEqual(len(set(ids)), len(ids))
+
+    def test_live_processes_never_share_a_node(self):
+        """Все номера заняты - новый процесс получает ошибку, пока чья-то аренда не истечет"""
+        path = settings.MESSAGE_ID_NODE_PATH
+        now = time.time()
+        with mock.patch.object(message_ids.time, 'time', return_value=now):
+            nodes = {NodeRegistry(path).current() for _ in range(MAX_NODES)}
+            self.assertEqual(nodes, set(range(MAX_NODES)))
+            with self.assertRaises(RuntimeError):
+                NodeRegistry(path).current()
+
+        with mock.patch.object(message_ids.time, 'time', return_value=now + 61):
+            self.assertIn(NodeRegistry(path).current(), nodes)
+
+    def test_lease_is_renewed_while_ids_are_generated(self):
+        registry = NodeRegistry(settings.MESSAGE_ID_NODE_PATH, lease=60)
+        now = time.time()
+        with mock.patch.object(message_ids.time, 'time', return_value=now):
+            node = registry.current()
+        with mock.patch.object(message_ids.time, 'time', return_value=now + 30):
+            self.assertEqual(registry.current(), node)
+        # Продленную аренду не занять даже после исходного срока
+        with mock.patch.object(message_ids.time, 'time', return_value=now + 61):
+            others = {NodeRegistry(settings.MESSAGE_ID_NODE_PATH).current() for _ in range(MAX_NODES - 1)}
+        self.assertNotIn(node, others)
+
+    def test_lost_lease_is_replaced_with_a_new_node(self):
+        """Номер процесса, не продлившего аренду в срок, занял другой: процесс берет новый"""
+        path = settings.MESSAGE_ID_NODE_PATH
+        registry = NodeRegistry(path, lease=60)
+        now = time.time()
+        with mock.patch.object(message_ids.time, 'time', return_value=now):
+            node = registry.current()
+        connection = sqlite3.connect(path)
+        with connection:
+            connection.execute("UPDATE nodes SET token = 'other', renewed = ? WHERE node = ?", (now + 61, node))
+        connection.close()
+
+        with mock.patch.object(message_ids.time, 'time', return_value=now + 62):
+            self.assertNotEqual(registry.current(), node)
+
+    def test_release_frees_the_node(self):
+        path = settings.MESSAGE_ID_NODE_PATH
+        with mock.patch.object(message_ids.random, 'choice', side_effect=min):
+            registry = NodeRegistry(path)
+            node = registry.current()
+            registry.release()
+            self.assertEqual(NodeRegistry(path).current(), node)
+
+
+@override_settings(MESSAGE_SHARDS=['default', 'messages_1', 'messages_2'])
+class MessageShardRoutingTests(SimpleTestCase):
+    """Выбор шарда сообщений беседы (jump consistent hash) и MessageShardRouter"""
+
+    def test_conversations_are_spread_evenly(self):
+        counts = {}
+        for conversation_id in range(1, 30001):
+            shard = message_shard(conversation_id)
+            self.assertEqual(message_shard(conversation_id), shard)
+            counts[shard] = counts.get(shard, 0) + 1
+        self.assertEqual(set(counts), {'default', 'messages_1', 'messages_2'})
+        for count in counts.values():
+            self.assertAlmostEqual(count / 30000, 1 / 3, delta=0.02)
+
+    def test_growth_moves_conversations_only_to_new_shards(self):
+        for old, new in ((1, 2), (2, 3), (2, 4), (3, 8)):
+            moved = 0
+            for key in range(1, 20001):
+                before, after = jump_hash(key, old), jump_hash(key, new)
+                if before != after:
+                    moved += 1
+                    self.assertGreaterEqual(after, old)
+            self.assertAlmostEqual(moved / 20000, 1 - old / new, delta=0.02)
+
+    def test_router_sends_messages_to_conversation_shard(self):
+        router = MessageShardRouter()
+        conversation_ids = {message_shard(conversation_id): conversation_id for conversation_id in range(1, 50)}
+        for shard, conversation_id in conversation_ids.items():
+            # Сообщения шарда основной базы маршрутизирует следующий роутер
+            expected = None if shard == DEFAULT_DB_ALIAS else shard
+            message = Message(conversation_id=conversation_id)
+            self.assertEqual(router.db_for_write(Message, instance=message), expected)
+            self.assertEqual(router.db_for_read(Message, instance=Conversation(pk=conversation_id)), expected)
+            self.assertEqual(router.db_for_read(Message, conversation=conversation_id), expected)
+        self.assertIsNone(router.db_for_read(Message))
+        self.assertIsNone(router.db_for_write(Conversation, instance=Conversation(pk=1)))
+
+
+@override_settings(MESSAGE_SHARDS=['default', 'messages_1', 'messages_2'])
+class ReshardMessagesTests(IsolatedCachesMixin, TransactionTestCase):
+    """
+    Перенос сообщений командой reshard_messages с одного шарда на три
+    Шарды - временные файлы SQLite с таблицей сообщений
+    """
+
+    SHARDS = ['default', 'messages_1', 'messages_2']
+    # Шардов нет в settings.DATABASES: '__all__' раскрывается в setUpClass, после их добавления
+    databases = '__all__'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.shard_dir = tempfile.mkdtemp(prefix='dating-site-shards-')
+        for alias in cls.SHARDS[1:]:
+            connections.settings[alias] = {
+                **copy.deepcopy(connections[DEFAULT_DB_ALIAS].settings_dict),
+                'NAME': os.path.join(cls.shard_dir, f'{alias}.sqlite3'),
+            }
+        cls.addClassCleanup(cls.remove_shards)
+        super().setUpClass()
+        for alias in cls.SHARDS[1:]:
+            call_command('migrate', database=alias, verbosity=0, interactive=False)
+
+    @classmethod
+    def remove_shards(cls):
+        for alias in cls.SHARDS[1:]:
+            connections[alias].close()
+            del connections[alias]
+            del connections.settings[alias]
+        shutil.rmtree(cls.shard_dir, ignore_errors=True)
+
+    def setUp(self):
+        super().setUp()
+        users = [User.objects.create_user(username=f'reshard_{index}') for index in range(8)]
+        self.conversations = [
+            Conversation.objects.create(participant1=first, participant2=second)
+            for index, first in enumerate(users) for second in users[index + 1:]
+        ]
+        # Сообщения записаны, когда шард был один
+        with self.settings(MESSAGE_SHARDS=['default']):
+            for conversation in self.conversations:
+                for index in range(3):
+                    self.send(conversation, f'Сообщение {index}')
+        self.original = self.messages_by_conversation()
+        self.moved = [
+            conversation for conversation in self.conversations
+            if message_shard(conversation.id) != DEFAULT_DB_ALIAS
+        ]
+        self.assertTrue(self.moved)
+
+    def send(self, conversation, content):
+        return Message.objects.create(conversation=conversation, sender=conversation.participant1,
+                                      receiver=conversation.participant2, content=content)
+
+    def messages_by_conversation(self, aliases=None):
+        """{id беседы: множество id сообщений} во всех шардах; id не повторяются между шардами"""
+        result = {}
+        ids = []
+        for alias in aliases or self.SHARDS:
+            for conversation_id, message_id in Message.objects.using(alias).values_list('conversation_id', 'id'):
+                result.setdefault(conversation_id, set()).add(message_id)
+                ids.append(message_id)
+        self.assertEqual(len(set(ids)), len(ids))
+        return result
+
+    def reshard(self, **options):
+        call_command('reshard_messages', from_count=1, to_count=3, stdout=StringIO(), **options)
+
+    def test_copy_keeps_ids_and_source(self):
+        self.reshard()
+
+        self.assertEqual(self.messages_by_conversation([DEFAULT_DB_ALIAS]), self.original)
+        for conversation in self.moved:
+            shard = message_shard(conversation.id)
+            self.assertEqual(self.messages_by_conversation([shard])[conversation.id], self.original[conversation.id])
+
+        # Повторная копия ничего не дублирует
+        self.reshard()
+        self.assertEqual(Message.objects.using('messages_1').count() + Message.objects.using('messages_2').count(),
+                         sum(len(self.original[conversation.id]) for conversation in self.moved))
+
+    def test_finalize_moves_late_messages_and_reads(self):
+        self.reshard()
+        conversation = self.moved[0]
+        shard = message_shard(conversation.id)
+        first, second, _ = sorted(self.original[conversation.id])
+        # До переключения в прежний шард пришло сообщение и было прочитано одно из сообщений,
+        # после переключения другое сообщение прочитано в новом шарде
+        with self.settings(MESSAGE_SHARDS=['default']):
+            late = self.send(conversation, 'Отправлено до переключения')
+            Message.objects.filter(id=first).update(is_read=True)
+        Message.objects.using(shard).filter(id=second).update(is_read=True)
+
+        self.reshard(finalize=True)
+
+        expected = {conversation_id: set(ids) for conversation_id, ids in self.original.items()}
+        expected[conversation.id].add(late.id)
+        self.assertEqual(self.messages_by_conversation(), expected)
+        for conversation_id, ids in expected.items():
+            self.assertEqual(
+                set(Message.objects.using(message_shard(conversation_id)).filter(conversation_id=conversation_id)
+                    .values_list('id', flat=True)),
+                ids,
+            )
+        self.assertEqual(
+            set(Message.objects.using(shard).filter(is_read=True).values_list('id', flat=True)), {first, second},
+        )
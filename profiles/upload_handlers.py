@@ -0,0 +1,92 @@
+"""
+Обработчики загрузки файлов для сайта знакомств
+Файлы пишутся во временные файлы небольшими блоками, поэтому изображения никогда
+не буферизуются в памяти процесса целиком; файл пропускается, как только
+превышен лимит размера или количества файлов
+"""
+
+from django.conf import settings
+from django.core.files.uploadhandler import SkipFile, TemporaryFileUploadHandler
+
+from .metrics import metrics
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def get_peak_rss_kb():
+    """Пиковый RSS процесса в КБ (None, если платформа не поддерживает getrusage)"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def get_upload_errors(request):
+    """Ошибки загрузки файлов текущего запроса (разбирает тело запроса, если это еще не сделано)"""
+    request.FILES
+    return getattr(request, 'upload_errors', [])
+
+
+class LimitedTemporaryFileUploadHandler(TemporaryFileUploadHandler):
+    """Потоковая запись файлов во временные файлы с пропуском файлов сверх лимитов"""
+
+    chunk_size = 64 * 2 ** 10  # 64KB в памяти на один файл
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.max_file_size = getattr(settings, 'PHOTO_UPLOAD_MAX_SIZE', 5 * 1024 * 1024)
+        self.max_files = getattr(settings, 'PHOTO_UPLOAD_MAX_FILES', 5)
+        self.file_count = 0
+        self.errors = []
+        if request is not None:
+            # Ошибки показываются пользователю в представлениях загрузки
+            request.upload_errors = self.errors
+
+    def reject(self, reason, message):
+        """Записать причину отказа файла"""
+        self.errors.append(message)
+        metrics.incr('uploads.rejected', reason=reason)
+
+    def new_file(self, field_name, file_name, content_type, content_length, *args, **kwargs):
+        # Файл предыдущей части уже передан в request.FILES: не даем закрыть его при пропуске
+        self.__dict__.pop('file', None)
+
+        self.file_count += 1
+        if self.file_count > self.max_files:
+            # Лишние файлы пропускаются (тело запроса дочитывается), чтобы представление
+            # показало ошибку, а не клиент получил обрыв соединения
+            if self.file_count == self.max_files + 1:
+                self.reject('count', f'Можно загрузить максимум {self.max_files} файлов за раз.')
+            raise SkipFile()
+
+        if not (content_type or '').startswith('image/'):
+            self.reject('type', f'Файл "{file_name}" не является изображением.')
+            raise SkipFile()
+
+        if content_length is not None and content_length > self.max_file_size:
+            self.reject('size', f'Файл "{file_name}" слишком большой (максимум {self.max_file_size // 1024 // 1024}MB).')
+            raise SkipFile()
+
+        self.current_size = 0
+        super().new_file(field_name, file_name, content_type, content_length, *args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.current_size += len(raw_data)
+        if self.current_size > self.max_file_size:
+            # Временный файл удаляется парсером при пропуске части
+            self.reject('size', f'Файл "{self.file_name}" слишком большой (максимум {self.max_file_size // 1024 // 1024}MB).')
+            raise SkipFile()
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        metrics.incr('uploads.files')
+        metrics.incr('uploads.bytes', file_size)
+        return super().file_complete(file_size)
+
+    def upload_complete(self):
+        peak_rss = get_peak_rss_kb()
+        if peak_rss is not None:
+            metrics.set_gauge('uploads.peak_rss_kb', peak_rss)
+        return super().upload_complete()
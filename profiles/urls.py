@@ -2,6 +2,7 @@ from django.urls import path
 from .views_package import profile_views
 from .views_package import photo_views
 from .views_package import message_views
+from .views_package import media_views
 
 app_name = 'profiles'
 
@@ -23,6 +24,7 @@ urlpatterns = [
     path('profiles/photos/upload-multiple/', photo_views.upload_multiple_photos, name='upload_multiple_photos'),
     path('profiles/photos/delete/<int:photo_id>/', photo_views.delete_photo, name='delete_photo'),
     path('profiles/photos/set-primary/<int:photo_id>/', photo_views.set_primary_photo, name='set_primary_photo'),
+    path('profiles/photos/<int:photo_id>/image/', media_views.photo_image, name='photo_image'),
     
     # Система сообщений
     path('profiles/conversations/', message_views.conversations_list, name='conversations_list'),
@@ -0,0 +1,227 @@
+import mimetypes
+import os
+import posixpath
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_etags
+from django.views.decorators.http import require_safe
+
+from ..media_utils import (
+    is_media_public, get_photo_owner_id, get_photo_meta, negotiate_photo_file
+)
+from ..metrics import metrics
+
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class FileRange:
+    """Файловый объект, ограниченный диапазоном байт (для ответов 206)"""
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.name = file.name
+        self.remaining = length
+        # Позиция файла учитывается WSGI-сервером при отправке через sendfile
+        file.seek(start)
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def make_etag(stat):
+    """Сильный ETag на основе времени изменения и размера файла"""
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def get_cache_control(name, is_public, immutable_url=True):
+    """
+    Заголовок Cache-Control для медиафайла
+    immutable - только если файл отдается по собственному адресу (immutable_url), содержимое
+    которого никогда не меняется; адрес фотографии (photo_image) отдает разные файлы
+    """
+    if not is_public:
+        return 'private, no-cache'
+    immutable_prefixes = getattr(settings, 'MEDIA_IMMUTABLE_PREFIXES', ())
+    if immutable_url and any(name.startswith(prefix) for prefix in immutable_prefixes):
+        return 'public, max-age=31536000, immutable'
+    return f"public, max-age={getattr(settings, 'MEDIA_CACHE_MAX_AGE', 86400)}"
+
+
+def parse_range(header, size):
+    """
+    Разобрать заголовок Range с одним диапазоном
+    Returns:
+        (start, end) включительно, None если заголовок не поддерживается,
+        или False если диапазон невыполним
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start >= size:
+            return False
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        suffix = int(last)
+        if suffix == 0:
+            return False
+        start = max(size - suffix, 0)
+        end = size - 1
+    return start, end
+
+
+def can_view_private_media(user, name):
+    """Неопубликованные фотографии доступны только владельцу и персоналу"""
+    if not user.is_authenticated:
+        return False
+    return user.is_staff or user.id == get_photo_owner_id(name)
+
+
+def serve_file(request, name, fullpath, is_public=True, extra_headers=None, immutable_url=True):
+    """
+    Отдать медиафайл с ETag, Cache-Control, поддержкой If-None-Match и Range
+    immutable_url=False - адрес запроса не совпадает с адресом файла (см. get_cache_control)
+    При настроенном MEDIA_ACCEL_HEADER передача файла делегируется фронтовому прокси
+    """
+    try:
+        stat = os.stat(fullpath)
+    except OSError:
+        raise Http404('Файл не найден')
+    if not os.path.isfile(fullpath):
+        raise Http404('Файл не найден')
+
+    etag = make_etag(stat)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Cache-Control': get_cache_control(name, is_public, immutable_url),
+        'Accept-Ranges': 'bytes',
+    }
+    headers.update(extra_headers or {})
+
+    # Клиент уже имеет актуальную версию
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        if '*' in etags or etag in etags or f'W/{etag}' in etags:
+            response = HttpResponseNotModified()
+            for header, value in headers.items():
+                response[header] = value
+            return response
+
+    content_type, encoding = mimetypes.guess_type(name)
+    content_type = content_type or 'application/octet-stream'
+
+    # Передача файла прокси-серверу (nginx: X-Accel-Redirect, Apache/lighttpd: X-Sendfile)
+    accel_header = getattr(settings, 'MEDIA_ACCEL_HEADER', None)
+    if accel_header:
+        response = HttpResponse(content_type=content_type)
+        if accel_header.lower() == 'x-accel-redirect':
+            prefix = getattr(settings, 'MEDIA_ACCEL_PREFIX', '/protected-media/')
+            response[accel_header] = prefix + quote(name)
+        else:
+            response[accel_header] = os.fspath(fullpath)
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    status = 200
+    file = open(fullpath, 'rb')
+    content = file
+    length = stat.st_size
+
+    range_header = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if range_header and (not if_range or if_range.strip() == etag):
+        byte_range = parse_range(range_header, stat.st_size)
+        if byte_range is False:
+            file.close()
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{stat.st_size}'
+            return response
+        if byte_range:
+            start, end = byte_range
+            length = end - start + 1
+            content = FileRange(file, start, length)
+            headers['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+            status = 206
+
+    # FileResponse отдается WSGI-серверу через wsgi.file_wrapper (sendfile без копирования)
+    response = FileResponse(content, status=status, content_type=content_type)
+    response['Content-Length'] = str(length)
+    if encoding:
+        response['Content-Encoding'] = encoding
+    for header, value in headers.items():
+        response[header] = value
+    return response
+
+
+@require_safe
+def serve_media(request, path):
+    """Отдача пользовательских медиафайлов"""
+    name = posixpath.normpath(path).lstrip('/')
+    try:
+        fullpath = safe_join(settings.MEDIA_ROOT, name)
+    except SuspiciousFileOperation:
+        raise Http404('Файл не найден')
+
+    # Пользователь загружается только для неопубликованных фотографий
+    is_public = is_media_public(name)
+    if not is_public and not can_view_private_media(request.user, name):
+        raise Http404('Файл не найден')
+
+    return serve_file(request, name, fullpath, is_public=is_public)
+
+
+@require_safe
+def photo_image(request, photo_id):
+    """
+    Отдача фотографии в самом компактном формате из принимаемых клиентом (AVIF/WebP/оригинал)
+    Варианты кодируются в фоне (после загрузки или при первом запросе), до этого отдается оригинал;
+    ответ зависит от Accept, поэтому отдается Vary: Accept
+    """
+    meta = get_photo_meta(photo_id)
+    if meta is None:
+        raise Http404('Фотография не найдена')
+    image_name, is_verified, owner_id = meta
+
+    if not is_verified and not can_view_private_media(request.user, image_name):
+        raise Http404('Фотография не найдена')
+
+    # Варианты создаются только для опубликованных фотографий, поэтому их можно отдавать всем
+    name, fmt = negotiate_photo_file(
+        photo_id, owner_id, image_name, request.META.get('HTTP_ACCEPT', ''),
+        allow_variants=is_verified
+    )
+    response = serve_file(
+        request, name, safe_join(settings.MEDIA_ROOT, name),
+        is_public=is_verified, extra_headers={'Vary': 'Accept'}, immutable_url=False
+    )
+
+    metrics.incr('media.requests', format=fmt)
+    if response.status_code in (200, 206):
+        metrics.incr('media.bytes_served', int(response['Content-Length']), format=fmt)
+    return response
@@ -8,65 +8,20 @@ from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 
 from ..models import Profile, Conversation, Message, MessageLimit, Report
 from ..forms_package import MessageForm, ReportForm
+from ..decorators import profile_required
 from ..cache_utils import (
-    get_cached_user_profile, get_cached_conversation_list, 
-    cache_conversation_list, invalidate_conversation_cache,
+    get_cached_user_profile, get_cached_conversation_list,
+    invalidate_conversation_cache,
     invalidate_unread_count_cache
 )
 
 
 @login_required
+@profile_required
 def conversations_list(request):
     """Список всех переписок пользователя с кэшированием"""
-    try:
-        own_profile = get_cached_user_profile(request.user)
-    except Profile.DoesNotExist:
-        messages.info(request, 'Сначала создайте свой профиль!')
-        return redirect('profiles:create_profile')
-    
-    if not own_profile:
-        messages.info(request, 'Сначала создайте свой профиль!')
-        return redirect('profiles:create_profile')
-    
-    # Пытаемся получить кэшированные переписки
-    cached_conversations = get_cached_conversation_list(request.user)
-    
-    if cached_conversations is not None:
-        conversation_data = cached_conversations
-    else:
-        # Получаем все переписки пользователя
-        conversations = Conversation.objects.filter(
-            Q(participant1=request.user) | Q(participant2=request.user)
-        ).prefetch_related('messages').order_by('-last_message_at')
-        
-        # Подготавливаем данные для каждой переписки
-        conversation_data = []
-        for conv in conversations:
-            other_user = conv.get_other_participant(request.user)
-            try:
-                other_profile = get_cached_user_profile(other_user)
-            except Profile.DoesNotExist:
-                continue
-            
-            if not other_profile:
-                continue
-            
-            # Последнее сообщение
-            last_message = conv.messages.last()
-            
-            # Количество непрочитанных сообщений
-            unread_count = conv.messages.filter(receiver=request.user, is_read=False).count()
-            
-            conversation_data.append({
-                'conversation': conv,
-                'other_user': other_user,
-                'other_profile': other_profile,
-                'last_message': last_message,
-                'unread_count': unread_count
-            })
-        
-        # Кэшируем список переписок
-        cache_conversation_list(request.user, conversation_data, timeout=180)
+    # Список строит только один из параллельных запросов, остальные получают кэш
+    conversation_data = get_cached_conversation_list(request.user)
     
     context = {
         'conversation_data': conversation_data,
@@ -14,6 +14,8 @@ import os
 
 from ..models import Profile, Photo
 from ..forms_package import ProfileForm, ProfileSearchForm
+from ..upload_handlers import get_upload_errors
+from ..decorators import profile_required
 from ..cache_utils import (
     get_cached_user_profile, invalidate_user_profile_cache,
     get_cached_profile_stats, get_cached_recent_profiles,
@@ -22,20 +24,17 @@ from ..cache_utils import (
 
 
 @login_required
+@profile_required
 def manage_photos(request):
     """Управление фотографиями профиля"""
-    try:
-        profile = Profile.objects.get(user=request.user)
-    except Profile.DoesNotExist:
-        messages.info(request, 'Сначала создайте профиль!')
-        return redirect('profiles:create_profile')
+    profile = request.profile
     
     # Исправлено: используем created_at вместо uploaded_at
-    photos = profile.photos.all().order_by('-is_primary', '-created_at')
+    photos = list(profile.photos.all().order_by('-is_primary', '-created_at'))
     
-    # Статистика
-    photos_count = photos.count()
-    primary_photo = photos.filter(is_primary=True).first()
+    # Статистика по уже загруженному списку
+    photos_count = len(photos)
+    primary_photo = next((photo for photo in photos if photo.is_primary), None)
     
     context = {
         'profile': profile,
@@ -49,24 +48,23 @@ def manage_photos(request):
 
 
 @login_required
+@profile_required
 def upload_photo(request):
     """Загрузка одной фотографии"""
-    try:
-        profile = Profile.objects.get(user=request.user)
-    except Profile.DoesNotExist:
-        messages.error(request, 'Сначала создайте профиль!')
-        return redirect('profiles:create_profile')
+    profile = request.profile
     
     if request.method == 'POST':
+        # Файлы, отклоненные обработчиком загрузки (размер, количество, тип)
+        for error in get_upload_errors(request):
+            messages.error(request, error)
+        
         # Здесь нужно будет создать форму PhotoUploadForm
         # Пока что простая обработка
         if 'image' in request.FILES:
             try:
-                photo = Photo.objects.create(
-                    profile=profile,
-                    image=request.FILES['image'],
-                    is_primary=(not profile.photos.exists()),
-                    is_verified=True
+                # Первая фотография профиля автоматически становится основной
+                Photo.objects.add_photo(
+                    Photo(profile=profile, image=request.FILES['image'], is_verified=True)
                 )
                 messages.success(request, 'Фотография успешно загружена!')
                 return redirect('profiles:manage_photos')
@@ -85,27 +83,22 @@ def upload_photo(request):
 
 
 @login_required
+@profile_required
 def upload_multiple_photos(request):
     """Загрузка нескольких фотографий"""
-    try:
-        profile = Profile.objects.get(user=request.user)
-    except Profile.DoesNotExist:
-        messages.error(request, 'Сначала создайте профиль!')
-        return redirect('profiles:create_profile')
+    profile = request.profile
     
     if request.method == 'POST':
+        for error in get_upload_errors(request):
+            messages.warning(request, error)
+        
         files = request.FILES.getlist('images')
         if files:
             uploaded_count = 0
             
             for file in files:
                 try:
-                    photo = Photo.objects.create(
-                        profile=profile,
-                        image=file,
-                        is_primary=(not profile.photos.exists() and uploaded_count == 0),
-                        is_verified=True
-                    )
+                    Photo.objects.add_photo(Photo(profile=profile, image=file, is_verified=True))
                     uploaded_count += 1
                 except Exception as e:
                     messages.warning(request, f'Не удалось загрузить файл "{file.name}": {str(e)}')
@@ -126,24 +119,16 @@ def upload_multiple_photos(request):
 
 
 @login_required
+@profile_required
 def delete_photo(request, photo_id):
     """Удаление фотографии"""
     try:
-        profile = Profile.objects.get(user=request.user)
-        photo = get_object_or_404(Photo, id=photo_id, profile=profile)
-        
-        # Если удаляем основную фотографию, назначаем другую основной
-        if photo.is_primary:
-            other_photos = profile.photos.exclude(id=photo_id).first()
-            if other_photos:
-                other_photos.is_primary = True
-                other_photos.save()
-        
-        photo.delete()
+        # Удаление и назначение новой основной фотографии - одной транзакцией
+        Photo.objects.delete_photo(request.profile, photo_id)
         messages.success(request, 'Фотография удалена!')
         
-    except Profile.DoesNotExist:
-        messages.error(request, 'Профиль не найден!')
+    except Photo.DoesNotExist:
+        messages.error(request, 'Фотография не найдена!')
     except Exception as e:
         messages.error(request, f'Ошибка при удалении фотографии: {str(e)}')
     
@@ -151,23 +136,17 @@ def delete_photo(request, photo_id):
 
 
 @login_required
+@profile_required
 def set_primary_photo(request, photo_id):
     """Установка основной фотографии"""
     try:
-        profile = Profile.objects.get(user=request.user)
-        photo = get_object_or_404(Photo, id=photo_id, profile=profile)
-        
-        # Убираем флаг основной у всех фотографий
-        profile.photos.update(is_primary=False)
-        
-        # Устанавливаем основной новую фотографию
-        photo.is_primary = True
-        photo.save()
+        # Атомарная смена основной фотографии
+        Photo.objects.set_primary(request.profile, photo_id)
         
         messages.success(request, 'Основная фотография изменена!')
         
-    except Profile.DoesNotExist:
-        messages.error(request, 'Профиль не найден!')
+    except Photo.DoesNotExist:
+        messages.error(request, 'Фотография не найдена!')
     except Exception as e:
         messages.error(request, f'Ошибка при изменении основной фотографии: {str(e)}')
     
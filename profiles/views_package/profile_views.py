@@ -3,15 +3,20 @@ from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.http import HttpResponse
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
-from django.db.models import Q
 
 from ..models import Profile
 from ..forms_package import ProfileForm, ProfileSearchForm
 from ..cache_utils import (
     get_cached_user_profile, invalidate_user_profile_cache,
     get_cached_profile_stats, get_cached_recent_profiles,
-    invalidate_search_cache
+    invalidate_search_cache, invalidate_recent_profiles_cache, SearchResultIds
 )
+from ..decorators import profile_required
+from ..presence import presence_tracker
+
+
+# Сколько новых профилей показывается на главной странице
+RECENT_PROFILES_LIMIT = 6
 
 
 def home(request):
@@ -20,14 +25,11 @@ def home(request):
     # Получаем кэшированную статистику профилей
     stats = get_cached_profile_stats()
     
-    # Проверяем наличие профиля у пользователя (если авторизован)
-    has_profile = False
-    if request.user.is_authenticated:
-        user_profile = get_cached_user_profile(request.user)
-        has_profile = user_profile is not None
+    # Проверяем наличие профиля у пользователя (None для анонимных)
+    has_profile = bool(request.profile)
     
     # Получаем кэшированный список новых профилей
-    recent_profiles = get_cached_recent_profiles(limit=6)
+    recent_profiles = get_cached_recent_profiles(limit=RECENT_PROFILES_LIMIT)
     
     context = {
         'total_profiles': stats.get('total', 0),
@@ -44,7 +46,7 @@ def home(request):
 def create_profile(request):
     """Создание нового профиля"""
     # Проверяем, есть ли уже профиль у пользователя
-    if Profile.objects.filter(user=request.user).exists():
+    if request.profile:
         messages.info(request, 'У вас уже есть профиль. Вы можете его редактировать.')
         return redirect('profiles:my_profile')
     
@@ -54,6 +56,11 @@ def create_profile(request):
             profile = form.save(commit=False)
             profile.user = request.user
             profile.save()
+            
+            # Новый профиль появляется в статистике, списке новых профилей и поиске
+            invalidate_user_profile_cache(request.user)
+            invalidate_recent_profiles_cache()
+            invalidate_search_cache(cities=[profile.city])
             messages.success(request, 'Профиль успешно создан!')
             return redirect('profiles:my_profile')
         else:
@@ -89,13 +96,10 @@ def create_profile(request):
 
 
 @login_required
+@profile_required
 def my_profile(request):
     """Просмотр собственного профиля"""
-    try:
-        profile = Profile.objects.get(user=request.user)
-    except Profile.DoesNotExist:
-        messages.info(request, 'У вас еще нет профиля. Создайте его!')
-        return redirect('profiles:create_profile')
+    profile = request.profile
     
     # Получаем все фотографии профиля
     photos = profile.photos.filter(is_verified=True).order_by('-is_primary', '-created_at')
@@ -110,26 +114,21 @@ def my_profile(request):
 
 
 @login_required
+@profile_required
 def edit_profile(request):
     """Редактирование профиля с инвалидацией кэша"""
-    try:
-        profile = get_cached_user_profile(request.user, use_cache=False)  # Получаем свежие данные
-    except Profile.DoesNotExist:
-        messages.info(request, 'У вас еще нет профиля. Создайте его!')
-        return redirect('profiles:create_profile')
-    
-    if not profile:
-        messages.info(request, 'У вас еще нет профиля. Создайте его!')
-        return redirect('profiles:create_profile')
+    profile = get_cached_user_profile(request.user, use_cache=False)  # Получаем свежие данные
     
     if request.method == 'POST':
+        old_city = profile.city
         form = ProfileForm(request.POST, instance=profile)
         if form.is_valid():
             form.save()
             
             # Инвалидируем все связанные кэши
             invalidate_user_profile_cache(request.user)
-            invalidate_search_cache()  # Поскольку профиль изменился, результаты поиска могут измениться
+            # Результаты поиска могут измениться только для старого и нового города
+            invalidate_search_cache(cities=[old_city, profile.city])
             
             messages.success(request, 'Профиль успешно обновлен!')
             return redirect('profiles:my_profile')
@@ -170,85 +169,34 @@ def view_profile(request, profile_id):
 
 
 @login_required
+@profile_required
 def search_profiles(request):
     """Поиск профилей с кэшированием результатов"""
-    try:
-        own_profile = get_cached_user_profile(request.user)
-    except Profile.DoesNotExist:
-        messages.info(request, 'Сначала создайте свой профиль!')
-        return redirect('profiles:create_profile')
-    
-    if not own_profile:
-        messages.info(request, 'Сначала создайте свой профиль!')
-        return redirect('profiles:create_profile')
+    own_profile = request.profile
     
     form = ProfileSearchForm(request.GET or None)
     
-    # Выполняем поиск
-    profiles = Profile.objects.search_optimized(exclude_user=request.user)
-    
-    # Применяем фильтры если форма валидна
-    if form.is_valid():
-        data = form.cleaned_data
-        
-        # Фильтр по полу
-        if data.get('gender'):
-            profiles = profiles.filter(gender=data['gender'])
-        
-        # Фильтр по возрасту
-        if data.get('age_min'):
-            profiles = profiles.filter(age__gte=data['age_min'])
-        if data.get('age_max'):
-            profiles = profiles.filter(age__lte=data['age_max'])
-        
-        # Фильтр по росту
-        if data.get('height_min'):
-            profiles = profiles.filter(height__gte=data['height_min'])
-        if data.get('height_max'):
-            profiles = profiles.filter(height__lte=data['height_max'])
-        
-        # Фильтр по городу
-        if data.get('city'):
-            profiles = profiles.filter(city=data['city'])
-        
-        # Фильтр по образованию
-        if data.get('education'):
-            profiles = profiles.filter(education=data['education'])
-        
-        # Фильтр по занятости
-        if data.get('employment'):
-            profiles = profiles.filter(employment=data['employment'])
-        
-        # Фильтр по курению
-        if data.get('smoking'):
-            profiles = profiles.filter(smoking=data['smoking'])
-        
-        # Фильтр по алкоголю
-        if data.get('alcohol'):
-            profiles = profiles.filter(alcohol=data['alcohol'])
-        
-        # ИСПРАВЛЕННЫЙ фильтр по наличию детей
-        has_children_str = data.get('has_children')
-        if has_children_str:  # Если выбрано что-то кроме пустой строки
-            if has_children_str == 'true':
-                profiles = profiles.filter(has_children=True)
-            elif has_children_str == 'false':
-                profiles = profiles.filter(has_children=False)
-        
-        # Фильтр по поиску
-        if data.get('search'):
-            search_query = data['search'].strip()
-            if search_query:
-                profiles = profiles.filter(
-                    Q(nickname__icontains=search_query) |
-                    Q(goal__icontains=search_query)
-                )
-    
-    # Подсчитываем общее количество
-    total_count = profiles.count()
+    # Идентификаторы подходящих профилей кэшируются (общие для всех пользователей)
+    search_params = form.get_search_params()
+    online_now = search_params.pop('online_now', False)
+    if online_now:
+        # Фильтры поиска проверяются по полям профилей онлайн из кэша присутствия, без базы
+        # (список id в кэше поиска ограничен и устаревает); текстовый поиск - запросом к базе
+        # только среди уже отобранных профилей
+        result_ids = [
+            profile_id for profile_id in presence_tracker.search_online(search_params)
+            if profile_id != own_profile.id
+        ]
+        if 'search' in search_params:
+            result_ids = Profile.objects.search_ids_among(search_params, result_ids)
+        total_count = len(result_ids)
+    else:
+        # Страницы за окном id из кэша поиска дочитываются из базы
+        result_ids = SearchResultIds(search_params, exclude_id=own_profile.id)
+        total_count = len(result_ids)
     
     # Применяем пагинацию
-    paginator = Paginator(profiles, 12)
+    paginator = Paginator(result_ids, 12)
     page_number = request.GET.get('page', 1)
     
     try:
@@ -256,6 +204,10 @@ def search_profiles(request):
     except (PageNotAnInteger, EmptyPage):
         page_obj = paginator.get_page(1)
     
+    # Профили текущей страницы одним запросом, в порядке результатов поиска
+    page_profiles = Profile.objects.search_optimized().in_bulk(page_obj.object_list)
+    page_obj.object_list = [page_profiles[pk] for pk in page_obj.object_list if pk in page_profiles]
+    
     context = {
         'form': form,
         'page_obj': page_obj,